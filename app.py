@@ -1,7 +1,6 @@
 import os
 import re
 import json
-import random
 import logging
 import socket
 import subprocess
@@ -96,8 +95,9 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "default_secret_key_for_development")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
-# Настройка базы данных SQLite
-database_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usbip_web.db')
+# Настройка базы данных SQLite (USBIP_WEB_DB - другой файл, например для стенда hermetic_bench)
+database_path = os.environ.get('USBIP_WEB_DB') or \
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'usbip_web.db')
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{database_path}"
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "connect_args": {"check_same_thread": False}
@@ -128,25 +128,49 @@ from usbip_utils import get_local_usb_devices, bind_device, get_remote_usb_devic
 from models import (
     User, DeviceAlias, UsbPort, LogEntry,
     VirtualUsbDevice, VirtualUsbPort, VirtualUsbFile, TerminalCommand,
-    FidoDevice, FidoCredential, FidoLog
+    FidoDevice, FidoCredential, FidoLog, HidScript, VirtualUsbPortLocation
 )
 
 # Импортирование модулей для управления виртуальным хранилищем
 from virtual_storage_utils import (
     create_device_storage, delete_device_storage, resize_device_storage,
     get_device_storage_usage, list_device_files, create_directory,
-    delete_item, upload_file, get_storage_stats, download_file
+    delete_item, upload_file, get_storage_stats, download_file,
+    STORAGE_MODE_DIRECTORY, STORAGE_MODE_IMAGE
 )
 from storage_routes import storage_bp
-from fido_routes import fido_bp
+from storage_watcher import start_storage_watcher
+from fido_routes import fido_bp, init_fido_supervisor, init_backup_scheduler
+from usbip_server import (
+    start_usbip_server, refresh_usbip_exports, get_usbip_export_status, start_usbip_capture, stop_usbip_capture,
+    UsbipControlError
+)
+from usbip_capture import list_captures, capture_path
+from hid_routes import hid_bp
+from topology_routes import topology_bp
+from profiler_routes import profiler_bp
+from request_profiler import init_request_profiler
+from metrics_routes import metrics_bp
+from app_metrics import init_metrics
+from usb_topology import check_device_connect
+from virtual_provisioning import (
+    provision_devices, allocate_port_numbers, port_allocation_lock, port_number_taken, ProvisioningError
+)
 
 # Регистрация Blueprints
 app.register_blueprint(storage_bp)
 app.register_blueprint(fido_bp)
+app.register_blueprint(hid_bp)
+app.register_blueprint(topology_bp)
+app.register_blueprint(profiler_bp)
+app.register_blueprint(metrics_bp)
 
 # Инициализация базы данных
 with app.app_context():
     db.create_all()
+    # create_all не добавляет индексы в уже существующие таблицы
+    for index in VirtualUsbFile.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
     # Создание администратора, если он не существует
     admin_user = User.query.filter_by(username='admin').first()
     if not admin_user:
@@ -156,6 +180,24 @@ with app.app_context():
         db.session.commit()
         logger.info("Создан пользователь admin")
 
+# Профилирование запросов (X-Profile, ?_profile=1, PROFILE_SAMPLE_RATE)
+init_request_profiler(app)
+
+# Метрики Prometheus (/metrics, METRICS=0 - отключены)
+init_metrics(app)
+
+# Фоновая синхронизация индекса файлов системных папок
+start_storage_watcher(app)
+
+# Супервизор процесса virtual-fido (автозапуск устройства)
+init_fido_supervisor(app)
+
+# Плановые резервные копии хранилища FIDO
+init_backup_scheduler(app)
+
+# Экспорт активных виртуальных устройств по USB/IP
+start_usbip_server(app)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -740,8 +782,12 @@ def create_virtual_device():
                 db.session.commit()
                 return redirect(url_for('virtual_devices'))
         else:
-            # Создаем обычное виртуальное хранилище
-            create_device_storage(device, storage_size)
+            # Создаем обычное виртуальное хранилище (директория или образ диска FAT32)
+            storage_mode = request.form.get('storage_mode', STORAGE_MODE_DIRECTORY)
+            if storage_mode not in (STORAGE_MODE_DIRECTORY, STORAGE_MODE_IMAGE):
+                storage_mode = STORAGE_MODE_DIRECTORY
+            if not create_device_storage(device, storage_size, storage_mode=storage_mode):
+                flash('Не удалось создать хранилище для устройства', 'warning')
     
     # Запись в лог
     log_message = f'Created virtual device: {name} ({vendor_id}:{product_id})'
@@ -753,6 +799,8 @@ def create_virtual_device():
             log_message += f' with system folder {system_path} ({system_storage_size} MB)'
         else:
             log_message += f' with virtual storage {storage_size} MB'
+            if request.form.get('storage_mode') == STORAGE_MODE_IMAGE:
+                log_message += ' (FAT32 image)'
     
     add_log_entry('INFO', log_message, 'virtual')
     
@@ -763,7 +811,7 @@ def create_virtual_device():
 @login_required
 def create_virtual_port():
     name = request.form.get('name')
-    port_number = request.form.get('port_number', f'vp{random.randint(0, 9999):04d}')
+    port_number = request.form.get('port_number', '').strip()
     device_id = request.form.get('device_id')
     
     # Базовая валидация
@@ -771,13 +819,21 @@ def create_virtual_port():
         flash('Имя порта обязательно', 'danger')
         return redirect(url_for('virtual_devices'))
     
-    # Создаем виртуальный порт
-    port = VirtualUsbPort(
-        name=name,
-        port_number=port_number,
-        device_id=device_id if device_id else None
-    )
-    db.session.add(port)
+    # Номер порта: указанный (если свободен) или следующий свободный
+    with port_allocation_lock():
+        if port_number and port_number_taken(port_number):
+            flash(f'Номер порта {port_number} уже занят', 'danger')
+            return redirect(url_for('virtual_devices'))
+        port_number = port_number or allocate_port_numbers(1)[0]
+        
+        # Создаем виртуальный порт
+        port = VirtualUsbPort(
+            name=name,
+            port_number=port_number,
+            device_id=device_id if device_id else None
+        )
+        db.session.add(port)
+        db.session.commit()
     
     # Запись в лог
     add_log_entry(
@@ -803,6 +859,13 @@ def connect_virtual_device():
         flash('Порт или устройство не найдены', 'danger')
         return redirect(url_for('virtual_devices'))
     
+    # Проверка бюджета периодических передач порта и хабов топологии
+    allowed, message = check_device_connect(device, port)
+    if not allowed:
+        add_log_entry('WARNING', f'Device {device.name} rejected on port {port.name}: {message}', 'virtual')
+        flash(message, 'danger')
+        return redirect(url_for('virtual_devices'))
+    
     # Подключаем устройство к порту
     port.device_id = device.id
     port.is_connected = True
@@ -814,6 +877,7 @@ def connect_virtual_device():
         f'Device {device.name} connected to port {port.name}',
         'virtual'
     )
+    refresh_usbip_exports()
     
     flash(f'Устройство {device.name} успешно подключено к порту {port.name}', 'success')
     return redirect(url_for('virtual_devices'))
@@ -846,6 +910,7 @@ def disconnect_virtual_device():
         f'Device {device_name} disconnected from port {port.name}',
         'virtual'
     )
+    refresh_usbip_exports()
     
     flash(f'Устройство отключено от порта {port.name}', 'success')
     return redirect(url_for('virtual_devices'))
@@ -871,6 +936,9 @@ def delete_virtual_device():
     if device.device_type == 'storage' and device.storage_path:
         delete_device_storage(device)
     
+    # Сценарии ввода HID-устройства
+    HidScript.query.filter_by(device_id=device.id).delete()
+    
     # Удаляем устройство
     device_name = device.name
     db.session.delete(device)
@@ -881,10 +949,97 @@ def delete_virtual_device():
         f'Virtual device {device_name} deleted',
         'virtual'
     )
+    refresh_usbip_exports()
     
     flash(f'Виртуальное устройство "{device_name}" удалено', 'success')
     return redirect(url_for('virtual_devices'))
 
+@app.route('/api/virtual_devices/provision', methods=['POST'])
+@login_required
+def provision_virtual_devices():
+    """
+    Массовое создание виртуальных устройств и портов по шаблону
+
+    Тело запроса: {"count": 200, "template": {"device_type": "storage",
+    "name": "rig-{n:03d}", "product_id": "{n:04x}", "serial_number": "RIG{n:05d}",
+    "storage_size": 64, "storage_mode": "image", "create_ports": true, "connect": false}}
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        result = provision_devices(data.get('template'), data.get('count'))
+    except ProvisioningError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    if any(port['device_id'] for port in result['ports']):
+        refresh_usbip_exports()
+    
+    return jsonify({
+        'success': True,
+        'message': f'Создано устройств: {len(result["devices"])}, портов: {len(result["ports"])}',
+        **result
+    })
+
+@app.route('/api/virtual_devices/usbip')
+@login_required
+def virtual_devices_usbip_status():
+    """Состояние экспорта виртуальных устройств по USB/IP"""
+    return jsonify(get_usbip_export_status())
+
+@app.route('/api/virtual_devices/usbip/capture', methods=['POST'])
+@login_required
+def virtual_devices_usbip_capture():
+    """
+    Запись URB сервера USB/IP в pcap (usbmon): {"action": "start", "busids": ["10-1"],
+    "snaplen": 65536, "max_mb": 256} или {"action": "stop"}
+    """
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    if action not in ('start', 'stop'):
+        return jsonify({'success': False, 'message': 'action: start или stop'}), 400
+    if action == 'start':
+        try:
+            busids = data.get('busids') or None
+            if busids is not None and (not isinstance(busids, list) or
+                                       not all(isinstance(busid, str) for busid in busids)):
+                raise ValueError('busids')
+            snaplen = int(data['snaplen']) if data.get('snaplen') else None
+            max_bytes = int(data['max_mb']) * 1024 * 1024 if data.get('max_mb') else None
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'Некорректные параметры записи'}), 400
+    
+    # Сервер может работать в другом воркере: команда передается ему через файлы
+    try:
+        if action == 'start':
+            capture = start_usbip_capture(busids, snaplen, max_bytes)
+            if capture is None:
+                return jsonify({'success': False, 'message': 'Сервер USB/IP не запущен'}), 409
+            message = 'Запись URB начата'
+        else:
+            capture = stop_usbip_capture()
+            message = 'Запись URB остановлена' if capture else 'Запись URB не ведется'
+    except UsbipControlError as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+    
+    if capture:
+        add_log_entry('INFO', f'USB/IP capture {capture["name"]} {action}: {capture["records"]} records', 'usbip')
+    return jsonify({'success': True, 'message': message, 'capture': capture})
+
+@app.route('/api/virtual_devices/usbip/captures')
+@login_required
+def virtual_devices_usbip_captures():
+    """Файлы записей URB"""
+    return jsonify({'success': True, 'captures': list_captures()})
+
+@app.route('/api/virtual_devices/usbip/captures/<name>')
+@login_required
+def download_usbip_capture(name):
+    """Скачать запись URB (открывается в Wireshark как захват usbmon)"""
+    path = capture_path(name)
+    if path is None:
+        return jsonify({'success': False, 'message': 'Запись не найдена'}), 404
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=name,
+                     mimetype='application/vnd.tcpdump.pcap')
+
 @app.route('/delete_virtual_port', methods=['POST'])
 @login_required
 def delete_virtual_port():
@@ -897,8 +1052,9 @@ def delete_virtual_port():
         flash('Порт не найден', 'danger')
         return redirect(url_for('virtual_devices'))
     
-    # Удаляем порт
+    # Удаляем порт и его место в топологии
     port_name = port.name
+    VirtualUsbPortLocation.query.filter_by(port_id=port.id).delete()
     db.session.delete(port)
     
     # Запись в лог
@@ -0,0 +1,620 @@
+"""
+Метрики приложения в формате Prometheus (страница /metrics).
+
+Счетчики и гистограммы ведутся без блокировок: каждый поток пишет в свой
+сегмент (shard), сегменты складываются только при сборе. Каждый рабочий
+процесс gunicorn раз в METRICS_FLUSH_SECONDS записывает свои значения в
+файл METRICS_DIR/<pid>.json (по умолчанию virtual_storage/metrics);
+процесс, принявший запрос /metrics, суммирует файлы всех процессов.
+Значения завершившихся процессов переносятся в retired.json, поэтому
+счетчики не убывают при перезапуске рабочих процессов.
+
+Собираются:
+  - время ответа по маршрутам (endpoint, метод, код ответа);
+  - вызовы run_command: число и время по команде и коду возврата,
+    переходы с sudo на pkexec и таймауты;
+  - время фиксации транзакций SQLite;
+  - очередь записи журнала FIDO и состояние процесса virtual-fido;
+  - число устройств: локальных, опубликованных, подключенных, виртуальных.
+
+METRICS=0 отключает сбор, METRICS_TOKEN требует заголовок
+Authorization: Bearer <token> для /metrics.
+"""
+
+import os
+import json
+import time
+import atexit
+import bisect
+import fcntl
+import functools
+import threading
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Переменные окружения
+METRICS_ENV_VAR = 'METRICS'
+METRICS_DIR_ENV_VAR = 'METRICS_DIR'
+FLUSH_INTERVAL_ENV_VAR = 'METRICS_FLUSH_SECONDS'
+TOKEN_ENV_VAR = 'METRICS_TOKEN'
+INVENTORY_MAX_AGE_ENV_VAR = 'METRICS_INVENTORY_MAX_AGE'
+
+DEFAULT_FLUSH_INTERVAL = 5
+# Старше этого возраста (секунды) списки устройств обновляются при сборе, 0 - никогда
+DEFAULT_INVENTORY_MAX_AGE = 60
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'usbip_web_'
+
+RETIRED_FILE = 'retired.json'
+LOCK_FILE = '.metrics.lock'
+
+# Границы корзин гистограмм (секунды)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COMMIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# Способ объединения датчиков разных процессов
+GAUGE_SUM = 'sum'        # сумма по живым процессам
+GAUGE_MAX = 'max'        # наибольшее значение
+GAUGE_LATEST = 'latest'  # самое свежее значение
+
+# Команды, для которых в имя метрики входит подкоманда (usbip list, usbip bind)
+SUBCOMMAND_TOOLS = ('usbip',)
+
+INVENTORY_KINDS = ('local', 'published', 'attached')
+
+
+class Family:
+    """Описание метрики: тип, подпись и имена меток"""
+
+    def __init__(self, name: str, kind: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = (), mode: str = GAUGE_SUM):
+        self.name = PREFIX + name
+        self.kind = kind
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.mode = mode
+
+
+FAMILIES: Dict[str, Family] = {family.name: family for family in (
+    Family('http_request_duration_seconds', 'histogram', 'Время обработки запроса по маршрутам',
+           ('endpoint', 'method', 'status'), REQUEST_BUCKETS),
+    Family('command_duration_seconds', 'histogram', 'Время выполнения run_command по команде и коду возврата',
+           ('command', 'exit_code'), COMMAND_BUCKETS),
+    Family('sudo_pkexec_fallback_total', 'counter', 'Повторы команды через pkexec после отказа sudo -n',
+           ('command',)),
+    Family('command_timeouts_total', 'counter', 'Команды, прерванные по таймауту', ('command',)),
+    Family('db_commit_duration_seconds', 'histogram', 'Время фиксации транзакции SQLite',
+           ('outcome',), COMMIT_BUCKETS),
+    Family('log_writer_queue_depth', 'gauge', 'События журнала FIDO, ожидающие записи в базу'),
+    Family('fido_up', 'gauge', 'Процесс virtual-fido запущен', mode=GAUGE_MAX),
+    Family('fido_supervised', 'gauge', 'Процесс virtual-fido запущен супервизором приложения', mode=GAUGE_MAX),
+    Family('fido_restarts', 'gauge', 'Перезапуски virtual-fido супервизором', mode=GAUGE_MAX),
+    Family('fido_last_exit_code', 'gauge', 'Код последнего завершения virtual-fido', mode=GAUGE_LATEST),
+    Family('inventory_devices', 'gauge', 'Число устройств по видам', ('kind',), mode=GAUGE_LATEST),
+    Family('inventory_updated_timestamp_seconds', 'gauge', 'Время последнего получения списка устройств',
+           ('kind',), mode=GAUGE_LATEST),
+    Family('metrics_processes', 'gauge', 'Рабочие процессы, приславшие метрики'),
+)}
+
+
+def metrics_enabled() -> bool:
+    return os.environ.get(METRICS_ENV_VAR, '1').strip().lower() not in ('0', 'false', 'no', 'off')
+
+
+def metrics_dir() -> str:
+    directory = os.environ.get(METRICS_DIR_ENV_VAR)
+    if directory:
+        return directory
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR
+    return os.path.join(VIRTUAL_STORAGE_BASE_DIR, 'metrics')
+
+
+# ----------------------------------------------------------------------
+# Счетчики процесса
+
+class Shard:
+    """Значения одного потока (пишет только этот поток)"""
+
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread: Optional[threading.Thread]):
+        self.thread = thread
+        # (имя, значения меток) -> число
+        self.counters: Dict[Tuple, float] = {}
+        # (имя, значения меток) -> [корзина 0, ..., корзина +Inf, сумма]
+        self.histograms: Dict[Tuple, List[float]] = {}
+
+
+class Registry:
+    """
+    Метрики процесса. Запись идет в сегмент текущего потока без
+    блокировок; сегменты завершившихся потоков сливаются при сборе.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[Shard] = []
+        self._retired = Shard(None)
+        self._collect_lock = threading.Lock()
+        self._gauges: Dict[Tuple, Tuple[float, float]] = {}
+        self._callbacks: List[Callable[[], List[Tuple[str, Tuple, float]]]] = []
+        self._sections: Dict[str, Callable[[], Dict]] = {}
+
+    def _shard(self) -> Shard:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = Shard(threading.current_thread())
+            self._shards.append(shard)
+        return shard
+
+    def inc(self, name: str, labels: Tuple = (), value: float = 1) -> None:
+        counters = self._shard().counters
+        key = (PREFIX + name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: Tuple, value: float) -> None:
+        family = FAMILIES[PREFIX + name]
+        histograms = self._shard().histograms
+        key = (family.name, labels)
+        values = histograms.get(key)
+        if values is None:
+            values = histograms[key] = [0] * (len(family.buckets) + 2)
+        values[bisect.bisect_left(family.buckets, value)] += 1
+        values[-1] += value
+
+    def set_gauge(self, name: str, labels: Tuple, value: float) -> None:
+        """Датчик со временем установки (замена значения атомарна)"""
+        self._gauges[(PREFIX + name, labels)] = (value, time.time())
+
+    def add_callback(self, callback: Callable[[], List[Tuple[str, Tuple, float]]]) -> None:
+        """Функция, возвращающая [(имя, метки, значение)] датчиков при каждом сборе"""
+        self._callbacks.append(callback)
+
+    def add_section(self, name: str, callback: Callable[[], Dict]) -> None:
+        """
+        Произвольные данные процесса (JSON), записываемые в его файл при каждом
+        сборе; читаются через process_sections (например, метрики FIDO)
+        """
+        self._sections[name] = callback
+
+    def collect(self) -> Dict:
+        """Сумма сегментов всех потоков и текущие датчики (для записи в файл)"""
+        with self._collect_lock:
+            counters: Dict[Tuple, float] = dict(self._retired.counters)
+            histograms: Dict[Tuple, List[float]] = {key: list(values) for key, values in self._retired.histograms.items()}
+            for shard in list(self._shards):
+                finished = not shard.thread.is_alive()
+                _merge(counters, histograms, dict(shard.counters), {key: list(values) for key, values in list(shard.histograms.items())})
+                if finished:
+                    # Поток больше не пишет: переносим его значения в общий сегмент
+                    _merge(self._retired.counters, self._retired.histograms, shard.counters, shard.histograms)
+                    self._shards.remove(shard)
+
+        now = time.time()
+        gauges = [[name, list(labels), value, at] for (name, labels), (value, at) in list(self._gauges.items())]
+        for callback in self._callbacks:
+            try:
+                gauges.extend([PREFIX + name, list(labels), value, now] for name, labels, value in callback())
+            except Exception as e:
+                logger.debug(f"Ошибка получения датчика метрик: {e}")
+        sections = {}
+        for name, callback in list(self._sections.items()):
+            try:
+                sections[name] = callback()
+            except Exception as e:
+                logger.debug(f"Ошибка получения раздела метрик {name}: {e}")
+        return {
+            'pid': os.getpid(),
+            'updated': now,
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), values] for (name, labels), values in histograms.items()],
+            'gauges': gauges,
+            'sections': sections
+        }
+
+    def reset_after_fork(self) -> None:
+        """В дочернем процессе значения родителя не учитываются повторно"""
+        self._local = threading.local()
+        self._shards = []
+        self._retired = Shard(None)
+        self._collect_lock = threading.Lock()
+        self._gauges = {}
+
+
+def _merge(counters: Dict, histograms: Dict, add_counters: Dict, add_histograms: Dict) -> None:
+    for key, value in add_counters.items():
+        counters[key] = counters.get(key, 0) + value
+    for key, values in add_histograms.items():
+        target = histograms.get(key)
+        if target is None or len(target) != len(values):
+            histograms[key] = list(values)
+        else:
+            for index, value in enumerate(values):
+                target[index] += value
+
+
+registry = Registry()
+
+
+# ----------------------------------------------------------------------
+# Точки измерения
+
+def command_name(command) -> str:
+    """Имя команды для метки: basename и подкоманда для usbip"""
+    if not command:
+        return ''
+    name = os.path.basename(str(command[0]))
+    if name in SUBCOMMAND_TOOLS and len(command) > 1 and not str(command[1]).startswith('-'):
+        name = f'{name} {command[1]}'
+    return name
+
+
+def counted_command(function):
+    """Декоратор run_command: число и время вызовов по команде и коду возврата"""
+    @functools.wraps(function)
+    def wrapper(command, *args, **kwargs):
+        started = time.perf_counter()
+        exit_code = 'error'
+        try:
+            result = function(command, *args, **kwargs)
+            exit_code = str(result[2])
+            return result
+        finally:
+            registry.observe('command_duration_seconds', (command_name(command), exit_code),
+                             time.perf_counter() - started)
+    return wrapper
+
+
+def count_pkexec_fallback(command) -> None:
+    registry.inc('sudo_pkexec_fallback_total', (command_name(command),))
+
+
+def count_command_timeout(command) -> None:
+    registry.inc('command_timeouts_total', (command_name(command),))
+
+
+def observed_inventory(kind: str):
+    """Декоратор функций usbip_utils, возвращающих список устройств"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            result = function(*args, **kwargs)
+            if isinstance(result, list):
+                registry.set_gauge('inventory_devices', (kind,), len(result))
+                registry.set_gauge('inventory_updated_timestamp_seconds', (kind,), time.time())
+            return result
+        return wrapper
+    return decorator
+
+
+def _before_commit(session):
+    session.info['metrics_commit_started'] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop('metrics_commit_started', None)
+    if started is not None:
+        registry.observe('db_commit_duration_seconds', ('commit',), time.perf_counter() - started)
+
+
+def _after_rollback(session):
+    started = session.info.pop('metrics_commit_started', None)
+    if started is not None:
+        registry.observe('db_commit_duration_seconds', ('rollback',), time.perf_counter() - started)
+
+
+def _process_gauges() -> List[Tuple[str, Tuple, float]]:
+    """Очередь записи журнала FIDO и состояние virtual-fido (при каждом сборе)"""
+    import fido_events
+    from fido_utils import get_fido_supervisor
+    gauges = []
+    recorder = fido_events._recorder
+    if recorder is not None:
+        gauges.append(('log_writer_queue_depth', (), recorder.pending()))
+    status = get_fido_supervisor().status()
+    gauges.append(('fido_up', (), 1 if status['is_running'] else 0))
+    gauges.append(('fido_supervised', (), 1 if status.get('supervised') else 0))
+    if status.get('restart_count') is not None:
+        gauges.append(('fido_restarts', (), status['restart_count']))
+    if status.get('last_exit_code') is not None:
+        gauges.append(('fido_last_exit_code', (), status['last_exit_code']))
+    return gauges
+
+
+# ----------------------------------------------------------------------
+# Файлы процессов
+
+def _write_json(path: str, data: Dict) -> None:
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def flush() -> None:
+    """Записать значения процесса в METRICS_DIR/<pid>.json"""
+    directory = metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    _write_json(os.path.join(directory, f'{os.getpid()}.json'), registry.collect())
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _retire_dead_processes(directory: str) -> None:
+    """Перенести счетчики завершившихся процессов в retired.json"""
+    lock_fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        dead = []
+        for name in os.listdir(directory):
+            stem = name[:-5]
+            if name.endswith('.json') and stem.isdigit() and not _pid_alive(int(stem)):
+                dead.append(os.path.join(directory, name))
+        if not dead:
+            return
+        retired_path = os.path.join(directory, RETIRED_FILE)
+        retired = _read_json(retired_path) or {}
+        counters = {(name, tuple(labels)): value for name, labels, value in retired.get('counters', [])}
+        histograms = {(name, tuple(labels)): values for name, labels, values in retired.get('histograms', [])}
+        for path in dead:
+            data = _read_json(path) or {}
+            _merge(counters, histograms,
+                   {(name, tuple(labels)): value for name, labels, value in data.get('counters', [])},
+                   {(name, tuple(labels)): values for name, labels, values in data.get('histograms', [])})
+        _write_json(retired_path, {
+            'updated': time.time(),
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), values] for (name, labels), values in histograms.items()]
+        })
+        for path in dead:
+            os.unlink(path)
+    finally:
+        os.close(lock_fd)
+
+
+def process_sections(name: str) -> List[Dict]:
+    """
+    Раздел name из файлов всех живых процессов (данные этого процесса -
+    текущие, остальных - на момент их последней записи)
+    """
+    flush()
+    directory = metrics_dir()
+    sections = []
+    for filename in os.listdir(directory):
+        stem = filename[:-5]
+        if not filename.endswith('.json') or not stem.isdigit() or not _pid_alive(int(stem)):
+            continue
+        data = _read_json(os.path.join(directory, filename))
+        if data is not None and name in data.get('sections', {}):
+            sections.append(data['sections'][name])
+    return sections
+
+
+def aggregate() -> Dict:
+    """
+    Значения всех процессов: счетчики и гистограммы суммируются (включая
+    завершившиеся процессы), датчики объединяются по режиму метрики
+    """
+    flush()
+    directory = metrics_dir()
+    _retire_dead_processes(directory)
+
+    counters: Dict[Tuple, float] = {}
+    histograms: Dict[Tuple, List[float]] = {}
+    gauges: Dict[Tuple, Tuple[float, float]] = {}
+    processes = 0
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        data = _read_json(os.path.join(directory, name))
+        if data is None:
+            continue
+        _merge(counters, histograms,
+               {(metric, tuple(labels)): value for metric, labels, value in data.get('counters', [])},
+               {(metric, tuple(labels)): values for metric, labels, values in data.get('histograms', [])})
+        if name == RETIRED_FILE:
+            continue
+        processes += 1
+        for metric, labels, value, at in data.get('gauges', []):
+            family = FAMILIES.get(metric)
+            if family is None:
+                continue
+            key = (metric, tuple(labels))
+            current = gauges.get(key)
+            if current is None:
+                gauges[key] = (value, at)
+            elif family.mode == GAUGE_SUM:
+                gauges[key] = (current[0] + value, max(current[1], at))
+            elif family.mode == GAUGE_MAX:
+                gauges[key] = (max(current[0], value), max(current[1], at))
+            elif at > current[1]:
+                gauges[key] = (value, at)
+    gauges[(PREFIX + 'metrics_processes', ())] = (processes, time.time())
+    return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+
+# ----------------------------------------------------------------------
+# Текстовый формат Prometheus
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def render(data: Dict) -> str:
+    """Текстовый формат экспозиции Prometheus 0.0.4"""
+    lines = []
+    for family in FAMILIES.values():
+        lines.append(f'# HELP {family.name} {family.help}')
+        lines.append(f'# TYPE {family.name} {family.kind}')
+        if family.kind == 'counter':
+            for (name, labels), value in sorted(data['counters'].items()):
+                if name == family.name:
+                    lines.append(f'{name}{_labels(family.labels, labels)} {_number(value)}')
+        elif family.kind == 'histogram':
+            for (name, labels), values in sorted(data['histograms'].items()):
+                if name != family.name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(family.buckets + (float('inf'),), values[:-1]):
+                    cumulative += count
+                    le = f'le="{_number(bound)}"'
+                    lines.append(f'{name}_bucket{_labels(family.labels, labels, le)} {_number(cumulative)}')
+                lines.append(f'{name}_sum{_labels(family.labels, labels)} {_number(values[-1])}')
+                lines.append(f'{name}_count{_labels(family.labels, labels)} {_number(cumulative)}')
+        else:
+            for (name, labels), (value, _) in sorted(data['gauges'].items()):
+                if name == family.name:
+                    lines.append(f'{name}{_labels(family.labels, labels)} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def scrape() -> str:
+    """Ответ /metrics: собрать значения всех процессов и отформатировать"""
+    data = aggregate()
+    if _refresh_inventory(data['gauges']):
+        data = aggregate()
+    data['gauges'].update(_virtual_inventory())
+    return render(data)
+
+
+def _refresh_inventory(gauges: Dict) -> bool:
+    """
+    Получить списки устройств, которые ни один процесс не обновлял дольше
+    METRICS_INVENTORY_MAX_AGE (True - списки обновлены)
+    """
+    max_age = float(os.environ.get(INVENTORY_MAX_AGE_ENV_VAR, DEFAULT_INVENTORY_MAX_AGE))
+    if max_age <= 0:
+        return False
+    from usbip_utils import get_local_usb_devices, get_published_devices, get_attached_devices
+    functions = {'local': get_local_usb_devices, 'published': get_published_devices, 'attached': get_attached_devices}
+    refreshed = False
+    for kind in INVENTORY_KINDS:
+        updated, _ = gauges.get((PREFIX + 'inventory_updated_timestamp_seconds', (kind,)), (0, 0))
+        if time.time() - updated > max_age:
+            try:
+                functions[kind]()
+                refreshed = True
+            except Exception as e:
+                logger.error(f"Ошибка получения списка устройств ({kind}) для метрик: {e}")
+    return refreshed
+
+
+def _virtual_inventory() -> Dict[Tuple, Tuple[float, float]]:
+    """Виртуальные устройства из базы данных (всего и активных)"""
+    from models import VirtualUsbDevice
+    now = time.time()
+    total = VirtualUsbDevice.query.count()
+    active = VirtualUsbDevice.query.filter_by(is_active=True).count()
+    return {
+        (PREFIX + 'inventory_devices', ('virtual',)): (total, now),
+        (PREFIX + 'inventory_devices', ('virtual_active',)): (active, now),
+    }
+
+
+# ----------------------------------------------------------------------
+# Подключение к приложению
+
+class _Flusher(threading.Thread):
+    """Периодическая запись значений процесса в файл"""
+
+    def __init__(self, interval: float):
+        super().__init__(name='metrics-flusher', daemon=True)
+        self.interval = interval
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи метрик: {e}")
+
+
+_flusher: Optional[_Flusher] = None
+
+
+def _start_flusher() -> None:
+    global _flusher
+    _flusher = _Flusher(float(os.environ.get(FLUSH_INTERVAL_ENV_VAR, DEFAULT_FLUSH_INTERVAL)))
+    _flusher.start()
+
+
+def _after_fork_in_child() -> None:
+    registry.reset_after_fork()
+    if _flusher is not None:
+        _start_flusher()
+
+
+def _flush_at_exit() -> None:
+    try:
+        flush()
+    except Exception:
+        pass
+
+
+def init_metrics(app) -> None:
+    """Подключить сбор метрик к приложению (METRICS=0 - отключен)"""
+    from flask import g, request
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    if not metrics_enabled() or _flusher is not None:
+        return
+
+    event.listen(Session, 'before_commit', _before_commit)
+    event.listen(Session, 'after_commit', _after_commit)
+    event.listen(Session, 'after_rollback', _after_rollback)
+    registry.add_callback(_process_gauges)
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            registry.observe('http_request_duration_seconds',
+                             (request.endpoint or 'none', request.method, str(response.status_code)),
+                             time.perf_counter() - started)
+        return response
+
+    _start_flusher()
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+    atexit.register(_flush_at_exit)
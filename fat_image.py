@@ -0,0 +1,861 @@
+"""
+Работа с образами дисков FAT32 для виртуальных USB-накопителей.
+
+Образ создается как разреженный файл (ftruncate) - на диске занимают место
+только загрузочный сектор, FSInfo и начало таблиц FAT. Чтение и запись файлов
+выполняются напрямую через mmap без монтирования, поэтому тот же образ может
+отдаваться по USB/IP как блочное устройство (mass storage).
+
+Поддерживаются длинные имена (VFAT LFN), вложенные директории, загрузка,
+скачивание и удаление файлов. exFAT не поддерживается.
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import time
+import logging
+from typing import List, Dict, Any, Optional, Iterator, Tuple, BinaryIO
+
+logger = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+RESERVED_SECTORS = 32
+NUM_FATS = 2
+ROOT_CLUSTER = 2
+
+# FAT32 требует не менее 65525 кластеров - это задает минимальный размер образа
+MIN_CLUSTER_COUNT = 65525
+MIN_IMAGE_SIZE_MB = 64
+MAX_IMAGE_SIZE_MB = 16384
+
+FAT_MASK = 0x0FFFFFFF
+FAT_EOC = 0x0FFFFFFF
+FAT_BAD = 0x0FFFFFF7
+
+ATTR_READ_ONLY = 0x01
+ATTR_HIDDEN = 0x02
+ATTR_SYSTEM = 0x04
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LFN = 0x0F
+
+DIR_ENTRY_SIZE = 32
+LFN_CHARS_PER_ENTRY = 13
+MAX_NAME_LENGTH = 255
+
+# Символы, допустимые в коротком имени 8.3 (помимо букв и цифр)
+SHORT_NAME_SPECIAL = set("$%'-_@~`!(){}^#&")
+
+# Размер блока при потоковом чтении/записи файлов
+IO_CHUNK_SIZE = 1024 * 1024
+
+
+class FatError(Exception):
+    """Ошибка работы с образом FAT"""
+    pass
+
+
+class FatDirEntry:
+    """Запись каталога FAT (файл или директория)"""
+
+    __slots__ = ('name', 'short_name', 'attr', 'cluster', 'size', 'modified', 'slots')
+
+    def __init__(self, name: str, short_name: bytes, attr: int, cluster: int,
+                 size: int, modified: float, slots: List[int]):
+        self.name = name
+        self.short_name = short_name
+        self.attr = attr
+        self.cluster = cluster
+        self.size = size
+        self.modified = modified
+        self.slots = slots  # Смещения 32-байтных записей (LFN + короткая) в образе
+
+    @property
+    def is_dir(self) -> bool:
+        return bool(self.attr & ATTR_DIRECTORY)
+
+    def __repr__(self):
+        return f'<FatDirEntry {self.name} ({"dir" if self.is_dir else self.size})>'
+
+
+def cluster_size_for(size_bytes: int) -> int:
+    """
+    Размер кластера для образа заданного размера (по рекомендациям Microsoft для FAT32)
+
+    Args:
+        size_bytes: Размер образа в байтах
+
+    Returns:
+        int: Размер кластера в байтах
+    """
+    size_mb = size_bytes // (1024 * 1024)
+    if size_mb <= 260:
+        return 512
+    if size_mb <= 8192:
+        return 4096
+    if size_mb <= 16384:
+        return 8192
+    if size_mb <= 32768:
+        return 16384
+    return 32768
+
+
+def fat_datetime(timestamp: Optional[float] = None) -> Tuple[int, int]:
+    """
+    Преобразовать время в формат FAT
+
+    Returns:
+        Tuple[int, int]: (дата, время) в формате FAT
+    """
+    t = time.localtime(timestamp if timestamp is not None else time.time())
+    year = min(max(t.tm_year, 1980), 2107)
+    fat_date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    fat_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return fat_date, fat_time
+
+
+def parse_fat_datetime(fat_date: int, fat_time: int) -> float:
+    """
+    Преобразовать дату и время FAT в timestamp
+    """
+    if not fat_date:
+        return 0
+    try:
+        return time.mktime((
+            ((fat_date >> 9) & 0x7F) + 1980, (fat_date >> 5) & 0x0F, fat_date & 0x1F,
+            (fat_time >> 11) & 0x1F, (fat_time >> 5) & 0x3F, (fat_time & 0x1F) * 2,
+            0, 0, -1
+        ))
+    except (OverflowError, ValueError):
+        return 0
+
+
+def lfn_checksum(short_name: bytes) -> int:
+    """
+    Контрольная сумма короткого имени для записей LFN
+    """
+    checksum = 0
+    for b in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + b) & 0xFF
+    return checksum
+
+
+def create_image(path: str, size_mb: int, label: str = 'USBIP') -> None:
+    """
+    Создать разреженный образ диска и отформатировать его в FAT32
+
+    Args:
+        path: Путь к файлу образа
+        size_mb: Размер образа в МБ
+        label: Метка тома (до 11 символов)
+    """
+    if size_mb < MIN_IMAGE_SIZE_MB or size_mb > MAX_IMAGE_SIZE_MB:
+        raise FatError(f"Размер образа FAT32 должен быть от {MIN_IMAGE_SIZE_MB} до {MAX_IMAGE_SIZE_MB} МБ")
+
+    size_bytes = size_mb * 1024 * 1024
+    total_sectors = size_bytes // SECTOR_SIZE
+    sectors_per_cluster = cluster_size_for(size_bytes) // SECTOR_SIZE
+
+    # Размер FAT по формуле из спецификации Microsoft (с небольшим запасом)
+    tmp1 = total_sectors - RESERVED_SECTORS
+    tmp2 = (256 * sectors_per_cluster + NUM_FATS) // 2
+    fat_sectors = (tmp1 + tmp2 - 1) // tmp2
+
+    data_sectors = total_sectors - RESERVED_SECTORS - NUM_FATS * fat_sectors
+    cluster_count = data_sectors // sectors_per_cluster
+    if cluster_count < MIN_CLUSTER_COUNT:
+        raise FatError("Слишком маленький образ для FAT32")
+
+    volume_id = int(time.time()) & 0xFFFFFFFF
+    volume_label = label.upper().encode('ascii', 'replace')[:11].ljust(11, b' ')
+
+    boot = bytearray(SECTOR_SIZE)
+    boot[0:3] = b'\xEB\x58\x90'
+    boot[3:11] = b'MSWIN4.1'
+    struct.pack_into('<HBHBHHBHHHII', boot, 11,
+                     SECTOR_SIZE, sectors_per_cluster, RESERVED_SECTORS, NUM_FATS,
+                     0, 0, 0xF8, 0, 63, 255, 0, total_sectors)
+    struct.pack_into('<IHHIHH', boot, 36, fat_sectors, 0, 0, ROOT_CLUSTER, 1, 6)
+    struct.pack_into('<BBBI', boot, 64, 0x80, 0, 0x29, volume_id)
+    boot[71:82] = volume_label
+    boot[82:90] = b'FAT32   '
+    boot[510:512] = b'\x55\xAA'
+
+    fsinfo = bytearray(SECTOR_SIZE)
+    struct.pack_into('<I', fsinfo, 0, 0x41615252)
+    struct.pack_into('<III', fsinfo, 484, 0x61417272, cluster_count - 1, ROOT_CLUSTER + 1)
+    struct.pack_into('<I', fsinfo, 508, 0xAA550000)
+
+    # Первые записи FAT: медиа-дескриптор, EOC, корневой каталог
+    fat_head = struct.pack('<III', 0x0FFFFFF8, FAT_EOC, FAT_EOC)
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Разреженный файл: незаписанные области не занимают места на диске
+        os.ftruncate(fd, size_bytes)
+        for sector in (0, 6):
+            os.pwrite(fd, bytes(boot), sector * SECTOR_SIZE)
+        for sector in (1, 7):
+            os.pwrite(fd, bytes(fsinfo), sector * SECTOR_SIZE)
+        for i in range(NUM_FATS):
+            os.pwrite(fd, fat_head, (RESERVED_SECTORS + i * fat_sectors) * SECTOR_SIZE)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    logger.info(f"Создан образ FAT32 {path}: {size_mb} МБ, {cluster_count} кластеров "
+                f"по {sectors_per_cluster * SECTOR_SIZE} байт")
+
+
+class FatImage:
+    """
+    Образ FAT32, отображенный в память.
+
+    Открытие для записи берет эксклюзивную блокировку файла, для чтения - разделяемую,
+    поэтому образ безопасно использовать из нескольких процессов-воркеров.
+    """
+
+    def __init__(self, path: str, writable: bool = False):
+        self.path = path
+        self.writable = writable
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self._fats = []
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if writable else fcntl.LOCK_SH)
+            self.mm = mmap.mmap(self._file.fileno(), 0,
+                                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+            self._parse_boot_sector()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse_boot_sector(self) -> None:
+        mm = self.mm
+        if len(mm) < SECTOR_SIZE or mm[510:512] != b'\x55\xAA':
+            raise FatError("Образ не содержит загрузочного сектора FAT")
+
+        (self.bytes_per_sector, self.sectors_per_cluster, reserved, num_fats,
+         root_entries, total16, _, fat16_size) = struct.unpack_from('<HBHBHHBH', mm, 11)
+        total32, = struct.unpack_from('<I', mm, 32)
+        fat_sectors, _, _, self.root_cluster, fsinfo_sector = struct.unpack_from('<IHHIH', mm, 36)
+
+        if fat16_size != 0 or root_entries != 0 or fat_sectors == 0:
+            raise FatError("Поддерживаются только образы FAT32")
+
+        total_sectors = total32 or total16
+        self.cluster_size = self.bytes_per_sector * self.sectors_per_cluster
+        self.fat_offset = reserved * self.bytes_per_sector
+        self.fat_bytes = fat_sectors * self.bytes_per_sector
+        self.data_offset = (reserved + num_fats * fat_sectors) * self.bytes_per_sector
+        self.cluster_count = (total_sectors - reserved - num_fats * fat_sectors) // self.sectors_per_cluster
+        self.fsinfo_offset = fsinfo_sector * self.bytes_per_sector if fsinfo_sector not in (0, 0xFFFF) else None
+
+        view = memoryview(self.mm)
+        self._fats = [
+            view[self.fat_offset + i * self.fat_bytes:self.fat_offset + (i + 1) * self.fat_bytes].cast('I')
+            for i in range(num_fats)
+        ]
+        view.release()
+
+        # Образ открывается на каждый запрос (листинг, stat), поэтому проход по всей
+        # таблице делается, только если в FSInfo нет правдоподобного счетчика.
+        # Счетчик FSInfo - подсказка (другие реализации FAT могут его не обновлять):
+        # перед отказом в выделении места он пересчитывается по таблице.
+        self.free_count = None
+        self.free_count_exact = False
+        self.next_free = ROOT_CLUSTER + 1
+        if self.fsinfo_offset is not None:
+            lead, = struct.unpack_from('<I', mm, self.fsinfo_offset)
+            struc, free, nxt = struct.unpack_from('<III', mm, self.fsinfo_offset + 484)
+            if lead == 0x41615252 and struc == 0x61417272:
+                if free <= self.cluster_count:
+                    self.free_count = free
+                if 2 <= nxt < self.cluster_count + 2:
+                    self.next_free = nxt
+        if self.free_count is None:
+            self._recount_free()
+
+    def close(self) -> None:
+        """
+        Сохранить FSInfo, сбросить изменения на диск и закрыть образ
+        """
+        for fat in self._fats:
+            fat.release()
+        self._fats = []
+        mm = getattr(self, 'mm', None)
+        if mm is not None and not mm.closed:
+            if self.writable:
+                if self.fsinfo_offset is not None:
+                    struct.pack_into('<II', mm, self.fsinfo_offset + 488, self.free_count, self.next_free)
+                mm.flush()
+            mm.close()
+        if not self._file.closed:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # ---- Таблица FAT ----
+
+    def _get(self, cluster: int) -> int:
+        return self._fats[0][cluster] & FAT_MASK
+
+    def _set(self, cluster: int, value: int) -> None:
+        for fat in self._fats:
+            fat[cluster] = (fat[cluster] & ~FAT_MASK & 0xFFFFFFFF) | value
+
+    def _count_free(self) -> int:
+        return self._fats[0][2:self.cluster_count + 2].tolist().count(0)
+
+    def _recount_free(self) -> None:
+        """Пересчитать свободные кластеры по таблице FAT"""
+        self.free_count = self._count_free()
+        self.free_count_exact = True
+
+    def _chain(self, start: int) -> List[int]:
+        clusters = []
+        cluster = start
+        while 2 <= cluster < FAT_BAD and len(clusters) <= self.cluster_count:
+            clusters.append(cluster)
+            cluster = self._get(cluster)
+        return clusters
+
+    def _find_free(self, start: int) -> int:
+        """
+        Найти свободный кластер, начиная с заданного (поиск нулевой записи в FAT)
+        """
+        fat_start = self.fat_offset + 2 * 4
+        fat_end = self.fat_offset + (self.cluster_count + 2) * 4
+        pos = self.fat_offset + start * 4
+        wrapped = False
+        while True:
+            found = self.mm.find(b'\x00\x00\x00\x00', pos, fat_end)
+            if found < 0:
+                if wrapped:
+                    raise FatError("Недостаточно места в образе")
+                wrapped = True
+                pos = fat_start
+                continue
+            misalign = (found - self.fat_offset) % 4
+            if misalign:
+                pos = found + 4 - misalign
+                continue
+            return (found - self.fat_offset) // 4
+
+    def _alloc(self, count: int, previous: int = 0) -> List[int]:
+        """
+        Выделить кластеры и связать их в цепочку (продолжая previous, если указан)
+        """
+        if count > self.free_count and not self.free_count_exact:
+            self._recount_free()
+        if count > self.free_count:
+            raise FatError("Недостаточно места в образе")
+
+        clusters = []
+        cluster = self.next_free
+        try:
+            for _ in range(count):
+                cluster = self._find_free(cluster)
+                clusters.append(cluster)
+                # Временно помечаем как конец цепочки, чтобы поиск не вернул его снова
+                self._set(cluster, FAT_EOC)
+                cluster = cluster + 1 if cluster + 1 < self.cluster_count + 2 else 2
+        except FatError:
+            # Счетчик из FSInfo оказался завышен: возвращаем кластеры и уточняем его
+            for allocated in clusters:
+                self._set(allocated, 0)
+            self._recount_free()
+            raise
+
+        for a, b in zip(clusters, clusters[1:]):
+            self._set(a, b)
+        if previous and clusters:
+            self._set(previous, clusters[0])
+
+        self.free_count -= count
+        self.next_free = cluster
+        return clusters
+
+    def _free_chain(self, start: int) -> None:
+        chain = self._chain(start)
+        for cluster in chain:
+            self._set(cluster, 0)
+        self.free_count += len(chain)
+
+    def cluster_offset(self, cluster: int) -> int:
+        """
+        Смещение начала кластера в образе
+        """
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    def _zero_cluster(self, cluster: int) -> None:
+        offset = self.cluster_offset(cluster)
+        self.mm[offset:offset + self.cluster_size] = bytes(self.cluster_size)
+
+    def _runs(self, clusters: List[int]) -> Iterator[Tuple[int, int]]:
+        """
+        Сгруппировать кластеры в непрерывные участки: (смещение, длина в байтах)
+        """
+        if not clusters:
+            return
+        run_start = prev = clusters[0]
+        for cluster in clusters[1:]:
+            if cluster != prev + 1:
+                yield self.cluster_offset(run_start), (prev - run_start + 1) * self.cluster_size
+                run_start = cluster
+            prev = cluster
+        yield self.cluster_offset(run_start), (prev - run_start + 1) * self.cluster_size
+
+    # ---- Каталоги ----
+
+    def _dir_slots(self, cluster: int) -> List[int]:
+        per_cluster = self.cluster_size // DIR_ENTRY_SIZE
+        slots = []
+        for c in self._chain(cluster):
+            base = self.cluster_offset(c)
+            slots.extend(base + i * DIR_ENTRY_SIZE for i in range(per_cluster))
+        return slots
+
+    def read_dir(self, cluster: int) -> List[FatDirEntry]:
+        """
+        Прочитать записи каталога (без '.', '..' и метки тома)
+
+        Args:
+            cluster: Первый кластер каталога
+
+        Returns:
+            List[FatDirEntry]: Записи каталога
+        """
+        mm = self.mm
+        entries = []
+        lfn_parts = {}
+        lfn_slots = []
+        lfn_sum = None
+
+        for offset in self._dir_slots(cluster):
+            first = mm[offset]
+            if first == 0x00:
+                break
+            if first == 0xE5:
+                lfn_parts, lfn_slots, lfn_sum = {}, [], None
+                continue
+
+            attr = mm[offset + 11]
+            if attr & 0x3F == ATTR_LFN:
+                if first & 0x40:
+                    lfn_parts, lfn_slots = {}, []
+                lfn_parts[first & 0x1F] = (bytes(mm[offset + 1:offset + 11]) +
+                                           bytes(mm[offset + 14:offset + 26]) +
+                                           bytes(mm[offset + 28:offset + 32]))
+                lfn_slots.append(offset)
+                lfn_sum = mm[offset + 13]
+                continue
+
+            short_name = bytes(mm[offset:offset + 11])
+            if attr & ATTR_VOLUME_ID or short_name[0] == 0x2E:
+                lfn_parts, lfn_slots, lfn_sum = {}, [], None
+                continue
+
+            if lfn_parts and lfn_sum == lfn_checksum(short_name):
+                raw = b''.join(lfn_parts[i] for i in sorted(lfn_parts))
+                name = raw.decode('utf-16-le', 'replace').split('\x00', 1)[0]
+                slots = lfn_slots + [offset]
+            else:
+                name = self._format_short_name(short_name, mm[offset + 12])
+                slots = [offset]
+
+            cluster_hi, wrt_time, wrt_date, cluster_lo, size = struct.unpack_from('<HHHHI', mm, offset + 20)
+            entries.append(FatDirEntry(
+                name=name,
+                short_name=short_name,
+                attr=attr,
+                cluster=(cluster_hi << 16) | cluster_lo,
+                size=size,
+                modified=parse_fat_datetime(wrt_date, wrt_time),
+                slots=slots
+            ))
+            lfn_parts, lfn_slots, lfn_sum = {}, [], None
+
+        return entries
+
+    @staticmethod
+    def _format_short_name(short_name: bytes, nt_flags: int) -> str:
+        base = short_name[:8]
+        if base[0] == 0x05:
+            base = b'\xE5' + base[1:]
+        base = base.rstrip(b' ').decode('cp437', 'replace')
+        ext = short_name[8:].rstrip(b' ').decode('cp437', 'replace')
+        if nt_flags & 0x08:
+            base = base.lower()
+        if nt_flags & 0x10:
+            ext = ext.lower()
+        return f"{base}.{ext}" if ext else base
+
+    def root_entry(self) -> FatDirEntry:
+        return FatDirEntry('', b'', ATTR_DIRECTORY, self.root_cluster, 0, 0, [])
+
+    def lookup(self, path: str) -> Optional[FatDirEntry]:
+        """
+        Найти запись по пути внутри образа (без учета регистра, как в FAT)
+
+        Args:
+            path: Путь вида 'dir/file.txt'
+
+        Returns:
+            Optional[FatDirEntry]: Запись или None
+        """
+        entry = self.root_entry()
+        for part in [p for p in path.replace('\\', '/').split('/') if p]:
+            if not entry.is_dir:
+                return None
+            key = part.casefold()
+            entry = next((e for e in self.read_dir(entry.cluster or self.root_cluster)
+                          if e.name.casefold() == key), None)
+            if entry is None:
+                return None
+        return entry
+
+    def walk(self, cluster: Optional[int] = None, prefix: str = '') -> Iterator[Tuple[str, List[FatDirEntry], List[FatDirEntry]]]:
+        """
+        Обход дерева каталогов (аналог os.walk)
+        """
+        entries = self.read_dir(cluster or self.root_cluster)
+        dirs = [e for e in entries if e.is_dir]
+        files = [e for e in entries if not e.is_dir]
+        yield prefix, dirs, files
+        for d in dirs:
+            yield from self.walk(d.cluster, f"{prefix}/{d.name}" if prefix else d.name)
+
+    def _make_short_name(self, name: str, existing: set) -> Tuple[bytes, bool]:
+        """
+        Сформировать короткое имя 8.3
+
+        Returns:
+            Tuple[bytes, bool]: (короткое имя, нужны ли записи LFN)
+        """
+        def clean(part: str) -> str:
+            result = []
+            for ch in part.upper():
+                if ch.isascii() and (ch.isalnum() or ch in SHORT_NAME_SPECIAL):
+                    result.append(ch)
+                elif ch != ' ':
+                    result.append('_')
+            return ''.join(result)
+
+        if '.' in name.lstrip('.'):
+            base, ext = name.rsplit('.', 1)
+        else:
+            base, ext = name, ''
+
+        # Имя уже соответствует формату 8.3 - LFN не нужен
+        if (name == name.upper() and 0 < len(base) <= 8 and len(ext) <= 3 and
+                clean(base) == base and clean(ext) == ext):
+            short = base.ljust(8).encode('ascii') + ext.ljust(3).encode('ascii')
+            if short not in existing:
+                return short, False
+
+        base = clean(base.replace('.', '')) or '_'
+        ext = clean(ext)[:3]
+        for n in range(1, 1000000):
+            tail = f"~{n}"
+            short = (base[:8 - len(tail)] + tail).ljust(8).encode('ascii') + ext.ljust(3).encode('ascii')
+            if short not in existing:
+                return short, True
+        raise FatError("Не удалось подобрать короткое имя")
+
+    def _build_entries(self, name: str, short_name: bytes, need_lfn: bool, attr: int,
+                       cluster: int, size: int) -> List[bytes]:
+        fat_date, fat_time = fat_datetime()
+        entries = []
+
+        if need_lfn:
+            encoded = name.encode('utf-16-le')
+            units = len(encoded) // 2
+            count = (units + LFN_CHARS_PER_ENTRY - 1) // LFN_CHARS_PER_ENTRY
+            padded = encoded
+            if units % LFN_CHARS_PER_ENTRY:
+                padded += b'\x00\x00'
+                padded += b'\xFF' * (count * LFN_CHARS_PER_ENTRY * 2 - len(padded))
+            checksum = lfn_checksum(short_name)
+            for seq in range(count, 0, -1):
+                chunk = padded[(seq - 1) * 26:seq * 26]
+                order = seq | (0x40 if seq == count else 0)
+                entries.append(struct.pack('<B10sBBB12sH4s', order, chunk[0:10], ATTR_LFN, 0,
+                                           checksum, chunk[10:22], 0, chunk[22:26]))
+
+        entries.append(struct.pack('<11sBBBHHHHHHHI', short_name, attr, 0, 0,
+                                   fat_time, fat_date, fat_date, cluster >> 16,
+                                   fat_time, fat_date, cluster & 0xFFFF, size))
+        return entries
+
+    def _insert_entries(self, dir_cluster: int, entries: List[bytes]) -> List[int]:
+        """
+        Записать набор записей в каталог, расширяя его при необходимости
+        """
+        needed = len(entries)
+        while True:
+            slots = self._dir_slots(dir_cluster)
+            run = []
+            for offset in slots:
+                if self.mm[offset] in (0x00, 0xE5):
+                    run.append(offset)
+                    if len(run) == needed:
+                        break
+                else:
+                    run = []
+            if len(run) == needed:
+                break
+            new_cluster = self._alloc(1, previous=self._chain(dir_cluster)[-1])[0]
+            self._zero_cluster(new_cluster)
+
+        for offset, data in zip(run, entries):
+            self.mm[offset:offset + DIR_ENTRY_SIZE] = data
+        return run
+
+    def _create_entry(self, path: str, attr: int, cluster: int, size: int) -> None:
+        parent_path, _, name = path.replace('\\', '/').strip('/').rpartition('/')
+        if not name or name in ('.', '..'):
+            raise FatError("Недопустимое имя")
+        if len(name.encode('utf-16-le')) // 2 > MAX_NAME_LENGTH:
+            raise FatError("Слишком длинное имя")
+
+        parent = self.lookup(parent_path)
+        if parent is None or not parent.is_dir:
+            raise FatError("Родительская директория не существует")
+
+        parent_cluster = parent.cluster or self.root_cluster
+        existing = self.read_dir(parent_cluster)
+        if any(e.name.casefold() == name.casefold() for e in existing):
+            raise FatError("Элемент с таким именем уже существует")
+
+        short_name, need_lfn = self._make_short_name(name, {e.short_name for e in existing})
+        self._insert_entries(parent_cluster,
+                             self._build_entries(name, short_name, need_lfn, attr, cluster, size))
+
+    # ---- Операции с файлами ----
+
+    def make_dir(self, path: str) -> None:
+        """
+        Создать директорию
+
+        Args:
+            path: Путь новой директории внутри образа
+        """
+        parent_path = path.replace('\\', '/').strip('/').rpartition('/')[0]
+        parent = self.lookup(parent_path)
+        if parent is None or not parent.is_dir:
+            raise FatError("Родительская директория не существует")
+
+        cluster = self._alloc(1)[0]
+        try:
+            self._zero_cluster(cluster)
+            parent_cluster = parent.cluster if parent.cluster != self.root_cluster else 0
+            fat_date, fat_time = fat_datetime()
+            offset = self.cluster_offset(cluster)
+            for i, (name, target) in enumerate(((b'.', cluster), (b'..', parent_cluster))):
+                struct.pack_into('<11sBBBHHHHHHHI', self.mm, offset + i * DIR_ENTRY_SIZE,
+                                 name.ljust(11), ATTR_DIRECTORY, 0, 0, fat_time, fat_date, fat_date,
+                                 target >> 16, fat_time, fat_date, target & 0xFFFF, 0)
+            self._create_entry(path, ATTR_DIRECTORY, cluster, 0)
+        except Exception:
+            self._free_chain(cluster)
+            raise
+
+    def write_file(self, path: str, stream: BinaryIO) -> int:
+        """
+        Записать файл из потока (существующий файл заменяется)
+
+        Данные пишутся в новую цепочку кластеров; запись каталога существующего
+        файла переключается на нее только после успешной записи, затем старая
+        цепочка освобождается. При ошибке (в том числе нехватке места) прежний
+        файл остается нетронутым.
+
+        Args:
+            path: Путь файла внутри образа
+            stream: Поток с содержимым
+
+        Returns:
+            int: Размер записанного файла
+        """
+        existing = self.lookup(path)
+        if existing is not None:
+            if existing.is_dir:
+                raise FatError("По указанному пути уже существует директория")
+            if not existing.slots:
+                raise FatError("Элемент не найден")
+
+        first_cluster = 0
+        last_cluster = 0
+        size = 0
+        pending = b''
+        try:
+            while True:
+                chunk = stream.read(IO_CHUNK_SIZE)
+                data = pending + chunk if pending else chunk
+                if chunk:
+                    # Поток может вернуть меньше запрошенного (сокет, запрос): кластер
+                    # выделяется только целиком заполненным, остаток ждет следующего
+                    # чтения, иначе в середине файла остался бы недописанный кластер
+                    whole = len(data) - len(data) % self.cluster_size
+                    data, pending = data[:whole], data[whole:]
+                if data:
+                    count = (len(data) + self.cluster_size - 1) // self.cluster_size
+                    clusters = self._alloc(count, previous=last_cluster)
+                    if not first_cluster:
+                        first_cluster = clusters[0]
+                    last_cluster = clusters[-1]
+
+                    # Записываем непрерывными участками, а не покластерно
+                    pos = 0
+                    for offset, length in self._runs(clusters):
+                        part = data[pos:pos + length]
+                        self.mm[offset:offset + len(part)] = part
+                        pos += length
+                    size += len(data)
+                if not chunk:
+                    break
+
+            if existing is None:
+                self._create_entry(path, ATTR_ARCHIVE, first_cluster, size)
+        except Exception:
+            if first_cluster:
+                self._free_chain(first_cluster)
+            raise
+
+        if existing is not None:
+            self._replace_entry_data(existing, first_cluster, size)
+        return size
+
+    def _replace_entry_data(self, entry: FatDirEntry, cluster: int, size: int) -> None:
+        """
+        Переключить короткую запись файла на новую цепочку и освободить старую
+        """
+        offset = entry.slots[-1]
+        fat_date, fat_time = fat_datetime()
+        struct.pack_into('<HHHHI', self.mm, offset + 20, cluster >> 16, fat_time, fat_date, cluster & 0xFFFF, size)
+        struct.pack_into('<H', self.mm, offset + 18, fat_date)
+        if entry.cluster:
+            self._free_chain(entry.cluster)
+
+    def rename(self, src: str, dst: str) -> None:
+        """
+        Переместить файл или директорию внутри образа (данные не копируются)
+
+        Args:
+            src: Текущий путь внутри образа
+            dst: Новый путь внутри образа
+        """
+        entry = self.lookup(src)
+        if entry is None or not entry.slots:
+            raise FatError("Элемент не найден")
+
+        src_key = src.replace('\\', '/').strip('/').casefold()
+        dst_key = dst.replace('\\', '/').strip('/').casefold()
+        if entry.is_dir and (dst_key == src_key or dst_key.startswith(src_key + '/')):
+            raise FatError("Невозможно переместить директорию внутрь самой себя")
+
+        self._create_entry(dst, entry.attr, entry.cluster, entry.size)
+        for offset in entry.slots:
+            self.mm[offset] = 0xE5
+
+        if entry.is_dir and entry.cluster:
+            # Запись '..' перемещенной директории должна указывать на нового родителя
+            parent = self.lookup(dst.replace('\\', '/').strip('/').rpartition('/')[0])
+            parent_cluster = parent.cluster if parent.cluster != self.root_cluster else 0
+            offset = self.cluster_offset(entry.cluster) + DIR_ENTRY_SIZE
+            struct.pack_into('<H', self.mm, offset + 20, parent_cluster >> 16)
+            struct.pack_into('<H', self.mm, offset + 26, parent_cluster & 0xFFFF)
+
+    def iter_file(self, entry: FatDirEntry) -> Iterator[bytes]:
+        """
+        Прочитать содержимое файла блоками
+        """
+        remaining = entry.size
+        for offset, length in self._runs(self._chain(entry.cluster)):
+            while length > 0 and remaining > 0:
+                n = min(length, remaining, IO_CHUNK_SIZE)
+                yield self.mm[offset:offset + n]
+                offset += n
+                length -= n
+                remaining -= n
+
+    def delete(self, path: str) -> None:
+        """
+        Удалить файл или директорию (рекурсивно)
+
+        Args:
+            path: Путь внутри образа
+        """
+        entry = self.lookup(path)
+        if entry is None or not entry.slots:
+            raise FatError("Элемент не найден")
+        self._delete_entry(entry)
+
+    def _delete_entry(self, entry: FatDirEntry) -> None:
+        if entry.is_dir and entry.cluster:
+            for child in self.read_dir(entry.cluster):
+                self._delete_entry(child)
+        if entry.cluster:
+            self._free_chain(entry.cluster)
+        for offset in entry.slots:
+            self.mm[offset] = 0xE5
+
+    def usage(self) -> Dict[str, int]:
+        """
+        Статистика использования образа
+
+        Returns:
+            Dict[str, int]: Общий, занятый и свободный объем в байтах
+        """
+        total = self.cluster_count * self.cluster_size
+        free = self.free_count * self.cluster_size
+        return {
+            'total_bytes': total,
+            'used_bytes': total - free,
+            'free_bytes': free
+        }
+
+
+def iter_image_file(image_path: str, path: str) -> Iterator[bytes]:
+    """
+    Потоковое чтение файла из образа (образ открыт, пока идет чтение)
+
+    Args:
+        image_path: Путь к файлу образа
+        path: Путь файла внутри образа
+    """
+    with FatImage(image_path) as image:
+        entry = image.lookup(path)
+        if entry is None or entry.is_dir:
+            raise FatError("Файл не найден")
+        yield from image.iter_file(entry)
+
+
+def list_image_dir(image_path: str, path: str = '') -> List[Dict[str, Any]]:
+    """
+    Получить содержимое каталога образа
+
+    Args:
+        image_path: Путь к файлу образа
+        path: Путь каталога внутри образа
+
+    Returns:
+        List[Dict[str, Any]]: Записи каталога (имя, тип, размер, время изменения)
+    """
+    with FatImage(image_path) as image:
+        entry = image.lookup(path)
+        if entry is None or not entry.is_dir:
+            return []
+        return [{
+            'name': e.name,
+            'type': 'directory' if e.is_dir else 'file',
+            'size': 0 if e.is_dir else e.size,
+            'modified': e.modified
+        } for e in image.read_dir(entry.cluster or image.root_cluster)]
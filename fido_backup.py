@@ -0,0 +1,369 @@
+"""
+FIDO2 Vault Backups
+Content-addressed, gzip-compressed vault snapshots with a manifest index
+and grandfather-father-son retention
+
+Layout of the backup directory:
+    manifest.json               Index of all snapshots (newest last)
+    objects/<sha256>.json.gz    Compressed vault contents, shared by identical snapshots
+    vault_backup_*.json         Plain backups of older versions (imported into the manifest)
+"""
+
+import os
+import gzip
+import json
+import fcntl
+import hashlib
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+OBJECTS_DIR = 'objects'
+LEGACY_PREFIX = 'vault_backup_'
+
+# Retention (environment variables override the defaults)
+KEEP_LAST = int(os.environ.get('FIDO_BACKUP_KEEP_LAST', '5'))
+KEEP_DAILY = int(os.environ.get('FIDO_BACKUP_KEEP_DAILY', '7'))
+KEEP_WEEKLY = int(os.environ.get('FIDO_BACKUP_KEEP_WEEKLY', '4'))
+KEEP_MONTHLY = int(os.environ.get('FIDO_BACKUP_KEEP_MONTHLY', '12'))
+
+# Scheduled backups: interval in hours (0 disables the job)
+BACKUP_INTERVAL_HOURS = float(os.environ.get('FIDO_BACKUP_INTERVAL_HOURS', '24'))
+
+# First scheduled run after application start (seconds)
+SCHEDULER_START_DELAY = 60
+
+# Parsed manifest per backup directory, valid while the manifest file is unchanged
+_manifest_cache: Dict[str, tuple] = {}
+_manifest_cache_lock = threading.Lock()
+
+
+def write_atomic(path: str, data: bytes, mode: Optional[int] = None) -> None:
+    """
+    Write a file via temp file + fsync + rename (+ directory fsync), so readers
+    see either the old or the new contents and a crash never leaves a partial file
+
+    Args:
+        path: Destination path
+        data: File contents
+        mode: Permissions (default: those of the existing file, else 0600)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except OSError:
+            mode = 0o600
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextmanager
+def _locked(backup_dir: str):
+    """Serialize manifest updates between threads and worker processes"""
+    fd = os.open(os.path.join(backup_dir, '.manifest.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _manifest_stat(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _import_legacy(backup_dir: str) -> Dict:
+    """Build the first manifest from plain vault_backup_*.json files"""
+    snapshots = []
+    for filename in sorted(os.listdir(backup_dir)):
+        if not (filename.startswith(LEGACY_PREFIX) and filename.endswith('.json')):
+            continue
+        filepath = os.path.join(backup_dir, filename)
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            stat_info = os.stat(filepath)
+        except OSError as e:
+            logger.warning(f"Skipping unreadable backup {filepath}: {e}")
+            continue
+        timestamp_str = filename[len(LEGACY_PREFIX):-len('.json')]
+        try:
+            created_at = datetime.strptime(timestamp_str, '%Y%m%d_%H%M%S')
+        except ValueError:
+            created_at = datetime.fromtimestamp(stat_info.st_mtime)
+        snapshots.append({
+            'name': filename,
+            'object': filename,
+            'compressed': False,
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'size': len(data),
+            'stored_size': len(data),
+            'created_at': created_at.isoformat(timespec='seconds'),
+            'kind': 'manual'
+        })
+    snapshots.sort(key=lambda s: s['created_at'])
+    if snapshots:
+        logger.info(f"Imported {len(snapshots)} existing backups into the manifest")
+    return {'version': 1, 'snapshots': snapshots, 'last_source': None}
+
+
+def _read_manifest(backup_dir: str) -> Dict:
+    """Read the manifest, creating it on first use (caller holds the lock if it may not exist)"""
+    path = os.path.join(backup_dir, MANIFEST_NAME)
+    key = _manifest_stat(path)
+    with _manifest_cache_lock:
+        cached = _manifest_cache.get(backup_dir)
+        if cached and key is not None and cached[0] == key:
+            return cached[1]
+    if key is None:
+        manifest = _import_legacy(backup_dir)
+        _save_manifest(backup_dir, manifest)
+        return manifest
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    with _manifest_cache_lock:
+        _manifest_cache[backup_dir] = (key, manifest)
+    return manifest
+
+
+def load_manifest(backup_dir: str) -> Dict:
+    """
+    Load the manifest (cached until the file changes, so listing costs one stat)
+
+    Returns:
+        Dict: Manifest, shared with the cache - do not modify
+    """
+    if _manifest_stat(os.path.join(backup_dir, MANIFEST_NAME)) is not None:
+        return _read_manifest(backup_dir)
+    with _locked(backup_dir):
+        return _read_manifest(backup_dir)
+
+
+def _copy_manifest(backup_dir: str) -> Dict:
+    """Private copy of the manifest for modification (caller holds the lock)"""
+    return json.loads(json.dumps(_read_manifest(backup_dir)))
+
+
+def _save_manifest(backup_dir: str, manifest: Dict) -> None:
+    path = os.path.join(backup_dir, MANIFEST_NAME)
+    write_atomic(path, json.dumps(manifest, indent=1).encode('utf-8'))
+    with _manifest_cache_lock:
+        _manifest_cache[backup_dir] = (_manifest_stat(path), manifest)
+
+
+def _object_path(backup_dir: str, snapshot: Dict) -> str:
+    return os.path.join(backup_dir, snapshot['object'])
+
+
+def _snapshot_name(manifest: Dict, now: datetime) -> str:
+    names = {s['name'] for s in manifest['snapshots']}
+    base = f"{LEGACY_PREFIX}{now.strftime('%Y%m%d_%H%M%S')}"
+    name = f'{base}.json.gz'
+    counter = 1
+    while name in names:
+        name = f'{base}_{counter}.json.gz'
+        counter += 1
+    return name
+
+
+def create_backup(vault_path: str, backup_dir: str, kind: str = 'manual', now: Optional[datetime] = None) -> Dict:
+    """
+    Snapshot the vault unless it is identical to the newest snapshot
+
+    An unchanged vault file (same inode, mtime and size as at the last backup)
+    is not even read.
+
+    Returns:
+        Dict: {'snapshot': snapshot, 'skipped': bool}
+    """
+    now = now or datetime.now()
+    st = os.stat(vault_path)
+    source = {'path': os.path.realpath(vault_path), 'ino': st.st_ino, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+    with _locked(backup_dir):
+        manifest = _copy_manifest(backup_dir)
+        snapshots = manifest['snapshots']
+        latest = snapshots[-1] if snapshots else None
+        last_source = manifest.get('last_source') or {}
+
+        if latest and {k: last_source.get(k) for k in source} == source and last_source.get('sha256') == latest['sha256']:
+            return {'snapshot': latest, 'skipped': True}
+
+        with open(vault_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        manifest['last_source'] = dict(source, sha256=digest)
+
+        if latest and latest['sha256'] == digest:
+            _save_manifest(backup_dir, manifest)
+            return {'snapshot': latest, 'skipped': True}
+
+        existing = next((s for s in snapshots if s['sha256'] == digest and s.get('compressed')), None)
+        if existing and os.path.exists(_object_path(backup_dir, existing)):
+            object_name, stored_size = existing['object'], existing['stored_size']
+        else:
+            os.makedirs(os.path.join(backup_dir, OBJECTS_DIR), exist_ok=True)
+            object_name = f'{OBJECTS_DIR}/{digest}.json.gz'
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            write_atomic(os.path.join(backup_dir, object_name), compressed)
+            stored_size = len(compressed)
+
+        snapshot = {
+            'name': _snapshot_name(manifest, now),
+            'object': object_name,
+            'compressed': True,
+            'sha256': digest,
+            'size': len(data),
+            'stored_size': stored_size,
+            'created_at': now.isoformat(timespec='seconds'),
+            'kind': kind
+        }
+        snapshots.append(snapshot)
+        _save_manifest(backup_dir, manifest)
+
+    logger.info(f"Vault snapshot {snapshot['name']} created ({snapshot['size']} -> {stored_size} bytes)")
+    return {'snapshot': snapshot, 'skipped': False}
+
+
+def find_snapshot(backup_dir: str, name: str) -> Optional[Dict]:
+    """Find a snapshot by name"""
+    return next((s for s in load_manifest(backup_dir)['snapshots'] if s['name'] == name), None)
+
+
+def read_backup(backup_dir: str, name: str) -> Optional[bytes]:
+    """
+    Read the vault contents of a snapshot
+
+    Returns:
+        Optional[bytes]: Vault file contents or None if there is no such snapshot
+    """
+    snapshot = find_snapshot(backup_dir, name)
+    if snapshot is None:
+        return None
+    with open(_object_path(backup_dir, snapshot), 'rb') as f:
+        data = f.read()
+    return gzip.decompress(data) if snapshot.get('compressed') else data
+
+
+def _remove_snapshots(backup_dir: str, manifest: Dict, names: set) -> List[Dict]:
+    """Drop snapshots from the manifest and delete objects nobody references any more"""
+    removed = [s for s in manifest['snapshots'] if s['name'] in names]
+    manifest['snapshots'] = [s for s in manifest['snapshots'] if s['name'] not in names]
+    referenced = {s['object'] for s in manifest['snapshots']}
+    for obj in {s['object'] for s in removed} - referenced:
+        try:
+            os.remove(os.path.join(backup_dir, obj))
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def delete_snapshot(backup_dir: str, name: str) -> bool:
+    """Delete one snapshot, returns False if it does not exist"""
+    with _locked(backup_dir):
+        manifest = _copy_manifest(backup_dir)
+        removed = _remove_snapshots(backup_dir, manifest, {name})
+        if removed:
+            _save_manifest(backup_dir, manifest)
+    return bool(removed)
+
+
+def select_retained(snapshots: List[Dict], keep_last: int = KEEP_LAST, keep_daily: int = KEEP_DAILY,
+                    keep_weekly: int = KEEP_WEEKLY, keep_monthly: int = KEEP_MONTHLY) -> set:
+    """
+    Grandfather-father-son selection: the newest snapshots plus the newest
+    snapshot of each of the last days, ISO weeks and months that have one
+
+    Returns:
+        set: Names of the snapshots to keep
+    """
+    ordered = sorted(snapshots, key=lambda s: s['created_at'], reverse=True)
+    keep = {s['name'] for s in ordered[:keep_last]}
+    periods = (
+        (keep_daily, lambda d: d.date()),
+        (keep_weekly, lambda d: d.isocalendar()[:2]),
+        (keep_monthly, lambda d: (d.year, d.month)),
+    )
+    for count, period_of in periods:
+        seen = []
+        for snapshot in ordered:
+            period = period_of(datetime.fromisoformat(snapshot['created_at']))
+            if period in seen:
+                continue
+            if len(seen) >= count:
+                break
+            seen.append(period)
+            keep.add(snapshot['name'])
+    return keep
+
+
+def prune_backups(backup_dir: str, **retention) -> List[Dict]:
+    """
+    Apply the retention policy
+
+    Returns:
+        List[Dict]: Removed snapshots
+    """
+    with _locked(backup_dir):
+        manifest = _copy_manifest(backup_dir)
+        keep = select_retained(manifest['snapshots'], **retention)
+        names = {s['name'] for s in manifest['snapshots']} - keep
+        if not names:
+            return []
+        removed = _remove_snapshots(backup_dir, manifest, names)
+        _save_manifest(backup_dir, manifest)
+    logger.info(f"Pruned {len(removed)} vault snapshots")
+    return removed
+
+
+class BackupScheduler(threading.Thread):
+    """Runs the backup job periodically in the background"""
+
+    def __init__(self, job: Callable[[], None], interval_hours: float = BACKUP_INTERVAL_HOURS,
+                 start_delay: float = SCHEDULER_START_DELAY):
+        super().__init__(name='fido-backup-scheduler', daemon=True)
+        self.job = job
+        self.interval = interval_hours * 3600
+        self.start_delay = start_delay
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        delay = self.start_delay
+        while not self._stop_event.wait(delay):
+            try:
+                self.job()
+            except Exception as e:
+                logger.error(f"Scheduled vault backup failed: {e}")
+            delay = self.interval
+
+    def stop(self) -> None:
+        self._stop_event.set()
@@ -0,0 +1,106 @@
+"""
+FIDO2 Shared Configuration
+Settings stored in the fido_settings table so that every worker uses the same
+passphrase and vault path. Each process keeps a cache that is reloaded when
+the version file (touched on every change) has a new inode/mtime, which costs
+one stat() per lookup instead of a query.
+"""
+
+import os
+import uuid
+import threading
+import logging
+from typing import Callable, Dict, List, Optional
+
+from flask import has_app_context
+
+logger = logging.getLogger(__name__)
+
+
+class FidoConfig:
+    """
+    Per-process cache of the fido_settings table with change notification.
+
+    Listeners are called with {key: new value} when this process sees a
+    change, whether it was made here or by another worker.
+    """
+
+    def __init__(self, version_file: str):
+        self.version_file = version_file
+        self._lock = threading.Lock()
+        self._values: Dict[str, Optional[str]] = {}
+        self._version = None
+        self._loaded = False
+        self._listeners: List[Callable[[Dict[str, Optional[str]]], None]] = []
+
+    def on_change(self, callback: Callable[[Dict[str, Optional[str]]], None]) -> None:
+        """Register callback(changed) for setting changes"""
+        self._listeners.append(callback)
+
+    def _current_version(self):
+        try:
+            st = os.stat(self.version_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def _bump_version(self) -> None:
+        """Replace the version file so other processes see a new inode/mtime"""
+        directory = os.path.dirname(self.version_file)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.version_file}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp_path, self.version_file)
+
+    def _reload(self) -> Dict[str, Optional[str]]:
+        """Reload settings if the version changed, returns the changed values"""
+        version = self._current_version()
+        with self._lock:
+            if self._loaded and version == self._version:
+                return {}
+        if not has_app_context():
+            return {}
+        # models imports the app, fido_utils must stay importable without it
+        from models import FidoSetting
+        
+        values = {setting.key: setting.value for setting in FidoSetting.query.all()}
+        with self._lock:
+            changed = {key: values.get(key) for key in set(values) | set(self._values)
+                       if values.get(key) != self._values.get(key)} if self._loaded else {}
+            self._values = values
+            self._version = version
+            self._loaded = True
+        return changed
+
+    def _notify(self, changed: Dict[str, Optional[str]]) -> None:
+        if not changed:
+            return
+        for callback in self._listeners:
+            try:
+                callback(changed)
+            except Exception as e:
+                logger.error(f"FIDO config listener failed: {e}")
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """Get a setting (default if it is not set)"""
+        self._notify(self._reload())
+        with self._lock:
+            value = self._values.get(key)
+        return default if value is None else value
+
+    def set(self, key: str, value: Optional[str]) -> None:
+        """Store a setting for all workers (None removes it)"""
+        from models import db, FidoSetting
+        
+        setting = db.session.get(FidoSetting, key)
+        if value is None:
+            if setting is not None:
+                db.session.delete(setting)
+        elif setting is None:
+            db.session.add(FidoSetting(key=key, value=value))
+        else:
+            setting.value = value
+        db.session.commit()
+        self._bump_version()
+        self._notify(self._reload())
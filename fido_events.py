@@ -0,0 +1,298 @@
+"""
+FIDO2 Device Event Stream
+Parses the output of the supervised virtual-fido process into registration and
+authentication events, stores them in batches and updates credential usage stats
+"""
+
+import re
+import json
+import time
+import queue
+import threading
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert, func
+
+from models import db, FidoCredential, FidoLog
+from fido_metrics import observe_event
+
+logger = logging.getLogger(__name__)
+
+# Flush queued events at least this often (seconds)
+FLUSH_INTERVAL = 1.0
+
+# ...or as soon as this many events are queued
+FLUSH_BATCH_SIZE = 200
+
+# An operation without response for this long is recorded as timed out
+OPERATION_TIMEOUT = 120.0
+
+# Line formats of virtual-fido (ctap/ctap.go, cmd/demo/server.go)
+RE_CTAP_COMMAND = re.compile(r'^\[CTAP\] CTAP COMMAND: (\w+)')
+RE_MAKE_CREDENTIAL = re.compile(
+    r'^\[CTAP\] MAKE CREDENTIAL: .*?Relying Party: RPEntity\{ ID: (?P<rp_id>.*?), Name: (?P<rp_name>.*?) \}'
+    r'(?:, User: User\{ ID: (?P<user_id>[0-9a-f]*), DisplayName: (?P<display_name>.*?), Name: (?P<user_name>.*?) \})?'
+)
+RE_GET_ASSERTION = re.compile(r'^\[CTAP\] GET ASSERTION: \S*\{RPID:"(?P<rp_id>(?:[^"\\]|\\.)*)"')
+RE_ALLOW_LIST_ID = re.compile(r'PublicKeyCredentialDescriptor\{Type:"[^"]*", ID:\[\]uint8\{([^}]*)\}')
+RE_AUTH_DATA = re.compile(r'AuthData:\[\]uint8\{([^}]*)\}')
+RE_LOGIN_APPROVED = re.compile(r'^\[AUTO-APPROVED\] Login for "(?P<rp_name>.*)" with identity "(?P<user_name>.*)"$')
+RE_CREATE_APPROVED = re.compile(r'^\[AUTO-APPROVED\] Account creation for "(?P<rp_name>.*)"$')
+RE_CTAP_ERROR = re.compile(r'^\[CTAP\] ERROR: (.*)$')
+
+# Offsets inside authenticator data: rpIdHash(32) flags(1) signCount(4) aaguid(16) credIdLen(2)
+AUTH_DATA_CRED_ID_LEN_OFFSET = 32 + 1 + 4 + 16
+
+
+def parse_go_bytes(literal: str) -> bytes:
+    """Parse the body of a Go `[]uint8{0x1, 0x2}` literal"""
+    return bytes(int(part, 16) for part in literal.replace(' ', '').split(',') if part)
+
+
+def credential_id_from_auth_data(auth_data: bytes) -> Optional[str]:
+    """Extract the credential ID (hex) from authenticator data with attested credential data"""
+    offset = AUTH_DATA_CRED_ID_LEN_OFFSET
+    if len(auth_data) < offset + 2:
+        return None
+    length = int.from_bytes(auth_data[offset:offset + 2], 'big')
+    credential_id = auth_data[offset + 2:offset + 2 + length]
+    if len(credential_id) != length or not length:
+        return None
+    return credential_id.hex()
+
+
+class CtapEventParser:
+    """
+    Streaming parser of virtual-fido output.
+
+    The device handles one CTAP request at a time, so a single pending
+    operation is tracked from its CTAP COMMAND line to the response or error.
+    """
+
+    def __init__(self):
+        self._pending: Optional[Dict] = None
+
+    def _finish(self, status: str, now: float, error: Optional[str] = None) -> Dict:
+        op = self._pending
+        self._pending = None
+        event = {
+            'event_type': op['event_type'],
+            'status': status,
+            'timestamp': datetime.utcfromtimestamp(op['started']),
+            'rp_id': op.get('rp_id'),
+            'credential_id': op.get('credential_id'),
+            'user_name': op.get('user_name'),
+            'user_id': op.get('user_id'),
+            'display_name': op.get('display_name'),
+            'latency_ms': round((now - op['started']) * 1000, 1)
+        }
+        if op.get('approved') is not None:
+            event['approval_ms'] = round((op['approved'] - op['started']) * 1000, 1)
+        if error:
+            event['error'] = error
+        return event
+
+    def feed(self, line: str, now: Optional[float] = None) -> List[Dict]:
+        """
+        Process one output line
+
+        Args:
+            line: Output line of the device
+            now: Time the line was read (default: current time)
+
+        Returns:
+            List of completed events (usually empty)
+        """
+        now = time.time() if now is None else now
+        events = []
+
+        if self._pending and now - self._pending['started'] > OPERATION_TIMEOUT:
+            events.append(self._finish('failed', now, 'timeout'))
+
+        match = RE_CTAP_COMMAND.match(line)
+        if match:
+            if self._pending:
+                events.append(self._finish('failed', now, 'interrupted'))
+            command = match.group(1)
+            if command == 'ctapCommandMakeCredential':
+                self._pending = {'event_type': 'registration', 'started': now}
+            elif command == 'ctapCommandGetAssertion':
+                self._pending = {'event_type': 'authentication', 'started': now}
+            return events
+
+        op = self._pending
+        if op is None:
+            return events
+
+        if line.startswith('[CTAP] MAKE CREDENTIAL RESPONSE:'):
+            auth_data = RE_AUTH_DATA.search(line)
+            if auth_data:
+                op['credential_id'] = credential_id_from_auth_data(parse_go_bytes(auth_data.group(1)))
+            events.append(self._finish('success', now))
+        elif line.startswith('[CTAP] GET ASSERTION RESPONSE:'):
+            events.append(self._finish('success', now))
+        elif line.startswith('[CTAP] MAKE CREDENTIAL:'):
+            match = RE_MAKE_CREDENTIAL.match(line)
+            if match:
+                op['rp_id'] = match.group('rp_id')
+                op['user_id'] = match.group('user_id')
+                op['user_name'] = match.group('user_name')
+                op['display_name'] = match.group('display_name')
+        elif line.startswith('[CTAP] GET ASSERTION:'):
+            match = RE_GET_ASSERTION.match(line)
+            if match:
+                op['rp_id'] = match.group('rp_id')
+            allowed = RE_ALLOW_LIST_ID.findall(line)
+            if len(allowed) == 1:
+                # With a single allowed credential the used credential is known exactly
+                op['credential_id'] = parse_go_bytes(allowed[0]).hex()
+        elif RE_LOGIN_APPROVED.match(line) or RE_CREATE_APPROVED.match(line):
+            match = RE_LOGIN_APPROVED.match(line)
+            if match:
+                op['user_name'] = match.group('user_name')
+            op['approved'] = now
+        else:
+            match = RE_CTAP_ERROR.match(line)
+            if match:
+                events.append(self._finish('failed', now, match.group(1).strip()))
+
+        return events
+
+
+class FidoEventRecorder:
+    """
+    Collects parsed events from the output stream and writes them to the
+    database in batches from a background thread
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.parser = CtapEventParser()
+        self._queue = queue.Queue()
+        self._parser_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='fido-event-recorder', daemon=True)
+        self._thread.start()
+
+    def handle_line(self, stream: str, line: str) -> None:
+        """Output line handler for FidoSupervisor (called from the drain threads)"""
+        if not line:
+            return
+        with self._parser_lock:
+            events = self.parser.feed(line)
+        for event in events:
+            observe_event(event)
+            self._queue.put(event)
+
+    def pending(self) -> int:
+        """Number of parsed events waiting to be written to the database"""
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=FLUSH_INTERVAL))
+            except queue.Empty:
+                continue
+            deadline = time.time() + FLUSH_INTERVAL
+            while len(batch) < FLUSH_BATCH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    self.flush(batch)
+            except Exception as e:
+                logger.error(f"Failed to store {len(batch)} FIDO events: {e}")
+
+    def flush(self, events: List[Dict]) -> None:
+        """Store a batch of events and update credential usage in one transaction"""
+        try:
+            store_events(events)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def store_events(events: List[Dict]) -> None:
+    """
+    Insert FidoLog rows for the events and update FidoCredential stats (without commit)
+    """
+    rows = []
+    for event in events:
+        details = {key: event[key] for key in ('latency_ms', 'approval_ms', 'user_name', 'error') if event.get(key) is not None}
+        rows.append({
+            'timestamp': event['timestamp'],
+            'event_type': event['event_type'],
+            'status': event['status'],
+            'rp_id': event.get('rp_id'),
+            'credential_id': event.get('credential_id'),
+            'details': json.dumps(details)
+        })
+    if rows:
+        db.session.execute(insert(FidoLog), rows)
+
+    # New credentials from successful registrations
+    registered = {}
+    for event in events:
+        if event['event_type'] == 'registration' and event['status'] == 'success' \
+                and event.get('credential_id') and event.get('rp_id'):
+            registered[event['credential_id']] = event
+    if registered:
+        existing = {cid for (cid,) in db.session.query(FidoCredential.credential_id)
+                    .filter(FidoCredential.credential_id.in_(list(registered)))}
+        new_rows = [{
+            'credential_id': cid,
+            'rp_id': event['rp_id'],
+            'user_id': event.get('user_id'),
+            'username': event.get('user_name'),
+            'display_name': event.get('display_name'),
+            'created_at': event['timestamp'],
+            'use_count': 0
+        } for cid, event in registered.items() if cid not in existing]
+        if new_rows:
+            db.session.execute(insert(FidoCredential), new_rows)
+
+    # Usage counters: one UPDATE per distinct credential in the batch
+    usage = {}
+    for event in events:
+        if event['event_type'] != 'authentication' or event['status'] != 'success':
+            continue
+        if event.get('credential_id'):
+            key = ('id', event['credential_id'])
+        elif event.get('rp_id') and event.get('user_name'):
+            key = ('user', event['rp_id'], event['user_name'])
+        else:
+            continue
+        count, last_used = usage.get(key, (0, event['timestamp']))
+        usage[key] = (count + 1, max(last_used, event['timestamp']))
+
+    for key, (count, last_used) in usage.items():
+        query = FidoCredential.query
+        if key[0] == 'id':
+            query = query.filter(FidoCredential.credential_id == key[1])
+        else:
+            query = query.filter(FidoCredential.rp_id == key[1], FidoCredential.username == key[2])
+        query.update({
+            FidoCredential.use_count: func.coalesce(FidoCredential.use_count, 0) + count,
+            FidoCredential.last_used: last_used
+        }, synchronize_session=False)
+
+
+_recorder = None
+
+
+def start_event_recorder(app, supervisor) -> FidoEventRecorder:
+    """Attach the event parser to the supervisor output (once per process)"""
+    global _recorder
+    if _recorder is None:
+        _recorder = FidoEventRecorder(app)
+        supervisor.add_line_handler(_recorder.handle_line)
+    return _recorder
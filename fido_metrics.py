@@ -0,0 +1,279 @@
+"""
+FIDO2 Operation Metrics
+Latency histograms with fixed buckets and per-minute throughput counters for
+device operations (start, stop, list, delete, attach) and CTAP requests
+(registration, assertion). Memory use is constant: one bucket array and one
+ring of minute slots per operation, independent of the number of requests.
+
+Each worker keeps its own registry; state() / merge_states() combine the
+registries of all gunicorn workers (exchanged through the app_metrics
+per-process files), and a reset marker file resets every worker.
+"""
+
+import bisect
+import os
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# Operations with their own histogram
+OPERATIONS = ('start', 'stop', 'list', 'delete', 'attach', 'registration', 'assertion')
+
+# Upper bounds of the latency buckets (milliseconds); slower values land in +Inf
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+# Throughput window: one counter per minute for the last hour
+THROUGHPUT_MINUTES = 60
+
+
+class LatencyHistogram:
+    """Counts per fixed latency bucket plus totals (not thread safe, see FidoMetrics)"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum_ms = 0.0
+        self.min_ms: Optional[float] = None
+        self.max_ms: Optional[float] = None
+
+    def observe(self, duration_ms: float, success: bool = True) -> None:
+        self.counts[bisect.bisect_left(self.bounds, duration_ms)] += 1
+        self.count += 1
+        if not success:
+            self.errors += 1
+        self.sum_ms += duration_ms
+        self.min_ms = duration_ms if self.min_ms is None else min(self.min_ms, duration_ms)
+        self.max_ms = duration_ms if self.max_ms is None else max(self.max_ms, duration_ms)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate a quantile by linear interpolation inside its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.bounds[index - 1] if index > 0 else 0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max_ms
+                value = lower + (upper - lower) * (rank - seen) / bucket_count
+                # The estimate never leaves the observed range
+                return round(min(max(value, self.min_ms), self.max_ms), 1)
+            seen += bucket_count
+        return self.max_ms
+
+
+class MinuteCounter:
+    """Ring of per-minute counters for the last THROUGHPUT_MINUTES minutes"""
+
+    def __init__(self, minutes: int = THROUGHPUT_MINUTES):
+        self.minutes = minutes
+        self.slots = [0] * minutes
+        self.slot_minute = [None] * minutes
+
+    def add(self, now: float) -> None:
+        minute = int(now // 60)
+        index = minute % self.minutes
+        if self.slot_minute[index] != minute:
+            self.slot_minute[index] = minute
+            self.slots[index] = 0
+        self.slots[index] += 1
+
+    def series(self, now: float) -> List[int]:
+        """Counts of the last minutes, oldest first (the current minute is last)"""
+        current = int(now // 60)
+        result = []
+        for minute in range(current - self.minutes + 1, current + 1):
+            index = minute % self.minutes
+            result.append(self.slots[index] if self.slot_minute[index] == minute else 0)
+        return result
+
+    def state(self) -> Dict[int, int]:
+        """Non-empty slots as {minute: count}"""
+        return {minute: count for minute, count in zip(self.slot_minute, self.slots) if minute is not None and count}
+
+    def merge(self, state: Dict) -> None:
+        for minute, count in state.items():
+            minute = int(minute)
+            index = minute % self.minutes
+            if self.slot_minute[index] == minute:
+                self.slots[index] += count
+            elif self.slot_minute[index] is None or self.slot_minute[index] < minute:
+                self.slot_minute[index] = minute
+                self.slots[index] = count
+
+
+class FidoMetrics:
+    """Per-process registry of operation histograms and throughput counters"""
+
+    def __init__(self, operations=OPERATIONS, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._histograms = {name: LatencyHistogram(self.bounds) for name in operations}
+        self._throughput = {name: MinuteCounter() for name in operations}
+
+    def observe(self, operation: str, duration_ms: float, success: bool = True, now: Optional[float] = None) -> None:
+        """Record one operation (unknown operation names are ignored)"""
+        now = time.time() if now is None else now
+        with self._lock:
+            histogram = self._histograms.get(operation)
+            if histogram is None:
+                return
+            histogram.observe(max(duration_ms, 0.0), success)
+            self._throughput[operation].add(now)
+
+    @contextmanager
+    def measure(self, operation: str):
+        """
+        Time a block; the block reports failure by setting outcome['success'] = False,
+        an exception counts as failure too
+        """
+        outcome = {'success': True}
+        started = time.perf_counter()
+        try:
+            yield outcome
+        except BaseException:
+            outcome['success'] = False
+            raise
+        finally:
+            self.observe(operation, (time.perf_counter() - started) * 1000, outcome['success'])
+
+    def timed(self, operation: str) -> Callable:
+        """Decorator for fido_utils style functions returning a dict with 'success'"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.measure(operation) as outcome:
+                    result = func(*args, **kwargs)
+                    if isinstance(result, dict):
+                        outcome['success'] = bool(result.get('success'))
+                    return result
+            return wrapper
+        return decorator
+
+    def snapshot(self, now: Optional[float] = None) -> Dict:
+        """Current numbers of all operations (JSON serializable)"""
+        now = time.time() if now is None else now
+        operations = {}
+        with self._lock:
+            for name, histogram in self._histograms.items():
+                per_minute = self._throughput[name].series(now)
+                operations[name] = {
+                    'count': histogram.count,
+                    'errors': histogram.errors,
+                    'sum_ms': round(histogram.sum_ms, 1),
+                    'avg_ms': round(histogram.sum_ms / histogram.count, 1) if histogram.count else None,
+                    'min_ms': None if histogram.min_ms is None else round(histogram.min_ms, 1),
+                    'max_ms': None if histogram.max_ms is None else round(histogram.max_ms, 1),
+                    'p50_ms': histogram.quantile(0.5),
+                    'p95_ms': histogram.quantile(0.95),
+                    'p99_ms': histogram.quantile(0.99),
+                    'buckets': list(histogram.counts),
+                    'per_minute': per_minute,
+                    'last_minute': per_minute[-1],
+                    'last_hour': sum(per_minute)
+                }
+        return {
+            'bucket_bounds_ms': list(self.bounds),
+            'operation_names': list(operations),
+            'since': self._started,
+            'operations': operations
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._started = time.time()
+            self._histograms = {name: LatencyHistogram(self.bounds) for name in self._histograms}
+            self._throughput = {name: MinuteCounter() for name in self._throughput}
+
+    def state(self) -> Dict:
+        """Raw counters of this process (JSON serializable, see merge_states)"""
+        with self._lock:
+            return {
+                'since': self._started,
+                'operations': {
+                    name: {
+                        'counts': list(histogram.counts),
+                        'count': histogram.count,
+                        'errors': histogram.errors,
+                        'sum_ms': histogram.sum_ms,
+                        'min_ms': histogram.min_ms,
+                        'max_ms': histogram.max_ms,
+                        'per_minute': self._throughput[name].state()
+                    }
+                    for name, histogram in self._histograms.items()
+                }
+            }
+
+    def merge(self, state: Dict) -> None:
+        """Add the counters of another process (a state() result)"""
+        with self._lock:
+            self._started = min(self._started, state['since'])
+            for name, data in state['operations'].items():
+                histogram = self._histograms.get(name)
+                if histogram is None or len(data['counts']) != len(histogram.counts):
+                    continue
+                histogram.counts = [a + b for a, b in zip(histogram.counts, data['counts'])]
+                histogram.count += data['count']
+                histogram.errors += data['errors']
+                histogram.sum_ms += data['sum_ms']
+                for attr, pick in (('min_ms', min), ('max_ms', max)):
+                    if data[attr] is not None:
+                        current = getattr(histogram, attr)
+                        setattr(histogram, attr, data[attr] if current is None else pick(current, data[attr]))
+                self._throughput[name].merge(data['per_minute'])
+
+    def sync_reset(self, marker: str) -> None:
+        """Reset this registry if a reset was requested (marker touched) after it started"""
+        try:
+            requested = os.stat(marker).st_mtime
+        except OSError:
+            return
+        if requested > self._started:
+            self.reset()
+
+    def request_reset(self, marker: str) -> None:
+        """Reset this registry and ask the other workers to reset theirs"""
+        os.makedirs(os.path.dirname(marker) or '.', exist_ok=True)
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+        self.reset()
+
+
+# Registry of this process (the supervisor and the fido_utils wrappers report here)
+metrics = FidoMetrics()
+
+# A forked worker starts empty, otherwise the parent's numbers would be counted twice
+os.register_at_fork(after_in_child=lambda: metrics.__init__(tuple(metrics._histograms), metrics.bounds))
+
+
+def merge_states(states: List[Dict], reset_at: float = 0) -> FidoMetrics:
+    """
+    Combine the states of several workers; states recorded before the last
+    reset (workers that have not picked up the reset marker yet) are skipped
+    """
+    merged = FidoMetrics()
+    states = [state for state in states if state['since'] >= reset_at]
+    if states:
+        merged._started = min(state['since'] for state in states)
+    for state in states:
+        merged.merge(state)
+    return merged
+
+# CTAP event types of fido_events -> operation names
+EVENT_OPERATIONS = {
+    'registration': 'registration',
+    'authentication': 'assertion'
+}
+
+
+def observe_event(event: Dict) -> None:
+    """Record a parsed CTAP event (fido_events.CtapEventParser) that carries latency_ms"""
+    operation = EVENT_OPERATIONS.get(event.get('event_type'))
+    if operation and event.get('latency_ms') is not None:
+        metrics.observe(operation, event['latency_ms'], event.get('status') == 'success')
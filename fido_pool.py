@@ -0,0 +1,381 @@
+"""
+FIDO2 Device Pool
+Several supervised virtual-fido authenticators side by side, each with its
+own vault, passphrase and USB/IP port, plus leases that hand free instances
+to test jobs
+"""
+
+import os
+import re
+import json
+import shutil
+import socket
+import secrets
+import threading
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from models import db, FidoInstance, FidoLog
+from fido_supervisor import FidoSupervisor
+from fido_readiness import wait_until_ready, find_import
+from fido_utils import (
+    FIDO_BINARY,
+    FIDO_DATA_DIR,
+    FIDO_USBIP_PORT,
+    FIDO_BUS_ID,
+    check_fido_binary,
+    attach_to_localhost,
+    detach_from_localhost,
+    list_fido_credentials
+)
+
+logger = logging.getLogger(__name__)
+
+# Directory with one subdirectory (vault, pidfile) per instance
+INSTANCES_DIR = os.path.join(FIDO_DATA_DIR, 'instances')
+
+# Instance names become directory names under INSTANCES_DIR
+INSTANCE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Ports of pool instances; the main device keeps FIDO_USBIP_PORT
+POOL_BASE_PORT = int(os.environ.get('FIDO_POOL_BASE_PORT', str(FIDO_USBIP_PORT + 1)))
+POOL_PORT_RANGE = 1000
+
+# acquire() creates new instances on demand up to this pool size
+POOL_MAX_INSTANCES = int(os.environ.get('FIDO_POOL_MAX_INSTANCES', '32'))
+
+# Lease duration if the job does not ask for one (seconds)
+DEFAULT_LEASE_TTL = 3600
+
+# Environment variable read by virtual-fido/usbip/usbip_server.go
+PORT_ENV_VAR = 'VIRTUAL_FIDO_PORT'
+
+
+def is_port_free(port: int) -> bool:
+    """Check that nobody listens on the TCP port (the device binds all interfaces)"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('', port))
+        except OSError:
+            return False
+    return True
+
+
+def log_instance_event(instance: FidoInstance, event_type: str, status: str, **details) -> None:
+    """Store a FidoLog event of a pool instance (the instance name goes first in details)"""
+    try:
+        db.session.add(FidoLog(
+            event_type=event_type,
+            status=status,
+            details=json.dumps(dict({'instance': instance.name}, **details))
+        ))
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Failed to log FIDO instance event: {e}")
+        db.session.rollback()
+
+
+class FidoPool:
+    """
+    Registry of instance supervisors.
+
+    Instance settings and leases live in the fido_instances table, so every
+    worker sees the same pool; the processes are owned by the worker that
+    started them and are found by the others through the instance pidfile.
+    """
+
+    def __init__(self, app=None, instances_dir: str = INSTANCES_DIR):
+        self.app = app
+        self.instances_dir = instances_dir
+        self._supervisors: Dict[int, FidoSupervisor] = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Instances
+
+    def instance_path(self, name: str) -> str:
+        """
+        Directory of the instance (not created)
+
+        Raises:
+            ValueError: The name is not a plain directory name or the path leaves instances_dir
+        """
+        if not isinstance(name, str) or not INSTANCE_NAME_PATTERN.match(name):
+            raise ValueError('Instance name may only contain letters, digits, "_" and "-" (1-64 characters)')
+        root = os.path.realpath(self.instances_dir)
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.dirname(path) != root:
+            raise ValueError(f'Instance directory is outside {self.instances_dir}: {name}')
+        return path
+
+    def instance_dir(self, name: str) -> str:
+        path = self.instance_path(name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def supervisor(self, instance: FidoInstance) -> FidoSupervisor:
+        with self._lock:
+            supervisor = self._supervisors.get(instance.id)
+            if supervisor is None:
+                pidfile = os.path.join(self.instance_dir(instance.name), 'virtual-fido.pid')
+                supervisor = FidoSupervisor(pidfile)
+                supervisor.add_exit_handler(self._exit_handler(instance.id))
+                self._supervisors[instance.id] = supervisor
+            return supervisor
+
+    def _exit_handler(self, instance_id: int):
+        def handler(exit_code, restarting):
+            if self.app is None:
+                return
+            with self.app.app_context():
+                instance = db.session.get(FidoInstance, instance_id)
+                if instance is not None:
+                    log_instance_event(instance, 'instance_crash', 'failed',
+                                       exit_code=exit_code, restarting=restarting)
+        return handler
+
+    def _next_port(self) -> int:
+        used = {port for (port,) in db.session.query(FidoInstance.port)}
+        used.add(FIDO_USBIP_PORT)
+        for port in range(POOL_BASE_PORT, POOL_BASE_PORT + POOL_PORT_RANGE):
+            if port not in used and is_port_free(port):
+                return port
+        raise RuntimeError('No free port for a new FIDO instance')
+
+    def create_instance(self, name: Optional[str] = None, passphrase: Optional[str] = None,
+                        port: Optional[int] = None, auto_start: bool = False) -> FidoInstance:
+        """
+        Register a new instance
+
+        Args:
+            name: Unique name (default: fido-<port>)
+            passphrase: Vault passphrase (default: random)
+            port: USB/IP port (default: lowest free port of the pool range)
+            auto_start: Start the instance together with the application
+        """
+        for _ in range(10):
+            instance_port = port or self._next_port()
+            instance_name = name or f'fido-{instance_port}'
+            instance = FidoInstance(
+                name=instance_name,
+                port=instance_port,
+                vault_path=os.path.join(self.instance_dir(instance_name), 'vault.json'),
+                passphrase=passphrase or secrets.token_urlsafe(16),
+                auto_start=auto_start
+            )
+            db.session.add(instance)
+            try:
+                db.session.commit()
+                logger.info(f"FIDO instance {instance_name} created on port {instance_port}")
+                return instance
+            except IntegrityError:
+                # Another worker took the name/port at the same time
+                db.session.rollback()
+                if name or port:
+                    raise ValueError(f'Instance name or port already in use: {instance_name}, {instance_port}')
+        raise RuntimeError('Could not allocate a FIDO instance')
+
+    def delete_instance(self, instance: FidoInstance) -> Dict:
+        """Stop the instance and remove it together with its vault"""
+        self.stop(instance)
+        with self._lock:
+            self._supervisors.pop(instance.id, None)
+        try:
+            shutil.rmtree(self.instance_path(instance.name), ignore_errors=True)
+        except ValueError as e:
+            logger.error(f"Instance {instance.id} files not removed: {e}")
+        db.session.delete(instance)
+        db.session.commit()
+        return {'success': True, 'message': f'Instance {instance.name} deleted'}
+
+    # ------------------------------------------------------------------
+    # Process control
+
+    def start(self, instance: FidoInstance, auto_restart: bool = True) -> Dict:
+        """Start the instance under its own supervisor"""
+        if not check_fido_binary():
+            return {'success': False, 'error': f'FIDO binary not found at {FIDO_BINARY}'}
+        supervisor = self.supervisor(instance)
+        if not supervisor.status()['is_running'] and not is_port_free(instance.port):
+            return {'success': False, 'error': f'Port {instance.port} is already in use'}
+
+        cmd = [FIDO_BINARY, 'start', '--passphrase', instance.passphrase, '--vault', instance.vault_path]
+        logger.info(f"Starting FIDO instance {instance.name} on port {instance.port}")
+        result = supervisor.start(
+            cmd, auto_restart=auto_restart, env={PORT_ENV_VAR: str(instance.port)},
+            ready=lambda is_alive: wait_until_ready(instance.port, FIDO_BUS_ID, is_alive=is_alive)
+        )
+
+        instance.last_error = None if result['success'] else result.get('error')
+        db.session.commit()
+        return result
+
+    def stop(self, instance: FidoInstance) -> Dict:
+        """Stop the instance (detaching it first if it is attached)"""
+        supervisor = self.supervisor(instance)
+        if not supervisor.status()['is_running']:
+            return {'success': True, 'message': 'Instance is not running'}
+        if find_import(instance.port):
+            detach_from_localhost(instance.port)
+        return supervisor.stop()
+
+    def status(self, instance: FidoInstance) -> Dict:
+        """Instance settings, lease and live process status"""
+        status = self.supervisor(instance).status()
+        status.update(instance.to_dict())
+        status['is_leased'] = instance.is_leased()
+        return status
+
+    def output(self, instance: FidoInstance, since: int = 0, limit: Optional[int] = None) -> Dict:
+        return self.supervisor(instance).output(since, limit)
+
+    def attach(self, instance: FidoInstance) -> Dict:
+        """Attach the instance to localhost through vhci-hcd"""
+        if not self.supervisor(instance).status()['is_running']:
+            return {'success': False, 'error': f'Instance {instance.name} is not running. Start it first.'}
+        return attach_to_localhost(port=instance.port, bus_id=FIDO_BUS_ID, check_running=False)
+
+    def detach(self, instance: FidoInstance) -> Dict:
+        return detach_from_localhost(instance.port)
+
+    def credentials(self, instance: FidoInstance) -> Dict:
+        return list_fido_credentials(instance.passphrase, instance.vault_path)
+
+    def start_auto_start_instances(self) -> None:
+        for instance in FidoInstance.query.filter_by(auto_start=True).all():
+            if not self.supervisor(instance).status()['is_running']:
+                result = self.start(instance)
+                if not result['success']:
+                    logger.error(f"Auto-start of FIDO instance {instance.name} failed: {result.get('error')}")
+
+    # ------------------------------------------------------------------
+    # Leases
+
+    def acquire(self, holder: str, ttl: int = DEFAULT_LEASE_TTL, create: bool = True) -> Dict:
+        """
+        Lease a free instance to a test job (running instances are preferred)
+        and make sure it is running
+
+        The lease is taken with a conditional UPDATE, so concurrent jobs in
+        different workers never get the same instance.
+
+        Args:
+            holder: Job identifier
+            ttl: Lease duration in seconds (expired leases are free again)
+            create: Grow the pool up to POOL_MAX_INSTANCES if no instance is free
+
+        Returns:
+            Dict with success status and the instance status
+        """
+        now = datetime.utcnow()
+        free_filter = or_(FidoInstance.lease_holder.is_(None), FidoInstance.lease_expires_at < now)
+        lease = {
+            FidoInstance.lease_holder: holder,
+            FidoInstance.leased_at: now,
+            FidoInstance.lease_expires_at: now + timedelta(seconds=ttl)
+        }
+
+        candidates = FidoInstance.query.filter(free_filter).all()
+        candidates.sort(key=lambda i: (not self.supervisor(i).status()['is_running'], i.id))
+        if not candidates and create and FidoInstance.query.count() < POOL_MAX_INSTANCES:
+            candidates = [self.create_instance()]
+
+        for candidate in candidates:
+            claimed = FidoInstance.query.filter(FidoInstance.id == candidate.id, free_filter) \
+                .update(lease, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                continue
+            instance = db.session.get(FidoInstance, candidate.id)
+            db.session.refresh(instance)
+            if not self.supervisor(instance).status()['is_running']:
+                result = self.start(instance)
+                if not result['success']:
+                    self.release(instance, holder)
+                    return {'success': False, 'error': f"Instance {instance.name} failed to start: {result.get('error')}"}
+            log_instance_event(instance, 'instance_lease', 'success', holder=holder, ttl=ttl)
+            return {'success': True, 'instance': self.status(instance)}
+
+        return {'success': False, 'error': 'No free FIDO instance available'}
+
+    def renew(self, instance: FidoInstance, holder: str, ttl: int = DEFAULT_LEASE_TTL) -> Dict:
+        """Extend the lease of the job that holds it"""
+        renewed = FidoInstance.query.filter_by(id=instance.id, lease_holder=holder) \
+            .update({FidoInstance.lease_expires_at: datetime.utcnow() + timedelta(seconds=ttl)},
+                    synchronize_session=False)
+        db.session.commit()
+        if not renewed:
+            return {'success': False, 'error': f'Instance {instance.name} is not leased by {holder}'}
+        return {'success': True}
+
+    def release(self, instance: FidoInstance, holder: Optional[str] = None, reset: bool = False) -> Dict:
+        """
+        Return the instance to the pool
+
+        Args:
+            holder: Only release if this job holds the lease (None: release unconditionally)
+            reset: Wipe the vault so the next job starts without credentials
+        """
+        db.session.refresh(instance)
+        if holder is not None and instance.lease_holder != holder:
+            return {'success': False, 'error': f'Instance {instance.name} is not leased by {holder}'}
+
+        # Reset while the lease is still held, so no other job gets the instance meanwhile
+        if reset:
+            was_running = self.supervisor(instance).status()['is_running']
+            if was_running:
+                self.stop(instance)
+            try:
+                os.remove(instance.vault_path)
+            except FileNotFoundError:
+                pass
+            if was_running:
+                self.start(instance)
+
+        query = FidoInstance.query.filter_by(id=instance.id)
+        if holder is not None:
+            query = query.filter_by(lease_holder=holder)
+        released = query.update({
+            FidoInstance.lease_holder: None,
+            FidoInstance.leased_at: None,
+            FidoInstance.lease_expires_at: None
+        }, synchronize_session=False)
+        db.session.commit()
+        if not released:
+            return {'success': False, 'error': f'Instance {instance.name} is not leased by {holder}'}
+
+        log_instance_event(instance, 'instance_release', 'success', holder=holder, reset=reset)
+        return {'success': True}
+
+
+_pool: Optional[FidoPool] = None
+
+
+def get_fido_pool() -> FidoPool:
+    """Get the device pool of this process"""
+    global _pool
+    if _pool is None:
+        _pool = FidoPool()
+    return _pool
+
+
+def init_fido_pool(app) -> FidoPool:
+    """Bind the pool to the application and start auto-start instances"""
+    pool = get_fido_pool()
+    pool.app = app
+    with app.app_context():
+        try:
+            pool.start_auto_start_instances()
+        except Exception as e:
+            logger.error(f"Failed to start FIDO pool instances: {e}")
+    return pool
+
+
+def list_instance_statuses() -> List[Dict]:
+    pool = get_fido_pool()
+    return [pool.status(instance) for instance in FidoInstance.query.order_by(FidoInstance.id).all()]
@@ -0,0 +1,222 @@
+"""
+FIDO2 Device Readiness
+Probes the USB/IP server of virtual-fido with OP_REQ_DEVLIST instead of
+sleeping for a fixed time, and resolves the usbip tooling once per process
+"""
+
+import os
+import glob
+import time
+import shutil
+import socket
+import struct
+import subprocess
+import logging
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# USB/IP protocol (virtual-fido/usbip/usbip.go)
+USBIP_VERSION = 0x0111
+OP_REQ_DEVLIST = 0x8005
+OP_REP_DEVLIST = 0x0005
+CONTROL_HEADER = struct.Struct('>HHI')          # version, command, status
+DEVICE_HEADER = struct.Struct('>256s32sIIIHHHBBBBBB')
+INTERFACE_SIZE = 4
+
+# Socket timeout of a single probe (seconds)
+PROBE_TIMEOUT = 0.5
+
+# Overall time to wait for the device to answer
+READY_TIMEOUT = 10.0
+
+# Poll backoff: starts short so a fast device is seen almost immediately
+BACKOFF_INITIAL = 0.01
+BACKOFF_MAX = 0.1
+
+# usbip attach itself only talks to the local device, it should never take long
+ATTACH_TIMEOUT = 10.0
+
+# Import records written by `usbip attach` (host, port, bus ID per vhci port)
+VHCI_STATE_DIR = '/var/run/vhci_hcd'
+VHCI_MODULE_DIR = '/sys/module/vhci_hcd'
+
+USBIP_CANDIDATES = ['/usr/sbin/usbip', '/usr/bin/usbip', '/usr/lib/linux-tools/*/usbip']
+
+
+class ProbeError(Exception):
+    """Device did not answer the USB/IP request"""
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProbeError('Connection closed by device')
+        data += chunk
+    return data
+
+
+def request_devlist(port: int, host: str = '127.0.0.1', timeout: float = PROBE_TIMEOUT) -> List[Dict]:
+    """
+    Ask the USB/IP server for its exported devices
+
+    The server handles one connection at a time, so the connection is closed
+    right after the reply. A device that is already imported does not answer.
+
+    Returns:
+        List of dicts with bus_id, vendor_id and product_id
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            sock.sendall(CONTROL_HEADER.pack(USBIP_VERSION, OP_REQ_DEVLIST, 0))
+            version, command, status = CONTROL_HEADER.unpack(_recv_exact(sock, CONTROL_HEADER.size))
+            if command != OP_REP_DEVLIST or status != 0:
+                raise ProbeError(f'Unexpected reply 0x{command:04x} (status {status})')
+            (count,) = struct.unpack('>I', _recv_exact(sock, 4))
+            devices = []
+            for index in range(count):
+                fields = DEVICE_HEADER.unpack(_recv_exact(sock, DEVICE_HEADER.size))
+                devices.append({
+                    'bus_id': fields[1].split(b'\0', 1)[0].decode('ascii', 'replace'),
+                    'vendor_id': f'{fields[5]:04x}',
+                    'product_id': f'{fields[6]:04x}'
+                })
+                # Interface descriptors are only read when another device follows
+                # (virtual-fido sends a shorter, non-standard descriptor)
+                if index + 1 < count:
+                    _recv_exact(sock, fields[13] * INTERFACE_SIZE)
+            return devices
+    except (OSError, struct.error) as e:
+        raise ProbeError(str(e)) from e
+
+
+def wait_until_ready(port: int, bus_id: Optional[str] = None, timeout: float = READY_TIMEOUT,
+                     is_alive: Optional[Callable[[], bool]] = None) -> Dict:
+    """
+    Poll the device with devlist requests until it answers (exponential backoff)
+
+    Args:
+        port: USB/IP TCP port
+        bus_id: Bus ID the device must export (None: any answer is enough)
+        timeout: Give up after this many seconds
+        is_alive: Returns False once the device process has exited (fail fast)
+
+    Returns:
+        Dict with ready flag, elapsed_ms, attempts, devices and the last error
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    delay = BACKOFF_INITIAL
+    attempts = 0
+    error = None
+
+    while True:
+        attempts += 1
+        try:
+            devices = request_devlist(port, timeout=min(PROBE_TIMEOUT, max(deadline - time.monotonic(), 0.01)))
+            if bus_id is None or any(d['bus_id'] == bus_id for d in devices):
+                return {
+                    'ready': True,
+                    'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+                    'attempts': attempts,
+                    'devices': devices
+                }
+            error = f'Bus ID {bus_id} is not exported (found: {", ".join(d["bus_id"] for d in devices) or "none"})'
+        except ProbeError as e:
+            error = str(e)
+
+        if is_alive is not None and not is_alive():
+            error = 'Device process exited'
+            break
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, BACKOFF_MAX)
+
+    return {
+        'ready': False,
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+        'attempts': attempts,
+        'error': error
+    }
+
+
+@lru_cache(maxsize=1)
+def find_usbip_command() -> Optional[tuple]:
+    """
+    Resolve the usbip binary once per process
+
+    Returns:
+        Command prefix (with sudo unless running as root) or None if usbip is missing
+    """
+    path = shutil.which('usbip')
+    if not path:
+        for candidate in USBIP_CANDIDATES:
+            matches = sorted(glob.glob(candidate))
+            if matches:
+                path = matches[-1]
+                break
+    if not path:
+        logger.warning("usbip binary not found")
+        return None
+    if os.geteuid() != 0 and shutil.which('sudo'):
+        return ('sudo', path)
+    return (path,)
+
+
+def ensure_vhci_loaded() -> Dict:
+    """Load vhci-hcd unless it is already loaded (checked through /sys, no subprocess)"""
+    if os.path.isdir(VHCI_MODULE_DIR):
+        return {'success': True}
+    cmd = ['modprobe', 'vhci-hcd']
+    if os.geteuid() != 0 and shutil.which('sudo'):
+        cmd.insert(0, 'sudo')
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return {'success': False, 'error': f'Failed to load vhci-hcd kernel module: {e}'}
+    if result.returncode != 0:
+        return {'success': False, 'error': f'Failed to load vhci-hcd kernel module: {result.stderr}'}
+    return {'success': True}
+
+
+def vhci_imports() -> List[Dict]:
+    """Devices imported through vhci-hcd, read from the usbip state files"""
+    imports = []
+    for path in glob.glob(os.path.join(VHCI_STATE_DIR, 'port*')):
+        try:
+            with open(path) as f:
+                host, tcp_port, bus_id = f.read().split()[:3]
+            imports.append({
+                'port': os.path.basename(path)[len('port'):],
+                'host': host,
+                'tcp_port': int(tcp_port),
+                'bus_id': bus_id
+            })
+        except (OSError, ValueError):
+            continue
+    return imports
+
+
+def find_import(port: int, bus_id: Optional[str] = None) -> Optional[Dict]:
+    for entry in vhci_imports():
+        if entry['tcp_port'] == port and (bus_id is None or entry['bus_id'] == bus_id):
+            return entry
+    return None
+
+
+def wait_for_import(port: int, bus_id: Optional[str] = None, timeout: float = 5.0) -> Optional[Dict]:
+    """Wait until the device shows up as imported (same backoff as the device probe)"""
+    deadline = time.monotonic() + timeout
+    delay = BACKOFF_INITIAL
+    while True:
+        entry = find_import(port, bus_id)
+        if entry or time.monotonic() >= deadline:
+            return entry
+        time.sleep(delay)
+        delay = min(delay * 2, BACKOFF_MAX)
@@ -5,11 +5,17 @@ Blueprint for virtual-fido device control and credential management
 
 from flask import Blueprint, render_template, request, jsonify, flash, redirect, url_for
 from flask_login import login_required, current_user
-from datetime import datetime
+from datetime import datetime, timedelta
+import os
+import json
 import logging
 
 from app import db
-from models import FidoDevice, FidoCredential, FidoLog
+from models import FidoDevice, FidoCredential, FidoLog, FidoInstance
+from fido_events import start_event_recorder
+from fido_metrics import metrics, merge_states
+from app_metrics import metrics_dir, metrics_enabled, process_sections, registry as metrics_registry
+from fido_pool import get_fido_pool, init_fido_pool, list_instance_statuses, log_instance_event, DEFAULT_LEASE_TTL
 from fido_utils import (
     check_fido_binary,
     get_fido_status,
@@ -17,6 +23,7 @@ from fido_utils import (
     stop_fido_device,
     list_fido_credentials,
     delete_fido_credential,
+    delete_fido_credentials,
     get_vault_info,
     backup_vault,
     restore_vault,
@@ -28,7 +35,10 @@ from fido_utils import (
     get_backup_history,
     attach_to_localhost,
     detach_from_localhost,
-    get_localhost_attach_status
+    get_localhost_attach_status,
+    get_fido_output,
+    get_fido_supervisor,
+    FIDO_USBIP_PORT
 )
 
 logger = logging.getLogger(__name__)
@@ -125,16 +135,17 @@ def start_device():
     try:
         device = get_or_create_fido_device()
         
-        # Check if already running
-        if device.is_running:
+        # Check if already running (live status from the supervisor, the DB flag may be stale)
+        status_info = get_fido_status()
+        if status_info['is_running']:
             return jsonify({
                 'success': False,
                 'message': 'FIDO device is already running',
-                'pid': device.pid
+                'pid': status_info.get('pid')
             }), 400
         
-        # Start device
-        result = start_fido_device()
+        # Start device (supervisor restarts it after crashes when auto-start is enabled)
+        result = start_fido_device(auto_restart=bool(device.auto_start))
         
         if result['success']:
             # Update database
@@ -145,13 +156,15 @@ def start_device():
             db.session.commit()
             
             # Log event
-            log_fido_event('device_start', 'success', details=f"PID: {result.get('pid')}")
+            log_fido_event('device_start', 'success',
+                           details=f"PID: {result.get('pid')}, ready in {result.get('ready_ms')} ms")
             
             flash('FIDO device started successfully!', 'success')
             return jsonify({
                 'success': True,
                 'message': 'FIDO device started successfully',
-                'pid': result.get('pid')
+                'pid': result.get('pid'),
+                'ready_ms': result.get('ready_ms')
             })
         else:
             # Update error
@@ -183,7 +196,11 @@ def stop_device():
         device = get_or_create_fido_device()
         
         # Check if not running
-        if not device.is_running:
+        if not get_fido_status()['is_running']:
+            if device.is_running:
+                device.is_running = False
+                device.pid = None
+                db.session.commit()
             return jsonify({
                 'success': False,
                 'message': 'FIDO device is not running'
@@ -265,6 +282,114 @@ def get_status():
         }), 500
 
 
+@fido_bp.route('/output', methods=['GET'])
+@login_required
+def get_output():
+    """Get recent output lines of the supervised FIDO device (API endpoint)"""
+    try:
+        since = request.args.get('since', 0, type=int)
+        limit = request.args.get('limit', 200, type=int)
+        output = get_fido_output(since=since, limit=min(max(limit, 1), 2000))
+        return jsonify({
+            'success': True,
+            'lines': output['lines'],
+            'last_seq': output['last_seq']
+        })
+    except Exception as e:
+        logger.error(f"Error getting FIDO device output: {e}")
+        return jsonify({
+            'success': False,
+            'message': f"Error: {str(e)}"
+        }), 500
+
+
+def fido_metrics_reset_marker():
+    """Reset marker shared by all workers (next to the app_metrics process files)"""
+    return os.path.join(metrics_dir(), 'fido_metrics.reset')
+
+
+def fido_metrics_state():
+    """State of this worker's registry for the app_metrics process file"""
+    metrics.sync_reset(fido_metrics_reset_marker())
+    return metrics.state()
+
+
+@fido_bp.route('/metrics', methods=['GET'])
+@login_required
+def get_metrics():
+    """
+    Latency histograms and throughput of FIDO operations of all workers
+    (API endpoint). Other workers are included as of their last app_metrics
+    flush (METRICS_FLUSH_SECONDS); with METRICS=0 only this worker is shown.
+    """
+    try:
+        states = process_sections('fido') if metrics_enabled() else []
+        if states:
+            try:
+                reset_at = os.stat(fido_metrics_reset_marker()).st_mtime
+            except OSError:
+                reset_at = 0
+            merged = merge_states(states, reset_at)
+            snapshot = merged.snapshot()
+            workers = sum(1 for state in states if state['since'] >= reset_at)
+        else:
+            snapshot = metrics.snapshot()
+            workers = 1
+        return jsonify({
+            'success': True,
+            'pid': os.getpid(),
+            'workers': workers,
+            **snapshot
+        })
+    except Exception as e:
+        logger.error(f"Error getting FIDO metrics: {e}")
+        return jsonify({
+            'success': False,
+            'message': f"Error: {str(e)}"
+        }), 500
+
+
+@fido_bp.route('/metrics/reset', methods=['POST'])
+@login_required
+def reset_metrics():
+    """Reset the FIDO operation metrics of all workers"""
+    if metrics_enabled():
+        metrics.request_reset(fido_metrics_reset_marker())
+    else:
+        metrics.reset()
+    return jsonify({
+        'success': True,
+        'message': 'Metrics reset'
+    })
+
+
+@fido_bp.route('/auto-start', methods=['POST'])
+@login_required
+def set_auto_start():
+    """Enable or disable auto-start (and supervised restart) of the FIDO device"""
+    try:
+        data = request.get_json(silent=True) or {}
+        device = get_or_create_fido_device()
+        device.auto_start = bool(data.get('enabled'))
+        db.session.commit()
+        
+        log_fido_event('auto_start_changed', 'success', details=f"enabled={device.auto_start}")
+        
+        return jsonify({
+            'success': True,
+            'auto_start': device.auto_start,
+            'message': 'Auto-start ' + ('enabled' if device.auto_start else 'disabled') +
+                       ('. Restart the device to apply to the running process.' if device.is_running else '')
+        })
+    except Exception as e:
+        logger.error(f"Error changing FIDO auto-start: {e}")
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': f"Error: {str(e)}"
+        }), 500
+
+
 @fido_bp.route('/credentials', methods=['GET'])
 @login_required
 def get_credentials():
@@ -336,6 +461,90 @@ def delete_credential(credential_id):
         }), 500
 
 
+@fido_bp.route('/credentials/bulk-delete', methods=['POST'])
+@login_required
+def bulk_delete_credentials():
+    """
+    Delete several FIDO credentials at once
+    
+    JSON body (all given filters must match):
+        credential_ids: list of credential IDs (or unique prefixes)
+        rp_id: Relying Party ID
+        older_than_days: only credentials registered earlier than this many days ago
+    """
+    data = request.get_json(silent=True) or {}
+    credential_ids = data.get('credential_ids')
+    rp_id = (data.get('rp_id') or '').strip() or None
+    older_than_days = data.get('older_than_days')
+    
+    if credential_ids is not None and (not isinstance(credential_ids, list)
+                                       or not all(isinstance(cid, str) for cid in credential_ids)):
+        return jsonify({'success': False, 'message': 'credential_ids must be a list of strings'}), 400
+    
+    allowed_ids = None
+    if older_than_days not in (None, ''):
+        try:
+            older_than_days = float(older_than_days)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'older_than_days must be a number'}), 400
+        # The vault does not store registration dates, so the age comes from FidoCredential
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        allowed_ids = {cid for (cid,) in db.session.query(FidoCredential.credential_id)
+                       .filter(FidoCredential.created_at < cutoff)}
+    else:
+        older_than_days = None
+    
+    if credential_ids is None and rp_id is None and allowed_ids is None:
+        return jsonify({'success': False, 'message': 'Specify credential_ids, rp_id or older_than_days'}), 400
+    
+    try:
+        result = delete_fido_credentials(credential_ids=credential_ids, rp_id=rp_id, allowed_ids=allowed_ids)
+        
+        summary = {
+            'filters': {
+                'credential_ids': len(credential_ids) if credential_ids is not None else None,
+                'rp_id': rp_id,
+                'older_than_days': older_than_days
+            }
+        }
+        
+        if not result.get('success'):
+            summary['error'] = result.get('error')
+            log_fido_event('credential_bulk_delete', 'failed', rp_id=rp_id, details=json.dumps(summary))
+            return jsonify({
+                'success': False,
+                'message': result.get('error', 'Failed to delete credentials')
+            }), 500
+        
+        deleted_ids = [record['credential_id'] for record in result['deleted']]
+        if deleted_ids:
+            FidoCredential.query.filter(FidoCredential.credential_id.in_(deleted_ids)) \
+                .delete(synchronize_session=False)
+        
+        summary['deleted'] = len(deleted_ids)
+        summary['credential_ids'] = deleted_ids
+        summary['not_found'] = result['not_found']
+        # Commits the FidoCredential cleanup together with the summary event
+        log_fido_event('credential_bulk_delete', 'success', rp_id=rp_id, details=json.dumps(summary))
+        
+        return jsonify({
+            'success': True,
+            'message': f"Deleted {len(deleted_ids)} credentials",
+            'deleted': deleted_ids,
+            'not_found': result['not_found'],
+            'count': len(deleted_ids)
+        })
+    
+    except Exception as e:
+        logger.error(f"Error deleting FIDO credentials: {e}")
+        db.session.rollback()
+        log_fido_event('credential_bulk_delete', 'failed', rp_id=rp_id, details=str(e))
+        return jsonify({
+            'success': False,
+            'message': f"Error: {str(e)}"
+        }), 500
+
+
 @fido_bp.route('/logs', methods=['GET'])
 @login_required
 def get_logs():
@@ -429,13 +638,25 @@ def backup_vault_route():
         result = backup_vault()
         
         if result['success']:
-            log_fido_event('vault_backup', 'success', details=f"Backup: {result.get('backup')}")
+            if result.get('skipped'):
+                # Nothing was written, so there is no event to log
+                return jsonify({
+                    'success': True,
+                    'skipped': True,
+                    'message': result.get('message'),
+                    'backup_path': result.get('backup'),
+                    'filename': result.get('filename')
+                })
+            
+            log_fido_event('vault_backup', 'success', details=f"Backup: {result.get('filename')}")
             
-            flash(f'Vault backup created: {result.get("backup")}', 'success')
+            flash(f'Vault backup created: {result.get("filename")}', 'success')
             return jsonify({
                 'success': True,
                 'message': 'Vault backup created successfully',
-                'backup_path': result.get('backup')
+                'backup_path': result.get('backup'),
+                'filename': result.get('filename'),
+                'pruned': result.get('pruned', [])
             })
         else:
             log_fido_event('vault_backup', 'failed', details=result.get('error'))
@@ -587,20 +808,30 @@ def download_backup_route(filename):
     try:
         from flask import send_file
         from fido_utils import get_backup_directory
+        from fido_backup import read_backup
+        import io
         import os
         
-        backup_dir = get_backup_directory()
-        backup_path = os.path.join(backup_dir, filename)
+        if '/' in filename or '\\' in filename or filename.startswith('.'):
+            return jsonify({
+                'success': False,
+                'message': 'Invalid filename'
+            }), 400
         
-        if not os.path.exists(backup_path):
+        backup_dir = get_backup_directory()
+        data = read_backup(backup_dir, filename)
+        if data is None:
             flash(f'Backup file not found: {filename}', 'error')
             return jsonify({
                 'success': False,
                 'message': f'Backup file not found: {filename}'
             }), 404
         
+        # Snapshots are stored compressed, the download is the plain vault file
+        download_name = filename[:-len('.gz')] if filename.endswith('.gz') else filename
         log_fido_event('backup_download', 'success', details=filename)
-        return send_file(backup_path, as_attachment=True, download_name=filename)
+        return send_file(io.BytesIO(data), as_attachment=True, download_name=download_name,
+                         mimetype='application/json')
             
     except Exception as e:
         logger.error(f"Error downloading backup: {e}")
@@ -617,11 +848,11 @@ def download_vault_route():
     """Download current vault.json file for backup"""
     try:
         from flask import send_file
-        from fido_utils import FIDO_VAULT_PATH
         import os
         from datetime import datetime
         
-        if not os.path.exists(FIDO_VAULT_PATH):
+        vault_path = get_vault_path()
+        if not os.path.exists(vault_path):
             flash('Vault file not found', 'error')
             return jsonify({
                 'success': False,
@@ -633,7 +864,7 @@ def download_vault_route():
         download_name = f'vault_backup_{timestamp}.json'
         
         log_fido_event('vault_download', 'success', details='Current vault downloaded')
-        return send_file(FIDO_VAULT_PATH, as_attachment=True, download_name=download_name)
+        return send_file(vault_path, as_attachment=True, download_name=download_name)
             
     except Exception as e:
         logger.error(f"Error downloading vault: {e}")
@@ -769,13 +1000,31 @@ def get_log_stats_route():
         last_24h = datetime.utcnow() - timedelta(hours=24)
         recent_count = FidoLog.query.filter(FidoLog.timestamp >= last_24h).count()
         
+        # Authentication rate per relying party (last 24 hours, from device output events)
+        rp_counts = db.session.query(
+            FidoLog.rp_id,
+            FidoLog.status,
+            func.count(FidoLog.id).label('count')
+        ).filter(
+            FidoLog.event_type == 'authentication',
+            FidoLog.timestamp >= last_24h
+        ).group_by(FidoLog.rp_id, FidoLog.status).all()
+        
+        by_relying_party = {}
+        for rp_id, status, count in rp_counts:
+            rp_stats = by_relying_party.setdefault(rp_id or 'unknown', {'success': 0, 'failed': 0})
+            rp_stats[status] = rp_stats.get(status, 0) + count
+        for rp_stats in by_relying_party.values():
+            rp_stats['per_hour'] = round((rp_stats['success'] + rp_stats['failed']) / 24, 2)
+        
         return jsonify({
             'success': True,
             'stats': {
                 'total_logs': total_logs,
                 'recent_24h': recent_count,
                 'by_event_type': {item[0]: item[1] for item in event_counts},
-                'by_status': {item[0]: item[1] for item in status_counts}
+                'by_status': {item[0]: item[1] for item in status_counts},
+                'by_relying_party_24h': by_relying_party
             }
         })
     
@@ -816,7 +1065,8 @@ def attach_localhost_route():
 def detach_localhost_route():
     """Detach virtual FIDO device from localhost"""
     try:
-        result = detach_from_localhost()
+        # Only the main device; pool instances are detached per instance
+        result = detach_from_localhost(FIDO_USBIP_PORT)
         
         if result['success']:
             log_fido_event('localhost_detach', 'success', details=result.get('message'))
@@ -852,3 +1102,297 @@ def localhost_status_route():
             'success': False,
             'message': f"Error: {str(e)}"
         }), 500
+
+
+# ----------------------------------------------------------------------
+# Device pool (additional authenticators for parallel test runs)
+
+def _get_instance_or_404(instance_id):
+    instance = db.session.get(FidoInstance, instance_id)
+    if instance is None:
+        return None, (jsonify({'success': False, 'message': f'Instance {instance_id} not found'}), 404)
+    return instance, None
+
+
+@fido_bp.route('/pool')
+@login_required
+def pool_page():
+    """Device pool management page"""
+    try:
+        return render_template('fido_pool.html', instances=list_instance_statuses(),
+                               binary_exists=check_fido_binary())
+    except Exception as e:
+        logger.error(f"Error loading FIDO pool page: {e}")
+        flash(f"Error loading FIDO pool page: {str(e)}", "danger")
+        return redirect(url_for('fido.device_page'))
+
+
+@fido_bp.route('/instances', methods=['GET'])
+@login_required
+def list_instances_route():
+    """List pool instances with live status"""
+    instances = list_instance_statuses()
+    return jsonify({'success': True, 'instances': instances, 'count': len(instances)})
+
+
+@fido_bp.route('/instances', methods=['POST'])
+@login_required
+def create_instance_route():
+    """Create a pool instance (name, passphrase, port and auto_start are optional)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        port = int(data['port']) if data.get('port') else None
+        instance = get_fido_pool().create_instance(
+            name=(data.get('name') or '').strip() or None,
+            passphrase=data.get('passphrase') or None,
+            port=port,
+            auto_start=bool(data.get('auto_start'))
+        )
+    except (ValueError, RuntimeError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    log_instance_event(instance, 'instance_create', 'success', port=instance.port)
+    return jsonify({'success': True, 'instance': get_fido_pool().status(instance)})
+
+
+@fido_bp.route('/instances/<int:instance_id>', methods=['DELETE'])
+@login_required
+def delete_instance_route(instance_id):
+    """Stop and delete a pool instance with its vault"""
+    instance, error = _get_instance_or_404(instance_id)
+    if error:
+        return error
+    name = instance.name
+    result = get_fido_pool().delete_instance(instance)
+    log_fido_event('instance_delete', 'success', details=json.dumps({'instance': name}))
+    return jsonify(result)
+
+
+@fido_bp.route('/instances/<int:instance_id>/status', methods=['GET'])
+@login_required
+def instance_status_route(instance_id):
+    """Live status of a pool instance"""
+    instance, error = _get_instance_or_404(instance_id)
+    if error:
+        return error
+    return jsonify({'success': True, 'instance': get_fido_pool().status(instance)})
+
+
+@fido_bp.route('/instances/<int:instance_id>/<action>', methods=['POST'])
+@login_required
+def instance_action_route(instance_id, action):
+    """Start, stop, attach or detach a pool instance"""
+    instance, error = _get_instance_or_404(instance_id)
+    if error:
+        return error
+    pool = get_fido_pool()
+    actions = {
+        'start': pool.start,
+        'stop': pool.stop,
+        'attach': pool.attach,
+        'detach': pool.detach
+    }
+    if action not in actions:
+        return jsonify({'success': False, 'message': f'Unknown action: {action}'}), 404
+    try:
+        result = actions[action](instance)
+    except Exception as e:
+        logger.error(f"Error in FIDO instance {action}: {e}")
+        result = {'success': False, 'error': str(e)}
+    if result.get('success'):
+        log_instance_event(instance, f'instance_{action}', 'success', pid=result.get('pid'),
+                           ready_ms=result.get('ready_ms'), attach_ms=result.get('attach_ms'))
+    else:
+        log_instance_event(instance, f'instance_{action}', 'failed', error=result.get('error'))
+        result['message'] = result.get('error')
+    result['instance'] = pool.status(instance)
+    return jsonify(result), 200 if result.get('success') else 500
+
+
+@fido_bp.route('/instances/<int:instance_id>/output', methods=['GET'])
+@login_required
+def instance_output_route(instance_id):
+    """Buffered output of a pool instance (poll with ?since=<last_seq>)"""
+    instance, error = _get_instance_or_404(instance_id)
+    if error:
+        return error
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', 500, type=int)
+    result = get_fido_pool().output(instance, since, limit)
+    result['success'] = True
+    return jsonify(result)
+
+
+@fido_bp.route('/instances/<int:instance_id>/logs', methods=['GET'])
+@login_required
+def instance_logs_route(instance_id):
+    """FidoLog events of a pool instance"""
+    instance, error = _get_instance_or_404(instance_id)
+    if error:
+        return error
+    limit = request.args.get('limit', 50, type=int)
+    logs = FidoLog.query.filter(
+        FidoLog.event_type.like('instance_%'),
+        FidoLog.details.like('{"instance": ' + json.dumps(instance.name) + '%')
+    ).order_by(FidoLog.timestamp.desc()).limit(limit).all()
+    return jsonify({'success': True, 'logs': [log.to_dict() for log in logs], 'count': len(logs)})
+
+
+@fido_bp.route('/instances/<int:instance_id>/credentials', methods=['GET'])
+@login_required
+def instance_credentials_route(instance_id):
+    """Credentials in the vault of a pool instance"""
+    instance, error = _get_instance_or_404(instance_id)
+    if error:
+        return error
+    result = get_fido_pool().credentials(instance)
+    if not result.get('success'):
+        return jsonify({'success': False, 'message': result.get('error'), 'credentials': [], 'count': 0})
+    return jsonify(result)
+
+
+@fido_bp.route('/instances/acquire', methods=['POST'])
+@login_required
+def acquire_instance_route():
+    """
+    Lease a free instance to a test job
+    
+    JSON body: holder (job ID, required), ttl (seconds), create (grow the pool if needed)
+    """
+    data = request.get_json(silent=True) or {}
+    holder = (data.get('holder') or '').strip()
+    if not holder:
+        return jsonify({'success': False, 'message': 'holder is required'}), 400
+    try:
+        ttl = int(data.get('ttl') or DEFAULT_LEASE_TTL)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'ttl must be a number of seconds'}), 400
+    result = get_fido_pool().acquire(holder, ttl=ttl, create=data.get('create', True) is not False)
+    if not result['success']:
+        result['message'] = result.get('error')
+        return jsonify(result), 503
+    return jsonify(result)
+
+
+@fido_bp.route('/instances/<int:instance_id>/renew', methods=['POST'])
+@login_required
+def renew_instance_route(instance_id):
+    """Extend the lease of a test job"""
+    instance, error = _get_instance_or_404(instance_id)
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    try:
+        ttl = int(data.get('ttl') or DEFAULT_LEASE_TTL)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'ttl must be a number of seconds'}), 400
+    result = get_fido_pool().renew(instance, data.get('holder') or '', ttl)
+    if not result['success']:
+        result['message'] = result.get('error')
+        return jsonify(result), 409
+    return jsonify(result)
+
+
+@fido_bp.route('/instances/<int:instance_id>/release', methods=['POST'])
+@login_required
+def release_instance_route(instance_id):
+    """Return a leased instance to the pool (holder omitted: force release)"""
+    instance, error = _get_instance_or_404(instance_id)
+    if error:
+        return error
+    data = request.get_json(silent=True) or {}
+    result = get_fido_pool().release(instance, data.get('holder') or None, reset=bool(data.get('reset')))
+    if not result['success']:
+        result['message'] = result.get('error')
+        return jsonify(result), 409
+    return jsonify(result)
+
+
+def init_fido_supervisor(app):
+    """
+    Connect the device supervisor to the database and start the device
+    on application startup if auto-start is enabled
+    """
+    def on_exit(exit_code, restarting):
+        with app.app_context():
+            try:
+                device = FidoDevice.query.first()
+                if device:
+                    device.last_error = f"Device exited with code {exit_code}"
+                    if not restarting:
+                        device.is_running = False
+                        device.pid = None
+                        device.stopped_at = datetime.utcnow()
+                db.session.add(FidoLog(
+                    event_type='device_crash',
+                    status='failed',
+                    details=f"Exit code: {exit_code}" + ("; restarting" if restarting else "")
+                ))
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Failed to record FIDO device exit: {e}")
+                db.session.rollback()
+
+    get_fido_supervisor().add_exit_handler(on_exit)
+    metrics_registry.add_section('fido', fido_metrics_state)
+    start_event_recorder(app, get_fido_supervisor())
+    init_fido_pool(app)
+
+    with app.app_context():
+        try:
+            device = FidoDevice.query.first()
+            if not device or not device.auto_start or not check_fido_binary():
+                return
+            if get_fido_status()['is_running']:
+                return
+            result = start_fido_device(auto_restart=True)
+            if result['success']:
+                device.is_running = True
+                device.pid = result.get('pid')
+                device.started_at = datetime.utcnow()
+                device.last_error = None
+                logger.info(f"FIDO device auto-started, PID: {result.get('pid')}")
+            else:
+                device.last_error = result.get('error')
+                logger.error(f"FIDO device auto-start failed: {result.get('error')}")
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Error during FIDO device auto-start: {e}")
+            db.session.rollback()
+
+
+def init_backup_scheduler(app):
+    """Start the periodic vault backup job (skipped for an unchanged vault)"""
+    from fido_backup import BackupScheduler, BACKUP_INTERVAL_HOURS
+    
+    if BACKUP_INTERVAL_HOURS <= 0:
+        logger.info("Scheduled vault backups are disabled")
+        return None
+    
+    def job():
+        with app.app_context():
+            from fido_utils import get_vault_path
+            import os
+            
+            if not os.path.exists(get_vault_path()):
+                return
+            result = backup_vault(kind='scheduled')
+            if not result.get('success'):
+                status, details = 'failed', result.get('error')
+            elif result.get('skipped'):
+                return
+            else:
+                status = 'success'
+                details = f"Scheduled backup: {result.get('filename')}"
+                if result.get('pruned'):
+                    details += f", pruned {len(result['pruned'])}"
+            try:
+                db.session.add(FidoLog(event_type='vault_backup', status=status, details=details))
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Failed to log scheduled backup: {e}")
+                db.session.rollback()
+    
+    scheduler = BackupScheduler(job)
+    scheduler.start()
+    logger.info(f"Scheduled vault backups every {BACKUP_INTERVAL_HOURS:g} h")
+    return scheduler
@@ -0,0 +1,427 @@
+"""
+FIDO2 Virtual Device Supervisor
+Owns the virtual-fido child process: drains its output, tracks the PID and
+restarts the device with backoff when auto-start is enabled
+"""
+
+import os
+import fcntl
+import signal
+import subprocess
+import threading
+import time
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from fido_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Number of output lines kept in memory
+OUTPUT_BUFFER_LINES = 2000
+
+# Restart backoff (seconds): doubles after each crash up to the maximum
+RESTART_BACKOFF_INITIAL = 1.0
+RESTART_BACKOFF_MAX = 60.0
+
+# A process that stayed up this long is considered healthy and resets the backoff
+RESTART_BACKOFF_RESET_AFTER = 60.0
+
+# How long to wait for the device to exit after SIGTERM before sending SIGKILL
+STOP_TIMEOUT = 5.0
+
+# How long a fresh process must survive to count as started
+STARTUP_GRACE_PERIOD = 0.5
+
+
+def format_uptime(seconds: float) -> str:
+    """Format uptime like `ps -o etime` ([[DD-]HH:]MM:SS)"""
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}-{hours:02d}:{minutes:02d}:{seconds:02d}"
+    if hours:
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+def read_pidfile(path: str) -> Optional[int]:
+    """Read PID from pidfile, None if missing or invalid"""
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def is_fido_process(pid: int) -> bool:
+    """Check through /proc that PID is alive and is a virtual-fido device process"""
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            argv = f.read().split(b'\0')
+    except OSError:
+        return False
+    # argv[0] may be an interpreter when the device is a wrapper script
+    return any(b'virtual-fido' in arg for arg in argv[:2]) and b'start' in argv[1:]
+
+
+class FidoSupervisor:
+    """
+    Supervisor for a single virtual-fido process.
+
+    Status is answered from memory for the process owned by this supervisor;
+    a device started by another worker or an earlier app instance is found
+    through the pidfile and /proc without spawning any helper processes.
+    """
+
+    def __init__(self, pidfile: str, buffer_lines: int = OUTPUT_BUFFER_LINES):
+        self.pidfile = pidfile
+        self._lock = threading.RLock()
+        self._process: Optional[subprocess.Popen] = None
+        self._cmd: Optional[List[str]] = None
+        self._env: Optional[Dict[str, str]] = None
+        self._started_at: Optional[float] = None
+        self._want_running = False
+        self._auto_restart = False
+        self._starting: Optional[subprocess.Popen] = None
+        self._backoff = RESTART_BACKOFF_INITIAL
+        self._restart_count = 0
+        self._last_exit_code: Optional[int] = None
+        self._ready_ms: Optional[float] = None
+        self._output = deque(maxlen=buffer_lines)
+        self._output_seq = 0
+        self._spawn_seq = 0
+        self._output_cond = threading.Condition()
+        self._line_handlers = []
+        self._exit_handlers = []
+
+    # ------------------------------------------------------------------
+    # Hooks
+
+    def add_line_handler(self, handler) -> None:
+        """Register callback(stream, line) called for every output line"""
+        self._line_handlers.append(handler)
+
+    def add_exit_handler(self, handler) -> None:
+        """Register callback(exit_code, restarting) called when the device exits unexpectedly"""
+        self._exit_handlers.append(handler)
+
+    # ------------------------------------------------------------------
+    # Process management
+
+    def _spawn(self) -> subprocess.Popen:
+        process = subprocess.Popen(
+            self._cmd,
+            env=dict(os.environ, **self._env) if self._env else None,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+        self._process = process
+        self._started_at = time.time()
+        with self._output_cond:
+            self._spawn_seq = self._output_seq
+
+        try:
+            with open(self.pidfile, 'w') as f:
+                f.write(str(process.pid))
+        except OSError as e:
+            logger.warning(f"Could not write FIDO pidfile {self.pidfile}: {e}")
+
+        for stream_name, stream in (('stdout', process.stdout), ('stderr', process.stderr)):
+            threading.Thread(
+                target=self._drain, args=(stream_name, stream),
+                name=f'fido-{stream_name}-{process.pid}', daemon=True
+            ).start()
+        threading.Thread(
+            target=self._monitor, args=(process,),
+            name=f'fido-monitor-{process.pid}', daemon=True
+        ).start()
+        return process
+
+    def _drain(self, stream_name: str, stream) -> None:
+        """Read a pipe until EOF so the device never blocks on a full pipe buffer"""
+        for raw in iter(stream.readline, b''):
+            line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+            with self._output_cond:
+                self._output_seq += 1
+                self._output.append((self._output_seq, time.time(), stream_name, line))
+                self._output_cond.notify_all()
+            for handler in self._line_handlers:
+                try:
+                    handler(stream_name, line)
+                except Exception as e:
+                    logger.error(f"FIDO output handler failed: {e}")
+        stream.close()
+
+    def _monitor(self, process: subprocess.Popen) -> None:
+        """Wait for the process to exit and restart it if required"""
+        exit_code = process.wait()
+
+        with self._lock:
+            if self._process is not process:
+                return
+            self._last_exit_code = exit_code
+            uptime = time.time() - (self._started_at or time.time())
+            self._process = None
+            self._started_at = None
+            self._remove_pidfile(process.pid)
+
+            if process is self._starting:
+                # Died during startup: start() reports the error, no restart
+                self._want_running = False
+                return
+
+            restarting = self._want_running and self._auto_restart
+            if not self._want_running:
+                return
+            if not restarting:
+                self._want_running = False
+
+            if uptime >= RESTART_BACKOFF_RESET_AFTER:
+                self._backoff = RESTART_BACKOFF_INITIAL
+            delay = self._backoff
+
+        logger.warning(f"FIDO device exited unexpectedly (code {exit_code})"
+                       + (f", restarting in {delay:.0f}s" if restarting else ""))
+        for handler in self._exit_handlers:
+            try:
+                handler(exit_code, restarting)
+            except Exception as e:
+                logger.error(f"FIDO exit handler failed: {e}")
+
+        if restarting:
+            time.sleep(delay)
+            with self._lock:
+                if not self._want_running or self._process is not None:
+                    return
+                self._backoff = min(self._backoff * 2, RESTART_BACKOFF_MAX)
+                self._restart_count += 1
+                try:
+                    process = self._spawn()
+                    logger.info(f"FIDO device restarted, PID: {process.pid}")
+                except OSError as e:
+                    self._want_running = False
+                    logger.error(f"Failed to restart FIDO device: {e}")
+
+    def _remove_pidfile(self, pid: int) -> None:
+        if read_pidfile(self.pidfile) == pid:
+            try:
+                os.remove(self.pidfile)
+            except OSError:
+                pass
+
+    def _foreign_pid(self) -> Optional[int]:
+        """PID of a device process not owned by this supervisor (from pidfile)"""
+        pid = read_pidfile(self.pidfile)
+        if pid and is_fido_process(pid):
+            return pid
+        return None
+
+    @metrics.timed('start')
+    def start(self, cmd: List[str], auto_restart: bool = False, env: Optional[Dict[str, str]] = None,
+              ready: Optional[Callable[[Callable[[], bool]], Dict]] = None) -> Dict:
+        """
+        Start the device process
+
+        Args:
+            cmd: Command line of the device process
+            auto_restart: Restart the process with backoff if it exits unexpectedly
+            env: Extra environment variables for the process
+            ready: Readiness check called with an is_alive callback; returns a dict
+                with 'ready' and 'elapsed_ms'. Without it the process only has to
+                survive STARTUP_GRACE_PERIOD.
+
+        Returns:
+            Dict with success status, pid, and message
+        """
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                return {
+                    'success': False,
+                    'error': 'FIDO device is already running',
+                    'pid': self._process.pid
+                }
+            # Lock so that several workers starting the device at once spawn only one process
+            with open(self.pidfile + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                foreign_pid = self._foreign_pid()
+                if foreign_pid:
+                    return {
+                        'success': False,
+                        'error': 'FIDO device is already running',
+                        'pid': foreign_pid
+                    }
+
+                self._cmd = cmd
+                self._env = env
+                self._want_running = True
+                self._auto_restart = auto_restart
+                self._backoff = RESTART_BACKOFF_INITIAL
+                self._restart_count = 0
+                self._last_exit_code = None
+                process = self._spawn()
+                self._starting = process
+
+        if ready is not None:
+            readiness = ready(lambda: process.poll() is None)
+            exit_code = process.poll()
+            if readiness.get('ready'):
+                with self._lock:
+                    if self._starting is process:
+                        self._starting = None
+                    self._ready_ms = readiness.get('elapsed_ms')
+                return {'success': True, 'pid': process.pid, 'ready_ms': readiness.get('elapsed_ms')}
+            if exit_code is None:
+                # Alive but not answering: do not leave a half-started device behind
+                self.stop()
+                return {
+                    'success': False,
+                    'error': f"Device did not become ready within {readiness.get('elapsed_ms')} ms: {readiness.get('error')}",
+                    'stdout': self.wait_for_output_eof(process)
+                }
+        else:
+            try:
+                exit_code = process.wait(timeout=STARTUP_GRACE_PERIOD)
+            except subprocess.TimeoutExpired:
+                with self._lock:
+                    if self._starting is process:
+                        self._starting = None
+                    self._ready_ms = None
+                return {'success': True, 'pid': process.pid}
+
+        # Died during startup: the monitor does not restart it, report its output instead
+        output = self.wait_for_output_eof(process)
+        return {
+            'success': False,
+            'error': f'Failed to start (exit code {exit_code}): ' + (output or 'Unknown error'),
+            'stdout': output
+        }
+
+    def wait_for_output_eof(self, process: subprocess.Popen, timeout: float = 1.0) -> str:
+        """Collect the last output lines of an exited process"""
+        deadline = time.time() + timeout
+        while time.time() < deadline and not (process.stdout.closed and process.stderr.closed):
+            time.sleep(0.02)
+        with self._output_cond:
+            lines = [line for seq, _, _, line in self._output if seq > self._spawn_seq]
+        return '\n'.join(lines[-20:])
+
+    @metrics.timed('stop')
+    def stop(self, timeout: float = STOP_TIMEOUT) -> Dict:
+        """
+        Stop the device process (SIGTERM, then SIGKILL after timeout)
+
+        Returns:
+            Dict with success status and message
+        """
+        with self._lock:
+            self._want_running = False
+            process = self._process
+
+        if process is not None and process.poll() is None:
+            pid = process.pid
+            try:
+                os.killpg(pid, signal.SIGTERM)
+                try:
+                    process.wait(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    logger.warning(f"FIDO device did not exit in {timeout}s, killing (PID: {pid})")
+                    os.killpg(pid, signal.SIGKILL)
+                    process.wait(timeout=timeout)
+            except ProcessLookupError:
+                pass
+            except (OSError, subprocess.TimeoutExpired) as e:
+                return {'success': False, 'error': f'Failed to stop process {pid}: {e}'}
+            return {'success': True, 'message': f'FIDO device stopped (PID: {pid})', 'pid': pid}
+
+        # Device started by another worker or a previous app instance
+        pid = self._foreign_pid()
+        if pid is None:
+            return {'success': True, 'message': 'FIDO device was not running', 'was_running': False}
+        try:
+            os.kill(pid, signal.SIGTERM)
+            deadline = time.time() + timeout
+            while is_fido_process(pid) and time.time() < deadline:
+                time.sleep(0.05)
+            if is_fido_process(pid):
+                os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        except OSError as e:
+            return {'success': False, 'error': f'Failed to kill process {pid}: {e}'}
+        self._remove_pidfile(pid)
+        return {'success': True, 'message': f'FIDO device stopped (PID: {pid})', 'pid': pid}
+
+    # ------------------------------------------------------------------
+    # Status and output
+
+    def status(self) -> Dict:
+        """
+        Get device status from memory (or pidfile + /proc for a foreign process)
+
+        Returns:
+            Dict with running status, pid, uptime
+        """
+        with self._lock:
+            process = self._process
+            if process is not None and process.poll() is None:
+                return {
+                    'is_running': True,
+                    'pid': process.pid,
+                    'uptime': format_uptime(time.time() - self._started_at),
+                    'started_at': datetime.utcfromtimestamp(self._started_at).isoformat(),
+                    'supervised': True,
+                    'auto_restart': self._auto_restart,
+                    'restart_count': self._restart_count,
+                    'last_exit_code': self._last_exit_code,
+                    'ready_ms': self._ready_ms
+                }
+            restarting = self._want_running and self._auto_restart
+            last_exit_code = self._last_exit_code
+            restart_count = self._restart_count
+
+        pid = self._foreign_pid()
+        if pid:
+            try:
+                started = os.stat(self.pidfile).st_mtime
+                uptime = format_uptime(time.time() - started)
+            except OSError:
+                uptime = 'unknown'
+            return {
+                'is_running': True,
+                'pid': pid,
+                'uptime': uptime,
+                'supervised': False
+            }
+
+        return {
+            'is_running': False,
+            'pid': None,
+            'uptime': None,
+            'restarting': restarting,
+            'restart_count': restart_count,
+            'last_exit_code': last_exit_code
+        }
+
+    def output(self, since: int = 0, limit: Optional[int] = None) -> Dict:
+        """
+        Get buffered output lines with sequence number greater than `since`
+
+        Returns:
+            Dict with lines and the last sequence number
+        """
+        with self._output_cond:
+            lines = [
+                {'seq': seq, 'time': datetime.utcfromtimestamp(ts).isoformat(), 'stream': stream, 'line': line}
+                for seq, ts, stream, line in self._output if seq > since
+            ]
+            last_seq = self._output_seq
+        if limit:
+            lines = lines[-limit:]
+        return {'lines': lines, 'last_seq': last_seq}
@@ -7,9 +7,27 @@ import subprocess
 import os
 import json
 import re
+import hashlib
 import logging
+import threading
+import time
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
+
+from fido_supervisor import FidoSupervisor
+from fido_readiness import (
+    wait_until_ready,
+    find_usbip_command,
+    ensure_vhci_loaded,
+    find_import,
+    wait_for_import,
+    ATTACH_TIMEOUT
+)
+import fido_backup
+import fido_vault
+from fido_config import FidoConfig
+from fido_metrics import metrics
+from fido_vault import VaultError, is_native_vault_supported
 
 logger = logging.getLogger(__name__)
 
@@ -69,23 +87,45 @@ FIDO_VAULT_PATH = os.environ.get(
     os.path.join(FIDO_DATA_DIR, 'vault.json')
 )
 
+# Cached credential listings: real vault path -> (cache key, credentials)
+_credential_cache = {}
+_credential_cache_lock = threading.Lock()
+
+# Pidfile of the running device (lets other workers find the supervised process)
+FIDO_PID_FILE = os.path.join(FIDO_DATA_DIR, 'virtual-fido.pid')
+
+# USB/IP server of the device (virtual-fido/usbip/usbip_server.go, VIRTUAL_FIDO_PORT overrides the port)
+FIDO_USBIP_PORT = 3241
+FIDO_BUS_ID = '2-2'
+
+_supervisor = None
+
+# Passphrase and vault path shared by all workers (fido_settings table);
+# the environment variables above only provide the defaults
+_config = FidoConfig(os.path.join(FIDO_DATA_DIR, '.config_version'))
+
+
+def _on_config_change(changed: Dict) -> None:
+    invalidate_credential_cache()
+    logger.info(f"FIDO configuration changed: {', '.join(sorted(changed))}")
+
+
+_config.on_change(_on_config_change)
+
 
 def get_fido_passphrase() -> str:
     """
-    Get FIDO passphrase from environment variable or use default
+    Get FIDO passphrase from the shared configuration
     
     Returns:
-        Current passphrase (from env or default)
+        Current passphrase (from settings, env or default)
     """
-    return os.environ.get(PASSPHRASE_ENV_VAR, DEFAULT_PASSPHRASE)
+    return _config.get('passphrase', os.environ.get(PASSPHRASE_ENV_VAR, DEFAULT_PASSPHRASE))
 
 
 def set_fido_passphrase(new_passphrase: str) -> Dict:
     """
-    Set FIDO passphrase in environment variable
-    
-    NOTE: Environment variable changes are only valid for current process.
-    For permanent storage, add to .env file or system environment.
+    Set FIDO passphrase for all workers (stored in the fido_settings table)
     
     Args:
         new_passphrase: New passphrase to set
@@ -100,9 +140,8 @@ def set_fido_passphrase(new_passphrase: str) -> Dict:
                 'error': 'Passphrase must be at least 8 characters long'
             }
         
-        # Set environment variable
-        os.environ[PASSPHRASE_ENV_VAR] = new_passphrase
-        logger.info("FIDO passphrase updated in environment")
+        _config.set('passphrase', new_passphrase)
+        logger.info("FIDO passphrase updated")
         
         return {
             'success': True,
@@ -118,17 +157,17 @@ def set_fido_passphrase(new_passphrase: str) -> Dict:
 
 def get_vault_path() -> str:
     """
-    Get current vault path from environment variable or use default
+    Get current vault path from the shared configuration
     
     Returns:
-        Current vault path
+        Current vault path (from settings, env or default)
     """
-    return os.environ.get(VAULT_PATH_ENV_VAR, FIDO_VAULT_PATH)
+    return _config.get('vault_path', FIDO_VAULT_PATH)
 
 
 def set_vault_path(new_path: str) -> Dict:
     """
-    Set vault path in environment variable
+    Set vault path for all workers (stored in the fido_settings table)
     
     Args:
         new_path: New vault file path
@@ -149,8 +188,7 @@ def set_vault_path(new_path: str) -> Dict:
             os.makedirs(vault_dir, exist_ok=True)
             logger.info(f"Created vault directory: {vault_dir}")
         
-        # Set environment variable
-        os.environ[VAULT_PATH_ENV_VAR] = new_path
+        _config.set('vault_path', new_path)
         logger.info(f"Vault path updated to: {new_path}")
         
         return {
@@ -177,6 +215,9 @@ def get_backup_history() -> Dict:
     """
     Get list of all backup files with metadata
     
+    Reads the backup manifest (cached until it changes) instead of scanning
+    the backup directory.
+    
     Returns:
         Dict with success status and list of backups
     """
@@ -184,30 +225,22 @@ def get_backup_history() -> Dict:
         backup_dir = get_backup_directory()
         backups = []
         
-        # Find all backup files
-        for filename in os.listdir(backup_dir):
-            if filename.startswith('vault_backup_') and filename.endswith('.json'):
-                filepath = os.path.join(backup_dir, filename)
-                stat_info = os.stat(filepath)
-                
-                # Extract timestamp from filename (format: vault_backup_YYYYMMDD_HHMMSS.json)
-                timestamp_str = filename.replace('vault_backup_', '').replace('.json', '')
-                try:
-                    created_at = datetime.strptime(timestamp_str, '%Y%m%d_%H%M%S')
-                except ValueError:
-                    created_at = datetime.fromtimestamp(stat_info.st_mtime)
-                
-                backups.append({
-                    'filename': filename,
-                    'filepath': filepath,
-                    'size': stat_info.st_size,
-                    'size_mb': round(stat_info.st_size / 1024 / 1024, 2),
-                    'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    'timestamp': created_at.isoformat()
-                })
+        for snapshot in fido_backup.load_manifest(backup_dir)['snapshots']:
+            created_at = datetime.fromisoformat(snapshot['created_at'])
+            backups.append({
+                'filename': snapshot['name'],
+                'filepath': os.path.join(backup_dir, snapshot['object']),
+                'size': snapshot['size'],
+                'size_mb': round(snapshot['size'] / 1024 / 1024, 2),
+                'stored_size': snapshot['stored_size'],
+                'sha256': snapshot['sha256'],
+                'kind': snapshot.get('kind', 'manual'),
+                'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                'timestamp': created_at.isoformat()
+            })
         
         # Sort by creation date (newest first)
-        backups.sort(key=lambda x: x['timestamp'], reverse=True)
+        backups.reverse()
         
         return {
             'success': True,
@@ -231,14 +264,24 @@ def check_fido_binary() -> bool:
     return os.path.isfile(FIDO_BINARY) and os.access(FIDO_BINARY, os.X_OK)
 
 
-def start_fido_device(passphrase: Optional[str] = None, vault_path: Optional[str] = None, verbose: bool = False) -> Dict:
+def get_fido_supervisor() -> FidoSupervisor:
+    """Get the process-wide supervisor of the virtual-fido device"""
+    global _supervisor
+    if _supervisor is None:
+        _supervisor = FidoSupervisor(FIDO_PID_FILE)
+    return _supervisor
+
+
+def start_fido_device(passphrase: Optional[str] = None, vault_path: Optional[str] = None, verbose: bool = False,
+                      auto_restart: bool = False) -> Dict:
     """
-    Start virtual FIDO2 device
+    Start virtual FIDO2 device under the supervisor
     
     Args:
         passphrase: Vault passphrase (default: 'passphrase')
-        vault_path: Path to vault file (default: FIDO_VAULT_PATH)
+        vault_path: Path to vault file (default: get_vault_path())
         verbose: Enable verbose logging
+        auto_restart: Restart the device with backoff if it exits unexpectedly
     
     Returns:
         Dict with success status, pid, and message
@@ -250,8 +293,6 @@ def start_fido_device(passphrase: Optional[str] = None, vault_path: Optional[str
         }
     
     try:
-        import time
-        
         cmd = [FIDO_BINARY, 'start']
         
         if passphrase:
@@ -259,45 +300,32 @@ def start_fido_device(passphrase: Optional[str] = None, vault_path: Optional[str
         else:
             cmd.extend(['--passphrase', get_fido_passphrase()])
         
-        if vault_path:
-            cmd.extend(['--vault', vault_path])
-        else:
-            cmd.extend(['--vault', FIDO_VAULT_PATH])
+        vault_path = vault_path or get_vault_path()
+        cmd.extend(['--vault', vault_path])
         
         if verbose:
             cmd.append('--verbose')
         
-        logger.info(f"Starting FIDO device: {' '.join(cmd)}")
+        logger.info(f"Starting FIDO device: {FIDO_BINARY} start --vault {vault_path}")
         
-        # Start process in background
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            start_new_session=True
+        # Started means the USB/IP server answers, not just that the process is alive
+        result = get_fido_supervisor().start(
+            cmd, auto_restart=auto_restart,
+            ready=lambda is_alive: wait_until_ready(FIDO_USBIP_PORT, FIDO_BUS_ID, is_alive=is_alive)
         )
         
-        # Give it a moment to start
-        time.sleep(0.5)
-        
-        # Check if process is still running
-        if process.poll() is None:
-            logger.info(f"FIDO device started successfully, PID: {process.pid}")
+        if result['success']:
+            logger.info(f"FIDO device ready in {result.get('ready_ms')} ms, PID: {result['pid']}")
             return {
                 'success': True,
-                'pid': process.pid,
+                'pid': result['pid'],
                 'message': 'FIDO device started successfully',
-                'vault_path': vault_path or FIDO_VAULT_PATH
+                'vault_path': vault_path,
+                'ready_ms': result.get('ready_ms')
             }
         else:
-            stdout, stderr = process.communicate()
-            error_msg = stderr.decode('utf-8') if stderr else 'Unknown error'
-            logger.error(f"FIDO device failed to start: {error_msg}")
-            return {
-                'success': False,
-                'error': f'Failed to start: {error_msg}',
-                'stdout': stdout.decode('utf-8') if stdout else ''
-            }
+            logger.error(f"FIDO device failed to start: {result['error']}")
+            return result
     
     except Exception as e:
         logger.exception("Error starting FIDO device")
@@ -315,34 +343,10 @@ def stop_fido_device() -> Dict:
         Dict with success status and message
     """
     try:
-        find_cmd = ['pgrep', '-f', 'virtual-fido.*start']
-        result = subprocess.run(find_cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0 and result.stdout.strip():
-            pid = result.stdout.strip().split('\n')[0]
-            
-            kill_cmd = ['kill', pid]
-            kill_result = subprocess.run(kill_cmd, capture_output=True, text=True)
-            
-            if kill_result.returncode == 0:
-                logger.info(f"FIDO device stopped (PID: {pid})")
-                return {
-                    'success': True,
-                    'message': f'FIDO device stopped (PID: {pid})',
-                    'pid': pid
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': f'Failed to kill process {pid}: {kill_result.stderr}'
-                }
-        else:
-            logger.warning("FIDO device not running")
-            return {
-                'success': True,
-                'message': 'FIDO device was not running',
-                'was_running': False
-            }
+        result = get_fido_supervisor().stop()
+        if result['success']:
+            logger.info(result['message'])
+        return result
     
     except Exception as e:
         logger.exception("Error stopping FIDO device")
@@ -354,36 +358,16 @@ def stop_fido_device() -> Dict:
 
 def get_fido_status() -> Dict:
     """
-    Get virtual FIDO2 device status
+    Get virtual FIDO2 device status (answered by the supervisor without forking)
     
     Returns:
         Dict with running status, pid, uptime
     """
     try:
-        # Check if process is running
-        cmd = ['pgrep', '-f', 'virtual-fido.*start']
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0 and result.stdout.strip():
-            pid = result.stdout.strip().split('\n')[0]
-            
-            # Get process start time (uptime)
-            ps_cmd = ['ps', '-p', pid, '-o', 'etime=']
-            ps_result = subprocess.run(ps_cmd, capture_output=True, text=True)
-            uptime = ps_result.stdout.strip() if ps_result.returncode == 0 else 'unknown'
-            
-            return {
-                'is_running': True,
-                'pid': int(pid),
-                'uptime': uptime,
-                'vault_path': FIDO_VAULT_PATH
-            }
-        else:
-            return {
-                'is_running': False,
-                'pid': None,
-                'uptime': None
-            }
+        status = get_fido_supervisor().status()
+        if status['is_running']:
+            status['vault_path'] = get_vault_path()
+        return status
     
     except Exception as e:
         logger.exception("Error getting FIDO status")
@@ -393,49 +377,111 @@ def get_fido_status() -> Dict:
         }
 
 
+def get_fido_output(since: int = 0, limit: Optional[int] = None) -> Dict:
+    """
+    Get output lines of the supervised device
+    
+    Args:
+        since: Return only lines with sequence number greater than this
+        limit: Maximum number of (most recent) lines
+    
+    Returns:
+        Dict with lines and last sequence number
+    """
+    return get_fido_supervisor().output(since, limit)
+
+
+def _credential_cache_key(vault_path: str, passphrase: str) -> Optional[Tuple]:
+    """
+    Cache key of a vault listing: file identity and version plus passphrase hash.
+    Returns None if the vault file does not exist (nothing to cache).
+    """
+    try:
+        st = os.stat(vault_path)
+    except OSError:
+        return None
+    passphrase_hash = hashlib.sha256(passphrase.encode('utf-8')).hexdigest()
+    return (os.path.realpath(vault_path), st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size, passphrase_hash)
+
+
+def invalidate_credential_cache(vault_path: Optional[str] = None) -> None:
+    """
+    Drop cached credential listings
+    
+    Args:
+        vault_path: Vault whose listing to drop (default: all vaults)
+    """
+    with _credential_cache_lock:
+        if vault_path is None:
+            _credential_cache.clear()
+        else:
+            _credential_cache.pop(os.path.realpath(vault_path), None)
+
+
+@metrics.timed('list')
 def list_fido_credentials(passphrase: Optional[str] = None, vault_path: Optional[str] = None) -> Dict:
     """
     List all credentials (identities) stored in vault
     
+    The vault is read natively (fido_vault) when the cryptography package is
+    available, otherwise through the virtual-fido binary. The listing is cached
+    until the vault file changes (inode, mtime or size), so repeated page views
+    do not decrypt the vault again.
+    
     Args:
         passphrase: Vault passphrase (default: DEFAULT_PASSPHRASE)
-        vault_path: Path to vault file (default: FIDO_VAULT_PATH)
+        vault_path: Path to vault file (default: get_vault_path())
     
     Returns:
         Dict with success status and list of credentials
     """
-    if not check_fido_binary():
+    passphrase = passphrase or get_fido_passphrase()
+    vault_path = vault_path or get_vault_path()
+    native = is_native_vault_supported()
+    
+    if not native and not check_fido_binary():
         return {
             'success': False,
             'error': f'FIDO binary not found at {FIDO_BINARY}'
         }
     
-    try:
-        cmd = [FIDO_BINARY, 'list']
-        
-        if passphrase:
-            cmd.extend(['--passphrase', passphrase])
-        else:
-            cmd.extend(['--passphrase', get_fido_passphrase()])
-        
-        if vault_path:
-            cmd.extend(['--vault', vault_path])
-        else:
-            cmd.extend(['--vault', FIDO_VAULT_PATH])
-        
-        logger.debug(f"Listing credentials: {' '.join(cmd)}")
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-        
-        if result.returncode != 0:
-            logger.error(f"Failed to list credentials: {result.stderr}")
+    cache_key = _credential_cache_key(vault_path, passphrase)
+    if cache_key is not None:
+        with _credential_cache_lock:
+            cached = _credential_cache.get(cache_key[0])
+        if cached and cached[0] == cache_key:
+            credentials = [dict(cred) for cred in cached[1]]
             return {
-                'success': False,
-                'error': result.stderr or 'Failed to list credentials'
+                'success': True,
+                'credentials': credentials,
+                'count': len(credentials),
+                'cached': True
             }
+    
+    try:
+        if native:
+            credentials = fido_vault.list_credentials(vault_path, passphrase)
+        else:
+            cmd = [FIDO_BINARY, 'list', '--passphrase', passphrase, '--vault', vault_path]
+            
+            logger.debug(f"Listing credentials: {FIDO_BINARY} list --vault {vault_path}")
+            
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+            
+            if result.returncode != 0:
+                logger.error(f"Failed to list credentials: {result.stderr}")
+                return {
+                    'success': False,
+                    'error': result.stderr or 'Failed to list credentials'
+                }
+            
+            # Parse output
+            credentials = parse_credential_list(result.stdout)
         
-        # Parse output
-        credentials = parse_credential_list(result.stdout)
+        # Cache only if the vault did not change while the listing was running
+        if cache_key is not None and cache_key == _credential_cache_key(vault_path, passphrase):
+            with _credential_cache_lock:
+                _credential_cache[cache_key[0]] = (cache_key, [dict(cred) for cred in credentials])
         
         logger.info(f"Found {len(credentials)} credentials")
         return {
@@ -444,6 +490,12 @@ def list_fido_credentials(passphrase: Optional[str] = None, vault_path: Optional
             'count': len(credentials)
         }
     
+    except VaultError as e:
+        logger.error(f"Failed to list credentials: {e}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
     except subprocess.TimeoutExpired:
         return {
             'success': False,
@@ -457,19 +509,24 @@ def list_fido_credentials(passphrase: Optional[str] = None, vault_path: Optional
         }
 
 
+@metrics.timed('delete')
 def delete_fido_credential(credential_id: str, passphrase: Optional[str] = None, vault_path: Optional[str] = None) -> Dict:
     """
     Delete a credential from vault
     
     Args:
-        credential_id: ID of credential to delete
+        credential_id: ID of credential to delete (full hex ID or unique prefix)
         passphrase: Vault passphrase (default: DEFAULT_PASSPHRASE)
-        vault_path: Path to vault file (default: FIDO_VAULT_PATH)
+        vault_path: Path to vault file (default: get_vault_path())
     
     Returns:
         Dict with success status and message
     """
-    if not check_fido_binary():
+    passphrase = passphrase or get_fido_passphrase()
+    vault_path = vault_path or get_vault_path()
+    native = is_native_vault_supported()
+    
+    if not native and not check_fido_binary():
         return {
             'success': False,
             'error': f'FIDO binary not found at {FIDO_BINARY}'
@@ -481,24 +538,29 @@ def delete_fido_credential(credential_id: str, passphrase: Optional[str] = None,
             'error': 'Credential ID is required'
         }
     
+    logger.info(f"Deleting credential: {credential_id}")
+    
     try:
-        cmd = [FIDO_BINARY, 'delete', credential_id]
-        
-        if passphrase:
-            cmd.extend(['--passphrase', passphrase])
-        else:
-            cmd.extend(['--passphrase', get_fido_passphrase()])
-        
-        if vault_path:
-            cmd.extend(['--vault', vault_path])
-        else:
-            cmd.extend(['--vault', FIDO_VAULT_PATH])
-        
-        logger.info(f"Deleting credential: {credential_id}")
+        if native:
+            removed, not_matched = fido_vault.delete_credentials(vault_path, passphrase, [credential_id])
+            if not removed:
+                return {
+                    'success': False,
+                    'error': f'No single credential matches {credential_id}'
+                }
+            logger.info(f"Credential deleted successfully: {removed[0]['credential_id']}")
+            return {
+                'success': True,
+                'message': f'Credential {credential_id} deleted successfully',
+                'credential_id': removed[0]['credential_id']
+            }
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        # Same lock as the native writer, so list/delete/restore never interleave
+        cmd = [FIDO_BINARY, 'delete', '--identity', credential_id, '--passphrase', passphrase, '--vault', vault_path]
+        with fido_vault.vault_lock(vault_path):
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
         
-        if result.returncode == 0:
+        if result.returncode == 0 and 'Done.' in result.stdout:
             logger.info(f"Credential deleted successfully: {credential_id}")
             return {
                 'success': True,
@@ -506,12 +568,18 @@ def delete_fido_credential(credential_id: str, passphrase: Optional[str] = None,
                 'credential_id': credential_id
             }
         else:
-            logger.error(f"Failed to delete credential: {result.stderr}")
+            logger.error(f"Failed to delete credential: {result.stderr or result.stdout}")
             return {
                 'success': False,
-                'error': result.stderr or 'Failed to delete credential'
+                'error': result.stderr or result.stdout or 'Failed to delete credential'
             }
     
+    except VaultError as e:
+        logger.error(f"Failed to delete credential: {e}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
     except subprocess.TimeoutExpired:
         return {
             'success': False,
@@ -523,6 +591,101 @@ def delete_fido_credential(credential_id: str, passphrase: Optional[str] = None,
             'success': False,
             'error': str(e)
         }
+    finally:
+        invalidate_credential_cache(vault_path)
+
+
+def delete_fido_credentials(credential_ids: Optional[List[str]] = None, rp_id: Optional[str] = None,
+                            allowed_ids: Optional[Set[str]] = None, passphrase: Optional[str] = None,
+                            vault_path: Optional[str] = None) -> Dict:
+    """
+    Delete several credentials at once
+    
+    All filters that are given must match. With the native vault support all
+    removals are applied in a single locked decrypt-modify-encrypt cycle; the
+    binary fallback has to delete the selected credentials one by one.
+    
+    Args:
+        credential_ids: Full hex IDs or unique prefixes
+        rp_id: Relying Party ID
+        allowed_ids: Full hex IDs the deletion is restricted to (e.g. selected by age)
+        passphrase: Vault passphrase (default: DEFAULT_PASSPHRASE)
+        vault_path: Path to vault file (default: get_vault_path())
+    
+    Returns:
+        Dict with success status, deleted credential records and IDs that were not found
+    """
+    passphrase = passphrase or get_fido_passphrase()
+    vault_path = vault_path or get_vault_path()
+    
+    if credential_ids is None and rp_id is None and allowed_ids is None:
+        return {
+            'success': False,
+            'error': 'At least one filter is required'
+        }
+    
+    def matches(record: Dict) -> bool:
+        if rp_id is not None and record.get('rp_id') != rp_id:
+            return False
+        if allowed_ids is not None and record.get('credential_id') not in allowed_ids:
+            return False
+        return True
+    
+    try:
+        if is_native_vault_supported():
+            if not os.path.exists(vault_path):
+                deleted, not_found = [], list(credential_ids or [])
+            else:
+                # One rewrite of the vault is one delete operation (the fallback below counts each call)
+                with metrics.measure('delete'):
+                    deleted, not_found = fido_vault.delete_credentials(vault_path, passphrase, credential_ids, matches)
+        else:
+            listing = list_fido_credentials(passphrase, vault_path)
+            if not listing.get('success'):
+                return listing
+            records = listing['credentials']
+            if credential_ids is None:
+                selected, not_found = records, []
+            else:
+                selected, not_found = [], []
+                for wanted in credential_ids:
+                    found = [r for r in records if wanted and r.get('credential_id', '').startswith(wanted.lower())]
+                    if len(found) == 1:
+                        selected.append(found[0])
+                    else:
+                        not_found.append(wanted)
+            deleted = []
+            for record in selected:
+                if not matches(record):
+                    continue
+                result = delete_fido_credential(record['credential_id'], passphrase, vault_path)
+                if result.get('success'):
+                    deleted.append(record)
+                else:
+                    not_found.append(record['credential_id'])
+        
+        logger.info(f"Deleted {len(deleted)} credentials")
+        return {
+            'success': True,
+            'deleted': deleted,
+            'not_found': not_found,
+            'count': len(deleted)
+        }
+    
+    except VaultError as e:
+        logger.error(f"Failed to delete credentials: {e}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
+    except Exception as e:
+        logger.exception("Error deleting credentials")
+        return {
+            'success': False,
+            'error': str(e)
+        }
+    finally:
+        invalidate_credential_cache(vault_path)
 
 
 def parse_credential_list(output: str) -> List[Dict]:
@@ -583,12 +746,12 @@ def get_vault_info(vault_path: Optional[str] = None) -> Dict:
     Get information about vault file
     
     Args:
-        vault_path: Path to vault file (default: FIDO_VAULT_PATH)
+        vault_path: Path to vault file (default: get_vault_path())
     
     Returns:
         Dict with vault info (exists, size, modified time)
     """
-    path = vault_path or FIDO_VAULT_PATH
+    path = vault_path or get_vault_path()
     
     try:
         if os.path.exists(path):
@@ -613,27 +776,24 @@ def get_vault_info(vault_path: Optional[str] = None) -> Dict:
         }
 
 
-def backup_vault(backup_path: Optional[str] = None, vault_path: Optional[str] = None) -> Dict:
+def backup_vault(backup_path: Optional[str] = None, vault_path: Optional[str] = None, kind: str = 'manual') -> Dict:
     """
     Create backup of vault file
     
+    Without backup_path a compressed snapshot is added to the backup directory
+    (skipped if the vault did not change since the newest snapshot) and the
+    retention policy is applied.
+    
     Args:
-        backup_path: Path for backup file (auto-generated if not provided)
-        vault_path: Path to vault file (default: current vault path from env)
+        backup_path: Path for a plain copy of the vault (optional)
+        vault_path: Path to vault file (default: get_vault_path())
+        kind: Snapshot origin ('manual' or 'scheduled')
     
     Returns:
         Dict with success status and backup_path
     """
-    import shutil
-    
     source = vault_path or get_vault_path()
     
-    # Auto-generate backup path if not provided
-    if not backup_path:
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_dir = get_backup_directory()
-        backup_path = os.path.join(backup_dir, f'vault_backup_{timestamp}.json')
-    
     try:
         # Check if vault file exists
         if not os.path.exists(source):
@@ -652,23 +812,44 @@ def backup_vault(backup_path: Optional[str] = None, vault_path: Optional[str] =
         
         # Check if device is running (warn but don't block)
         status = get_fido_status()
-        if status.get('running', False):
+        if status.get('is_running', False):
             logger.warning("FIDO device is running during backup. Data may not be fully flushed.")
         
-        shutil.copy2(source, backup_path)
+        if backup_path:
+            with fido_vault.vault_lock(source):
+                with open(source, 'rb') as f:
+                    fido_backup.write_atomic(backup_path, f.read())
+            logger.info(f"Vault backed up: {source} -> {backup_path}")
+            return {
+                'success': True,
+                'message': f'Vault backed up successfully',
+                'source': source,
+                'backup': backup_path,
+                'filename': os.path.basename(backup_path),
+                'size': os.path.getsize(backup_path),
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
         
-        # Get file size
-        file_size = os.path.getsize(backup_path)
+        backup_dir = get_backup_directory()
+        result = fido_backup.create_backup(source, backup_dir, kind=kind)
+        snapshot = result['snapshot']
+        pruned = [] if result['skipped'] else fido_backup.prune_backups(backup_dir)
         
-        logger.info(f"Vault backed up: {source} -> {backup_path}")
+        if result['skipped']:
+            logger.info(f"Vault unchanged since backup {snapshot['name']}, nothing to do")
+        else:
+            logger.info(f"Vault backed up: {source} -> {snapshot['name']}")
         return {
             'success': True,
-            'message': f'Vault backed up successfully',
+            'message': f"Vault unchanged since backup {snapshot['name']}" if result['skipped'] else 'Vault backed up successfully',
+            'skipped': result['skipped'],
             'source': source,
-            'backup': backup_path,
-            'filename': os.path.basename(backup_path),
-            'size': file_size,
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            'backup': os.path.join(backup_dir, snapshot['object']),
+            'filename': snapshot['name'],
+            'size': snapshot['size'],
+            'stored_size': snapshot['stored_size'],
+            'pruned': [s['name'] for s in pruned],
+            'timestamp': datetime.fromisoformat(snapshot['created_at']).strftime('%Y-%m-%d %H:%M:%S')
         }
     
     except Exception as e:
@@ -688,31 +869,33 @@ def restore_vault(backup_path: str, vault_path: Optional[str] = None) -> Dict:
     
     Args:
         backup_path: Path to backup file (or just filename if in backup directory)
-        vault_path: Path to vault file (default: current vault path from env)
+        vault_path: Path to vault file (default: get_vault_path())
     
     Returns:
         Dict with success status and restart instructions
     """
-    import shutil
-    
     destination = vault_path or get_vault_path()
     
-    # If backup_path is just a filename, look in backup directory
-    if not os.path.dirname(backup_path):
-        backup_dir = get_backup_directory()
-        backup_path = os.path.join(backup_dir, backup_path)
-    
     try:
-        # Validate backup file exists
-        if not os.path.exists(backup_path):
-            return {
-                'success': False,
-                'error': f'Backup file not found: {backup_path}'
-            }
+        # Backups in the backup directory are looked up by name in the manifest
+        data = None
+        if not os.path.dirname(backup_path):
+            data = fido_backup.read_backup(get_backup_directory(), backup_path)
+            if data is None:
+                backup_path = os.path.join(get_backup_directory(), backup_path)
+        
+        if data is None:
+            # Validate backup file exists
+            if not os.path.exists(backup_path):
+                return {
+                    'success': False,
+                    'error': f'Backup file not found: {backup_path}'
+                }
+            with open(backup_path, 'rb') as f:
+                data = f.read()
         
         # Validate backup file is not empty
-        backup_size = os.path.getsize(backup_path)
-        if backup_size == 0:
+        if not data:
             return {
                 'success': False,
                 'error': 'Backup file is empty. Cannot restore from empty backup.'
@@ -721,7 +904,7 @@ def restore_vault(backup_path: str, vault_path: Optional[str] = None) -> Dict:
         # Stop FIDO device if running (required for safe restore)
         device_was_running = False
         status = get_fido_status()
-        if status.get('running', False):
+        if status.get('is_running', False):
             device_was_running = True
             logger.info("Stopping FIDO device for safe vault restore...")
             stop_result = stop_fido_device()
@@ -731,14 +914,18 @@ def restore_vault(backup_path: str, vault_path: Optional[str] = None) -> Dict:
                     'error': 'Failed to stop FIDO device before restore. Restore aborted for safety.'
                 }
         
-        # Create backup of current vault if exists
-        if os.path.exists(destination):
-            temp_backup = f"{destination}.before_restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            shutil.copy2(destination, temp_backup)
-            logger.info(f"Current vault backed up to: {temp_backup}")
-        
-        # Restore vault file
-        shutil.copy2(backup_path, destination)
+        # Under the vault lock no list/delete of another worker sees a half-restored vault
+        with fido_vault.vault_lock(destination):
+            # Create backup of current vault if exists
+            if os.path.exists(destination):
+                temp_backup = f"{destination}.before_restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                with open(destination, 'rb') as f:
+                    fido_backup.write_atomic(temp_backup, f.read())
+                logger.info(f"Current vault backed up to: {temp_backup}")
+            
+            # Restore vault file atomically (a crash must not leave a truncated vault)
+            fido_backup.write_atomic(destination, data)
+        invalidate_credential_cache(destination)
         
         logger.info(f"Vault restored: {backup_path} -> {destination}")
         
@@ -804,6 +991,14 @@ def delete_backup(backup_filename: str) -> Dict:
                 'error': 'Invalid backup file path'
             }
         
+        # Snapshots are removed via the manifest (together with objects no other snapshot uses)
+        if fido_backup.delete_snapshot(backup_dir, backup_filename):
+            logger.info(f"Backup deleted: {backup_filename}")
+            return {
+                'success': True,
+                'message': f'Backup {backup_filename} deleted successfully'
+            }
+        
         # Check if file exists
         if not os.path.exists(backup_path):
             return {
@@ -835,73 +1030,85 @@ def delete_backup(backup_filename: str) -> Dict:
         }
 
 
-def attach_to_localhost() -> Dict:
+@metrics.timed('attach')
+def attach_to_localhost(port: int = FIDO_USBIP_PORT, bus_id: str = FIDO_BUS_ID, check_running: bool = True) -> Dict:
     """
     Attach virtual FIDO device to localhost via USB/IP.
     This makes the virtual FIDO device appear as a real USB device on the local system.
     
+    Args:
+        port: USB/IP TCP port of the device (pool instances use their own port)
+        bus_id: Bus ID exported by the device
+        check_running: Check that the main device is running first
+    
     Returns:
         Dict with success status and message
     """
     try:
         # First check if virtual-fido is running
-        status = get_fido_status()
-        if not status.get('is_running'):
+        if check_running:
+            status = get_fido_status()
+            if not status.get('is_running'):
+                return {
+                    'success': False,
+                    'error': 'FIDO device is not running. Start it first.'
+                }
+        
+        started = time.monotonic()
+        
+        # Attaching twice would block: the device serves one USB/IP connection at a time
+        existing = find_import(port, bus_id)
+        if existing:
+            return {
+                'success': True,
+                'message': f"Device is already attached (vhci port {existing['port']})",
+                'port': port,
+                'already_attached': True
+            }
+        
+        usbip = find_usbip_command()
+        if not usbip:
             return {
                 'success': False,
-                'error': 'FIDO device is not running. Start it first.'
+                'error': 'usbip binary not found. Install usbip (linux-tools) first.'
             }
         
-        # Load vhci-hcd kernel module (virtual USB host controller)
-        logger.info("Loading vhci-hcd kernel module...")
-        modprobe_cmd = ['sudo', 'modprobe', 'vhci-hcd']
-        result = subprocess.run(modprobe_cmd, capture_output=True, text=True, timeout=10)
+        # Load vhci-hcd kernel module (virtual USB host controller) unless already loaded
+        loaded = ensure_vhci_loaded()
+        if not loaded['success']:
+            logger.error(loaded['error'])
+            return loaded
         
-        if result.returncode != 0:
-            logger.error(f"Failed to load vhci-hcd module: {result.stderr}")
+        # Fail fast if the device does not answer instead of waiting for usbip to time out
+        probe = wait_until_ready(port, bus_id, timeout=2.0)
+        if not probe['ready']:
             return {
                 'success': False,
-                'error': f'Failed to load vhci-hcd kernel module: {result.stderr}'
+                'error': f"Device on port {port} is not answering: {probe.get('error')}"
             }
         
-        import time
-        time.sleep(0.5)
-        
-        # Attach to localhost on port 3241
         # IMPORTANT: --tcp-port must come BEFORE the 'attach' command!
-        logger.info("Attaching virtual FIDO device to localhost...")
-        attach_cmd = ['sudo', 'usbip', '--tcp-port', '3241', 'attach', '-r', '127.0.0.1', '-b', '2-2']
-        result = subprocess.run(attach_cmd, capture_output=True, text=True, timeout=30)
+        logger.info(f"Attaching virtual FIDO device on port {port} to localhost...")
+        attach_cmd = list(usbip) + ['--tcp-port', str(port), 'attach', '-r', '127.0.0.1', '-b', bus_id]
+        result = subprocess.run(attach_cmd, capture_output=True, text=True, timeout=ATTACH_TIMEOUT)
         
         if result.returncode != 0:
-            # Try alternative usbip paths
-            for usbip_path in ['/usr/sbin/usbip', '/usr/bin/usbip', '/usr/lib/linux-tools/*/usbip']:
-                if '*' in usbip_path:
-                    import glob as glob_module
-                    paths = glob_module.glob(usbip_path)
-                    if paths:
-                        usbip_path = paths[0]
-                    else:
-                        continue
-                
-                # IMPORTANT: --tcp-port must come BEFORE the 'attach' command!
-                attach_cmd = ['sudo', usbip_path, '--tcp-port', '3241', 'attach', '-r', '127.0.0.1', '-b', '2-2']
-                result = subprocess.run(attach_cmd, capture_output=True, text=True, timeout=30)
-                if result.returncode == 0:
-                    break
-            
-            if result.returncode != 0:
-                logger.error(f"Failed to attach device: {result.stderr}")
-                return {
-                    'success': False,
-                    'error': f'Failed to attach device: {result.stderr}'
-                }
+            logger.error(f"Failed to attach device: {result.stderr}")
+            return {
+                'success': False,
+                'error': f'Failed to attach device: {result.stderr}'
+            }
         
-        logger.info("Virtual FIDO device attached to localhost successfully")
+        imported = wait_for_import(port, bus_id)
+        attach_ms = round((time.monotonic() - started) * 1000, 1)
+        
+        logger.info(f"Virtual FIDO device attached to localhost in {attach_ms} ms")
         return {
             'success': True,
             'message': 'Virtual FIDO device attached to localhost. It should now appear as a USB device.',
-            'port': 3241
+            'port': port,
+            'vhci_port': imported['port'] if imported else None,
+            'attach_ms': attach_ms
         }
     
     except subprocess.TimeoutExpired:
@@ -917,36 +1124,56 @@ def attach_to_localhost() -> Dict:
         }
 
 
-def detach_from_localhost() -> Dict:
+def parse_usbip_ports(output: str) -> List[Dict]:
+    """
+    Parse output of 'usbip port'
+    
+    Example output format:
+    Port 00: <Port in Use> at Full Speed(12Mbps)
+           unknown vendor : unknown product (0483:a2ca)
+           3-1 -> usbip://127.0.0.1:3241/2-2
+    
+    Returns:
+        List of dicts with vhci port, remote TCP port and bus ID (None if not shown)
+    """
+    ports = []
+    for line in output.split('\n'):
+        match = re.search(r'Port\s+(\d+):', line)
+        if match and 'in use' in line.lower():
+            ports.append({'port': match.group(1), 'tcp_port': None, 'bus_id': None})
+            continue
+        match = re.search(r'usbip://[^:/]+:(\d+)/(\S+)', line)
+        if match and ports:
+            ports[-1]['tcp_port'] = int(match.group(1))
+            ports[-1]['bus_id'] = match.group(2)
+    return ports
+
+
+def detach_from_localhost(port: Optional[int] = None) -> Dict:
     """
     Detach virtual FIDO device from localhost.
     
+    Args:
+        port: Only detach devices imported from this USB/IP TCP port (default: all)
+    
     Returns:
         Dict with success status and message
     """
     try:
         # Find attached USB/IP ports
         logger.info("Finding attached USB/IP devices...")
-        port_cmd = ['sudo', 'usbip', 'port']
-        result = subprocess.run(port_cmd, capture_output=True, text=True, timeout=10)
-        
-        if result.returncode != 0:
-            # Try alternative paths
-            for usbip_path in ['/usr/sbin/usbip', '/usr/bin/usbip']:
-                port_cmd = ['sudo', usbip_path, 'port']
-                result = subprocess.run(port_cmd, capture_output=True, text=True, timeout=10)
-                if result.returncode == 0:
-                    break
+        usbip = find_usbip_command()
+        if not usbip:
+            return {
+                'success': False,
+                'error': 'usbip binary not found'
+            }
+        result = subprocess.run(list(usbip) + ['port'], capture_output=True, text=True, timeout=10)
         
-        # Parse output to find port numbers
-        # Example: "Port 00: <Port in Use> at Full Speed(12Mbps)"
-        ports_to_detach = []
-        for line in result.stdout.split('\n'):
-            if 'Port' in line and 'in Use' in line.lower():
-                # Extract port number
-                match = re.search(r'Port\s+(\d+):', line)
-                if match:
-                    ports_to_detach.append(match.group(1))
+        ports_to_detach = [
+            entry['port'] for entry in parse_usbip_ports(result.stdout)
+            if port is None or entry['tcp_port'] == port
+        ]
         
         if not ports_to_detach:
             logger.warning("No attached USB/IP devices found")
@@ -959,15 +1186,15 @@ def detach_from_localhost() -> Dict:
         # Detach all found ports
         detached = []
         errors = []
-        for port in ports_to_detach:
-            detach_cmd = ['sudo', 'usbip', 'detach', '-p', port]
+        for vhci_port in ports_to_detach:
+            detach_cmd = list(usbip) + ['detach', '-p', vhci_port]
             result = subprocess.run(detach_cmd, capture_output=True, text=True, timeout=10)
             
             if result.returncode == 0:
-                detached.append(port)
-                logger.info(f"Detached USB/IP port {port}")
+                detached.append(vhci_port)
+                logger.info(f"Detached USB/IP port {vhci_port}")
             else:
-                errors.append(f"Port {port}: {result.stderr}")
+                errors.append(f"Port {vhci_port}: {result.stderr}")
         
         if detached:
             return {
@@ -1004,24 +1231,17 @@ def get_localhost_attach_status() -> Dict:
     """
     try:
         # Check usbip port status
-        port_cmd = ['sudo', 'usbip', 'port']
-        result = subprocess.run(port_cmd, capture_output=True, text=True, timeout=10)
-        
-        if result.returncode != 0:
-            # Try alternative paths
-            for usbip_path in ['/usr/sbin/usbip', '/usr/bin/usbip']:
-                port_cmd = ['sudo', usbip_path, 'port']
-                result = subprocess.run(port_cmd, capture_output=True, text=True, timeout=10)
-                if result.returncode == 0:
-                    break
+        usbip = find_usbip_command()
+        if not usbip:
+            return {
+                'is_attached': False,
+                'error': 'usbip binary not found'
+            }
+        result = subprocess.run(list(usbip) + ['port'], capture_output=True, text=True, timeout=10)
         
         # Parse output
-        attached_ports = []
-        for line in result.stdout.split('\n'):
-            if 'Port' in line and 'in Use' in line.lower():
-                match = re.search(r'Port\s+(\d+):', line)
-                if match:
-                    attached_ports.append(match.group(1))
+        imported = parse_usbip_ports(result.stdout)
+        attached_ports = [entry['port'] for entry in imported]
         
         is_attached = len(attached_ports) > 0
         
@@ -1032,6 +1252,7 @@ def get_localhost_attach_status() -> Dict:
         return {
             'is_attached': is_attached,
             'attached_ports': attached_ports,
+            'imported': imported,
             'visible_in_lsusb': fido_in_lsusb,
             'port_output': result.stdout if result.returncode == 0 else None
         }
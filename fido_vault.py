@@ -0,0 +1,287 @@
+"""
+FIDO2 Identity Vault
+Native reader/writer for the virtual-fido vault file
+(virtual-fido/identities/saved_state.go, identity_vault.go)
+
+Vault file: JSON PassphraseEncryptedBlob with base64 fields
+    salt, encryption_key, key_nonce, encrypted_data, data_nonce
+Key derivation: scrypt(passphrase, salt, N=32768, r=8, p=1, 32 bytes)
+The derived key decrypts (AES-256-GCM) a random data key, which decrypts the
+FIDODeviceConfig JSON holding the credential sources.
+"""
+
+import os
+import json
+import fcntl
+import base64
+import hashlib
+import tempfile
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple, Iterable
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:  # Optional dependency: fall back to the virtual-fido binary
+    AESGCM = None
+    InvalidTag = ValueError
+
+logger = logging.getLogger(__name__)
+
+# scrypt parameters used by EncryptWithPassphrase
+SCRYPT_N = 32768
+SCRYPT_R = 8
+SCRYPT_P = 1
+KEY_LENGTH = 32
+
+# scrypt needs 128 * N * r bytes; OpenSSL's default limit is 32 MB
+SCRYPT_MAXMEM = 128 * SCRYPT_N * SCRYPT_R * 2
+
+NONCE_LENGTH = 12
+SALT_LENGTH = 16
+
+# Length of the ID prefix printed by `virtual-fido list`
+SHORT_ID_LENGTH = 8
+
+
+class VaultError(Exception):
+    """Vault cannot be read or written (wrong passphrase, corrupt file, ...)"""
+
+
+def is_native_vault_supported() -> bool:
+    """Check if the AES-GCM implementation (cryptography package) is available"""
+    return AESGCM is not None
+
+
+def derive_key(passphrase: str, salt: bytes) -> bytes:
+    """Derive the key encryption key from the passphrase (scrypt)"""
+    return hashlib.scrypt(passphrase.encode('utf-8'), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P,
+                          maxmem=SCRYPT_MAXMEM, dklen=KEY_LENGTH)
+
+
+def _b64decode(blob: Dict, field: str) -> bytes:
+    try:
+        return base64.b64decode(blob[field] or '')
+    except (KeyError, TypeError, ValueError) as e:
+        raise VaultError(f"Invalid vault field '{field}': {e}")
+
+
+def _decrypt(key: bytes, data: bytes, nonce: bytes) -> bytes:
+    try:
+        return AESGCM(key).decrypt(nonce, data, None)
+    except (InvalidTag, ValueError) as e:
+        raise VaultError('Could not decrypt vault (wrong passphrase?)') from e
+
+
+class Vault:
+    """
+    Decrypted vault contents.
+
+    Keeps the wrapped data key so that a rewrite only re-encrypts the data
+    (with a fresh nonce) and does not run scrypt a second time.
+    """
+
+    def __init__(self, blob: Dict, data_key: bytes, state: Dict):
+        self.blob = blob
+        self.data_key = data_key
+        self.state = state
+
+    @property
+    def sources(self) -> List[Dict]:
+        return self.state.setdefault('sources', []) or []
+
+    @classmethod
+    def decrypt(cls, data: bytes, passphrase: str) -> 'Vault':
+        """
+        Decrypt vault file contents
+
+        Args:
+            data: Raw vault file bytes
+            passphrase: Vault passphrase
+
+        Returns:
+            Vault: Decrypted vault
+        """
+        if not is_native_vault_supported():
+            raise VaultError('cryptography package is not installed')
+        try:
+            blob = json.loads(data)
+        except ValueError as e:
+            raise VaultError(f'Vault is not valid JSON: {e}')
+        if not isinstance(blob, dict):
+            raise VaultError('Vault is not a JSON object')
+
+        key_encryption_key = derive_key(passphrase, _b64decode(blob, 'salt'))
+        data_key = _decrypt(key_encryption_key, _b64decode(blob, 'encryption_key'), _b64decode(blob, 'key_nonce'))
+        state_bytes = _decrypt(data_key, _b64decode(blob, 'encrypted_data'), _b64decode(blob, 'data_nonce'))
+        try:
+            state = json.loads(state_bytes)
+        except ValueError as e:
+            raise VaultError(f'Decrypted vault state is not valid JSON: {e}')
+        return cls(blob, data_key, state)
+
+    def encrypt(self) -> bytes:
+        """Encrypt the (modified) state with the existing data key and a new nonce"""
+        nonce = os.urandom(NONCE_LENGTH)
+        state_bytes = json.dumps(self.state, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        blob = dict(self.blob)
+        blob['encrypted_data'] = base64.b64encode(AESGCM(self.data_key).encrypt(nonce, state_bytes, None)).decode('ascii')
+        blob['data_nonce'] = base64.b64encode(nonce).decode('ascii')
+        return json.dumps(blob, separators=(',', ':')).encode('utf-8')
+
+    def credentials(self) -> List[Dict]:
+        """Structured credential records of the vault"""
+        return [credential_record(source) for source in self.sources]
+
+    def match(self, credential_ids: Iterable[str]) -> Tuple[Set[int], List[str]]:
+        """
+        Find credentials by full hex ID or unique ID prefix (like `virtual-fido delete`)
+
+        Returns:
+            Tuple[Set[int], List[str]]: (indexes in sources, IDs that matched nothing or were ambiguous)
+        """
+        ids_hex = [record['credential_id'] for record in self.credentials()]
+        indexes = set()
+        not_matched = []
+        for wanted in credential_ids:
+            wanted = (wanted or '').strip().lower()
+            matches = [i for i, cid in enumerate(ids_hex) if wanted and cid.startswith(wanted)]
+            if len(matches) == 1:
+                indexes.add(matches[0])
+            else:
+                not_matched.append(wanted)
+        return indexes, not_matched
+
+    def remove_indexes(self, indexes: Set[int]) -> List[Dict]:
+        """Remove sources by index, returns the removed records"""
+        removed = [credential_record(self.sources[i]) for i in sorted(indexes)]
+        self.state['sources'] = [source for i, source in enumerate(self.sources) if i not in indexes]
+        return removed
+
+    def remove(self, credential_ids: Iterable[str]) -> Tuple[List[Dict], List[str]]:
+        """
+        Remove credentials by full hex ID or unique ID prefix
+
+        Returns:
+            Tuple[List[Dict], List[str]]: (removed records, IDs that matched nothing or were ambiguous)
+        """
+        indexes, not_matched = self.match(credential_ids)
+        return self.remove_indexes(indexes), not_matched
+
+
+def credential_record(source: Dict) -> Dict:
+    """Convert a SavedCredentialSource to a credential record for the UI/API"""
+    credential_id = base64.b64decode(source.get('id') or '').hex()
+    relying_party = source.get('relying_party') or {}
+    user = source.get('user') or {}
+    return {
+        'credential_id': credential_id,
+        'short_id': credential_id[:SHORT_ID_LENGTH],
+        'type': source.get('type'),
+        'rp_id': relying_party.get('id'),
+        'rp_name': relying_party.get('name'),
+        'user_id': base64.b64decode(user.get('id') or '').hex(),
+        'user_name': user.get('name'),
+        'display_name': user.get('display_name'),
+        'signature_counter': source.get('signature_counter', 0)
+    }
+
+
+def read_vault(vault_path: str, passphrase: str) -> Vault:
+    """Read and decrypt a vault file"""
+    try:
+        with open(vault_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        raise VaultError(f'Could not read vault {vault_path}: {e}')
+    return Vault.decrypt(data, passphrase)
+
+
+def write_vault(vault_path: str, vault: Vault) -> None:
+    """
+    Encrypt and write a vault atomically (temp file + fsync + rename),
+    so a crash never leaves a truncated vault behind
+    """
+    data = vault.encrypt()
+    directory = os.path.dirname(os.path.abspath(vault_path))
+    try:
+        mode = os.stat(vault_path).st_mode & 0o777
+    except OSError:
+        mode = 0o600
+    fd, tmp_path = tempfile.mkstemp(prefix='.vault-', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, vault_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def list_credentials(vault_path: str, passphrase: str) -> List[Dict]:
+    """
+    List credential records of a vault
+
+    Returns:
+        List[Dict]: Credential records (empty if the vault does not exist yet)
+    """
+    if not os.path.exists(vault_path):
+        return []
+    return read_vault(vault_path, passphrase).credentials()
+
+
+@contextmanager
+def vault_lock(vault_path: str):
+    """
+    Exclusive lock for a read-modify-write cycle of the vault
+    (flock on a sidecar file, the vault itself is replaced by rename)
+    """
+    fd = os.open(vault_path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def delete_credentials(vault_path: str, passphrase: str, credential_ids: Optional[Iterable[str]] = None,
+                       predicate: Optional[Callable[[Dict], bool]] = None) -> Tuple[List[Dict], List[str]]:
+    """
+    Delete credentials in one locked decrypt-modify-encrypt pass
+
+    Args:
+        vault_path: Path to vault file
+        passphrase: Vault passphrase
+        credential_ids: Full hex IDs or unique prefixes (None: all credentials)
+        predicate: Additional filter on credential records (e.g. by relying party)
+
+    Returns:
+        Tuple[List[Dict], List[str]]: (removed records, IDs that were not found or ambiguous)
+    """
+    with vault_lock(vault_path):
+        vault = read_vault(vault_path, passphrase)
+        if credential_ids is None:
+            indexes, not_matched = set(range(len(vault.sources))), []
+        else:
+            indexes, not_matched = vault.match(credential_ids)
+        if predicate is not None:
+            records = vault.credentials()
+            indexes = {i for i in indexes if predicate(records[i])}
+        removed = vault.remove_indexes(indexes)
+        if removed:
+            write_vault(vault_path, vault)
+            logger.info(f"Removed {len(removed)} credentials from vault {vault_path}")
+    return removed, not_matched
@@ -0,0 +1,495 @@
+"""
+Герметичный стенд для измерения задержек страниц и API без USB-оборудования.
+
+FakeToolchain создает во временном каталоге все, к чему обращается
+usbip_utils:
+
+    bin/    sudo, pkexec, usbip, lsusb, doctor.sh - shell-скрипты с настраиваемой
+            задержкой и числом устройств (sudo подменяет пути /sys и /proc
+            на поддельные и запускает поддельные инструменты вместо /usr/bin/usbip)
+    sys/    поддельный sysfs: bus/usb/devices/<busid>, bus/usb/drivers/usbip-host
+    state/  готовые выводы команд, опубликованные устройства и журнал вызовов
+
+а "usbip list -r" обращается к настоящему протоколу USB/IP: стенд поднимает
+UsbipServer с моделями-заглушками тех же устройств (любой адрес обслуживает
+этот сервер). Приложение при этом работает с отдельной БД (USBIP_WEB_DB) в
+каталоге стенда.
+
+Измерение задержек /, /api/local_devices, /bind_device и /get_remote_devices:
+
+    python hermetic_bench.py run --devices 1,50,500 --rounds 20 [--latency-ms 5] [--sudo password]
+
+Инструменты для ручной проверки без запуска измерений:
+
+    python hermetic_bench.py toolchain /tmp/fake --devices 50
+    PATH=/tmp/fake/bin:$PATH sudo -n usbip list -l
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import logging
+from typing import Dict, List, Optional
+
+from usb_device_models import UsbDeviceModel, UsbInterface
+from usbip_server import UsbipServer, UsbipClient
+
+logger = logging.getLogger(__name__)
+
+# Портов на поддельном корневом хабе (busid <шина>-<порт>)
+PORTS_PER_BUS = 15
+
+# Устройства стенда по кругу: VID, PID, производитель, продукт, класс интерфейса
+DEVICE_CATALOG = [
+    ('046d', 'c05a', 'Logitech, Inc.', 'Optical Mouse M90', (0x03, 0x01, 0x02)),
+    ('0781', '5567', 'SanDisk Corp.', 'Cruzer Blade', (0x08, 0x06, 0x50)),
+    ('04f2', 'b5d8', 'Chicony Electronics Co., Ltd', 'Integrated Camera', (0x0e, 0x01, 0x00)),
+    ('1a86', '7523', 'QinHeng Electronics', 'CH340 serial converter', (0xff, 0x01, 0x02)),
+    ('0bda', '8153', 'Realtek Semiconductor Corp.', 'RTL8153 Gigabit Ethernet Adapter', (0xff, 0xff, 0x00)),
+    ('1050', '0407', 'Yubico.com', 'Yubikey 4/5 OTP+U2F+CCID', (0x03, 0x00, 0x00))
+]
+
+# Измеряемые запросы: имя, метод, путь
+BENCH_ENDPOINTS = [
+    ('index', 'GET', '/'),
+    ('local_devices', 'GET', '/api/local_devices'),
+    ('bind_device', 'POST', '/bind_device'),
+    ('get_remote_devices', 'POST', '/get_remote_devices')
+]
+
+DEFAULT_DEVICE_COUNTS = (1, 50, 500)
+DEFAULT_ROUNDS = 20
+
+
+class FakeDevice:
+    """Устройство стенда"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.bus = index // PORTS_PER_BUS + 1
+        self.port = index % PORTS_PER_BUS + 1
+        self.busid = f'{self.bus}-{self.port}'
+        (self.vendor_id, self.product_id, self.manufacturer, self.product,
+         self.interface_class) = DEVICE_CATALOG[index % len(DEVICE_CATALOG)]
+
+    @property
+    def name(self) -> str:
+        return f'{self.manufacturer} : {self.product}'
+
+    @property
+    def ids(self) -> str:
+        return f'{self.vendor_id}:{self.product_id}'
+
+
+def fake_devices(count: int) -> List[FakeDevice]:
+    return [FakeDevice(index) for index in range(count)]
+
+
+def device_name(vendor_id: str, product_id: str) -> str:
+    """Имя устройства по VID:PID (как usb.ids у настоящего usbip)"""
+    for entry in DEVICE_CATALOG:
+        if entry[0] == vendor_id and entry[1] == product_id:
+            return f'{entry[2]} : {entry[3]}'
+    return 'unknown vendor : unknown product'
+
+
+class StandInDevice(UsbDeviceModel):
+    """Модель-заглушка для списка устройств стенда usbipd"""
+
+    device_type = 'standin'
+
+    def __init__(self, device: FakeDevice):
+        super().__init__(int(device.vendor_id, 16), int(device.product_id, 16), f'HB{device.index:05d}',
+                         device.product)
+        self.manufacturer = device.manufacturer
+        self.interface_class = device.interface_class
+
+    def interfaces(self) -> List[UsbInterface]:
+        return [UsbInterface(0, *self.interface_class)]
+
+
+# ----------------------------------------------------------------------
+# Поддельные инструменты
+
+SUDO_SCRIPT = '''#!/bin/sh
+# sudo стенда: без повышения прав, поддельные инструменты и sysfs вместо настоящих
+echo {name} >> {state}/calls.log
+[ "$1" = "-n" ] && shift
+{password_check}
+tool="${{1##*/}}"
+if [ -x "{bin}/$tool" ]; then shift; set -- "{bin}/$tool" "$@"; fi
+for arg do
+    shift
+    case "$arg" in /sys/*|/proc/*|/var/log/*) arg="{root}$arg" ;; esac
+    set -- "$@" "$arg"
+done
+exec "$@"
+'''
+
+PASSWORD_CHECK = '''if [ "{name}" = "sudo" ]; then echo "sudo: a password is required" >&2; exit 1; fi'''
+
+USBIP_SCRIPT = '''#!/bin/sh
+# usbip стенда
+echo usbip >> {state}/calls.log
+{sleep}
+cmd="$1"; [ $# -gt 0 ] && shift
+case "$cmd" in
+list)
+    case "$1" in
+    -l|--local) cat {state}/list_local.txt ;;
+    -b) for f in {state}/bound/*; do [ -f "$f" ] && cat "$f"; done ;;
+    -r|--remote) shift; exec {python} {script} list-remote --port {usbipd_port} "$@" ;;
+    *) echo "usbip: error: unsupported list option $1" >&2; exit 1 ;;
+    esac ;;
+bind|unbind)
+    [ "$1" = "-b" ] || [ "$1" = "--busid" ] || {{ echo "usbip: error: $cmd: missing busid" >&2; exit 1; }}
+    busid="$2"
+    if [ ! -d {sys}/bus/usb/devices/"$busid" ]; then
+        echo "usbip: error: device with the specified bus ID does not exist" >&2; exit 1
+    fi
+    if [ "$cmd" = "bind" ]; then
+        if [ -f {state}/bound/"$busid" ]; then
+            echo "usbip: error: device on busid $busid is already bound to usbip-host" >&2; exit 1
+        fi
+        cp {state}/devices/"$busid" {state}/bound/"$busid"
+        ln -s ../../../../devices/"$busid" {sys}/bus/usb/drivers/usbip-host/"$busid"
+        echo "usbip: info: bind device on busid $busid: complete"
+    else
+        rm -f {state}/bound/"$busid" {sys}/bus/usb/drivers/usbip-host/"$busid"
+        echo "usbip: info: unbind device on busid $busid: complete"
+    fi ;;
+port) cat {state}/port.txt ;;
+attach|detach) ;;
+*) echo "usbip: error: unknown command $cmd" >&2; exit 1 ;;
+esac
+'''
+
+LSUSB_SCRIPT = '''#!/bin/sh
+# lsusb стенда
+echo lsusb >> {state}/calls.log
+{sleep}
+cat {state}/lsusb.txt
+'''
+
+DOCTOR_SCRIPT = '''#!/bin/sh
+# doctor.sh стенда: только секции, которые разбирает usbip_utils
+echo doctor.sh >> {state}/calls.log
+{sleep}
+echo "Local USB devices:"
+cat {state}/list_local.txt
+echo "Published devices:"
+echo "Via kernel status:"
+for f in {state}/bound/*; do [ -f "$f" ] && echo "  Device ${{f##*/}} (status: 1)"; done
+echo "===================================================="
+'''
+
+
+class FakeToolchain:
+    """
+    Поддельные usbip, lsusb, doctor.sh, sudo/pkexec, sysfs и стенд usbipd
+
+    Args:
+        root: Каталог стенда (создается)
+        devices: Число локальных устройств (и устройств стенда usbipd)
+        latency_ms: Задержка каждого запуска usbip, lsusb и doctor.sh
+        attached: Число устройств в выводе "usbip port"
+        sudo: 'nopasswd' или 'password' (sudo -n отказывает, работает pkexec)
+    """
+
+    def __init__(self, root: str, devices: int = 1, latency_ms: float = 0.0, attached: int = 0,
+                 sudo: str = 'nopasswd'):
+        if sudo not in ('nopasswd', 'password'):
+            raise ValueError("sudo: 'nopasswd' или 'password'")
+        self.root = os.path.abspath(root)
+        self.devices = fake_devices(devices)
+        self.latency_ms = latency_ms
+        self.attached = min(attached, devices)
+        self.sudo = sudo
+        self.bin = os.path.join(self.root, 'bin')
+        self.sys = os.path.join(self.root, 'sys')
+        self.state = os.path.join(self.root, 'state')
+        self.usbipd: Optional[UsbipServer] = None
+        self.usbipd_port = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._saved_path: Optional[str] = None
+
+    # ------------------------------------------------------------------
+    # Файлы стенда
+
+    def build(self) -> 'FakeToolchain':
+        for directory in (self.bin, os.path.join(self.state, 'bound'), os.path.join(self.state, 'devices'),
+                          os.path.join(self.sys, 'bus', 'usb', 'devices'),
+                          os.path.join(self.sys, 'bus', 'usb', 'drivers', 'usbip-host')):
+            os.makedirs(directory, exist_ok=True)
+        if not self.usbipd_port:
+            self.usbipd_port = _free_port()
+
+        list_local, lsusb = [], []
+        for device in self.devices:
+            list_local += [f' - busid {device.busid} ({device.ids})', f'   {device.name} ({device.ids})', '']
+            lsusb.append(f'Bus {device.bus:03d} Device {device.port + 1:03d}: ID {device.ids} '
+                         f'{device.manufacturer} {device.product}')
+            with open(os.path.join(self.state, 'devices', device.busid), 'w') as f:
+                f.write(f'{device.busid}: {device.name} ({device.ids})\n')
+            sysfs = os.path.join(self.sys, 'bus', 'usb', 'devices', device.busid)
+            os.makedirs(sysfs, exist_ok=True)
+            for attribute, value in (('idVendor', device.vendor_id), ('idProduct', device.product_id),
+                                     ('manufacturer', device.manufacturer), ('product', device.product),
+                                     ('busnum', device.bus), ('devnum', device.port + 1), ('speed', 480)):
+                with open(os.path.join(sysfs, attribute), 'w') as f:
+                    f.write(f'{value}\n')
+
+        port = ['Imported USB devices', '====================']
+        for number, device in enumerate(self.devices[:self.attached]):
+            port += [f'Port {number:02d}: <Port in Use> at High Speed(480Mbps)',
+                     f'       {device.name} ({device.ids})',
+                     f'       {number + 1}-1 -> usbip://10.0.0.2:3240/{device.busid}',
+                     f'           -> remote bus/dev {device.bus:03d}/{device.port + 1:03d}']
+        self._write_state('list_local.txt', list_local)
+        self._write_state('lsusb.txt', lsusb)
+        self._write_state('port.txt', port)
+        open(os.path.join(self.state, 'calls.log'), 'w').close()
+
+        values = {
+            'root': shlex.quote(self.root), 'bin': shlex.quote(self.bin), 'sys': shlex.quote(self.sys),
+            'state': shlex.quote(self.state), 'python': shlex.quote(sys.executable),
+            'script': shlex.quote(os.path.abspath(__file__)), 'usbipd_port': self.usbipd_port,
+            'sleep': f'sleep {self.latency_ms / 1000:.3f}' if self.latency_ms else ''
+        }
+        for name in ('sudo', 'pkexec'):
+            check = PASSWORD_CHECK.format(name=name) if self.sudo == 'password' else ''
+            self._write_tool(name, SUDO_SCRIPT.format(name=name, password_check=check, **values))
+        self._write_tool('usbip', USBIP_SCRIPT.format(**values))
+        self._write_tool('lsusb', LSUSB_SCRIPT.format(**values))
+        self._write_tool('doctor.sh', DOCTOR_SCRIPT.format(**values))
+        return self
+
+    def _write_state(self, name: str, lines: List[str]) -> None:
+        with open(os.path.join(self.state, name), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _write_tool(self, name: str, content: str) -> None:
+        path = os.path.join(self.bin, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, 0o755)
+
+    def unbind_all(self) -> None:
+        """Снять публикацию со всех устройств (между раундами измерения /bind_device)"""
+        for busid in os.listdir(os.path.join(self.state, 'bound')):
+            os.unlink(os.path.join(self.state, 'bound', busid))
+            link = os.path.join(self.sys, 'bus', 'usb', 'drivers', 'usbip-host', busid)
+            if os.path.lexists(link):
+                os.unlink(link)
+
+    def take_calls(self) -> Dict[str, int]:
+        """Запуски инструментов с прошлого вызова: имя -> число"""
+        path = os.path.join(self.state, 'calls.log')
+        with open(path, 'r+') as f:
+            names = f.read().split()
+            f.seek(0)
+            f.truncate()
+        calls: Dict[str, int] = {}
+        for name in names:
+            calls[name] = calls.get(name, 0) + 1
+        return calls
+
+    # ------------------------------------------------------------------
+    # Стенд usbipd и PATH
+
+    def start_usbipd(self) -> None:
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self.usbipd = UsbipServer('127.0.0.1', self.usbipd_port)
+            self._loop.run_until_complete(self.usbipd.start())
+            for device in self.devices:
+                self.usbipd.add_device(StandInDevice(device), device.busid, device.index + 1)
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='hermetic-usbipd', daemon=True)
+        self._thread.start()
+        started.wait(10)
+
+    def stop_usbipd(self) -> None:
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.usbipd.stop(), self._loop).result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self) -> 'FakeToolchain':
+        self.build()
+        self.start_usbipd()
+        self._saved_path = os.environ.get('PATH', '')
+        os.environ['PATH'] = self.bin + os.pathsep + self._saved_path
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._saved_path is not None:
+            os.environ['PATH'] = self._saved_path
+            self._saved_path = None
+        self.stop_usbipd()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def _list_remote(port: int, host: str) -> int:
+    """Вывод "usbip list -r" по списку устройств стенда usbipd"""
+    try:
+        devices = await UsbipClient('127.0.0.1', port).devlist()
+    except OSError as e:
+        print(f'usbip: error: could not connect to {host}:3240: {e}', file=sys.stderr)
+        return 1
+    print('Exportable USB devices')
+    print('======================')
+    print(f' - {host}')
+    for device in devices:
+        ids = f'{device["vendor_id"]:04x}:{device["product_id"]:04x}'
+        print(f'{device["busid"]:>12}: {device_name(*ids.split(":"))} ({ids})')
+        print(f'{"":>12}: /sys/devices/platform/hermetic/usb1/{device["busid"]}')
+        print(f'{"":>12}: (Defined at Interface level) (00/00/00)')
+        for number, (cls, subclass, protocol) in enumerate(device['interfaces']):
+            print(f'{"":>12}:  {number} - ({cls:02x}/{subclass:02x}/{protocol:02x})')
+        print()
+    return 0
+
+
+# ----------------------------------------------------------------------
+# Измерение
+
+def _summary(values: List[float]) -> Dict:
+    values = sorted(values)
+
+    def percentile(q):
+        return round(values[min(int(q * len(values)), len(values) - 1)] * 1000, 2)
+    return {'mean_ms': round(sum(values) / len(values) * 1000, 2), 'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95), 'min_ms': round(values[0] * 1000, 2), 'max_ms': round(values[-1] * 1000, 2)}
+
+
+def run_benchmark(device_counts=DEFAULT_DEVICE_COUNTS, rounds: int = DEFAULT_ROUNDS, latency_ms: float = 0.0,
+                  sudo: str = 'nopasswd', endpoints: Optional[List[str]] = None,
+                  workdir: Optional[str] = None) -> List[Dict]:
+    """
+    Измерить задержки запросов приложения на поддельных инструментах
+
+    Приложение импортируется с БД и рабочим каталогом стенда, поэтому
+    функцию нужно вызывать в процессе, где app еще не импортирован.
+
+    Returns:
+        List[Dict]: По строке на (число устройств, запрос): задержки и запуски инструментов
+    """
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='hermetic-bench-'))
+    os.makedirs(workdir, exist_ok=True)
+    os.environ['USBIP_WEB_DB'] = os.path.join(workdir, 'bench.db')
+    os.environ.setdefault('USBIP_SERVER', '0')
+    os.environ.setdefault('FIDO_BACKUP_INTERVAL_HOURS', '0')
+    os.chdir(workdir)
+    if 'app' in sys.modules:
+        raise RuntimeError('app уже импортирован: стенд должен запускаться в отдельном процессе')
+    from app import app
+
+    selected = [entry for entry in BENCH_ENDPOINTS if not endpoints or entry[0] in endpoints]
+    results = []
+    for count in device_counts:
+        with FakeToolchain(os.path.join(workdir, f'devices-{count}'), count, latency_ms,
+                           attached=min(count, 8), sudo=sudo) as toolchain:
+            client = app.test_client()
+            client.post('/login', data={'username': 'admin', 'password': 'admin'})
+            target = toolchain.devices[-1].busid
+            for name, method, path in selected:
+                data = {'busid': target} if name == 'bind_device' else \
+                    {'ip': '10.0.0.2'} if name == 'get_remote_devices' else None
+                timings = []
+                for attempt in range(rounds + 1):
+                    if name == 'bind_device':
+                        toolchain.unbind_all()
+                    toolchain.take_calls()
+                    started = time.perf_counter()
+                    response = client.open(path, method=method, data=data)
+                    elapsed = time.perf_counter() - started
+                    if response.status_code != 200:
+                        raise RuntimeError(f'{method} {path}: HTTP {response.status_code}')
+                    calls = toolchain.take_calls()
+                    # Первый запрос - прогрев (шаблоны, соединение с БД)
+                    if attempt:
+                        timings.append(elapsed)
+                results.append({'devices': count, 'endpoint': name, 'rounds': rounds,
+                                'calls': calls, **_summary(timings)})
+    return results
+
+
+def _print_table(results: List[Dict]) -> None:
+    print(f'{"devices":>7}  {"endpoint":<20} {"mean":>9} {"p50":>9} {"p95":>9} {"max":>9}  tools')
+    for row in results:
+        calls = ' '.join(f'{name}={count}' for name, count in sorted(row['calls'].items()))
+        print(f'{row["devices"]:>7}  {row["endpoint"]:<20} {row["mean_ms"]:>7.1f}ms {row["p50_ms"]:>7.1f}ms '
+              f'{row["p95_ms"]:>7.1f}ms {row["max_ms"]:>7.1f}ms  {calls}')
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Герметичный стенд: поддельные usbip/lsusb/sysfs и измерения')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Измерить задержки запросов')
+    run.add_argument('--devices', default=','.join(map(str, DEFAULT_DEVICE_COUNTS)))
+    run.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS)
+    run.add_argument('--latency-ms', type=float, default=0.0, help='Задержка каждого запуска инструмента')
+    run.add_argument('--sudo', choices=('nopasswd', 'password'), default='nopasswd')
+    run.add_argument('--endpoint', action='append', choices=[entry[0] for entry in BENCH_ENDPOINTS])
+    run.add_argument('--workdir', help='Каталог стенда (по умолчанию временный, удаляется)')
+    run.add_argument('--json', action='store_true')
+
+    toolchain = commands.add_parser('toolchain', help='Только создать поддельные инструменты')
+    toolchain.add_argument('root')
+    toolchain.add_argument('--devices', type=int, default=1)
+    toolchain.add_argument('--latency-ms', type=float, default=0.0)
+    toolchain.add_argument('--sudo', choices=('nopasswd', 'password'), default='nopasswd')
+
+    remote = commands.add_parser('list-remote', help=argparse.SUPPRESS)
+    remote.add_argument('--port', type=int, required=True)
+    remote.add_argument('host', nargs='?', default='127.0.0.1')
+    args = parser.parse_args(argv)
+
+    if args.command == 'list-remote':
+        return asyncio.run(_list_remote(args.port, args.host))
+    if args.command == 'toolchain':
+        fake = FakeToolchain(args.root, args.devices, args.latency_ms, sudo=args.sudo).build()
+        print(f'{fake.bin} (usbip list -r ожидает стенд usbipd на порту {fake.usbipd_port})')
+        return 0
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='hermetic-bench-')
+    try:
+        results = run_benchmark([int(n) for n in args.devices.split(',')], args.rounds, args.latency_ms,
+                                args.sudo, args.endpoint, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import json
+import logging
+from datetime import datetime
+from flask import Blueprint, request, jsonify
+from flask_login import login_required
+from models import db, VirtualUsbDevice, HidScript, LogEntry
+from usb_hid import ScriptError, compile_device_script
+from usbip_server import refresh_usbip_exports
+
+# Настройка логгирования
+logger = logging.getLogger(__name__)
+
+# Создаем Blueprint для API сценариев HID-устройств
+hid_bp = Blueprint('hid', __name__)
+
+# Сколько последних сценариев показывать в списке
+SCRIPT_LIST_LIMIT = 50
+
+
+def script_to_dict(script):
+    return {
+        'id': script.id,
+        'device_id': script.device_id,
+        'status': script.status,
+        'reports_total': script.reports_total,
+        'reports_sent': script.reports_sent,
+        'max_lag_ms': script.max_lag_ms,
+        'error': script.error,
+        'created_at': script.created_at.isoformat() if script.created_at else None,
+        'started_at': script.started_at.isoformat() if script.started_at else None,
+        'finished_at': script.finished_at.isoformat() if script.finished_at else None
+    }
+
+
+def get_hid_device(device_id):
+    """Устройство типа hid или (None, ответ с ошибкой)"""
+    device = db.session.get(VirtualUsbDevice, device_id)
+    if device is None:
+        return None, (jsonify({'success': False, 'message': 'Устройство не найдено'}), 404)
+    if device.device_type != 'hid':
+        return None, (jsonify({'success': False, 'message': 'Сценарии доступны только для устройств типа "hid"'}), 400)
+    return device, None
+
+
+@hid_bp.route('/api/virtual_devices/<int:device_id>/hid/scripts', methods=['GET'])
+@login_required
+def list_hid_scripts(device_id):
+    """
+    Последние сценарии ввода устройства с состоянием проигрывания
+    """
+    device, error = get_hid_device(device_id)
+    if error:
+        return error
+    scripts = HidScript.query.filter_by(device_id=device.id) \
+        .order_by(HidScript.id.desc()).limit(SCRIPT_LIST_LIMIT).all()
+    return jsonify({'success': True, 'scripts': [script_to_dict(script) for script in scripts]})
+
+
+@hid_bp.route('/api/virtual_devices/<int:device_id>/hid/scripts', methods=['POST'])
+@login_required
+def queue_hid_script(device_id):
+    """
+    Поставить сценарий ввода в очередь подключенного HID-устройства
+
+    Тело запроса - JSON сценария (список шагов или {"steps": [...], "repeat": N},
+    см. usb_hid.compile_script). Сценарии устройства выполняются по очереди.
+    """
+    device, error = get_hid_device(device_id)
+    if error:
+        return error
+    if not device.is_active:
+        return jsonify({'success': False, 'message': 'Устройство не подключено к виртуальному порту'}), 409
+
+    script = request.get_json(silent=True)
+    if script is None:
+        return jsonify({'success': False, 'message': 'Ожидается JSON со сценарием'}), 400
+    try:
+        compiled = compile_device_script(device, script)
+    except ScriptError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    hid_script = HidScript(
+        device_id=device.id,
+        script_json=json.dumps(script),
+        reports_total=compiled.total_reports
+    )
+    db.session.add(hid_script)
+    db.session.add(LogEntry(
+        level='INFO',
+        message=f'Queued HID script for {device.name}: {compiled.total_reports} reports, '
+                f'{compiled.duration_ms * compiled.repeat / 1000:.1f} s',
+        source='virtual'
+    ))
+    db.session.commit()
+    refresh_usbip_exports()
+
+    return jsonify({
+        'success': True,
+        'message': 'Сценарий поставлен в очередь',
+        'script': script_to_dict(hid_script),
+        'duration_ms': round(compiled.duration_ms * compiled.repeat, 1)
+    })
+
+
+@hid_bp.route('/api/virtual_devices/<int:device_id>/hid/scripts/<int:script_id>/cancel', methods=['POST'])
+@login_required
+def cancel_hid_script(device_id, script_id):
+    """
+    Отменить сценарий (ожидающий - сразу, проигрываемый - при следующей сверке сервера)
+    """
+    device, error = get_hid_device(device_id)
+    if error:
+        return error
+    script = HidScript.query.filter_by(id=script_id, device_id=device.id).first()
+    if script is None:
+        return jsonify({'success': False, 'message': 'Сценарий не найден'}), 404
+    if script.status in ('done', 'failed', 'cancelled'):
+        return jsonify({'success': False, 'message': 'Сценарий уже завершен', 'script': script_to_dict(script)}), 409
+
+    if script.status == 'pending':
+        script.status = 'cancelled'
+        script.finished_at = datetime.utcnow()
+    else:
+        script.status = 'cancelling'
+    db.session.commit()
+    refresh_usbip_exports()
+    return jsonify({'success': True, 'message': 'Сценарий отменяется', 'script': script_to_dict(script)})
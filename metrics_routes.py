@@ -0,0 +1,30 @@
+import hmac
+import logging
+import os
+from flask import Blueprint, Response, abort, request
+from app_metrics import CONTENT_TYPE, TOKEN_ENV_VAR, metrics_enabled, scrape
+
+# Настройка логгирования
+logger = logging.getLogger(__name__)
+
+# Создаем Blueprint для экспорта метрик Prometheus
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.route('/metrics')
+def metrics_page():
+    """
+    Метрики всех рабочих процессов в текстовом формате Prometheus
+    (при заданном METRICS_TOKEN - только с заголовком Authorization: Bearer)
+    """
+    if not metrics_enabled():
+        abort(404)
+    token = os.environ.get(TOKEN_ENV_VAR)
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    try:
+        return Response(scrape(), content_type=CONTENT_TYPE)
+    except Exception as e:
+        logger.error(f"Ошибка сбора метрик: {e}")
+        return Response(f'# error: {e}\n', status=500, content_type=CONTENT_TYPE)
@@ -77,6 +77,7 @@ class VirtualUsbDevice(db.Model):
 
 class VirtualUsbFile(db.Model):
     __tablename__ = 'virtual_usb_files'
+    __table_args__ = (db.Index('ix_virtual_usb_files_device_path', 'device_id', 'file_path'),)
     id = db.Column(db.Integer, primary_key=True)
     device_id = db.Column(db.Integer, db.ForeignKey('virtual_usb_devices.id'))
     filename = db.Column(db.String(256), nullable=False)
@@ -92,6 +93,32 @@ class VirtualUsbFile(db.Model):
     def __repr__(self):
         return f'<VirtualUsbFile {self.filename} ({self.file_size} bytes)>'
 
+class StorageBlob(db.Model):
+    """Содержимое файла в общем хранилище блобов (дедупликация по хешу)"""
+    __tablename__ = 'storage_blobs'
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)  # Хеш содержимого (hex)
+    size = db.Column(db.BigInteger, default=0)  # Размер содержимого в байтах
+    ref_count = db.Column(db.Integer, default=0)  # Количество файлов устройств, ссылающихся на блоб
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StorageBlob {self.sha256[:12]} ({self.size} bytes, refs={self.ref_count})>'
+
+class StorageBlobRef(db.Model):
+    """Ссылка файла виртуального устройства на блоб"""
+    __tablename__ = 'storage_blob_refs'
+    __table_args__ = (db.UniqueConstraint('device_id', 'file_path', name='uq_blob_ref_device_path'),)
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('virtual_usb_devices.id'), nullable=False, index=True)
+    file_path = db.Column(db.String(512), nullable=False)  # Относительный путь внутри storage_path
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StorageBlobRef {self.device_id}:{self.file_path} -> {self.sha256[:12]}>'
+
 class VirtualUsbPort(db.Model):
     __tablename__ = 'virtual_usb_ports'
     id = db.Column(db.Integer, primary_key=True)
@@ -108,6 +135,61 @@ class VirtualUsbPort(db.Model):
     def __repr__(self):
         return f'<VirtualUsbPort {self.name} ({self.port_number})>'
 
+class VirtualUsbHub(db.Model):
+    """Виртуальный хаб топологии; хаб без родителя - корневой хаб шины"""
+    __tablename__ = 'virtual_usb_hubs'
+    __table_args__ = (db.UniqueConstraint('parent_hub_id', 'parent_port', name='uq_hub_parent_port'),)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    bus_number = db.Column(db.Integer, unique=True)  # Номер шины (только у корневого хаба)
+    parent_hub_id = db.Column(db.Integer, db.ForeignKey('virtual_usb_hubs.id'), index=True)
+    parent_port = db.Column(db.Integer)  # Порт родительского хаба (1..num_ports)
+    num_ports = db.Column(db.Integer, default=4)
+    speed = db.Column(db.String(8), default='high')  # full, high, super
+    periodic_slots = db.Column(db.Integer)  # Периодических конечных точек ниже хаба (None - по скорости)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    parent = db.relationship('VirtualUsbHub', remote_side=[id], backref=db.backref('children', lazy=True))
+
+    def __repr__(self):
+        return f'<VirtualUsbHub {self.name} ({self.num_ports} ports, {self.speed})>'
+
+class VirtualUsbPortLocation(db.Model):
+    """Место виртуального порта в топологии: порт хаба и бюджет пропускной способности"""
+    __tablename__ = 'virtual_usb_port_locations'
+    __table_args__ = (db.UniqueConstraint('hub_id', 'hub_port', name='uq_port_location_hub_port'),)
+    port_id = db.Column(db.Integer, db.ForeignKey('virtual_usb_ports.id'), primary_key=True)
+    hub_id = db.Column(db.Integer, db.ForeignKey('virtual_usb_hubs.id'), nullable=False, index=True)
+    hub_port = db.Column(db.Integer, nullable=False)  # 1..num_ports
+    bandwidth_budget = db.Column(db.Integer)  # Байт/с периодических передач на порт (None - без ограничения порта)
+    periodic_slots = db.Column(db.Integer)  # Периодических конечных точек на порт (None - без ограничения порта)
+
+    port = db.relationship('VirtualUsbPort', backref=db.backref('location', uselist=False, lazy=True))
+    hub = db.relationship('VirtualUsbHub', backref=db.backref('port_locations', lazy=True))
+
+    def __repr__(self):
+        return f'<VirtualUsbPortLocation port={self.port_id} hub={self.hub_id}:{self.hub_port}>'
+
+class HidScript(db.Model):
+    """Сценарий ввода для виртуального HID-устройства (очередь для сервера USB/IP)"""
+    __tablename__ = 'hid_scripts'
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('virtual_usb_devices.id'), nullable=False, index=True)
+    script_json = db.Column(db.Text, nullable=False)  # JSON со сценарием (см. usb_hid.compile_script)
+    status = db.Column(db.String(16), default='pending', index=True)  # pending, queued, running, done, failed, cancelling, cancelled
+    reports_total = db.Column(db.Integer, default=0)  # Количество отчетов в сценарии
+    reports_sent = db.Column(db.Integer, default=0)  # Отчетов передано хосту
+    max_lag_ms = db.Column(db.Float, default=0.0)  # Наибольшее опоздание отчета относительно расписания
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    device = db.relationship('VirtualUsbDevice', backref=db.backref('hid_scripts', lazy=True))
+
+    def __repr__(self):
+        return f'<HidScript {self.id} device={self.device_id} {self.status}>'
+
 
 class TerminalCommand(db.Model):
     __tablename__ = 'terminal_commands'
@@ -148,6 +230,59 @@ class FidoDevice(db.Model):
         return f'<FidoDevice {status} (PID: {self.pid})>'
 
 
+class FidoSetting(db.Model):
+    """Shared FIDO configuration (passphrase, vault path), common for all workers"""
+    __tablename__ = 'fido_settings'
+    
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Text, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<FidoSetting {self.key}>'
+
+
+class FidoInstance(db.Model):
+    """Additional virtual FIDO2 authenticator of the device pool (own vault and USB/IP port)"""
+    __tablename__ = 'fido_instances'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True, nullable=False)
+    port = db.Column(db.Integer, unique=True, nullable=False)  # TCP порт USB/IP сервера
+    vault_path = db.Column(db.String(512), nullable=False)
+    passphrase = db.Column(db.String(256), nullable=False)  # Нужен для запуска процесса (тестовые ключи)
+    auto_start = db.Column(db.Boolean, default=False)
+    lease_holder = db.Column(db.String(128), nullable=True, index=True)  # ID тестового задания
+    leased_at = db.Column(db.DateTime, nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<FidoInstance {self.name} (port {self.port})>'
+    
+    def is_leased(self, now=None):
+        """Lease is held and has not expired"""
+        now = now or datetime.utcnow()
+        return bool(self.lease_holder) and (self.lease_expires_at is None or self.lease_expires_at > now)
+    
+    def to_dict(self):
+        """Convert to dictionary for JSON serialization (without passphrase)"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'port': self.port,
+            'vault_path': self.vault_path,
+            'auto_start': self.auto_start,
+            'lease_holder': self.lease_holder if self.is_leased() else None,
+            'leased_at': self.leased_at.isoformat() if self.leased_at and self.is_leased() else None,
+            'lease_expires_at': self.lease_expires_at.isoformat() if self.lease_expires_at and self.is_leased() else None,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
 class FidoCredential(db.Model):
     """Metadata for FIDO2 credentials (not the actual credentials)"""
     __tablename__ = 'fido_credentials'
@@ -0,0 +1,71 @@
+import logging
+from flask import Blueprint, render_template, redirect, url_for, flash, jsonify, abort, Response
+from flask_login import login_required, current_user
+from request_profiler import list_traces, load_trace, load_collapsed_stacks, flatten_spans
+
+# Настройка логгирования
+logger = logging.getLogger(__name__)
+
+# Создаем Blueprint для просмотра трасс профилирования запросов
+profiler_bp = Blueprint('profiler', __name__)
+
+
+def admin_only():
+    """Ответ для не-администратора или None"""
+    if not current_user.is_admin:
+        flash('У вас нет прав доступа к админ-панели', 'danger')
+        return redirect(url_for('index'))
+    return None
+
+
+@profiler_bp.route('/admin/profiles')
+@login_required
+def profiles_page():
+    """
+    Последние трассы запросов (X-Profile: 1|stack, ?_profile=1 или PROFILE_SAMPLE_RATE)
+    """
+    denied = admin_only()
+    if denied:
+        return denied
+    return render_template('profiles.html', traces=list_traces())
+
+
+@profiler_bp.route('/admin/profiles/<trace_id>')
+@login_required
+def profile_page(trace_id):
+    """
+    Дерево интервалов трассы с долей каждого интервала во времени запроса
+    """
+    denied = admin_only()
+    if denied:
+        return denied
+    trace = load_trace(trace_id)
+    if trace is None:
+        abort(404)
+    return render_template('profiles.html', trace=trace, spans=flatten_spans(trace['root']))
+
+
+@profiler_bp.route('/admin/profiles/<trace_id>.json')
+@login_required
+def profile_json(trace_id):
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'}), 403
+    trace = load_trace(trace_id)
+    if trace is None:
+        return jsonify({'success': False, 'message': 'Трасса не найдена'}), 404
+    return jsonify({'success': True, 'trace': trace})
+
+
+@profiler_bp.route('/admin/profiles/<trace_id>/stacks.folded')
+@login_required
+def profile_stacks(trace_id):
+    """
+    Выборка стека в формате collapsed stacks (flamegraph.pl, speedscope)
+    """
+    if not current_user.is_admin:
+        abort(403)
+    stacks = load_collapsed_stacks(trace_id)
+    if stacks is None:
+        abort(404)
+    return Response(stacks, mimetype='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename={trace_id}.folded'})
@@ -0,0 +1,458 @@
+"""
+Профилирование отдельных запросов: дерево интервалов и выборка стека.
+
+Промежуточный слой WSGI (RequestProfiler) включается для запроса:
+  - заголовком X-Profile: 1 или параметром ?_profile=1 (значение stack -
+    дополнительно статистическая выборка стека). Флаг учитывается только в
+    сессии администратора, у остальных запросов он игнорируется;
+  - выборкой: PROFILE_SAMPLE_RATE=0.01 - каждый сотый запрос (без стека).
+
+Трасса - дерево интервалов: запрос, вызовы run_command (команда, код
+возврата), SQL-запросы, фиксации сессии и отрисовка шаблонов. Выборка стека
+сохраняется в формате collapsed stacks (flamegraph.pl, speedscope).
+
+Трассы пишутся в каталог PROFILE_DIR (по умолчанию virtual_storage/profiles),
+хранятся последние PROFILE_KEEP и видны всем рабочим процессам gunicorn;
+просмотр - страница /admin/profiles.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import functools
+import threading
+import itertools
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+# Переменные окружения
+SAMPLE_RATE_ENV_VAR = 'PROFILE_SAMPLE_RATE'
+PROFILE_DIR_ENV_VAR = 'PROFILE_DIR'
+PROFILE_KEEP_ENV_VAR = 'PROFILE_KEEP'
+STACK_INTERVAL_ENV_VAR = 'PROFILE_STACK_INTERVAL_MS'
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_QUERY_PARAM = '_profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+
+DEFAULT_KEEP = 50
+DEFAULT_STACK_INTERVAL_MS = 5
+
+# Предельная длина текста SQL и команды в трассе
+MAX_STATEMENT_LENGTH = 500
+
+# Режимы: интервалы или интервалы с выборкой стека
+MODE_SPANS = 'spans'
+MODE_STACK = 'stack'
+
+_local = threading.local()
+_counter = itertools.count(1)
+
+
+class Span:
+    """Интервал трассы"""
+
+    __slots__ = ('name', 'attrs', 'start', 'duration', 'children')
+
+    def __init__(self, name: str, attrs: Dict):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.children: List['Span'] = []
+
+    def to_dict(self, origin: float) -> Dict:
+        return {
+            'name': self.name,
+            'attrs': self.attrs,
+            'offset_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round((self.duration or 0) * 1000, 3),
+            'children': [child.to_dict(origin) for child in self.children]
+        }
+
+
+class Trace:
+    """Трасса одного запроса (принадлежит потоку, обрабатывающему запрос)"""
+
+    def __init__(self, method: str, path: str, mode: str, reason: str):
+        self.id = f'{datetime.now().strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{next(_counter)}'
+        self.started_at = datetime.utcnow()
+        self.mode = mode
+        self.reason = reason
+        self.keep = reason == 'sample'
+        self.root = Span('request', {'method': method, 'path': path})
+        self.stack: List[Span] = [self.root]
+        self.sampler: Optional[StackSampler] = None
+
+    def begin(self, name: str, **attrs) -> Span:
+        span = Span(name, attrs)
+        self.stack[-1].children.append(span)
+        self.stack.append(span)
+        return span
+
+    def end(self, span: Span, **attrs) -> None:
+        span.duration = time.perf_counter() - span.start
+        span.attrs.update(attrs)
+        if span in self.stack:
+            # Незакрытые вложенные интервалы (исключение посреди SQL) закрываются вместе с этим
+            while self.stack[-1] is not span:
+                inner = self.stack.pop()
+                inner.duration = time.perf_counter() - inner.start
+            self.stack.pop()
+
+    def finish(self) -> None:
+        while len(self.stack) > 1:
+            self.end(self.stack[-1])
+        self.root.duration = time.perf_counter() - self.root.start
+
+    def summary(self) -> Dict[str, Dict]:
+        """Число и время интервалов по видам (вложенные в интервал того же вида не суммируются)"""
+        totals: Dict[str, Dict] = {}
+
+        def walk(span: Span, counted: set):
+            for child in span.children:
+                entry = totals.setdefault(child.name, {'count': 0, 'total_ms': 0.0})
+                entry['count'] += 1
+                if child.name not in counted:
+                    entry['total_ms'] += (child.duration or 0) * 1000
+                walk(child, counted | {child.name})
+        walk(self.root, set())
+        for entry in totals.values():
+            entry['total_ms'] = round(entry['total_ms'], 3)
+        return totals
+
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'started_at': self.started_at.isoformat(),
+            'pid': os.getpid(),
+            'mode': self.mode,
+            'reason': self.reason,
+            'method': self.root.attrs.get('method'),
+            'path': self.root.attrs.get('path'),
+            'endpoint': self.root.attrs.get('endpoint'),
+            'status': self.root.attrs.get('status'),
+            'duration_ms': round((self.root.duration or 0) * 1000, 3),
+            'summary': self.summary(),
+            'stack_samples': self.sampler.total if self.sampler else 0,
+            'root': self.root.to_dict(self.root.start)
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def profile_span(name: str, **attrs):
+    """Интервал в трассе текущего запроса (без трассы ничего не делает)"""
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    span = trace.begin(name, **attrs)
+    try:
+        yield span
+    finally:
+        trace.end(span)
+
+
+def profiled_command(function):
+    """Декоратор run_command: интервал с командой, режимом sudo и кодом возврата"""
+    @functools.wraps(function)
+    def wrapper(command, *args, **kwargs):
+        trace = current_trace()
+        if trace is None:
+            return function(command, *args, **kwargs)
+        use_sudo = kwargs.get('use_sudo', args[0] if args else True)
+        span = trace.begin('run_command', argv=' '.join(map(str, command))[:MAX_STATEMENT_LENGTH], sudo=use_sudo)
+        result = None
+        try:
+            result = function(command, *args, **kwargs)
+            return result
+        finally:
+            trace.end(span, return_code=result[2] if result else None)
+    return wrapper
+
+
+# ----------------------------------------------------------------------
+# Выборка стека
+
+class StackSampler(threading.Thread):
+    """Периодически снимает стек потока запроса и считает одинаковые стеки"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self.total = 0
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            key = ';'.join(reversed(names))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.total += 1
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self) -> str:
+        """Строки "кадр;кадр;... число" для построения flamegraph"""
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.counts.items()))
+
+
+# ----------------------------------------------------------------------
+# Хранение трасс
+
+def profile_dir() -> str:
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR
+    return os.environ.get(PROFILE_DIR_ENV_VAR) or os.path.join(VIRTUAL_STORAGE_BASE_DIR, 'profiles')
+
+
+def _trace_path(trace_id: str, suffix: str) -> Optional[str]:
+    if not trace_id or os.path.basename(trace_id) != trace_id or trace_id.startswith('.'):
+        return None
+    return os.path.join(profile_dir(), trace_id + suffix)
+
+
+def save_trace(trace: Trace) -> None:
+    """Записать трассу и удалить самые старые сверх PROFILE_KEEP"""
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    data = trace.to_dict()
+    temporary = os.path.join(directory, f'.{trace.id}.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(data, f)
+    if trace.sampler is not None:
+        with open(os.path.join(directory, trace.id + '.folded'), 'w') as f:
+            f.write(trace.sampler.collapsed())
+    os.replace(temporary, os.path.join(directory, trace.id + '.json'))
+
+    keep = int(os.environ.get(PROFILE_KEEP_ENV_VAR, DEFAULT_KEEP))
+    names = sorted((name for name in os.listdir(directory) if name.endswith('.json')),
+                   key=lambda name: os.path.getmtime(os.path.join(directory, name)))
+    for name in names[:max(len(names) - keep, 0)]:
+        for suffix in ('.json', '.folded'):
+            try:
+                os.unlink(os.path.join(directory, name[:-5] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def list_traces() -> List[Dict]:
+    """Сохраненные трассы без дерева интервалов, новые первыми"""
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    traces = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        data.pop('root', None)
+        traces.append(data)
+    return sorted(traces, key=lambda t: t['started_at'], reverse=True)
+
+
+def load_trace(trace_id: str) -> Optional[Dict]:
+    path = _trace_path(trace_id, '.json')
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_collapsed_stacks(trace_id: str) -> Optional[str]:
+    path = _trace_path(trace_id, '.folded')
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+
+def flatten_spans(span: Dict, depth: int = 0) -> List[Dict]:
+    """Дерево интервалов построчно (с глубиной) для таблицы"""
+    rows = [dict(span, depth=depth)]
+    for child in span.get('children', []):
+        rows.extend(flatten_spans(child, depth + 1))
+    return rows
+
+
+# ----------------------------------------------------------------------
+# Промежуточный слой и события Flask/SQLAlchemy
+
+class RequestProfiler:
+    """
+    Промежуточный слой WSGI: трасса запроса при флаге или по выборке
+
+    Флаг учитывается только если authorize(environ) подтверждает сессию
+    администратора, иначе запрос профилируется разве что по выборке.
+    """
+
+    def __init__(self, wsgi_app, authorize: Optional[Callable[[Dict], bool]] = None):
+        self.wsgi_app = wsgi_app
+        self.authorize = authorize
+        try:
+            self.sample_rate = float(os.environ.get(SAMPLE_RATE_ENV_VAR, 0))
+        except ValueError:
+            self.sample_rate = 0.0
+        self.stack_interval = int(os.environ.get(STACK_INTERVAL_ENV_VAR, DEFAULT_STACK_INTERVAL_MS)) / 1000
+
+    def _mode(self, environ) -> Optional[tuple]:
+        flag = environ.get(PROFILE_HEADER)
+        query = environ.get('QUERY_STRING', '')
+        if flag is None and PROFILE_QUERY_PARAM in query:
+            flag = parse_qs(query).get(PROFILE_QUERY_PARAM, [None])[0]
+        if flag and flag.lower() not in ('0', 'false', 'no', 'off') and self._authorized(environ):
+            return (MODE_STACK if flag.lower() == MODE_STACK else MODE_SPANS), 'flag'
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return MODE_SPANS, 'sample'
+        return None
+
+    def _authorized(self, environ) -> bool:
+        if self.authorize is None:
+            return False
+        try:
+            return self.authorize(environ)
+        except Exception as e:
+            logger.error(f"Ошибка проверки прав на профилирование: {e}")
+            return False
+
+    def __call__(self, environ, start_response):
+        selected = self._mode(environ)
+        if selected is None:
+            return self.wsgi_app(environ, start_response)
+
+        mode, reason = selected
+        trace = Trace(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), mode, reason)
+
+        def profiled_start_response(status, headers, exc_info=None):
+            trace.root.attrs['status'] = int(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        _local.trace = trace
+        if mode == MODE_STACK:
+            trace.sampler = StackSampler(threading.get_ident(), self.stack_interval)
+            trace.sampler.start()
+        try:
+            return self.wsgi_app(environ, profiled_start_response)
+        finally:
+            _local.trace = None
+            if trace.sampler is not None:
+                trace.sampler.stop()
+            trace.finish()
+            if trace.keep:
+                try:
+                    save_trace(trace)
+                except OSError as e:
+                    logger.error(f"Не удалось сохранить трассу {trace.id}: {e}")
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = current_trace()
+    if trace is not None:
+        span = trace.begin('sql', statement=statement[:MAX_STATEMENT_LENGTH], executemany=executemany)
+        conn.info.setdefault('profile_spans', []).append(span)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = current_trace()
+    spans = conn.info.get('profile_spans')
+    if trace is not None and spans:
+        trace.end(spans.pop(), rows=cursor.rowcount)
+
+
+def _handle_error(exception_context):
+    trace = current_trace()
+    connection = exception_context.connection
+    spans = connection.info.get('profile_spans') if connection is not None else None
+    if trace is not None and spans:
+        trace.end(spans.pop(), error=str(exception_context.original_exception)[:MAX_STATEMENT_LENGTH])
+
+
+def _before_commit(session):
+    trace = current_trace()
+    if trace is not None:
+        session.info['profile_commit'] = trace.begin('db.commit')
+
+
+def _after_commit(session):
+    trace = current_trace()
+    span = session.info.pop('profile_commit', None)
+    if trace is not None and span is not None:
+        trace.end(span)
+
+
+def _before_render_template(sender, template, context, **extra):
+    trace = current_trace()
+    if trace is not None:
+        _local.template_spans = getattr(_local, 'template_spans', []) + [trace.begin('template', template=template.name)]
+
+
+def _template_rendered(sender, template, context, **extra):
+    trace = current_trace()
+    spans = getattr(_local, 'template_spans', None)
+    if trace is not None and spans:
+        trace.end(spans.pop())
+
+
+def init_request_profiler(app) -> None:
+    """Подключить профилирование запросов к приложению"""
+    from flask import before_render_template, template_rendered
+    from flask_login import current_user
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import Session
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    event.listen(Session, 'before_commit', _before_commit)
+    event.listen(Session, 'after_commit', _after_commit)
+    event.listen(Session, 'after_rollback', _after_commit)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+    def is_admin_session(environ) -> bool:
+        # Сессия проверяется до запуска трассы, чтобы флаг анонимного или
+        # обычного пользователя не запускал сэмплер стеков
+        with app.request_context(environ):
+            return current_user.is_authenticated and current_user.is_admin
+
+    @app.after_request
+    def finish_profile(response):
+        from flask import request
+        trace = current_trace()
+        if trace is None:
+            return response
+        trace.root.attrs['endpoint'] = request.endpoint
+        if trace.reason == 'flag':
+            # Флаг профилирования учитывается только для администратора
+            trace.keep = current_user.is_authenticated and current_user.is_admin
+        if trace.keep:
+            response.headers[PROFILE_ID_HEADER] = trace.id
+        return response
+
+    app.wsgi_app = RequestProfiler(app.wsgi_app, is_admin_session)
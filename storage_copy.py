@@ -0,0 +1,578 @@
+"""
+Копирование, перемещение и клонирование файлов и целых хранилищ на стороне сервера.
+
+Файлы копируются без передачи данных через браузер: сначала пробуется reflink
+(FICLONE, btrfs/xfs), затем os.copy_file_range (копирование в ядре), и только
+потом обычное копирование. Разреженные области (например, в образах дисков)
+пропускаются через SEEK_DATA/SEEK_HOLE. Перемещение внутри устройства - это
+rename. Записи VirtualUsbFile копируются и обновляются одним запросом
+INSERT ... SELECT / UPDATE; при копировании записи фиксируются только после
+того, как данные скопированы полностью.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import logging
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Dict, Optional, Tuple, List, Iterator
+
+from sqlalchemy import func, literal, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, VirtualUsbDevice, VirtualUsbFile
+from fat_image import FatImage, FatError
+import storage_dedup
+import storage_trash
+
+logger = logging.getLogger(__name__)
+
+# Размер блока при копировании без reflink
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class ChunkReader:
+    """
+    Файлоподобная обертка над итератором блоков (для FatImage.write_file)
+
+    read(size) возвращает ровно size байт (меньше - только в конце данных),
+    независимо от размеров блоков источника.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data = bytes(self.buffer) + b''.join(self.chunks)
+            self.buffer.clear()
+            return data
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def data_segments(fd: int, size: int) -> Iterator[Tuple[int, int]]:
+    """
+    Участки файла, содержащие данные (дыры разреженного файла пропускаются)
+
+    Returns:
+        Iterator[Tuple[int, int]]: (смещение, длина)
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Дальше только дыра
+                return
+            # SEEK_DATA/SEEK_HOLE не поддерживается (EINVAL и т.п.) - читаем остаток целиком
+            yield offset, size - offset
+            return
+        except AttributeError:
+            yield offset, size - offset
+            return
+        yield start, min(end, size) - start
+        offset = end
+
+
+def clone_file(src: str, dst: str) -> str:
+    """
+    Скопировать файл наиболее дешевым доступным способом
+
+    Args:
+        src: Исходный файл
+        dst: Файл назначения (перезаписывается)
+
+    Returns:
+        str: Использованный метод ('reflink', 'copy_file_range' или 'copy')
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        try:
+            fcntl.ioctl(dst_fd, storage_dedup.FICLONE, src_fd)
+            method = 'reflink'
+        except OSError:
+            size = os.fstat(src_fd).st_size
+            method = 'copy_file_range'
+            for offset, length in data_segments(src_fd, size):
+                copied = 0
+                while copied < length:
+                    pos = offset + copied
+                    if method == 'copy_file_range':
+                        try:
+                            n = os.copy_file_range(src_fd, dst_fd, min(length - copied, COPY_CHUNK_SIZE), pos, pos)
+                        except (OSError, AttributeError):
+                            method = 'copy'
+                            continue
+                    else:
+                        chunk = os.pread(src_fd, min(length - copied, COPY_CHUNK_SIZE), pos)
+                        n = os.pwrite(dst_fd, chunk, pos) if chunk else 0
+                    if n == 0:
+                        break
+                    copied += n
+            # Размер задается явно, чтобы хвостовая дыра осталась дырой
+            os.ftruncate(dst_fd, size)
+    shutil.copymode(src, dst)
+    return method
+
+
+def copy_tree(src_dir: str, dst_dir: str) -> Dict[str, str]:
+    """
+    Рекурсивно скопировать директорию (каждый файл через clone_file)
+
+    Returns:
+        Dict[str, str]: Метод копирования каждого файла по пути относительно src_dir
+    """
+    methods = {}
+    os.makedirs(dst_dir, exist_ok=False)
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames[:] = [d for d in dirnames if not storage_trash.is_trash_name(d)]
+        target_dir = os.path.join(dst_dir, os.path.relpath(dirpath, src_dir))
+        for dirname in dirnames:
+            os.makedirs(os.path.join(target_dir, dirname), exist_ok=True)
+        for filename in filenames:
+            rel_path = os.path.relpath(os.path.join(dirpath, filename), src_dir).replace('\\', '/')
+            methods[rel_path] = clone_file(os.path.join(dirpath, filename), os.path.join(target_dir, filename))
+    return methods
+
+
+def join_path(base: str, name: str) -> str:
+    return f"{base}/{name}" if base else name
+
+
+def item_kind(device: VirtualUsbDevice, clean_path: str, image: Optional[FatImage] = None) -> Optional[str]:
+    """
+    Определить тип элемента хранилища
+
+    Returns:
+        Optional[str]: 'file', 'directory' или None, если элемента нет
+    """
+    from virtual_storage_utils import is_image_storage
+    if not clean_path:
+        return 'directory'
+    if is_image_storage(device):
+        if image is not None:
+            entry = image.lookup(clean_path)
+        else:
+            with FatImage(device.storage_path) as img:
+                entry = img.lookup(clean_path)
+        if entry is None:
+            return None
+        return 'directory' if entry.is_dir else 'file'
+    full_path = os.path.join(device.storage_path, clean_path)
+    if os.path.isdir(full_path):
+        return 'directory'
+    if os.path.lexists(full_path):
+        return 'file'
+    return None
+
+
+def item_size(device: VirtualUsbDevice, clean_path: str, image: Optional[FatImage] = None) -> int:
+    """
+    Логический размер файла или директории в байтах
+    """
+    if image is not None:
+        entry = image.lookup(clean_path)
+        if not entry.is_dir:
+            return entry.size
+        return sum(f.size for _, _, files in image.walk(entry.cluster, clean_path) for f in files)
+    full_path = os.path.join(device.storage_path, clean_path)
+    if not os.path.isdir(full_path):
+        return os.path.getsize(full_path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(full_path):
+        dirnames[:] = [d for d in dirnames if not storage_trash.is_trash_name(d)]
+        total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+    return total
+
+
+def copy_file_records(src_device_id: int, src_path: str, dst_device_id: int, dst_path: str) -> None:
+    """
+    Скопировать записи VirtualUsbFile одним запросом INSERT ... SELECT (без коммита)
+
+    Args:
+        src_device_id: ID исходного устройства
+        src_path: Исходный путь (пустая строка - все записи устройства)
+        dst_device_id: ID целевого устройства
+        dst_path: Целевой путь
+    """
+    now = datetime.utcnow()
+    conditions = [VirtualUsbFile.device_id == src_device_id]
+    if src_path:
+        conditions.append(db.or_(
+            VirtualUsbFile.file_path == src_path,
+            db.and_(VirtualUsbFile.file_path >= src_path + '/', VirtualUsbFile.file_path < src_path + '0')
+        ))
+        new_path = literal(dst_path) + func.substr(VirtualUsbFile.file_path, len(src_path) + 1)
+    else:
+        new_path = VirtualUsbFile.file_path
+
+    # Для одиночного файла меняется и имя файла
+    new_filename = db.case(
+        (VirtualUsbFile.file_path == src_path, literal(os.path.basename(dst_path))),
+        else_=VirtualUsbFile.filename
+    ) if src_path else VirtualUsbFile.filename
+
+    source = select(
+        literal(dst_device_id), new_filename, new_path, VirtualUsbFile.file_size,
+        VirtualUsbFile.file_type, literal(now), literal(now)
+    ).where(*conditions)
+
+    if dst_path:
+        # Записи, которые наблюдатель системных папок успел создать по скопированным файлам
+        VirtualUsbFile.query.filter(
+            VirtualUsbFile.device_id == dst_device_id,
+            db.or_(VirtualUsbFile.file_path == dst_path,
+                   db.and_(VirtualUsbFile.file_path >= dst_path + '/', VirtualUsbFile.file_path < dst_path + '0'))
+        ).delete(synchronize_session=False)
+
+    db.session.execute(insert(VirtualUsbFile).from_select(
+        ['device_id', 'filename', 'file_path', 'file_size', 'file_type', 'created_at', 'updated_at'],
+        source
+    ))
+
+
+def copy_linked_refs(src_device_id: int, src_path: str, dst_device_id: int, dst_path: str,
+                     methods: Dict[str, str]) -> None:
+    """
+    Скопировать ссылки на блобы только для файлов, скопированных через reflink
+    (их данные остаются общими с блобом); обычная копия - независимый файл (без коммита)
+
+    Args:
+        methods: Метод копирования по пути относительно src_path ('' - сам src_path)
+    """
+    if methods and all(method == 'reflink' for method in methods.values()):
+        storage_dedup.copy_refs(src_device_id, src_path, dst_device_id, dst_path)
+        return
+    for rel_path, method in methods.items():
+        if method == 'reflink':
+            storage_dedup.copy_refs(src_device_id, join_path(src_path, rel_path) if rel_path else src_path,
+                                    dst_device_id, join_path(dst_path, rel_path) if rel_path else dst_path)
+
+
+def move_file_records(device_id: int, src_path: str, dst_path: str) -> None:
+    """
+    Обновить пути записей VirtualUsbFile при перемещении одним запросом UPDATE (без коммита)
+    """
+    VirtualUsbFile.query.filter(
+        VirtualUsbFile.device_id == device_id,
+        VirtualUsbFile.file_path == src_path
+    ).update({VirtualUsbFile.file_path: dst_path, VirtualUsbFile.filename: os.path.basename(dst_path)},
+             synchronize_session=False)
+    VirtualUsbFile.query.filter(
+        VirtualUsbFile.device_id == device_id,
+        VirtualUsbFile.file_path >= src_path + '/',
+        VirtualUsbFile.file_path < src_path + '0'
+    ).update({VirtualUsbFile.file_path: literal(dst_path) + func.substr(VirtualUsbFile.file_path, len(src_path) + 1)},
+             synchronize_session=False)
+    storage_dedup.move_refs(device_id, src_path, dst_path)
+
+
+def iter_local_file(path: str) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def stream_copy(src_device: VirtualUsbDevice, src_path: str, src_image: Optional[FatImage],
+                dst_device: VirtualUsbDevice, dst_path: str, dst_image: Optional[FatImage]) -> int:
+    """
+    Копирование с участием образа диска: данные читаются и пишутся блоками на сервере
+
+    Returns:
+        int: Количество скопированных файлов
+    """
+    # Список (тип, исходный путь, целевой путь, источник данных)
+    items = []
+    if src_image is not None:
+        entry = src_image.lookup(src_path)
+        if not entry.is_dir:
+            items.append(('file', dst_path, lambda e=entry: src_image.iter_file(e)))
+        else:
+            items.append(('directory', dst_path, None))
+            for rel_dir, dirs, files in src_image.walk(entry.cluster, src_path):
+                target_dir = dst_path + rel_dir[len(src_path):]
+                items.extend(('directory', join_path(target_dir, d.name), None) for d in dirs)
+                items.extend(('file', join_path(target_dir, f.name), lambda e=f: src_image.iter_file(e)) for f in files)
+    else:
+        root = os.path.join(src_device.storage_path, src_path)
+        if not os.path.isdir(root):
+            items.append(('file', dst_path, lambda p=root: iter_local_file(p)))
+        else:
+            items.append(('directory', dst_path, None))
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if not storage_trash.is_trash_name(d)]
+                rel = os.path.relpath(dirpath, root).replace('\\', '/')
+                target_dir = dst_path if rel == '.' else join_path(dst_path, rel)
+                items.extend(('directory', join_path(target_dir, d), None) for d in dirnames)
+                items.extend(('file', join_path(target_dir, f), lambda p=os.path.join(dirpath, f): iter_local_file(p))
+                             for f in filenames)
+
+    count = 0
+    for kind, target, source in items:
+        if dst_image is not None:
+            if kind == 'directory':
+                dst_image.make_dir(target)
+            else:
+                dst_image.write_file(target, ChunkReader(source()))
+                count += 1
+        else:
+            full_target = os.path.join(dst_device.storage_path, target)
+            if kind == 'directory':
+                os.makedirs(full_target, exist_ok=True)
+            else:
+                with open(full_target, 'wb') as f:
+                    for chunk in source():
+                        f.write(chunk)
+                count += 1
+    return count
+
+
+def open_images(stack: ExitStack, src_device: VirtualUsbDevice, dst_device: VirtualUsbDevice) -> Tuple[Optional[FatImage], Optional[FatImage]]:
+    """
+    Открыть образы устройств, участвующих в копировании.
+    Образы открываются в порядке путей, чтобы встречные копирования не взаимоблокировались.
+    """
+    from virtual_storage_utils import is_image_storage
+    wanted = {}
+    if is_image_storage(src_device):
+        wanted[src_device.storage_path] = False
+    if is_image_storage(dst_device):
+        wanted[dst_device.storage_path] = True
+
+    handles = {}
+    for path in sorted(wanted):
+        handles[path] = stack.enter_context(FatImage(path, writable=wanted[path]))
+
+    src_image = handles.get(src_device.storage_path) if is_image_storage(src_device) else None
+    dst_image = handles.get(dst_device.storage_path) if is_image_storage(dst_device) else None
+    return src_image, dst_image
+
+
+def resolve_destination(dst_device: VirtualUsbDevice, src_path: str, dst_path: str,
+                        image: Optional[FatImage]) -> str:
+    """
+    Если назначение - существующая директория, элемент помещается внутрь нее (как в cp/mv)
+    """
+    if item_kind(dst_device, dst_path, image) == 'directory':
+        return join_path(dst_path, os.path.basename(src_path))
+    return dst_path
+
+
+def check_storage(device: VirtualUsbDevice) -> Optional[str]:
+    if device.device_type != 'storage' or not device.storage_path or not os.path.exists(device.storage_path):
+        return f"Хранилище устройства {device.name} недоступно"
+    return None
+
+
+def copy_item(src_device: VirtualUsbDevice, src_path: str, dst_device: VirtualUsbDevice,
+              dst_path: str) -> Tuple[bool, Optional[str]]:
+    """
+    Скопировать файл или директорию внутри устройства или между устройствами
+
+    Args:
+        src_device: Исходное устройство
+        src_path: Путь исходного элемента
+        dst_device: Целевое устройство (может совпадать с исходным)
+        dst_path: Путь назначения (существующая директория или новое имя)
+
+    Returns:
+        Tuple[bool, Optional[str]]: (успешность, сообщение об ошибке)
+    """
+    from virtual_storage_utils import normalize_path, get_device_storage_usage, is_image_storage
+
+    error = check_storage(src_device) or check_storage(dst_device)
+    if error:
+        return False, error
+
+    src_path = normalize_path(src_path).strip('/')
+    dst_path = normalize_path(dst_path).strip('/')
+    if not src_path:
+        return False, "Невозможно скопировать корневую директорию"
+
+    target = None
+    try:
+        with ExitStack() as stack:
+            src_image, dst_image = open_images(stack, src_device, dst_device)
+
+            kind = item_kind(src_device, src_path, src_image)
+            if kind is None:
+                return False, "Исходный элемент не найден"
+
+            target = resolve_destination(dst_device, src_path, dst_path, dst_image)
+            if item_kind(dst_device, target, dst_image) is not None:
+                return False, "Элемент с таким именем уже существует"
+            if item_kind(dst_device, os.path.dirname(target), dst_image) != 'directory':
+                return False, "Целевая директория не существует"
+            if src_device.id == dst_device.id and kind == 'directory' and \
+                    (target == src_path or target.startswith(src_path + '/')):
+                return False, "Невозможно скопировать директорию внутрь самой себя"
+
+            # Квота целевого устройства (для образа ее проверяет сама ФС образа)
+            if dst_image is None:
+                size = item_size(src_device, src_path, src_image)
+                used = get_device_storage_usage(dst_device)
+                if used + size > (dst_device.storage_size or 0) * 1024 * 1024:
+                    return False, "Недостаточно места в целевом хранилище"
+
+            # Сначала данные, затем записи в БД: неудачное копирование не оставляет записей
+            methods = {}
+            if src_image is None and dst_image is None:
+                src_full = os.path.join(src_device.storage_path, src_path)
+                dst_full = os.path.join(dst_device.storage_path, target)
+                if kind == 'directory':
+                    methods = copy_tree(src_full, dst_full)
+                else:
+                    methods = {'': clone_file(src_full, dst_full)}
+                count = len(methods)
+            else:
+                count = stream_copy(src_device, src_path, src_image, dst_device, target, dst_image)
+
+            copy_file_records(src_device.id, src_path, dst_device.id, target)
+            copy_linked_refs(src_device.id, src_path, dst_device.id, target, methods)
+            db.session.commit()
+
+        logger.info(f"Скопировано {count} файлов: {src_device.name}:{src_path} -> {dst_device.name}:{target}")
+        return True, None
+    except (OSError, FatError, SQLAlchemyError) as e:
+        logger.error(f"Ошибка при копировании {src_path}: {e}")
+        db.session.rollback()
+        if target:
+            # Откатываем частично выполненное копирование
+            from virtual_storage_utils import delete_item
+            delete_item(dst_device, target)
+        return False, str(e)
+
+
+def move_item(device: VirtualUsbDevice, src_path: str, dst_path: str) -> Tuple[bool, Optional[str]]:
+    """
+    Переместить (переименовать) файл или директорию внутри устройства
+
+    Args:
+        device: Модель виртуального устройства
+        src_path: Текущий путь элемента
+        dst_path: Путь назначения (существующая директория или новое имя)
+
+    Returns:
+        Tuple[bool, Optional[str]]: (успешность, сообщение об ошибке)
+    """
+    from virtual_storage_utils import normalize_path, is_image_storage
+
+    error = check_storage(device)
+    if error:
+        return False, error
+
+    src_path = normalize_path(src_path).strip('/')
+    dst_path = normalize_path(dst_path).strip('/')
+    if not src_path:
+        return False, "Невозможно переместить корневую директорию"
+
+    try:
+        with ExitStack() as stack:
+            image = None
+            if is_image_storage(device):
+                image = stack.enter_context(FatImage(device.storage_path, writable=True))
+
+            kind = item_kind(device, src_path, image)
+            if kind is None:
+                return False, "Исходный элемент не найден"
+
+            target = resolve_destination(device, src_path, dst_path, image)
+            if target == src_path:
+                return True, None
+            if kind == 'directory' and target.startswith(src_path + '/'):
+                return False, "Невозможно переместить директорию внутрь самой себя"
+            if item_kind(device, target, image) is not None:
+                return False, "Элемент с таким именем уже существует"
+            if item_kind(device, os.path.dirname(target), image) != 'directory':
+                return False, "Целевая директория не существует"
+
+            move_file_records(device.id, src_path, target)
+            if image is not None:
+                image.rename(src_path, target)
+            else:
+                os.rename(os.path.join(device.storage_path, src_path), os.path.join(device.storage_path, target))
+            db.session.commit()
+
+        logger.info(f"Перемещен элемент {src_path} -> {target} для устройства {device.name}")
+        return True, None
+    except (OSError, FatError) as e:
+        logger.error(f"Ошибка при перемещении {src_path}: {e}")
+        db.session.rollback()
+        return False, str(e)
+
+
+def clone_device(device: VirtualUsbDevice, name: str) -> Tuple[Optional[VirtualUsbDevice], Optional[str]]:
+    """
+    Клонировать устройство хранения вместе с содержимым в новое виртуальное устройство.
+    Клон всегда получает собственное виртуальное хранилище (даже если исходное - системная папка).
+
+    Args:
+        device: Исходное устройство
+        name: Имя нового устройства
+
+    Returns:
+        Tuple[Optional[VirtualUsbDevice], Optional[str]]: (новое устройство, сообщение об ошибке)
+    """
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR, ensure_storage_dir_exists, is_image_storage
+
+    error = check_storage(device)
+    if error:
+        return None, error
+
+    clone = VirtualUsbDevice(
+        name=name,
+        device_type=device.device_type,
+        vendor_id=device.vendor_id,
+        product_id=device.product_id,
+        serial_number=device.serial_number,
+        config_json=device.config_json,
+        storage_size=device.storage_size,
+        is_system_path=False
+    )
+    db.session.add(clone)
+    db.session.flush()
+
+    ensure_storage_dir_exists()
+    image = is_image_storage(device)
+    target = os.path.join(VIRTUAL_STORAGE_BASE_DIR, f"device_{clone.id}" + ('.img' if image else ''))
+
+    try:
+        methods = {}
+        if image:
+            # Блокировка исходного образа на время копирования, reflink копирует за O(1)
+            with FatImage(device.storage_path):
+                method = clone_file(device.storage_path, target)
+        else:
+            method = 'tree'
+            methods = copy_tree(device.storage_path, target)
+
+        clone.storage_path = target
+        copy_file_records(device.id, '', clone.id, '')
+        copy_linked_refs(device.id, '', clone.id, '', methods)
+        db.session.commit()
+    except (OSError, FatError, SQLAlchemyError) as e:
+        logger.error(f"Ошибка при клонировании устройства {device.name}: {e}")
+        db.session.rollback()
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        elif os.path.exists(target):
+            os.remove(target)
+        return None, str(e)
+
+    logger.info(f"Устройство {device.name} клонировано в {clone.name} ({method})")
+    return clone, None
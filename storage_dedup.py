@@ -0,0 +1,442 @@
+"""
+Дедуплицирующее хранилище содержимого для виртуальных USB-накопителей.
+
+Содержимое файлов хранится один раз в общем каталоге блобов
+(virtual_storage/.blobs/<xx>/<sha256>), а деревья устройств содержат
+reflink-копии или жесткие ссылки на блобы. Количество ссылок ведется
+в таблице storage_blobs, привязка файлов устройств к блобам - в storage_blob_refs.
+
+Режим включается переменной окружения VIRTUAL_STORAGE_DEDUP=1 и применяется
+только к виртуальным хранилищам (системные папки не затрагиваются).
+"""
+
+import os
+import fcntl
+import hashlib
+import logging
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+
+from sqlalchemy import func
+from models import db, StorageBlob, StorageBlobRef
+
+logger = logging.getLogger(__name__)
+
+# Переменная окружения для включения дедупликации
+DEDUP_ENV_VAR = 'VIRTUAL_STORAGE_DEDUP'
+
+# Имя каталога с блобами внутри базовой директории виртуальных хранилищ
+BLOB_DIR_NAME = '.blobs'
+
+# Размер блока чтения при вычислении хеша
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# ioctl FICLONE (linux/fs.h): reflink всего файла на btrfs/xfs
+FICLONE = 0x40049409
+
+# Сборка мусора не трогает блобы, записанные или использованные за последний
+# час: ingest_file мог поместить блоб, но вызывающий код еще не закоммитил ссылку
+GC_GRACE_SECONDS = 3600
+
+
+def is_dedup_enabled() -> bool:
+    """
+    Проверить, включен ли режим дедупликации
+    """
+    return os.environ.get(DEDUP_ENV_VAR, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def get_blob_store_dir() -> str:
+    """
+    Получить путь к каталогу блобов (создается при необходимости)
+    """
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR
+    blob_dir = os.path.join(VIRTUAL_STORAGE_BASE_DIR, BLOB_DIR_NAME)
+    os.makedirs(blob_dir, exist_ok=True)
+    return blob_dir
+
+
+def blob_path(digest: str) -> str:
+    """
+    Путь к файлу блоба по его хешу
+
+    Args:
+        digest: SHA-256 содержимого (hex)
+
+    Returns:
+        str: Путь к файлу блоба
+    """
+    return os.path.join(get_blob_store_dir(), digest[:2], digest)
+
+
+def is_valid_digest(digest: Optional[str]) -> bool:
+    """
+    Проверить, что строка похожа на SHA-256 в hex
+    """
+    if not digest or len(digest) != 64:
+        return False
+    try:
+        int(digest, 16)
+        return True
+    except ValueError:
+        return False
+
+
+def hash_file(path: str) -> Tuple[str, int]:
+    """
+    Вычислить SHA-256 и размер файла
+
+    Args:
+        path: Путь к файлу
+
+    Returns:
+        Tuple[str, int]: (хеш в hex, размер в байтах)
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+def clone_or_link(source: str, destination: str) -> str:
+    """
+    Разместить содержимое source по пути destination без копирования данных.
+
+    Сначала пробуется reflink (FICLONE), затем жесткая ссылка. Файл создается
+    под временным именем и атомарно переименовывается, поэтому существующий
+    файл назначения заменяется, а не перезаписывается на месте.
+
+    Args:
+        source: Путь к блобу
+        destination: Путь к файлу в дереве устройства
+
+    Returns:
+        str: Использованный метод ('reflink' или 'hardlink')
+    """
+    dest_dir = os.path.dirname(destination) or '.'
+    tmp_path = os.path.join(dest_dir, f".link-{uuid.uuid4().hex}")
+    method = 'hardlink'
+
+    try:
+        try:
+            with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            method = 'reflink'
+        except OSError:
+            # Файловая система не поддерживает reflink - используем жесткую ссылку
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            os.link(source, tmp_path)
+
+        os.replace(tmp_path, destination)
+        return method
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def find_blob(digest: str) -> Optional[StorageBlob]:
+    """
+    Найти блоб по хешу (только если его файл действительно существует)
+
+    Args:
+        digest: SHA-256 содержимого
+
+    Returns:
+        Optional[StorageBlob]: Запись о блобе или None
+    """
+    if not is_valid_digest(digest):
+        return None
+    blob = StorageBlob.query.filter_by(sha256=digest.lower()).first()
+    if blob and os.path.exists(blob_path(blob.sha256)):
+        return blob
+    return None
+
+
+def _set_ref(device_id: int, rel_path: str, digest: str) -> None:
+    """
+    Привязать файл устройства к блобу, освободив предыдущую привязку
+    """
+    ref = StorageBlobRef.query.filter_by(device_id=device_id, file_path=rel_path).first()
+    if ref:
+        if ref.sha256 == digest:
+            return
+        StorageBlob.query.filter_by(sha256=ref.sha256).update(
+            {StorageBlob.ref_count: StorageBlob.ref_count - 1}, synchronize_session=False)
+        ref.sha256 = digest
+    else:
+        db.session.add(StorageBlobRef(device_id=device_id, file_path=rel_path, sha256=digest))
+
+    StorageBlob.query.filter_by(sha256=digest).update(
+        {StorageBlob.ref_count: StorageBlob.ref_count + 1,
+         StorageBlob.last_used_at: datetime.utcnow()},
+        synchronize_session=False)
+
+
+def _touch_blob(path: str) -> None:
+    """
+    Отметить использование блоба (ctime), чтобы сборка мусора не удалила его
+    до фиксации новой ссылки
+    """
+    try:
+        os.utime(path)
+    except OSError as e:
+        logger.debug(f"Не удалось обновить время блоба {path}: {e}")
+
+
+def _recently_used(path: str, now: float) -> bool:
+    """Файл блоба создан или использован в пределах GC_GRACE_SECONDS"""
+    try:
+        return now - os.stat(path).st_ctime < GC_GRACE_SECONDS
+    except FileNotFoundError:
+        return False
+
+
+def ingest_file(device, tmp_path: str, rel_path: str) -> Tuple[str, int, bool]:
+    """
+    Поместить загруженный файл в хранилище блобов и связать его с деревом устройства.
+
+    Изменения в БД не коммитятся - это делает вызывающий код.
+
+    Args:
+        device: Модель виртуального устройства
+        tmp_path: Временный файл с загруженным содержимым (удаляется или перемещается)
+        rel_path: Путь файла относительно storage_path
+
+    Returns:
+        Tuple[str, int, bool]: (хеш, размер, было ли содержимое уже в хранилище)
+    """
+    digest, size = hash_file(tmp_path)
+    target = blob_path(digest)
+    blob = StorageBlob.query.filter_by(sha256=digest).first()
+    reused = blob is not None and os.path.exists(target)
+
+    if reused:
+        os.remove(tmp_path)
+        _touch_blob(target)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(tmp_path, target)
+        # Блоб только для чтения: содержимое меняется только заменой ссылки
+        os.chmod(target, 0o444)
+        if not blob:
+            blob = StorageBlob(sha256=digest, size=size, ref_count=0)
+            db.session.add(blob)
+            db.session.flush()
+
+    clone_or_link(target, os.path.join(device.storage_path, rel_path))
+    _set_ref(device.id, rel_path, digest)
+
+    logger.debug(f"Дедупликация: {rel_path} -> {digest[:12]} ({'повтор' if reused else 'новый блоб'})")
+    return digest, size, reused
+
+
+def link_existing_blob(device, digest: str, rel_path: str) -> Optional[int]:
+    """
+    Создать файл в дереве устройства из уже известного блоба (загрузка по хешу).
+
+    Args:
+        device: Модель виртуального устройства
+        digest: SHA-256 содержимого
+        rel_path: Путь файла относительно storage_path
+
+    Returns:
+        Optional[int]: Размер файла или None, если блоб неизвестен
+    """
+    blob = find_blob(digest)
+    if not blob:
+        return None
+
+    _touch_blob(blob_path(blob.sha256))
+    clone_or_link(blob_path(blob.sha256), os.path.join(device.storage_path, rel_path))
+    _set_ref(device.id, rel_path, blob.sha256)
+    return blob.size
+
+
+def refs_query(device_id: int, rel_path: Optional[str] = None):
+    """
+    Запрос ссылок на блобы для файла или поддерева устройства
+    """
+    query = StorageBlobRef.query.filter(StorageBlobRef.device_id == device_id)
+    if rel_path:
+        rel_path = rel_path.strip('/')
+        query = query.filter(db.or_(
+            StorageBlobRef.file_path == rel_path,
+            db.and_(StorageBlobRef.file_path >= rel_path + '/',
+                    StorageBlobRef.file_path < rel_path + '0')
+        ))
+    return query
+
+
+def release_refs(device_id: int, rel_path: Optional[str] = None) -> int:
+    """
+    Освободить ссылки файлов устройства на блобы (при удалении файлов).
+
+    Изменения в БД не коммитятся - это делает вызывающий код.
+
+    Args:
+        device_id: ID виртуального устройства
+        rel_path: Путь файла или директории; None - все файлы устройства
+
+    Returns:
+        int: Количество освобожденных ссылок
+    """
+    query = refs_query(device_id, rel_path)
+    counts = (query.with_entities(StorageBlobRef.sha256, func.count(StorageBlobRef.id))
+              .group_by(StorageBlobRef.sha256).all())
+    if not counts:
+        return 0
+
+    for digest, count in counts:
+        StorageBlob.query.filter_by(sha256=digest).update(
+            {StorageBlob.ref_count: StorageBlob.ref_count - count}, synchronize_session=False)
+
+    released = query.delete(synchronize_session=False)
+    logger.debug(f"Освобождено {released} ссылок на блобы для устройства {device_id}")
+    return released
+
+
+def copy_refs(src_device_id: int, src_path: str, dst_device_id: int, dst_path: str) -> int:
+    """
+    Скопировать ссылки на блобы при копировании файлов между путями/устройствами.
+
+    Изменения в БД не коммитятся - это делает вызывающий код.
+
+    Args:
+        src_device_id: ID исходного устройства
+        src_path: Исходный путь (пустая строка - все устройство)
+        dst_device_id: ID целевого устройства
+        dst_path: Целевой путь
+
+    Returns:
+        int: Количество скопированных ссылок
+    """
+    src_path = src_path.strip('/')
+    dst_path = dst_path.strip('/')
+    refs = refs_query(src_device_id, src_path).with_entities(StorageBlobRef.file_path, StorageBlobRef.sha256).all()
+    if not refs:
+        return 0
+
+    counts = {}
+    for file_path, digest in refs:
+        suffix = file_path[len(src_path):].lstrip('/') if src_path else file_path
+        new_path = f"{dst_path}/{suffix}".strip('/') if suffix else dst_path
+        db.session.add(StorageBlobRef(device_id=dst_device_id, file_path=new_path, sha256=digest))
+        counts[digest] = counts.get(digest, 0) + 1
+
+    for digest, count in counts.items():
+        StorageBlob.query.filter_by(sha256=digest).update(
+            {StorageBlob.ref_count: StorageBlob.ref_count + count}, synchronize_session=False)
+    return len(refs)
+
+
+def move_refs(device_id: int, src_path: str, dst_path: str) -> int:
+    """
+    Обновить пути ссылок на блобы при перемещении внутри устройства (без коммита)
+    """
+    src_path = src_path.strip('/')
+    return refs_query(device_id, src_path).update(
+        {StorageBlobRef.file_path: db.literal(dst_path.strip('/')) + func.substr(StorageBlobRef.file_path, len(src_path) + 1)},
+        synchronize_session=False)
+
+
+def collect_garbage() -> Dict[str, Any]:
+    """
+    Удалить блобы, на которые не ссылается ни один файл устройства.
+
+    Счетчики ссылок пересчитываются по таблице storage_blob_refs, затем удаляются
+    блобы с нулевым счетчиком и файлы в каталоге блобов без записи в БД.
+    Блобы, записанные или использованные за последние GC_GRACE_SECONDS, не
+    удаляются: их ссылки могут быть еще не закоммичены другим запросом.
+
+    Returns:
+        Dict[str, Any]: Статистика сборки мусора
+    """
+    ref_counts = dict(
+        db.session.query(StorageBlobRef.sha256, func.count(StorageBlobRef.id))
+        .group_by(StorageBlobRef.sha256).all()
+    )
+
+    removed = 0
+    freed_bytes = 0
+    known = set()
+    now = time.time()
+
+    for blob in StorageBlob.query.all():
+        actual = ref_counts.get(blob.sha256, 0)
+        if actual > 0:
+            known.add(blob.sha256)
+            if blob.ref_count != actual:
+                blob.ref_count = actual
+            continue
+
+        path = blob_path(blob.sha256)
+        if _recently_used(path, now):
+            known.add(blob.sha256)
+            continue
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+                freed_bytes += blob.size or 0
+        except OSError as e:
+            logger.error(f"Не удалось удалить блоб {blob.sha256}: {e}")
+            known.add(blob.sha256)
+            continue
+        db.session.delete(blob)
+        removed += 1
+
+    db.session.commit()
+
+    # Файлы-сироты (например, после прерванной загрузки)
+    orphans = 0
+    blob_dir = get_blob_store_dir()
+    for dirpath, _, filenames in os.walk(blob_dir):
+        for filename in filenames:
+            if filename not in known:
+                full_path = os.path.join(dirpath, filename)
+                if _recently_used(full_path, now):
+                    continue
+                try:
+                    freed_bytes += os.path.getsize(full_path)
+                    os.remove(full_path)
+                    orphans += 1
+                except OSError as e:
+                    logger.error(f"Не удалось удалить файл-сироту {full_path}: {e}")
+
+    logger.info(f"Сборка мусора блобов: удалено {removed} блобов и {orphans} сирот, освобождено {freed_bytes} байт")
+    return {
+        'removed_blobs': removed,
+        'removed_orphans': orphans,
+        'freed_bytes': freed_bytes
+    }
+
+
+def get_dedup_stats() -> Dict[str, Any]:
+    """
+    Получить статистику хранилища блобов
+
+    Returns:
+        Dict[str, Any]: Количество блобов, физический и логический объем
+    """
+    blob_count, physical, logical = db.session.query(
+        func.count(StorageBlob.id),
+        func.coalesce(func.sum(StorageBlob.size), 0),
+        func.coalesce(func.sum(StorageBlob.size * StorageBlob.ref_count), 0)
+    ).one()
+
+    return {
+        'enabled': is_dedup_enabled(),
+        'blob_count': blob_count,
+        'physical_bytes': int(physical),
+        'logical_bytes': int(logical),
+        'saved_bytes': max(0, int(logical) - int(physical))
+    }
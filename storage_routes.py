@@ -1,14 +1,18 @@
 import os
 import logging
-from flask import Blueprint, render_template, redirect, url_for, request, flash, send_file, abort
+from urllib.parse import quote
+from flask import Blueprint, render_template, redirect, url_for, request, flash, send_file, abort, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 from models import db, VirtualUsbDevice, VirtualUsbFile, LogEntry
 from virtual_storage_utils import (
     create_device_storage, delete_device_storage, resize_device_storage,
     get_device_storage_usage, list_device_files, create_directory,
-    delete_item, upload_file, get_storage_stats, download_file
+    delete_item, upload_file, upload_file_by_hash, get_storage_stats, download_file,
+    download_image_file, is_image_storage
 )
+import storage_dedup
+from storage_copy import copy_item, move_item, clone_device
 
 # Настройка логгирования
 logger = logging.getLogger(__name__)
@@ -83,7 +87,9 @@ def manage_storage(device_id, path=None):
         files=files,
         stats=stats,
         current_path=path,
-        parent_path=parent_path
+        parent_path=parent_path,
+        storage_devices=VirtualUsbDevice.query.filter_by(device_type='storage').order_by(VirtualUsbDevice.name).all(),
+        dedup_enabled=storage_dedup.is_dedup_enabled() and not device.is_system_path and not is_image_storage(device)
     )
 
 @storage_bp.route('/storage/<int:device_id>/resize', methods=['POST'])
@@ -111,6 +117,10 @@ def resize_storage(device_id):
         flash('Размер хранилища должен быть от 1 МБ до 16 ГБ', 'warning')
         return redirect(url_for('storage.manage_storage', device_id=device_id))
     
+    if is_image_storage(device):
+        flash('Изменение размера недоступно для хранилища в виде образа диска', 'warning')
+        return redirect(url_for('storage.manage_storage', device_id=device_id))
+    
     # Изменяем размер хранилища
     success = resize_device_storage(device, new_size)
     
@@ -322,6 +332,65 @@ def upload_storage_file(device_id):
     
     return redirect(url_for('storage.manage_storage', device_id=device_id, path=current_path))
 
+@storage_bp.route('/storage/<int:device_id>/upload_by_hash', methods=['POST'])
+@login_required
+def upload_storage_file_by_hash(device_id):
+    """
+    Загрузка файла по хешу содержимого (без передачи данных, если содержимое уже известно)
+    """
+    device = VirtualUsbDevice.query.get_or_404(device_id)
+    
+    data = request.get_json(silent=True) or request.form
+    digest = (data.get('sha256') or '').lower()
+    filename = data.get('filename', '')
+    current_path = normalize_path(data.get('current_path', '/'))
+    
+    if not storage_dedup.is_valid_digest(digest) or not filename:
+        return jsonify({'success': False, 'found': False, 'error': 'Не указан хеш или имя файла'}), 400
+    
+    file_entry = upload_file_by_hash(device, digest, filename, current_path)
+    if not file_entry:
+        # Содержимое неизвестно - клиент должен выполнить обычную загрузку
+        return jsonify({'success': False, 'found': False})
+    
+    log_entry = LogEntry(
+        level='INFO',
+        message=f'Загружен файл {file_entry.filename} для устройства {device.name} (по хешу {digest[:12]})',
+        source='system'
+    )
+    db.session.add(log_entry)
+    db.session.commit()
+    
+    return jsonify({'success': True, 'found': True, 'filename': file_entry.filename, 'file_size': file_entry.file_size})
+
+@storage_bp.route('/storage/blobs/gc', methods=['POST'])
+@login_required
+def collect_storage_garbage():
+    """
+    Сборка мусора в хранилище блобов (только для администраторов)
+    """
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Недостаточно прав'}), 403
+    
+    try:
+        result = storage_dedup.collect_garbage()
+    except Exception as e:
+        logger.error(f"Ошибка при сборке мусора в хранилище блобов: {str(e)}")
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    log_entry = LogEntry(
+        level='INFO',
+        message=f"Сборка мусора блобов: удалено {result['removed_blobs']}, освобождено {result['freed_bytes']} байт",
+        source='system'
+    )
+    db.session.add(log_entry)
+    db.session.commit()
+    
+    result['success'] = True
+    result['stats'] = storage_dedup.get_dedup_stats()
+    return jsonify(result)
+
 @storage_bp.route('/storage/<int:device_id>/delete_item', methods=['POST'])
 @login_required
 def delete_storage_item(device_id):
@@ -385,10 +454,6 @@ def delete_storage_item(device_id):
             
             flash(f'{element_type.capitalize()} успешно удален(а)', 'success')
             
-            # Пауза перед перенаправлением для гарантированного завершения операций
-            import time
-            time.sleep(0.5)
-            
             # Если мы находимся в корневой директории, всегда перенаправляем туда же после удаления
             if current_path == '/':
                 logger.debug(f"Удаление в корневой директории, остаемся в корне")
@@ -420,6 +485,106 @@ def delete_storage_item(device_id):
     # В случае успешного удаления обычного файла или другой ошибки, остаемся в текущей директории
     return redirect(url_for('storage.manage_storage', device_id=device_id, path=current_path))
 
+@storage_bp.route('/storage/<int:device_id>/copy', methods=['POST'])
+@login_required
+def copy_storage_item(device_id):
+    """
+    Копирование файла или директории на стороне сервера (внутри устройства или на другое устройство)
+    """
+    device = VirtualUsbDevice.query.get_or_404(device_id)
+
+    source_path = request.form.get('source_path', '')
+    destination_path = request.form.get('destination_path', '')
+    current_path = normalize_path(request.form.get('current_path', '/'))
+
+    target_device = device
+    target_device_id = request.form.get('target_device_id', type=int)
+    if target_device_id and target_device_id != device.id:
+        target_device = VirtualUsbDevice.query.get_or_404(target_device_id)
+
+    success, error_message = copy_item(device, source_path, target_device, destination_path)
+
+    if success:
+        log_entry = LogEntry(
+            level='INFO',
+            message=f'Скопирован элемент {source_path} устройства {device.name} в {target_device.name}:{destination_path or "/"}',
+            source='system'
+        )
+        db.session.add(log_entry)
+        db.session.commit()
+
+        flash('Элемент успешно скопирован', 'success')
+    else:
+        flash(f'Не удалось скопировать элемент: {error_message}', 'danger')
+
+    return redirect(url_for('storage.manage_storage', device_id=device_id, path=current_path))
+
+@storage_bp.route('/storage/<int:device_id>/move', methods=['POST'])
+@login_required
+def move_storage_item(device_id):
+    """
+    Перемещение (переименование) файла или директории внутри устройства
+    """
+    device = VirtualUsbDevice.query.get_or_404(device_id)
+
+    source_path = request.form.get('source_path', '')
+    destination_path = request.form.get('destination_path', '')
+    current_path = normalize_path(request.form.get('current_path', '/'))
+
+    success, error_message = move_item(device, source_path, destination_path)
+
+    if success:
+        log_entry = LogEntry(
+            level='INFO',
+            message=f'Перемещен элемент {source_path} в {destination_path or "/"} для устройства {device.name}',
+            source='system'
+        )
+        db.session.add(log_entry)
+        db.session.commit()
+
+        flash('Элемент успешно перемещен', 'success')
+
+        # Текущая директория могла быть перемещена вместе с элементом
+        source_clean = normalize_path(source_path).strip('/')
+        current_clean = current_path.strip('/')
+        if current_clean == source_clean or current_clean.startswith(source_clean + '/'):
+            return redirect(url_for('storage.manage_storage', device_id=device_id))
+    else:
+        flash(f'Не удалось переместить элемент: {error_message}', 'danger')
+
+    return redirect(url_for('storage.manage_storage', device_id=device_id, path=current_path))
+
+@storage_bp.route('/storage/<int:device_id>/clone', methods=['POST'])
+@login_required
+def clone_storage_device(device_id):
+    """
+    Клонирование устройства хранения вместе с содержимым
+    """
+    device = VirtualUsbDevice.query.get_or_404(device_id)
+
+    if device.device_type != 'storage':
+        flash('Клонирование доступно только для устройств типа "storage"', 'warning')
+        return redirect(url_for('virtual_devices'))
+
+    name = request.form.get('name', '').strip() or f'{device.name} (копия)'
+
+    clone, error_message = clone_device(device, name)
+
+    if clone is None:
+        flash(f'Не удалось клонировать устройство: {error_message}', 'danger')
+        return redirect(url_for('storage.manage_storage', device_id=device_id))
+
+    log_entry = LogEntry(
+        level='INFO',
+        message=f'Устройство {device.name} клонировано в новое устройство {clone.name}',
+        source='system'
+    )
+    db.session.add(log_entry)
+    db.session.commit()
+
+    flash(f'Устройство успешно клонировано: {clone.name}', 'success')
+    return redirect(url_for('virtual_devices'))
+
 @storage_bp.route('/storage/<int:device_id>/download/<path:file_path>', methods=['GET'])
 @login_required
 def download_storage_file(device_id, file_path):
@@ -435,6 +600,26 @@ def download_storage_file(device_id, file_path):
     logger.debug(f"Скачивание файла: устройство_id={device_id}, путь файла={file_path}")
     
     try:
+        # Файлы образа диска отдаем потоком прямо из образа
+        if is_image_storage(device):
+            stream, filename, file_size = download_image_file(device, file_path)
+            if stream is None:
+                flash('Файл не найден', 'warning')
+                return redirect(url_for('storage.manage_storage', device_id=device_id))
+            
+            log_entry = LogEntry(
+                level='INFO',
+                message=f'Скачан файл {file_path} для устройства {device.name}',
+                source='system'
+            )
+            db.session.add(log_entry)
+            db.session.commit()
+            
+            response = Response(stream_with_context(stream), mimetype='application/octet-stream')
+            response.headers['Content-Length'] = str(file_size)
+            response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+            return response
+        
         # Получаем путь к файлу для скачивания
         full_path, filename = download_file(device, file_path)
         
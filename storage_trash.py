@@ -0,0 +1,215 @@
+"""
+Корзина для быстрого удаления файлов и директорий виртуальных хранилищ.
+
+Удаляемый элемент переименовывается в каталог корзины (одна операция rename
+независимо от размера дерева), а физическое удаление выполняет фоновый поток.
+Для системных папок на другой файловой системе (rename между ФС невозможен)
+используется скрытая корзина внутри самой папки.
+
+Поток очистки работает только в одном процессе (блокировка
+.storage_trash.lock); локальные корзины остальных процессов записываются
+в общий список .storage_trash_dirs, который читает этот поток.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import threading
+import time
+import uuid
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Имя общей корзины внутри базовой директории виртуальных хранилищ
+TRASH_DIR_NAME = '.trash'
+
+# Имя скрытой корзины внутри системной папки (если общая на другой ФС)
+LOCAL_TRASH_DIR_NAME = '.usbip_trash'
+
+# Блокировка процесса, очищающего корзины, и общий список локальных корзин
+PURGER_LOCK_FILE = '.storage_trash.lock'
+TRASH_DIRS_FILE = '.storage_trash_dirs'
+
+# Интервал проверки корзин процессом очистки (секунды): элементы, перемещенные
+# другими процессами, удаляются не позже чем через этот интервал
+PURGE_POLL_INTERVAL = 5
+
+# Корзины, которые нужно очищать (общая + локальные в системных папках)
+_trash_dirs = set()
+_trash_lock = threading.Lock()
+_purge_event = threading.Event()
+_purger = None
+_purger_lock_fd = None
+
+
+def _storage_file(name: str) -> str:
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR, ensure_storage_dir_exists
+    ensure_storage_dir_exists()
+    return os.path.join(VIRTUAL_STORAGE_BASE_DIR, name)
+
+
+def _update_registered_dirs(add: Optional[str] = None, remove: Optional[str] = None) -> set:
+    """
+    Прочитать (и при необходимости изменить) общий список локальных корзин
+
+    Returns:
+        set: Зарегистрированные локальные корзины
+    """
+    with open(_storage_file(TRASH_DIRS_FILE), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        dirs = set(filter(None, f.read().splitlines()))
+        changed = (add and add not in dirs) or (remove and remove in dirs)
+        if add:
+            dirs.add(add)
+        if remove:
+            dirs.discard(remove)
+        if changed:
+            f.seek(0)
+            f.truncate()
+            f.write(''.join(f"{d}\n" for d in sorted(dirs)))
+    return dirs
+
+
+def get_trash_dir() -> str:
+    """
+    Получить путь к общей корзине (создается при необходимости)
+    """
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR
+    trash_dir = os.path.join(VIRTUAL_STORAGE_BASE_DIR, TRASH_DIR_NAME)
+    os.makedirs(trash_dir, exist_ok=True)
+    return trash_dir
+
+
+def is_trash_name(name: str) -> bool:
+    """
+    Проверить, является ли имя служебным каталогом корзины (скрывается из списков)
+    """
+    return name in (TRASH_DIR_NAME, LOCAL_TRASH_DIR_NAME)
+
+
+def move_to_trash(full_path: str, storage_root: Optional[str] = None) -> str:
+    """
+    Переместить файл или директорию в корзину
+
+    Args:
+        full_path: Полный путь к удаляемому элементу
+        storage_root: Корень хранилища (для локальной корзины при EXDEV)
+
+    Returns:
+        str: Путь элемента в корзине
+    """
+    trash_name = f"{int(time.time())}-{uuid.uuid4().hex}"
+    trash_dir = get_trash_dir()
+    target = os.path.join(trash_dir, trash_name)
+
+    try:
+        os.rename(full_path, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV or not storage_root:
+            raise
+        # Общая корзина на другой файловой системе - используем локальную
+        trash_dir = os.path.join(storage_root, LOCAL_TRASH_DIR_NAME)
+        os.makedirs(trash_dir, exist_ok=True)
+        target = os.path.join(trash_dir, trash_name)
+        os.rename(full_path, target)
+
+    if trash_dir.endswith(LOCAL_TRASH_DIR_NAME):
+        _update_registered_dirs(add=trash_dir)
+    ensure_purger_started()
+    _purge_event.set()
+
+    logger.debug(f"Элемент {full_path} перемещен в корзину: {target}")
+    return target
+
+
+def purge_trash() -> int:
+    """
+    Физически удалить содержимое всех известных корзин
+
+    Returns:
+        int: Количество удаленных элементов
+    """
+    with _trash_lock:
+        trash_dirs = list(_trash_dirs)
+    trash_dirs.extend(_update_registered_dirs() - set(trash_dirs))
+
+    removed = 0
+    for trash_dir in trash_dirs:
+        try:
+            names = os.listdir(trash_dir)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(trash_dir, name)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError as e:
+                logger.error(f"Не удалось очистить элемент корзины {path}: {e}")
+        if trash_dir.endswith(LOCAL_TRASH_DIR_NAME):
+            # Локальную корзину не оставляем в системной папке пользователя
+            try:
+                os.rmdir(trash_dir)
+                _update_registered_dirs(remove=trash_dir)
+            except FileNotFoundError:
+                _update_registered_dirs(remove=trash_dir)
+            except OSError:
+                pass
+
+    if removed:
+        logger.info(f"Очищена корзина хранилищ: удалено {removed} элементов")
+    return removed
+
+
+def purge_loop() -> None:
+    while True:
+        _purge_event.wait(PURGE_POLL_INTERVAL)
+        _purge_event.clear()
+        try:
+            purge_trash()
+        except Exception as e:
+            logger.error(f"Ошибка при очистке корзины: {e}")
+
+
+def acquire_purger_lock() -> Optional[int]:
+    """
+    Захватить блокировку очистки корзин (очищает только один процесс)
+
+    Returns:
+        Optional[int]: Дескриптор файла блокировки или None, если она занята
+    """
+    fd = os.open(_storage_file(PURGER_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def ensure_purger_started() -> None:
+    """
+    Запустить фоновый поток очистки корзины, если блокировку очистки не
+    держит другой процесс (при его завершении поток запустится в процессе,
+    который следующим переместит элемент в корзину).
+    При запуске очищаются и остатки корзин от прошлых запусков.
+    """
+    global _purger, _purger_lock_fd
+    with _trash_lock:
+        if _purger is not None:
+            return
+        lock_fd = acquire_purger_lock()
+        if lock_fd is None:
+            return
+        _purger_lock_fd = lock_fd
+        _trash_dirs.add(get_trash_dir())
+        _purger = threading.Thread(target=purge_loop, name='storage-trash-purger', daemon=True)
+        _purger.start()
+    _purge_event.set()
@@ -0,0 +1,619 @@
+"""
+Синхронизация индекса файлов (VirtualUsbFile) для устройств с системными папками.
+
+Файлы, добавленные в системную папку в обход веб-интерфейса, раньше не попадали
+в базу данных. Фоновый поток следит за такими папками через inotify (ctypes,
+без внешних зависимостей) и превращает события создания, удаления и перемещения
+в пакетные вставки/обновления/удаления записей. При старте выполняется
+параллельное сканирование дерева с ключом по mtime - меняются только записи,
+у которых изменились размер или время модификации.
+
+Если inotify недоступен, используется периодический опрос тем же сканером.
+Наблюдатель запускается только в одном процессе (блокировка файла), поэтому
+несколько воркеров gunicorn не дублируют работу.
+"""
+
+import os
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import queue
+import select
+import struct
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from typing import Dict, List, Tuple, Optional
+
+from models import db, VirtualUsbDevice, VirtualUsbFile
+from storage_trash import is_trash_name
+
+logger = logging.getLogger(__name__)
+
+# Переменная окружения для отключения наблюдателя
+WATCHER_ENV_VAR = 'STORAGE_WATCHER'
+
+# Интервал сброса накопленных событий в БД (секунды)
+FLUSH_INTERVAL = 0.5
+
+# Максимальный размер пакета событий до принудительного сброса
+MAX_BATCH_SIZE = 500
+
+# Размер порции для запросов с IN (...)
+SQL_CHUNK_SIZE = 500
+
+# Интервал опроса при недоступности inotify (секунды)
+POLL_INTERVAL = 10
+
+# Интервал проверки списка устройств в БД (новые/удаленные системные папки)
+RESYNC_INTERVAL = 30
+
+# Количество потоков для начального сканирования
+SCAN_WORKERS = 4
+
+# Флаги inotify (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# Операции в очереди изменений
+OP_UPSERT = 'upsert'
+OP_DELETE = 'delete'
+OP_DELETE_TREE = 'delete_tree'
+
+# Единственный экземпляр наблюдателя в процессе
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+class Inotify:
+    """Минимальная обертка над inotify через ctypes"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd: int) -> None:
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> List[Tuple[int, int, int, str]]:
+        """
+        Прочитать доступные события: список (wd, mask, cookie, name)
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def scan_directory(root: str, rel_dir: str) -> Tuple[Dict[str, Tuple[int, float]], List[str]]:
+    """
+    Просканировать одну директорию
+
+    Args:
+        root: Корень хранилища
+        rel_dir: Путь директории относительно корня
+
+    Returns:
+        Tuple: ({путь файла: (размер, mtime)}, [пути поддиректорий])
+    """
+    files = {}
+    dirs = []
+    try:
+        with os.scandir(os.path.join(root, rel_dir)) as it:
+            for entry in it:
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if is_trash_name(entry.name):
+                            continue
+                        dirs.append(rel_path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files[rel_path] = (st.st_size, st.st_mtime)
+                except OSError:
+                    continue
+    except OSError as e:
+        logger.debug(f"Не удалось просканировать {rel_dir or '/'} в {root}: {e}")
+    return files, dirs
+
+
+def scan_tree(root: str, rel_dir: str = '', workers: int = SCAN_WORKERS) -> Tuple[Dict[str, Tuple[int, float]], List[str]]:
+    """
+    Параллельно просканировать дерево директорий
+
+    Args:
+        root: Корень хранилища
+        rel_dir: Поддиректория, с которой начинать
+        workers: Количество потоков
+
+    Returns:
+        Tuple: ({путь файла: (размер, mtime)}, [пути всех поддиректорий])
+    """
+    files = {}
+    dirs = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan_directory, root, rel_dir)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                sub_files, sub_dirs = future.result()
+                files.update(sub_files)
+                dirs.extend(sub_dirs)
+                for sub_dir in sub_dirs:
+                    pending.add(pool.submit(scan_directory, root, sub_dir))
+    return files, dirs
+
+
+def file_type_for(path: str) -> str:
+    _, extension = os.path.splitext(path)
+    return extension.lower().lstrip('.') if extension else 'unknown'
+
+
+def mtime_to_datetime(mtime: float) -> datetime:
+    return datetime.utcfromtimestamp(mtime).replace(microsecond=0)
+
+
+def reconcile_device(device_id: int, files: Dict[str, Tuple[int, float]], prefix: str = '') -> Tuple[int, int, int]:
+    """
+    Привести записи VirtualUsbFile в соответствие с результатом сканирования.
+
+    Запись считается устаревшей, если изменился размер или mtime файла
+    (время изменения файла сохраняется в updated_at).
+
+    Args:
+        device_id: ID устройства
+        files: Результат сканирования {путь: (размер, mtime)}
+        prefix: Если задан, сверяются только записи внутри этой поддиректории
+
+    Returns:
+        Tuple[int, int, int]: (добавлено, обновлено, удалено)
+    """
+    query = db.session.query(VirtualUsbFile.id, VirtualUsbFile.file_path,
+                             VirtualUsbFile.file_size, VirtualUsbFile.updated_at
+                             ).filter(VirtualUsbFile.device_id == device_id)
+    if prefix:
+        query = query.filter(VirtualUsbFile.file_path >= prefix + '/',
+                             VirtualUsbFile.file_path < prefix + '0')
+
+    existing = {row.file_path: row for row in query.all()}
+
+    inserts = []
+    updates = []
+    for path, (size, mtime) in files.items():
+        modified = mtime_to_datetime(mtime)
+        row = existing.pop(path, None)
+        if row is None:
+            inserts.append({
+                'device_id': device_id,
+                'filename': os.path.basename(path),
+                'file_path': path,
+                'file_size': size,
+                'file_type': file_type_for(path),
+                'created_at': modified,
+                'updated_at': modified
+            })
+        elif row.file_size != size or row.updated_at is None or row.updated_at != modified:
+            updates.append({'id': row.id, 'file_size': size, 'updated_at': modified})
+
+    stale_ids = [row.id for row in existing.values()]
+
+    if inserts:
+        db.session.bulk_insert_mappings(VirtualUsbFile, inserts)
+    if updates:
+        db.session.bulk_update_mappings(VirtualUsbFile, updates)
+    for i in range(0, len(stale_ids), SQL_CHUNK_SIZE):
+        VirtualUsbFile.query.filter(VirtualUsbFile.id.in_(stale_ids[i:i + SQL_CHUNK_SIZE])).delete(synchronize_session=False)
+    db.session.commit()
+
+    return len(inserts), len(updates), len(stale_ids)
+
+
+class StorageWatcher(threading.Thread):
+    """Фоновый поток, поддерживающий индекс файлов системных папок"""
+
+    def __init__(self, app):
+        super().__init__(name='storage-watcher', daemon=True)
+        self.app = app
+        self.commands = queue.Queue()
+        self.devices = {}    # device_id -> корень хранилища
+        self.watches = {}    # wd -> (device_id, относительный путь директории)
+        self.pending = {}    # (device_id, путь) -> операция
+        self.pending_since = None
+        self.inotify = None
+        self.stopped = threading.Event()
+
+    # ---- Управление списком устройств ----
+
+    def add_device(self, device_id: int, root: str) -> None:
+        if device_id in self.devices:
+            self.remove_device(device_id)
+        if not os.path.isdir(root):
+            logger.warning(f"Системная папка устройства {device_id} недоступна: {root}")
+            return
+
+        self.devices[device_id] = root
+        if self.inotify:
+            # Ставим наблюдение до сканирования, чтобы не потерять события между ними
+            self.add_watches(device_id, '')
+        self.full_scan(device_id)
+
+    def remove_device(self, device_id: int) -> None:
+        self.devices.pop(device_id, None)
+        for wd, (dev_id, _) in list(self.watches.items()):
+            if dev_id == device_id:
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+        for key in [k for k in self.pending if k[0] == device_id]:
+            del self.pending[key]
+
+    def add_watches(self, device_id: int, rel_dir: str) -> List[str]:
+        """
+        Рекурсивно поставить наблюдение на директорию и ее поддиректории
+        """
+        root = self.devices[device_id]
+        dirs = [rel_dir]
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            try:
+                wd = self.inotify.add_watch(os.path.join(root, current))
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.error("Исчерпан лимит inotify (fs.inotify.max_user_watches)")
+                    return dirs
+                continue
+            self.watches[wd] = (device_id, current)
+            try:
+                with os.scandir(os.path.join(root, current)) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False) and not is_trash_name(entry.name):
+                            child = f"{current}/{entry.name}" if current else entry.name
+                            dirs.append(child)
+                            stack.append(child)
+            except OSError:
+                continue
+        return dirs
+
+    def drop_watches(self, device_id: int, rel_dir: str) -> None:
+        for wd, (dev_id, path) in list(self.watches.items()):
+            if dev_id == device_id and (path == rel_dir or path.startswith(rel_dir + '/')):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def root_lost(self, device_id: int) -> None:
+        """
+        Корень системной папки удален, перемещен или снят с наблюдения.
+        Наблюдение снимается; если по тому же пути уже есть директория
+        (папку заменили), она сразу ставится на наблюдение с полным
+        сканированием, иначе устройство возвращается при проверке списка
+        устройств (RESYNC_INTERVAL), когда папка снова появится.
+        """
+        root = self.devices.get(device_id)
+        if root is None:
+            return
+        logger.warning(f"Системная папка устройства {device_id} удалена или перемещена: {root}")
+        self.remove_device(device_id)
+        if os.path.isdir(root):
+            self.add_device(device_id, root)
+
+    def full_scan(self, device_id: int, rel_dir: str = '') -> None:
+        root = self.devices.get(device_id)
+        if root is None:
+            return
+        started = time.monotonic()
+        files, _ = scan_tree(root, rel_dir)
+        added, updated, removed = reconcile_device(device_id, files, rel_dir)
+        if added or updated or removed:
+            logger.info(f"Синхронизация папки {root}: добавлено {added}, обновлено {updated}, "
+                        f"удалено {removed} ({time.monotonic() - started:.2f} с)")
+
+    def resync_devices(self) -> None:
+        """
+        Сверить список наблюдаемых устройств с БД
+        """
+        rows = db.session.query(VirtualUsbDevice.id, VirtualUsbDevice.storage_path).filter(
+            VirtualUsbDevice.is_system_path == True,  # noqa: E712
+            VirtualUsbDevice.storage_path.isnot(None)
+        ).all()
+        current = {row.id: row.storage_path for row in rows}
+        for device_id in list(self.devices):
+            if current.get(device_id) != self.devices[device_id]:
+                self.remove_device(device_id)
+        for device_id, root in current.items():
+            if device_id not in self.devices:
+                self.add_device(device_id, root)
+
+    # ---- Обработка событий ----
+
+    def queue_change(self, device_id: int, path: str, op: str) -> None:
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        self.pending[(device_id, path)] = op
+
+    def handle_events(self, events: List[Tuple[int, int, int, str]]) -> None:
+        for wd, mask, _, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Очередь ядра переполнена - часть событий потеряна, пересканируем все
+                logger.warning("Переполнение очереди inotify, выполняется полное сканирование")
+                self.pending.clear()
+                self.pending_since = None
+                for device_id in list(self.devices):
+                    self.full_scan(device_id)
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                watch = self.watches.get(wd)
+                if watch is not None and watch[1] == '':
+                    self.root_lost(watch[0])
+                elif mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                continue
+
+            watch = self.watches.get(wd)
+            if watch is None or not name or is_trash_name(name):
+                continue
+            device_id, rel_dir = watch
+            path = f"{rel_dir}/{name}" if rel_dir else name
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Файлы могли появиться до установки наблюдения - сканируем новую директорию
+                    self.add_watches(device_id, path)
+                    files, _ = scan_tree(self.devices[device_id], path)
+                    for file_path in files:
+                        self.queue_change(device_id, file_path, OP_UPSERT)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    if mask & IN_MOVED_FROM:
+                        self.drop_watches(device_id, path)
+                    self.queue_change(device_id, path, OP_DELETE_TREE)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+                self.queue_change(device_id, path, OP_UPSERT)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.queue_change(device_id, path, OP_DELETE)
+
+    def flush(self) -> None:
+        """
+        Применить накопленные изменения к БД одной транзакцией
+        """
+        if not self.pending:
+            return
+        pending, self.pending, self.pending_since = self.pending, {}, None
+
+        by_device = {}
+        for (device_id, path), op in pending.items():
+            by_device.setdefault(device_id, {OP_UPSERT: [], OP_DELETE: [], OP_DELETE_TREE: []})[op].append(path)
+
+        try:
+            for device_id, ops in by_device.items():
+                root = self.devices.get(device_id)
+                if root is None:
+                    continue
+
+                deletes = list(ops[OP_DELETE])
+                for prefix in ops[OP_DELETE_TREE]:
+                    VirtualUsbFile.query.filter(
+                        VirtualUsbFile.device_id == device_id,
+                        VirtualUsbFile.file_path >= prefix + '/',
+                        VirtualUsbFile.file_path < prefix + '0'
+                    ).delete(synchronize_session=False)
+                    deletes.append(prefix)
+
+                files = {}
+                for path in ops[OP_UPSERT]:
+                    try:
+                        st = os.stat(os.path.join(root, path))
+                    except OSError:
+                        deletes.append(path)
+                        continue
+                    if not os.path.isdir(os.path.join(root, path)):
+                        files[path] = (st.st_size, st.st_mtime)
+
+                for i in range(0, len(deletes), SQL_CHUNK_SIZE):
+                    VirtualUsbFile.query.filter(
+                        VirtualUsbFile.device_id == device_id,
+                        VirtualUsbFile.file_path.in_(deletes[i:i + SQL_CHUNK_SIZE])
+                    ).delete(synchronize_session=False)
+
+                self.upsert_files(device_id, files)
+
+            db.session.commit()
+            logger.debug(f"Применено {len(pending)} изменений файлов системных папок")
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении изменений файлов: {e}")
+            db.session.rollback()
+
+    def upsert_files(self, device_id: int, files: Dict[str, Tuple[int, float]]) -> None:
+        paths = list(files)
+        existing = {}
+        for i in range(0, len(paths), SQL_CHUNK_SIZE):
+            rows = db.session.query(VirtualUsbFile.id, VirtualUsbFile.file_path).filter(
+                VirtualUsbFile.device_id == device_id,
+                VirtualUsbFile.file_path.in_(paths[i:i + SQL_CHUNK_SIZE])
+            ).all()
+            existing.update({row.file_path: row.id for row in rows})
+
+        inserts = []
+        updates = []
+        for path, (size, mtime) in files.items():
+            modified = mtime_to_datetime(mtime)
+            if path in existing:
+                updates.append({'id': existing[path], 'file_size': size, 'updated_at': modified})
+            else:
+                inserts.append({
+                    'device_id': device_id,
+                    'filename': os.path.basename(path),
+                    'file_path': path,
+                    'file_size': size,
+                    'file_type': file_type_for(path),
+                    'created_at': modified,
+                    'updated_at': modified
+                })
+        if inserts:
+            db.session.bulk_insert_mappings(VirtualUsbFile, inserts)
+        if updates:
+            db.session.bulk_update_mappings(VirtualUsbFile, updates)
+
+    # ---- Основной цикл ----
+
+    def process_commands(self) -> None:
+        while True:
+            try:
+                command, device_id, root = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            if command == 'add':
+                self.add_device(device_id, root)
+            elif command == 'remove':
+                self.remove_device(device_id)
+
+    def run(self) -> None:
+        with self.app.app_context():
+            try:
+                self.inotify = Inotify()
+                logger.info("Наблюдение за системными папками: inotify")
+            except (OSError, AttributeError) as e:
+                self.inotify = None
+                logger.info(f"inotify недоступен ({e}), используется периодический опрос")
+
+            last_resync = 0
+            last_poll = time.monotonic()
+            while not self.stopped.is_set():
+                try:
+                    now = time.monotonic()
+                    if now - last_resync >= RESYNC_INTERVAL:
+                        self.resync_devices()
+                        last_resync = now
+                    self.process_commands()
+
+                    if self.inotify:
+                        readable, _, _ = select.select([self.inotify.fd], [], [], FLUSH_INTERVAL)
+                        if readable:
+                            self.handle_events(self.inotify.read_events())
+                        if self.pending and (len(self.pending) >= MAX_BATCH_SIZE or
+                                             time.monotonic() - self.pending_since >= FLUSH_INTERVAL):
+                            self.flush()
+                    else:
+                        self.stopped.wait(1)
+                        if time.monotonic() - last_poll >= POLL_INTERVAL:
+                            for device_id in list(self.devices):
+                                self.full_scan(device_id)
+                            last_poll = time.monotonic()
+                except Exception as e:
+                    logger.error(f"Ошибка в наблюдателе системных папок: {e}")
+                    db.session.rollback()
+                    self.stopped.wait(1)
+                finally:
+                    db.session.remove()
+
+            if self.inotify:
+                self.inotify.close()
+
+
+def acquire_leader_lock() -> Optional[int]:
+    """
+    Захватить блокировку наблюдателя (только один процесс ведет наблюдение)
+
+    Returns:
+        Optional[int]: Дескриптор файла блокировки или None, если она занята
+    """
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR, ensure_storage_dir_exists
+    ensure_storage_dir_exists()
+    fd = os.open(os.path.join(VIRTUAL_STORAGE_BASE_DIR, '.storage_watcher.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def start_storage_watcher(app) -> bool:
+    """
+    Запустить наблюдатель системных папок (если он включен и не запущен другим процессом)
+
+    Args:
+        app: Приложение Flask
+
+    Returns:
+        bool: Запущен ли наблюдатель в этом процессе
+    """
+    global _watcher
+    if os.environ.get(WATCHER_ENV_VAR, '1').strip().lower() in ('0', 'false', 'no', 'off'):
+        return False
+
+    with _watcher_lock:
+        if _watcher is not None:
+            return True
+        lock_fd = acquire_leader_lock()
+        if lock_fd is None:
+            logger.debug("Наблюдатель системных папок уже запущен в другом процессе")
+            return False
+        _watcher = StorageWatcher(app)
+        _watcher.lock_fd = lock_fd
+        _watcher.start()
+    return True
+
+
+def watch_device(device: VirtualUsbDevice) -> None:
+    """
+    Начать наблюдение за системной папкой устройства (в процессе-наблюдателе).
+    В остальных процессах устройство будет подхвачено при очередной сверке с БД.
+    """
+    if _watcher is not None and device.is_system_path and device.storage_path:
+        _watcher.commands.put(('add', device.id, device.storage_path))
+
+
+def unwatch_device(device_id: int) -> None:
+    """
+    Прекратить наблюдение за системной папкой устройства
+    """
+    if _watcher is not None:
+        _watcher.commands.put(('remove', device_id, None))
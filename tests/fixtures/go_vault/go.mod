@@ -0,0 +1,13 @@
+module vaultfixture
+
+go 1.19
+
+require github.com/bulwarkid/virtual-fido v0.0.0
+
+require (
+	github.com/fxamacker/cbor/v2 v2.4.0 // indirect
+	github.com/x448/float16 v0.8.4 // indirect
+	golang.org/x/crypto v0.22.0 // indirect
+)
+
+replace github.com/bulwarkid/virtual-fido => ../../../virtual-fido
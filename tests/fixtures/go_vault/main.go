@@ -0,0 +1,102 @@
+// Generates the vault fixture for tests/test_fido_vault.py with the bundled
+// virtual-fido code, and reads vaults back to check files written by Python.
+//
+//	go run . write ../vault_go.json passphrase
+//	go run . read <vault> <passphrase>
+package main
+
+import (
+	"crypto/sha256"
+	"encoding/hex"
+	"encoding/json"
+	"fmt"
+	"os"
+
+	"github.com/bulwarkid/virtual-fido/cose"
+	"github.com/bulwarkid/virtual-fido/fido_client"
+	"github.com/bulwarkid/virtual-fido/identities"
+	"github.com/bulwarkid/virtual-fido/webauthn"
+)
+
+type fileSaver struct {
+	path       string
+	passphrase string
+}
+
+func (saver *fileSaver) SaveData(data []byte) {
+	if err := os.WriteFile(saver.path, data, 0600); err != nil {
+		panic(err)
+	}
+}
+
+func (saver *fileSaver) RetrieveData() []byte {
+	return nil
+}
+
+func (saver *fileSaver) Passphrase() string {
+	return saver.passphrase
+}
+
+type approver struct{}
+
+func (approver) ApproveClientAction(action fido_client.ClientAction, params fido_client.ClientActionRequestParams) bool {
+	return true
+}
+
+func write(path, passphrase string) {
+	caPrivateKey, err := identities.CreateCAPrivateKey()
+	if err != nil {
+		panic(err)
+	}
+	certificateAuthority, err := identities.CreateSelfSignedCA(caPrivateKey)
+	if err != nil {
+		panic(err)
+	}
+	saver := &fileSaver{path: path, passphrase: passphrase}
+	client := fido_client.NewDefaultClient(certificateAuthority, caPrivateKey, sha256.Sum256([]byte("test")),
+		false, approver{}, saver)
+	params := []webauthn.PublicKeyCredentialParams{{Type: "public-key", Algorithm: cose.COSE_ALGORITHM_ID_ES256}}
+	users := []struct{ rp, name string }{
+		{"example.com", "alice"},
+		{"example.com", "bob"},
+		{"test.example.org", "carol"},
+	}
+	for i, user := range users {
+		client.NewCredentialSource(params, nil,
+			&webauthn.PublicKeyCredentialRPEntity{ID: user.rp, Name: user.rp},
+			&webauthn.PublicKeyCrendentialUserEntity{ID: []byte{byte(i + 1)}, Name: user.name, DisplayName: user.name})
+	}
+}
+
+func read(path, passphrase string) {
+	data, err := os.ReadFile(path)
+	if err != nil {
+		panic(err)
+	}
+	state, err := identities.DecryptFIDOState(data, passphrase)
+	if err != nil {
+		fmt.Fprintln(os.Stderr, err)
+		os.Exit(1)
+	}
+	ids := []string{}
+	for _, source := range state.Sources {
+		ids = append(ids, hex.EncodeToString(source.ID))
+	}
+	out, _ := json.Marshal(map[string]interface{}{"credential_ids": ids})
+	fmt.Println(string(out))
+}
+
+func main() {
+	if len(os.Args) != 4 {
+		fmt.Fprintln(os.Stderr, "usage: go_vault write|read <vault> <passphrase>")
+		os.Exit(2)
+	}
+	switch os.Args[1] {
+	case "write":
+		write(os.Args[2], os.Args[3])
+	case "read":
+		read(os.Args[2], os.Args[3])
+	default:
+		os.Exit(2)
+	}
+}
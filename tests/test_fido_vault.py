@@ -0,0 +1,162 @@
+"""
+Vault format compatibility with virtual-fido (identities/saved_state.go).
+
+The Go fixture is fixtures/vault_go.json (passphrase "passphrase"), written by
+fixtures/go_vault with the bundled virtual-fido code:
+
+    cd tests/fixtures/go_vault && go run . write ../vault_go.json passphrase
+
+Without a checked-in fixture the tests generate one the same way; they are
+skipped only if Go or its modules are not available.
+"""
+
+import os
+import json
+import base64
+import shutil
+import subprocess
+
+import pytest
+
+import fido_vault
+from fido_vault import Vault, VaultError, read_vault, write_vault, delete_credentials, list_credentials
+
+pytestmark = pytest.mark.skipif(not fido_vault.is_native_vault_supported(),
+                                reason='cryptography package is not installed')
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+GO_VAULT_FIXTURE = os.path.join(FIXTURES_DIR, 'vault_go.json')
+GO_VAULT_TOOL = os.path.join(FIXTURES_DIR, 'go_vault')
+PASSPHRASE = 'passphrase'
+
+# Credentials created by go_vault (relying party, user name)
+GO_CREDENTIALS = [('example.com', 'alice'), ('example.com', 'bob'), ('test.example.org', 'carol')]
+
+
+@pytest.fixture(scope='session')
+def go_vault_tool(tmp_path_factory) -> str:
+    """go_vault binary built against the bundled virtual-fido"""
+    if shutil.which('go') is None:
+        pytest.skip('Go toolchain is not installed')
+    binary = str(tmp_path_factory.mktemp('go_vault') / 'go_vault')
+    result = subprocess.run(['go', 'build', '-o', binary, '.'], cwd=GO_VAULT_TOOL,
+                            capture_output=True, text=True, timeout=600)
+    if result.returncode != 0:
+        pytest.skip(f'go_vault cannot be built: {result.stderr.strip().splitlines()[-1]}')
+    return binary
+
+
+def run_go_vault(tool: str, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([tool] + list(args), capture_output=True, text=True, timeout=60)
+
+
+@pytest.fixture
+def go_vault_path(request, tmp_path) -> str:
+    """Copy of the vault written by virtual-fido"""
+    path = str(tmp_path / 'vault.json')
+    if os.path.exists(GO_VAULT_FIXTURE):
+        shutil.copyfile(GO_VAULT_FIXTURE, path)
+    else:
+        result = run_go_vault(request.getfixturevalue('go_vault_tool'), 'write', path, PASSPHRASE)
+        assert result.returncode == 0, result.stderr
+    return path
+
+
+def encrypt_with_passphrase(passphrase: str, state: dict) -> bytes:
+    """EncryptWithPassphrase from saved_state.go"""
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    salt = os.urandom(fido_vault.SALT_LENGTH)
+    key_encryption_key = fido_vault.derive_key(passphrase, salt)
+    data_key = os.urandom(32)
+    key_nonce, data_nonce = os.urandom(12), os.urandom(12)
+    blob = {
+        'salt': salt,
+        'encryption_key': AESGCM(key_encryption_key).encrypt(key_nonce, data_key, None),
+        'key_nonce': key_nonce,
+        'encrypted_data': AESGCM(data_key).encrypt(data_nonce, json.dumps(state).encode(), None),
+        'data_nonce': data_nonce,
+    }
+    return json.dumps({field: base64.b64encode(value).decode() for field, value in blob.items()}).encode()
+
+
+def source(credential_id: bytes, rp_id: str, user_name: str) -> dict:
+    return {
+        'type': 'public-key',
+        'id': base64.b64encode(credential_id).decode(),
+        'private_key': base64.b64encode(b'key').decode(),
+        'relying_party': {'id': rp_id, 'name': rp_id},
+        'user': {'id': base64.b64encode(user_name.encode()).decode(), 'display_name': user_name, 'name': user_name},
+        'signature_counter': 0
+    }
+
+
+def test_reads_go_vault(go_vault_path):
+    credentials = list_credentials(go_vault_path, PASSPHRASE)
+    assert sorted((c['rp_id'], c['user_name']) for c in credentials) == GO_CREDENTIALS
+    assert all(c['short_id'] == c['credential_id'][:fido_vault.SHORT_ID_LENGTH] for c in credentials)
+
+
+def test_go_vault_round_trip(go_vault_path):
+    original = read_vault(go_vault_path, PASSPHRASE)
+    write_vault(go_vault_path, original)
+
+    rewritten = read_vault(go_vault_path, PASSPHRASE)
+    assert rewritten.state == original.state
+    # Only the data is re-encrypted: scrypt salt and wrapped data key stay
+    for field in ('salt', 'encryption_key', 'key_nonce'):
+        assert rewritten.blob[field] == original.blob[field]
+    assert rewritten.blob['data_nonce'] != original.blob['data_nonce']
+
+
+def test_go_reads_python_rewrite(go_vault_path, go_vault_tool):
+    removed, not_matched = delete_credentials(go_vault_path, PASSPHRASE,
+                                              predicate=lambda record: record['user_name'] == 'bob')
+    assert [record['user_name'] for record in removed] == ['bob'] and not_matched == []
+
+    result = run_go_vault(go_vault_tool, 'read', go_vault_path, PASSPHRASE)
+    assert result.returncode == 0, result.stderr
+    expected = sorted(c['credential_id'] for c in list_credentials(go_vault_path, PASSPHRASE))
+    assert sorted(json.loads(result.stdout)['credential_ids']) == expected
+
+
+def test_wrong_passphrase_fails(go_vault_path):
+    with pytest.raises(VaultError):
+        read_vault(go_vault_path, 'wrong passphrase')
+
+
+def test_go_rejects_wrong_passphrase(go_vault_path, go_vault_tool):
+    assert run_go_vault(go_vault_tool, 'read', go_vault_path, 'wrong passphrase').returncode != 0
+
+
+def test_encrypt_decrypt_reencrypt(tmp_path):
+    state = {'authentication_counter': 3, 'sources': [source(b'\x01' * 16, 'example.com', 'alice'),
+                                                      source(b'\x02' * 16, 'example.org', 'bob')]}
+    path = str(tmp_path / 'vault.json')
+    with open(path, 'wb') as f:
+        f.write(encrypt_with_passphrase(PASSPHRASE, state))
+
+    vault = read_vault(path, PASSPHRASE)
+    assert vault.state == state
+    removed, not_matched = vault.remove(['0101', 'ffff'])
+    assert [record['user_name'] for record in removed] == ['alice'] and not_matched == ['ffff']
+    write_vault(path, vault)
+
+    with open(path, 'rb') as f:
+        blob = json.loads(f.read())
+    assert sorted(blob) == ['data_nonce', 'encrypted_data', 'encryption_key', 'key_nonce', 'salt']
+    assert len(base64.b64decode(blob['data_nonce'])) == fido_vault.NONCE_LENGTH
+    assert [c['user_name'] for c in list_credentials(path, PASSPHRASE)] == ['bob']
+    with pytest.raises(VaultError):
+        read_vault(path, PASSPHRASE + 'x')
+
+
+def test_corrupt_vault_fails():
+    blob = json.loads(encrypt_with_passphrase(PASSPHRASE, {'sources': []}))
+    data = bytearray(base64.b64decode(blob['encrypted_data']))
+    data[0] ^= 0xFF
+    blob['encrypted_data'] = base64.b64encode(bytes(data)).decode()
+    with pytest.raises(VaultError):
+        Vault.decrypt(json.dumps(blob).encode(), PASSPHRASE)
+    with pytest.raises(VaultError):
+        Vault.decrypt(b'not json', PASSPHRASE)
@@ -0,0 +1,111 @@
+import logging
+from flask import Blueprint, request, jsonify
+from flask_login import login_required
+from models import db, VirtualUsbDevice, VirtualUsbPort, LogEntry
+from usb_topology import Topology, TopologyError, create_hub, delete_hub, place_port
+from usbip_server import refresh_usbip_exports
+
+# Настройка логгирования
+logger = logging.getLogger(__name__)
+
+# Создаем Blueprint для API топологии виртуальных USB-устройств
+topology_bp = Blueprint('topology', __name__)
+
+
+@topology_bp.route('/api/topology', methods=['GET'])
+@login_required
+def get_topology():
+    """
+    Дерево шин и хабов с размещенными портами, busid и загрузкой периодических передач
+    """
+    try:
+        topology = Topology()
+        return jsonify({'success': True, 'buses': topology.tree()})
+    except TopologyError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+
+@topology_bp.route('/api/topology/hubs', methods=['POST'])
+@login_required
+def add_hub():
+    """
+    Создать хаб: без parent_hub_id - корневой хаб новой шины,
+    иначе внешний хаб на порту parent_port родителя
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        hub = create_hub(
+            name=data.get('name'),
+            parent_hub_id=data.get('parent_hub_id'),
+            parent_port=data.get('parent_port'),
+            num_ports=data.get('num_ports', 4),
+            speed=data.get('speed', 'high'),
+            periodic_slots=data.get('periodic_slots')
+        )
+    except TopologyError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    db.session.add(LogEntry(level='INFO', message=f'Created virtual USB hub {hub.name}', source='virtual'))
+    db.session.commit()
+    return jsonify({'success': True, 'message': 'Хаб создан', 'hub_id': hub.id,
+                    'bus_number': Topology().path(hub.id)[0].bus_number})
+
+
+@topology_bp.route('/api/topology/hubs/<int:hub_id>/delete', methods=['POST'])
+@login_required
+def remove_hub(hub_id):
+    """
+    Удалить пустой хаб
+    """
+    try:
+        delete_hub(hub_id)
+    except TopologyError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify({'success': True, 'message': 'Хаб удален'})
+
+
+@topology_bp.route('/api/topology/ports/<int:port_id>/place', methods=['POST'])
+@login_required
+def place_virtual_port(port_id):
+    """
+    Разместить виртуальный порт на порту хаба ({"hub_id": null} - убрать из топологии)
+
+    Необязательные bandwidth_budget (байт/с) и periodic_slots ограничивают порт.
+    Подключенное устройство получает новый busid при следующей сверке экспорта.
+    """
+    port = db.session.get(VirtualUsbPort, port_id)
+    if port is None:
+        return jsonify({'success': False, 'message': 'Порт не найден'}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        busid = place_port(
+            port,
+            hub_id=data.get('hub_id'),
+            hub_port=data.get('hub_port'),
+            bandwidth_budget=data.get('bandwidth_budget'),
+            periodic_slots=data.get('periodic_slots')
+        )
+    except TopologyError as e:
+        return jsonify({'success': False, 'message': str(e)}), 409
+
+    refresh_usbip_exports()
+    return jsonify({'success': True, 'message': 'Порт размещен' if busid else 'Порт убран из топологии',
+                    'busid': busid})
+
+
+@topology_bp.route('/api/topology/check', methods=['POST'])
+@login_required
+def check_topology_connect():
+    """
+    Проверить без подключения, пройдет ли устройство device_id по бюджету порта port_id
+    """
+    data = request.get_json(silent=True) or {}
+    device = db.session.get(VirtualUsbDevice, data.get('device_id') or 0)
+    port = db.session.get(VirtualUsbPort, data.get('port_id') or 0)
+    if device is None or port is None:
+        return jsonify({'success': False, 'message': 'Устройство или порт не найдены'}), 404
+    try:
+        requirements = Topology().check_connect(device, port.id)
+    except TopologyError as e:
+        return jsonify({'success': True, 'allowed': False, 'message': str(e)})
+    return jsonify({'success': True, 'allowed': True, 'requirements': requirements})
@@ -0,0 +1,540 @@
+"""
+Модель последовательного порта USB CDC-ACM для экспорта по USB/IP.
+
+Bulk-конечные точки интерфейса данных соединены с бэкендом на стороне
+сервера через неблокирующий мост в цикле событий:
+    pty  - псевдотерминал (путь к slave-стороне в состоянии устройства,
+           при pty_link - символическая ссылка на него);
+    tcp  - TCP-сокет: прослушивание порта (tcp_mode=listen, один клиент,
+           новый вытесняет старого) или подключение к tcp_host:tcp_port
+           (tcp_mode=connect, с повторными попытками).
+
+Пример config_json:
+    {"backend": "tcp", "tcp_mode": "listen", "tcp_host": "127.0.0.1", "tcp_port": 7001}
+
+Управление потоком - через противодавление: данные бэкенда читаются в
+буферы из пула, пока хост не забирает их (не присылает URB IN) и в очереди
+больше RX_HIGH_WATER байт, чтение бэкенда приостанавливается; запись хоста
+(URB OUT) не завершается, пока очередь записи в бэкенд выше TX_HIGH_WATER.
+Параметры линии (SET_LINE_CODING) применяются к termios псевдотерминала
+(ядро Linux сохраняет у псевдотерминала скорость и стоп-биты, размер
+символа и четность всегда 8N); для TCP они только сохраняются и видны в
+состоянии устройства.
+"""
+
+import os
+import tty
+import errno
+import struct
+import termios
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from usb_device_models import (
+    UsbDeviceModel, UsbInterface, UsbEndpoint, UsbStall, SetupPacket,
+    EP_BULK, EP_INTERRUPT, REQ_TYPE_CLASS, USB_SPEED_FULL,
+    register_device_model, device_model_params
+)
+
+logger = logging.getLogger(__name__)
+
+# Классы CDC
+CLASS_CDC = 0x02
+SUBCLASS_ACM = 0x02
+CLASS_CDC_DATA = 0x0A
+CS_INTERFACE = 0x24
+
+# Конечные точки
+EP_ACM_DATA_IN = 0x81
+EP_ACM_DATA_OUT = 0x02
+EP_ACM_NOTIFY = 0x83
+BULK_MAX_PACKET = 64
+
+# Запросы класса CDC
+SET_LINE_CODING = 0x20
+GET_LINE_CODING = 0x21
+SET_CONTROL_LINE_STATE = 0x22
+SEND_BREAK = 0x23
+
+# Уведомление SERIAL_STATE: биты DCD и DSR
+NOTIFY_SERIAL_STATE = 0x20
+SERIAL_STATE_DCD = 0x01
+SERIAL_STATE_DSR = 0x02
+
+# Биты SET_CONTROL_LINE_STATE
+CONTROL_DTR = 0x01
+CONTROL_RTS = 0x02
+
+LINE_CODING = struct.Struct('<IBBB')
+DEFAULT_LINE_CODING = (115200, 0, 0, 8)
+
+# Буферы приема из бэкенда и пороги противодавления
+RX_BUFFER_SIZE = 16 * 1024
+RX_POOL_SIZE = 32
+RX_HIGH_WATER = 256 * 1024
+RX_LOW_WATER = 64 * 1024
+TX_HIGH_WATER = 256 * 1024
+
+# Свободное место в последнем буфере, при котором в него дописываются данные
+RX_APPEND_MIN = 512
+
+TCP_RECONNECT_DELAY = 2.0
+
+BACKENDS = ('pty', 'tcp')
+
+
+class BufferPool:
+    """Пул буферов фиксированного размера (повторное использование без выделения памяти)"""
+
+    def __init__(self, size: int = RX_BUFFER_SIZE, limit: int = RX_POOL_SIZE):
+        self.size = size
+        self.limit = limit
+        self._free: List[bytearray] = []
+        self.allocated = 0
+
+    def acquire(self) -> bytearray:
+        if self._free:
+            return self._free.pop()
+        self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray) -> None:
+        if len(self._free) < self.limit:
+            self._free.append(buffer)
+
+
+class RxChunk:
+    """Данные бэкенда в буфере пула: [start, end) еще не отданы хосту"""
+
+    __slots__ = ('buffer', 'start', 'end')
+
+    def __init__(self, buffer: bytearray):
+        self.buffer = buffer
+        self.start = 0
+        self.end = 0
+
+
+class _TcpProtocol(asyncio.BufferedProtocol):
+    """TCP-бэкенд: чтение сразу в буферы пула модели"""
+
+    def __init__(self, device: 'CdcAcmDevice'):
+        self.device = device
+        self.transport: Optional[asyncio.Transport] = None
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        self.device._attach_tcp(self)
+
+    def get_buffer(self, sizehint: int):
+        return self.device._rx_space()
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.device._rx_commit(nbytes)
+
+    def pause_writing(self) -> None:
+        self.device._tx_paused = True
+
+    def resume_writing(self) -> None:
+        self.device._tx_paused = False
+        self.device._tx_drained.set()
+
+    def connection_lost(self, exc) -> None:
+        self.device._detach_tcp(self)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+@register_device_model('serial')
+class CdcAcmDevice(UsbDeviceModel):
+    """
+    CDC-ACM: интерфейс управления (уведомления SERIAL_STATE) и интерфейс
+    данных с парой bulk-конечных точек
+    """
+
+    device_type = 'serial'
+    speed = USB_SPEED_FULL
+    bcd_usb = 0x0200
+    device_class = CLASS_CDC
+
+    def __init__(self, backend: str = 'pty', tcp_mode: str = 'listen', tcp_host: str = '127.0.0.1',
+                 tcp_port: Optional[int] = None, pty_link: Optional[str] = None, **params):
+        super().__init__(**params)
+        if backend not in BACKENDS:
+            raise ValueError(f'Неизвестный бэкенд последовательного порта: {backend}')
+        if backend == 'tcp' and (tcp_mode not in ('listen', 'connect') or not tcp_port):
+            raise ValueError('Для TCP нужны tcp_mode (listen/connect) и tcp_port')
+        self.backend = backend
+        self.tcp_mode = tcp_mode
+        self.tcp_host = tcp_host
+        self.tcp_port = tcp_port
+        self.pty_link = pty_link
+        self.line_coding = DEFAULT_LINE_CODING
+        self.control_lines = 0
+        self.breaks = 0
+
+        self.pool = BufferPool()
+        self.rx: Deque[RxChunk] = deque()
+        self.rx_bytes = 0
+        self._rx_ready = asyncio.Event()
+        self._rx_paused = False
+        self._rx_returned: List[bytearray] = []
+        self._tx_pending = bytearray()
+        self._tx_paused = False
+        self._tx_drained = asyncio.Event()
+        self._tx_drained.set()
+        self._notifications: asyncio.Queue = asyncio.Queue(maxsize=16)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        self.master_fd: Optional[int] = None
+        self.slave_fd: Optional[int] = None
+        self.pty_path: Optional[str] = None
+        self._tcp: Optional[_TcpProtocol] = None
+        self._tcp_server: Optional[asyncio.AbstractServer] = None
+        self._tcp_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @classmethod
+    def from_device(cls, device, config: Dict) -> 'CdcAcmDevice':
+        """Модель для записи VirtualUsbDevice типа serial (бэкенд из config_json)"""
+        try:
+            tcp_port = int(config['tcp_port']) if config.get('tcp_port') else None
+        except (TypeError, ValueError):
+            raise ValueError('tcp_port должен быть числом')
+        return cls(
+            backend=config.get('backend') or 'pty',
+            tcp_mode=config.get('tcp_mode') or 'listen',
+            tcp_host=config.get('tcp_host') or '127.0.0.1',
+            tcp_port=tcp_port,
+            pty_link=config.get('pty_link'),
+            **device_model_params(device, config)
+        )
+
+    def interfaces(self) -> List[UsbInterface]:
+        functional = (
+            struct.pack('<BBBH', 5, CS_INTERFACE, 0x00, 0x0110) +  # Header
+            struct.pack('<BBBBB', 5, CS_INTERFACE, 0x01, 0x00, 1) +  # Call Management
+            struct.pack('<BBBB', 4, CS_INTERFACE, 0x02, 0x06) +  # ACM: line coding, break
+            struct.pack('<BBBBB', 5, CS_INTERFACE, 0x06, 0, 1)  # Union: управление 0, данные 1
+        )
+        return [
+            UsbInterface(0, CLASS_CDC, SUBCLASS_ACM, 0, endpoints=[
+                UsbEndpoint(EP_ACM_NOTIFY, EP_INTERRUPT, 16, 16)
+            ], class_descriptors=functional),
+            UsbInterface(1, CLASS_CDC_DATA, endpoints=[
+                UsbEndpoint(EP_ACM_DATA_IN, EP_BULK, BULK_MAX_PACKET),
+                UsbEndpoint(EP_ACM_DATA_OUT, EP_BULK, BULK_MAX_PACKET)
+            ])
+        ]
+
+    # ------------------------------------------------------------------
+    # Запросы класса
+
+    async def handle_class_request(self, setup: SetupPacket, data: bytes) -> bytes:
+        if setup.type != REQ_TYPE_CLASS:
+            raise UsbStall(f'Unsupported CDC request {setup!r}')
+        if setup.request == SET_LINE_CODING:
+            if len(data) < LINE_CODING.size:
+                raise UsbStall('Short line coding')
+            self.line_coding = LINE_CODING.unpack_from(data)
+            self._apply_line_coding()
+            return b''
+        if setup.request == GET_LINE_CODING:
+            return LINE_CODING.pack(*self.line_coding)
+        if setup.request == SET_CONTROL_LINE_STATE:
+            self.control_lines = setup.value & (CONTROL_DTR | CONTROL_RTS)
+            self._notify_serial_state()
+            return b''
+        if setup.request == SEND_BREAK:
+            self.breaks += 1
+            if self.slave_fd is not None:
+                try:
+                    termios.tcsendbreak(self.slave_fd, 0)
+                except termios.error:
+                    pass
+            return b''
+        raise UsbStall(f'Unsupported CDC request {setup!r}')
+
+    def _apply_line_coding(self) -> None:
+        """Скорость, размер символа, четность и стоп-биты - в termios псевдотерминала"""
+        if self.slave_fd is None:
+            return
+        rate, stop_bits, parity, data_bits = self.line_coding
+        try:
+            attrs = termios.tcgetattr(self.slave_fd)
+            cflag = attrs[2] & ~(termios.CSIZE | termios.PARENB | termios.PARODD | termios.CSTOPB)
+            cflag |= {5: termios.CS5, 6: termios.CS6, 7: termios.CS7}.get(data_bits, termios.CS8)
+            if parity in (1, 2):
+                cflag |= termios.PARENB | (termios.PARODD if parity == 1 else 0)
+            if stop_bits == 2:
+                cflag |= termios.CSTOPB
+            attrs[2] = cflag
+            speed = getattr(termios, f'B{rate}', None)
+            if speed is not None:
+                attrs[4] = attrs[5] = speed
+            termios.tcsetattr(self.slave_fd, termios.TCSANOW, attrs)
+        except termios.error as e:
+            logger.warning(f"Последовательный порт {self.product}: не удалось применить параметры линии: {e}")
+
+    def _serial_state(self) -> int:
+        connected = self.backend == 'pty' or self._tcp is not None
+        return (SERIAL_STATE_DCD | SERIAL_STATE_DSR) if connected else 0
+
+    def _notify_serial_state(self) -> None:
+        notification = struct.pack('<BBHHHH', 0xA1, NOTIFY_SERIAL_STATE, 0, 0, 2, self._serial_state())
+        if not self._notifications.full():
+            self._notifications.put_nowait(notification)
+
+    # ------------------------------------------------------------------
+    # Передачи
+
+    async def handle_data(self, endpoint: UsbEndpoint, data: bytes, length: int):
+        if endpoint.address == EP_ACM_DATA_OUT:
+            await self._write_backend(data)
+            return b''
+        if endpoint.address == EP_ACM_DATA_IN:
+            return await self._read_host(length)
+        if endpoint.address == EP_ACM_NOTIFY:
+            return await self._notifications.get()
+        raise UsbStall(f'Endpoint 0x{endpoint.address:02x} is not implemented')
+
+    async def _read_host(self, length: int):
+        # Срез, отданный прошлым URB, уже записан в сокет клиента (URB одной
+        # конечной точки обрабатываются по очереди) - буферы можно вернуть в пул
+        for buffer in self._rx_returned:
+            self.pool.release(buffer)
+        self._rx_returned.clear()
+
+        while True:
+            # Пустой буфер в начале очереди остается от чтения без данных
+            while self.rx and self.rx[0].start == self.rx[0].end:
+                self.pool.release(self.rx.popleft().buffer)
+            if self.rx:
+                break
+            self._rx_ready.clear()
+            await self._rx_ready.wait()
+        chunk = self.rx[0]
+        size = min(length, chunk.end - chunk.start)
+        data = memoryview(chunk.buffer)[chunk.start:chunk.start + size]
+        chunk.start += size
+        if chunk.start == chunk.end:
+            self.rx.popleft()
+            self._rx_returned.append(chunk.buffer)
+        self.rx_bytes -= size
+        self.bytes_in += size
+        if self._rx_paused and self.rx_bytes <= RX_LOW_WATER:
+            self._resume_rx()
+        return data
+
+    def _rx_space(self) -> memoryview:
+        """Свободное место для чтения из бэкенда: хвост последнего буфера или новый буфер"""
+        tail = self.rx[-1] if self.rx else None
+        if tail is None or len(tail.buffer) - tail.end < RX_APPEND_MIN:
+            tail = RxChunk(self.pool.acquire())
+            self.rx.append(tail)
+        return memoryview(tail.buffer)[tail.end:]
+
+    def _rx_commit(self, nbytes: int) -> None:
+        if nbytes <= 0:
+            return
+        self.rx[-1].end += nbytes
+        self.rx_bytes += nbytes
+        self._rx_ready.set()
+        if self.rx_bytes >= RX_HIGH_WATER and not self._rx_paused:
+            self._pause_rx()
+
+    def _drop_empty_tail(self) -> None:
+        if self.rx and self.rx[-1].start == self.rx[-1].end:
+            self.pool.release(self.rx.pop().buffer)
+
+    def _pause_rx(self) -> None:
+        self._rx_paused = True
+        if self.master_fd is not None:
+            asyncio.get_running_loop().remove_reader(self.master_fd)
+        elif self._tcp is not None:
+            self._tcp.transport.pause_reading()
+
+    def _resume_rx(self) -> None:
+        self._rx_paused = False
+        if self.master_fd is not None:
+            asyncio.get_running_loop().add_reader(self.master_fd, self._on_pty_readable)
+        elif self._tcp is not None:
+            self._tcp.transport.resume_reading()
+
+    async def _write_backend(self, data: bytes) -> None:
+        self.bytes_out += len(data)
+        if self.master_fd is not None:
+            if self._tx_pending:
+                self._tx_pending += data
+            else:
+                self._pty_write(data)
+        elif self._tcp is not None:
+            self._tcp.transport.write(data)
+            if self._tx_paused:
+                self._tx_drained.clear()
+        # Без подключенного TCP-клиента данные теряются, как на линии без приемника
+        if self._tx_pending and len(self._tx_pending) >= TX_HIGH_WATER:
+            self._tx_drained.clear()
+        # URB OUT завершается после освобождения очереди записи: хост ждет (NAK)
+        await self._tx_drained.wait()
+
+    # ------------------------------------------------------------------
+    # Псевдотерминал
+
+    def _open_pty(self) -> None:
+        self.master_fd, self.slave_fd = os.openpty()
+        os.set_blocking(self.master_fd, False)
+        tty.setraw(self.slave_fd)
+        self.pty_path = os.ttyname(self.slave_fd)
+        self._apply_line_coding()
+        if self.pty_link:
+            try:
+                if os.path.islink(self.pty_link):
+                    os.unlink(self.pty_link)
+                os.symlink(self.pty_path, self.pty_link)
+            except OSError as e:
+                logger.warning(f"Не удалось создать ссылку {self.pty_link} на {self.pty_path}: {e}")
+        asyncio.get_running_loop().add_reader(self.master_fd, self._on_pty_readable)
+        logger.info(f"Последовательный порт {self.product}: псевдотерминал {self.pty_path}")
+
+    def _on_pty_readable(self) -> None:
+        try:
+            nbytes = os.readv(self.master_fd, [self._rx_space()])
+        except BlockingIOError:
+            nbytes = 0
+        except OSError as e:
+            # EIO - на slave-стороне никого нет (не возникает, пока открыт slave_fd)
+            if e.errno != errno.EIO:
+                logger.error(f"Ошибка чтения псевдотерминала {self.pty_path}: {e}")
+            nbytes = 0
+        if nbytes:
+            self._rx_commit(nbytes)
+        else:
+            self._drop_empty_tail()
+
+    def _pty_write(self, data) -> None:
+        try:
+            written = os.write(self.master_fd, data)
+        except BlockingIOError:
+            written = 0
+        if written < len(data):
+            self._tx_pending += data[written:]
+            asyncio.get_running_loop().add_writer(self.master_fd, self._on_pty_writable)
+
+    def _on_pty_writable(self) -> None:
+        try:
+            written = os.write(self.master_fd, self._tx_pending)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error(f"Ошибка записи в псевдотерминал {self.pty_path}: {e}")
+            written = len(self._tx_pending)
+        del self._tx_pending[:written]
+        if not self._tx_pending:
+            asyncio.get_running_loop().remove_writer(self.master_fd)
+            self._tx_drained.set()
+        elif len(self._tx_pending) < TX_HIGH_WATER:
+            self._tx_drained.set()
+
+    # ------------------------------------------------------------------
+    # TCP
+
+    def _attach_tcp(self, protocol: _TcpProtocol) -> None:
+        if self._tcp is not None:
+            # Новый клиент вытесняет прежнего
+            self._tcp.transport.close()
+        self._tcp = protocol
+        self._tx_paused = False
+        self._tx_drained.set()
+        if self._rx_paused:
+            protocol.transport.pause_reading()
+        self._notify_serial_state()
+        logger.info(f"Последовательный порт {self.product}: TCP-соединение "
+                    f"{protocol.transport.get_extra_info('peername')}")
+
+    def _detach_tcp(self, protocol: _TcpProtocol) -> None:
+        if self._tcp is protocol:
+            self._tcp = None
+            self._tx_drained.set()
+            self._drop_empty_tail()
+            if not self._closed:
+                self._notify_serial_state()
+
+    async def _connect_tcp(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._closed:
+            try:
+                _, protocol = await loop.create_connection(
+                    lambda: _TcpProtocol(self), self.tcp_host, self.tcp_port)
+                await protocol.closed
+            except OSError as e:
+                logger.debug(f"Последовательный порт {self.product}: нет соединения с "
+                             f"{self.tcp_host}:{self.tcp_port}: {e}")
+            await asyncio.sleep(TCP_RECONNECT_DELAY)
+
+    async def _listen_tcp(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            self._tcp_server = await loop.create_server(
+                lambda: _TcpProtocol(self), self.tcp_host, self.tcp_port, reuse_address=True)
+            logger.info(f"Последовательный порт {self.product}: TCP {self.tcp_host}:{self.tcp_port}")
+        except OSError as e:
+            logger.error(f"Последовательный порт {self.product}: не удалось открыть "
+                         f"{self.tcp_host}:{self.tcp_port}: {e}")
+
+    # ------------------------------------------------------------------
+    # Жизненный цикл
+
+    def on_export(self) -> None:
+        if self.backend == 'pty':
+            self._open_pty()
+        elif self.tcp_mode == 'listen':
+            self._tcp_task = asyncio.ensure_future(self._listen_tcp())
+        else:
+            self._tcp_task = asyncio.ensure_future(self._connect_tcp())
+
+    def status(self) -> Dict:
+        rate, stop_bits, parity, data_bits = self.line_coding
+        status = {
+            'backend': self.backend,
+            'line_coding': f"{rate} {data_bits}{'NOEMS'[parity] if parity < 5 else '?'}"
+                           f"{(1, 1.5, 2)[stop_bits] if stop_bits < 3 else '?'}",
+            'dtr': bool(self.control_lines & CONTROL_DTR),
+            'rts': bool(self.control_lines & CONTROL_RTS),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'rx_buffered': self.rx_bytes,
+            'rx_paused': self._rx_paused
+        }
+        if self.backend == 'pty':
+            status['pty'] = self.pty_path
+            status['pty_link'] = self.pty_link
+        else:
+            status['tcp'] = f'{self.tcp_mode} {self.tcp_host}:{self.tcp_port}'
+            status['tcp_connected'] = self._tcp is not None
+        return status
+
+    def close(self) -> None:
+        self._closed = True
+        if self._tcp_task is not None:
+            self._tcp_task.cancel()
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+        if self._tcp is not None:
+            self._tcp.transport.close()
+        if self.master_fd is not None:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.master_fd)
+            loop.remove_writer(self.master_fd)
+            os.close(self.master_fd)
+            os.close(self.slave_fd)
+            self.master_fd = self.slave_fd = None
+            if self.pty_link and os.path.islink(self.pty_link):
+                try:
+                    os.unlink(self.pty_link)
+                except OSError:
+                    pass
+        self._tx_drained.set()
@@ -0,0 +1,457 @@
+"""
+Программные модели USB-устройств для экспорта по USB/IP.
+
+Модель описывает устройство дескрипторами (устройство, конфигурация,
+интерфейсы, конечные точки, строки) и обрабатывает передачи: стандартные
+запросы нулевой конечной точки обрабатываются здесь, запросы классов и
+передачи по остальным конечным точкам - в подклассах конкретных типов
+устройств. Обработчики асинхронные: прерывание IN, например, ждет появления
+данных, не блокируя остальные устройства в цикле событий.
+
+Модель строится из записи VirtualUsbDevice: тип устройства выбирает класс
+модели, VID/PID, серийный номер и config_json задают параметры.
+"""
+
+import json
+import struct
+import logging
+import importlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Скорости устройства (linux/usb/ch9.h, enum usb_device_speed)
+USB_SPEED_LOW = 1
+USB_SPEED_FULL = 2
+USB_SPEED_HIGH = 3
+USB_SPEED_SUPER = 5
+
+# Типы дескрипторов
+DT_DEVICE = 0x01
+DT_CONFIG = 0x02
+DT_STRING = 0x03
+DT_INTERFACE = 0x04
+DT_ENDPOINT = 0x05
+DT_DEVICE_QUALIFIER = 0x06
+
+# Стандартные запросы
+REQ_GET_STATUS = 0x00
+REQ_CLEAR_FEATURE = 0x01
+REQ_SET_FEATURE = 0x03
+REQ_SET_ADDRESS = 0x05
+REQ_GET_DESCRIPTOR = 0x06
+REQ_GET_CONFIGURATION = 0x08
+REQ_SET_CONFIGURATION = 0x09
+REQ_GET_INTERFACE = 0x0A
+REQ_SET_INTERFACE = 0x0B
+
+# Поля bmRequestType
+REQ_DIR_IN = 0x80
+REQ_TYPE_MASK = 0x60
+REQ_TYPE_STANDARD = 0x00
+REQ_TYPE_CLASS = 0x20
+REQ_TYPE_VENDOR = 0x40
+REQ_RECIPIENT_MASK = 0x1F
+REQ_RECIPIENT_DEVICE = 0x00
+REQ_RECIPIENT_INTERFACE = 0x01
+REQ_RECIPIENT_ENDPOINT = 0x02
+
+# Типы передач конечных точек (bmAttributes)
+EP_CONTROL = 0x00
+EP_ISOCHRONOUS = 0x01
+EP_BULK = 0x02
+EP_INTERRUPT = 0x03
+
+# Класс "зависит от производителя" для устройств без собственной модели
+CLASS_VENDOR_SPECIFIC = 0xFF
+
+LANGID_EN_US = 0x0409
+
+# Модули с моделями конкретных типов устройств (регистрируются при импорте)
+MODEL_MODULES: List[str] = ['usb_mass_storage', 'usb_hid', 'usb_cdc_acm']
+
+SETUP_PACKET = struct.Struct('<BBHHH')
+
+
+class UsbStall(Exception):
+    """Запрос не поддерживается устройством (ответ STALL)"""
+    pass
+
+
+class SetupPacket:
+    """Разобранный SETUP-пакет управляющей передачи"""
+
+    __slots__ = ('request_type', 'request', 'value', 'index', 'length')
+
+    def __init__(self, data: bytes):
+        self.request_type, self.request, self.value, self.index, self.length = SETUP_PACKET.unpack(data)
+
+    @property
+    def is_in(self) -> bool:
+        return bool(self.request_type & REQ_DIR_IN)
+
+    @property
+    def type(self) -> int:
+        return self.request_type & REQ_TYPE_MASK
+
+    @property
+    def recipient(self) -> int:
+        return self.request_type & REQ_RECIPIENT_MASK
+
+    def __repr__(self):
+        return (f'<SetupPacket type=0x{self.request_type:02x} req=0x{self.request:02x} '
+                f'value=0x{self.value:04x} index=0x{self.index:04x} len={self.length}>')
+
+
+class UsbEndpoint:
+    """Конечная точка интерфейса"""
+
+    def __init__(self, address: int, transfer_type: int, max_packet_size: int, interval: int = 0):
+        self.address = address
+        self.transfer_type = transfer_type
+        self.max_packet_size = max_packet_size
+        self.interval = interval
+
+    @property
+    def number(self) -> int:
+        return self.address & 0x0F
+
+    @property
+    def is_in(self) -> bool:
+        return bool(self.address & 0x80)
+
+    def descriptor(self) -> bytes:
+        return struct.pack('<BBBBHB', 7, DT_ENDPOINT, self.address, self.transfer_type,
+                           self.max_packet_size, self.interval)
+
+
+class UsbInterface:
+    """Интерфейс конфигурации с конечными точками и дескрипторами класса"""
+
+    def __init__(self, number: int, interface_class: int, subclass: int = 0, protocol: int = 0,
+                 endpoints: Optional[List[UsbEndpoint]] = None, class_descriptors: bytes = b'',
+                 name: Optional[str] = None):
+        self.number = number
+        self.interface_class = interface_class
+        self.subclass = subclass
+        self.protocol = protocol
+        self.endpoints = endpoints or []
+        # Дескрипторы класса идут между дескриптором интерфейса и конечными точками
+        self.class_descriptors = class_descriptors
+        self.name = name
+
+    def descriptor(self, string_index: int = 0) -> bytes:
+        header = struct.pack('<BBBBBBBBB', 9, DT_INTERFACE, self.number, 0, len(self.endpoints),
+                             self.interface_class, self.subclass, self.protocol, string_index)
+        return header + self.class_descriptors + b''.join(ep.descriptor() for ep in self.endpoints)
+
+
+class UsbDeviceModel:
+    """
+    Базовая модель USB-устройства с одной конфигурацией.
+
+    Подклассы задают interfaces() и переопределяют handle_class_request()
+    (запросы класса/производителя на нулевой конечной точке) и handle_data()
+    (передачи по остальным конечным точкам).
+    """
+
+    device_type = 'custom'
+    speed = USB_SPEED_HIGH
+    bcd_usb = 0x0200
+    bcd_device = 0x0100
+    device_class = 0
+    device_subclass = 0
+    device_protocol = 0
+    max_packet_size0 = 64
+    max_power_ma = 100
+    manufacturer = 'OrangeUSB'
+
+    def __init__(self, vendor_id: int, product_id: int, serial_number: str = '',
+                 product: str = 'Virtual USB Device', config: Optional[Dict] = None):
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.serial_number = serial_number or ''
+        self.product = product
+        self.config = config or {}
+        self.configuration = 0
+        self.alternate_settings: Dict[int, int] = {}
+        self.halted: set = set()
+        self._interfaces: Optional[List[UsbInterface]] = None
+        self._endpoints: Optional[Dict[int, UsbEndpoint]] = None
+        self._strings: Optional[List[str]] = None
+
+    # ------------------------------------------------------------------
+    # Описание устройства
+
+    def interfaces(self) -> List[UsbInterface]:
+        """Интерфейсы единственной конфигурации (по умолчанию без конечных точек)"""
+        return [UsbInterface(0, CLASS_VENDOR_SPECIFIC)]
+
+    def get_interfaces(self) -> List[UsbInterface]:
+        if self._interfaces is None:
+            self._interfaces = self.interfaces()
+        return self._interfaces
+
+    def get_endpoint(self, address: int) -> Optional[UsbEndpoint]:
+        if self._endpoints is None:
+            self._endpoints = {ep.address: ep for interface in self.get_interfaces() for ep in interface.endpoints}
+        return self._endpoints.get(address)
+
+    def _string_table(self) -> List[str]:
+        """Строки в порядке индексов: производитель, продукт, серийный номер, интерфейсы"""
+        if self._strings is None:
+            self._strings = []
+            for text in [self.manufacturer, self.product, self.serial_number] + \
+                    [interface.name for interface in self.get_interfaces()]:
+                if text and text not in self._strings:
+                    self._strings.append(text)
+        return self._strings
+
+    def _string_index(self, value: Optional[str]) -> int:
+        """Индекс строкового дескриптора (0 - строки нет)"""
+        if not value:
+            return 0
+        return self._string_table().index(value) + 1
+
+    def device_descriptor(self) -> bytes:
+        return struct.pack(
+            '<BBHBBBBHHHBBBB', 18, DT_DEVICE, self.bcd_usb, self.device_class, self.device_subclass,
+            self.device_protocol, self.max_packet_size0, self.vendor_id, self.product_id, self.bcd_device,
+            self._string_index(self.manufacturer), self._string_index(self.product),
+            self._string_index(self.serial_number), 1
+        )
+
+    def configuration_descriptor(self) -> bytes:
+        interfaces = self.get_interfaces()
+        body = b''.join(interface.descriptor(self._string_index(interface.name)) for interface in interfaces)
+        header = struct.pack('<BBHBBBBB', 9, DT_CONFIG, 9 + len(body), len(interfaces), 1, 0,
+                             0x80, min(self.max_power_ma // 2, 250))
+        return header + body
+
+    def string_descriptor(self, index: int) -> bytes:
+        if index == 0:
+            return struct.pack('<BBH', 4, DT_STRING, LANGID_EN_US)
+        strings = self._string_table()
+        if index > len(strings):
+            raise UsbStall(f'No string descriptor {index}')
+        encoded = strings[index - 1].encode('utf-16-le')[:252]
+        return struct.pack('<BB', 2 + len(encoded), DT_STRING) + encoded
+
+    def export_info(self) -> Dict:
+        """Поля устройства для ответов OP_REP_DEVLIST/OP_REP_IMPORT"""
+        return {
+            'speed': self.speed,
+            'vendor_id': self.vendor_id,
+            'product_id': self.product_id,
+            'bcd_device': self.bcd_device,
+            'device_class': self.device_class,
+            'device_subclass': self.device_subclass,
+            'device_protocol': self.device_protocol,
+            'configuration': self.configuration,
+            'num_configurations': 1,
+            'interfaces': [(i.interface_class, i.subclass, i.protocol) for i in self.get_interfaces()]
+        }
+
+    # ------------------------------------------------------------------
+    # Передачи
+
+    async def handle_control(self, setup: SetupPacket, data: bytes) -> bytes:
+        """
+        Обработать управляющую передачу
+
+        Args:
+            setup: SETUP-пакет
+            data: Данные стадии OUT (для IN - пусто)
+
+        Returns:
+            bytes: Данные стадии IN (не длиннее setup.length)
+        """
+        if setup.type != REQ_TYPE_STANDARD:
+            result = await self.handle_class_request(setup, data)
+        else:
+            result = self.handle_standard_request(setup, data)
+        return result[:setup.length] if setup.is_in else b''
+
+    def handle_standard_request(self, setup: SetupPacket, data: bytes) -> bytes:
+        request = setup.request
+        if request == REQ_GET_DESCRIPTOR:
+            kind, index = setup.value >> 8, setup.value & 0xFF
+            if kind == DT_DEVICE:
+                return self.device_descriptor()
+            if kind == DT_CONFIG:
+                return self.configuration_descriptor()
+            if kind == DT_STRING:
+                return self.string_descriptor(index)
+            return self.get_class_descriptor(setup)
+        if request == REQ_SET_CONFIGURATION:
+            self.configuration = setup.value & 0xFF
+            self.halted.clear()
+            self.on_configured()
+            return b''
+        if request == REQ_GET_CONFIGURATION:
+            return bytes([self.configuration])
+        if request == REQ_SET_INTERFACE:
+            self.alternate_settings[setup.index] = setup.value
+            return b''
+        if request == REQ_GET_INTERFACE:
+            return bytes([self.alternate_settings.get(setup.index, 0)])
+        if request == REQ_GET_STATUS:
+            if setup.recipient == REQ_RECIPIENT_ENDPOINT:
+                return struct.pack('<H', 1 if (setup.index & 0xFF) in self.halted else 0)
+            return struct.pack('<H', 0)
+        if request == REQ_CLEAR_FEATURE:
+            if setup.recipient == REQ_RECIPIENT_ENDPOINT:
+                self.halted.discard(setup.index & 0xFF)
+                self.on_clear_halt(setup.index & 0xFF)
+            return b''
+        if request in (REQ_SET_FEATURE, REQ_SET_ADDRESS):
+            return b''
+        raise UsbStall(f'Unsupported standard request {setup!r}')
+
+    def get_class_descriptor(self, setup: SetupPacket) -> bytes:
+        """GET_DESCRIPTOR для дескрипторов класса (HID report и т.п.)"""
+        raise UsbStall(f'Unsupported descriptor type 0x{setup.value >> 8:02x}')
+
+    async def handle_class_request(self, setup: SetupPacket, data: bytes) -> bytes:
+        """Запрос класса или производителя на нулевой конечной точке"""
+        raise UsbStall(f'Unsupported class request {setup!r}')
+
+    async def handle_data(self, endpoint: UsbEndpoint, data: bytes, length: int) -> bytes:
+        """
+        Передача по конечной точке (bulk/interrupt)
+
+        Args:
+            endpoint: Конечная точка
+            data: Данные для OUT
+            length: Размер буфера хоста для IN
+
+        Returns:
+            bytes: Данные для IN (для OUT - пусто)
+        """
+        raise UsbStall(f'Endpoint 0x{endpoint.address:02x} is not implemented')
+
+    def on_configured(self) -> None:
+        """Хост выбрал конфигурацию (SET_CONFIGURATION)"""
+        pass
+
+    def on_clear_halt(self, address: int) -> None:
+        """Хост снял STALL с конечной точки (CLEAR_FEATURE ENDPOINT_HALT)"""
+        pass
+
+    def reset(self) -> None:
+        """Сброс состояния при новом импорте устройства"""
+        self.configuration = 0
+        self.alternate_settings.clear()
+        self.halted.clear()
+
+    def on_export(self) -> None:
+        """Модель добавлена в экспорт (вызывается в цикле событий сервера)"""
+        pass
+
+    def status(self) -> Dict:
+        """Состояние модели для ответа /api/virtual_devices/usbip"""
+        return {}
+
+    def close(self) -> None:
+        """Освободить ресурсы (файлы, mmap) при снятии устройства с экспорта"""
+        pass
+
+
+# ----------------------------------------------------------------------
+# Реестр моделей
+
+_models: Dict[str, Callable[..., UsbDeviceModel]] = {}
+_sync_hooks: List[Callable] = []
+_modules_loaded = False
+
+
+def register_device_model(device_type: str):
+    """
+    Декоратор регистрации модели для типа устройства (VirtualUsbDevice.device_type)
+
+    Фабрика вызывается как factory(device, config) и возвращает UsbDeviceModel.
+    Для класса модели фабрикой служит classmethod from_device.
+    """
+    def decorator(factory):
+        _models[device_type] = factory.from_device if isinstance(factory, type) else factory
+        return factory
+    return decorator
+
+
+def register_sync_hook(hook: Callable) -> Callable:
+    """
+    Декоратор функции hook(service), которую сервис экспорта вызывает при
+    каждой сверке с БД (в потоке сверки, вне цикла событий). Так модули
+    моделей забирают из БД свои очереди команд (например, сценарии HID).
+    """
+    _sync_hooks.append(hook)
+    return hook
+
+
+def run_sync_hooks(service) -> None:
+    """Вызвать обработчики сверки всех модулей моделей"""
+    _load_model_modules()
+    for hook in _sync_hooks:
+        try:
+            hook(service)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика сверки {hook.__module__}.{hook.__name__}: {e}")
+
+
+def _load_model_modules() -> None:
+    global _modules_loaded
+    if _modules_loaded:
+        return
+    _modules_loaded = True
+    for module_name in MODEL_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            logger.error(f"Не удалось загрузить модели USB-устройств из {module_name}: {e}")
+
+
+def parse_device_config(config_json: Optional[str]) -> Dict:
+    """Разобрать config_json устройства (некорректный JSON - пустая конфигурация)"""
+    if not config_json:
+        return {}
+    try:
+        config = json.loads(config_json)
+    except (TypeError, ValueError):
+        logger.warning("Некорректный config_json виртуального устройства, используется пустая конфигурация")
+        return {}
+    return config if isinstance(config, dict) else {}
+
+
+def device_model_params(device, config: Dict) -> Dict:
+    """Общие параметры конструктора модели из записи VirtualUsbDevice (для фабрик подклассов)"""
+    return {
+        'vendor_id': int(device.vendor_id, 16),
+        'product_id': int(device.product_id, 16),
+        'serial_number': device.serial_number or '',
+        'product': config.get('product') or device.name,
+        'config': config
+    }
+
+
+def build_device_model(device) -> UsbDeviceModel:
+    """
+    Построить модель для записи VirtualUsbDevice
+
+    Типы без зарегистрированной модели экспортируются как устройство
+    "vendor specific" без конечных точек данных (перечисляется хостом, но не
+    привязывается ни к одному драйверу класса).
+    """
+    _load_model_modules()
+    config = parse_device_config(device.config_json)
+    factory = _models.get(device.device_type)
+    if factory is not None:
+        return factory(device, config)
+    model = UsbDeviceModel(**device_model_params(device, config))
+    model.device_type = device.device_type
+    return model
+
+
+def model_device_types() -> List[str]:
+    """Типы устройств, для которых есть собственная модель"""
+    _load_model_modules()
+    return sorted(_models)
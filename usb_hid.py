@@ -0,0 +1,687 @@
+"""
+Модель HID-устройства (клавиатура, мышь, геймпад) для экспорта по USB/IP
+и движок сценариев ввода.
+
+Профиль устройства задается в config_json:
+    {"hid_type": "keyboard" | "mouse" | "gamepad" | "custom",
+     "poll_interval_ms": 1,
+     "report_descriptor": "05010906...",   # для custom (hex)
+     "report_length": 8}                   # для custom
+
+Сценарий - JSON со списком шагов (см. compile_script). Он компилируется в
+расписание отчетов (смещение в мс, отчет) и проигрывается в цикле событий
+сервера USB/IP. Время каждого отчета отсчитывается от момента запуска по
+монотонным часам цикла (loop.time()), а не от предыдущего отчета, поэтому
+задержки отдельных отчетов не накапливаются. Соседние отчеты разводятся не
+ближе интервала опроса конечной точки: хост забирает один отчет за опрос,
+так что при 1 мс это до 1000 отчетов в секунду на устройство (нажатие
+клавиши - два отчета).
+
+Сценарии ставятся в очередь через таблицу hid_scripts (hid_routes), сервис
+экспорта забирает их при сверке с БД и передает модели устройства.
+"""
+
+import math
+import struct
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from usb_device_models import (
+    UsbDeviceModel, UsbInterface, UsbEndpoint, UsbStall, SetupPacket,
+    EP_INTERRUPT, REQ_TYPE_CLASS, USB_SPEED_FULL,
+    register_device_model, register_sync_hook, device_model_params
+)
+
+logger = logging.getLogger(__name__)
+
+# Класс HID и дескрипторы класса
+CLASS_HID = 0x03
+SUBCLASS_BOOT = 0x01
+PROTOCOL_KEYBOARD = 0x01
+PROTOCOL_MOUSE = 0x02
+DT_HID = 0x21
+DT_HID_REPORT = 0x22
+
+# Запросы класса HID
+HID_GET_REPORT = 0x01
+HID_GET_IDLE = 0x02
+HID_GET_PROTOCOL = 0x03
+HID_SET_REPORT = 0x09
+HID_SET_IDLE = 0x0A
+HID_SET_PROTOCOL = 0x0B
+
+EP_HID_IN = 0x81
+
+HID_TYPES = ('keyboard', 'mouse', 'gamepad', 'custom')
+DEFAULT_POLL_INTERVAL_MS = 1
+
+# Отчетов в очереди на отправку; при переполнении сценарий ждет хоста
+REPORT_QUEUE_SIZE = 64
+
+# Ограничения сценария
+MAX_SCRIPT_REPORTS = 100000
+MAX_SCRIPT_REPEAT = 1000000
+
+# Boot-клавиатура: модификаторы, резерв, 6 клавиш; выход - светодиоды
+KEYBOARD_REPORT_DESCRIPTOR = bytes.fromhex(
+    '05010906a101'
+    '050719e029e71500250175019508810295017508810195057501'
+    '05081901290591029501750391019506750815002565050719002965'
+    '8100c0'
+)
+
+# Мышь (совместима с boot): 3 кнопки, X, Y, колесо
+MOUSE_REPORT_DESCRIPTOR = bytes.fromhex(
+    '05010902a1010901a100'
+    '05091901290315002501950375018102950175058101'
+    '05010930093109381581257f750895038106'
+    'c0c0'
+)
+
+# Геймпад: 16 кнопок, оси X, Y, Z, Rz
+GAMEPAD_REPORT_DESCRIPTOR = bytes.fromhex(
+    '05010905a101'
+    '05091901291015002501750195108102'
+    '050109300931093209351581257f750895048102'
+    'c0'
+)
+
+PROFILES = {
+    'keyboard': (KEYBOARD_REPORT_DESCRIPTOR, 8, SUBCLASS_BOOT, PROTOCOL_KEYBOARD),
+    'mouse': (MOUSE_REPORT_DESCRIPTOR, 4, SUBCLASS_BOOT, PROTOCOL_MOUSE),
+    'gamepad': (GAMEPAD_REPORT_DESCRIPTOR, 6, 0, 0)
+}
+
+# Модификаторы клавиатуры (биты первого байта отчета)
+MODIFIERS = {
+    'ctrl': 0x01, 'lctrl': 0x01, 'shift': 0x02, 'lshift': 0x02, 'alt': 0x04, 'lalt': 0x04,
+    'gui': 0x08, 'win': 0x08, 'meta': 0x08, 'cmd': 0x08, 'lgui': 0x08,
+    'rctrl': 0x10, 'rshift': 0x20, 'ralt': 0x40, 'altgr': 0x40, 'rgui': 0x80
+}
+
+# Коды клавиш (HID Usage Tables, Keyboard/Keypad page)
+KEY_CODES = {chr(ord('a') + i): 0x04 + i for i in range(26)}
+KEY_CODES.update({str(i): 0x1E + i - 1 for i in range(1, 10)})
+KEY_CODES.update({
+    '0': 0x27, 'enter': 0x28, 'esc': 0x29, 'escape': 0x29, 'backspace': 0x2A, 'tab': 0x2B,
+    'space': 0x2C, '-': 0x2D, '=': 0x2E, '[': 0x2F, ']': 0x30, '\\': 0x31, ';': 0x33,
+    "'": 0x34, '`': 0x35, ',': 0x36, '.': 0x37, '/': 0x38, 'capslock': 0x39,
+    'printscreen': 0x46, 'scrolllock': 0x47, 'pause': 0x48, 'insert': 0x49, 'home': 0x4A,
+    'pageup': 0x4B, 'delete': 0x4C, 'end': 0x4D, 'pagedown': 0x4E,
+    'right': 0x4F, 'left': 0x50, 'down': 0x51, 'up': 0x52
+})
+KEY_CODES.update({f'f{i}': 0x3A + i - 1 for i in range(1, 13)})
+
+# Символы, набираемые с Shift (раскладка US)
+SHIFTED_CHARS = dict(zip('!@#$%^&*()_+{}|:"~<>?', '1234567890-=[]\\;\'`,./'))
+TEXT_CHARS = {' ': 'space', '\n': 'enter', '\t': 'tab'}
+
+MOUSE_BUTTONS = {'left': 0x01, 'right': 0x02, 'middle': 0x04}
+
+
+class ScriptError(ValueError):
+    """Некорректный сценарий HID"""
+
+
+class CompiledScript:
+    """Расписание одного прохода сценария и число повторов"""
+
+    def __init__(self, events: List[Tuple[float, bytes]], duration_ms: float, repeat: int):
+        self.events = events
+        self.duration_ms = duration_ms
+        self.repeat = repeat
+
+    @property
+    def total_reports(self) -> int:
+        return len(self.events) * self.repeat
+
+
+class _Timeline:
+    """Построение расписания: курсор времени и разведение отчетов по интервалу опроса"""
+
+    def __init__(self, poll_ms: float):
+        self.poll_ms = poll_ms
+        self.cursor = 0.0
+        self.last: Optional[float] = None
+        self.events: List[Tuple[float, bytes]] = []
+
+    def emit(self, report: bytes, at: Optional[float] = None) -> float:
+        at = self.cursor if at is None else at
+        if self.last is not None:
+            at = max(at, self.last + self.poll_ms)
+        if len(self.events) >= MAX_SCRIPT_REPORTS:
+            raise ScriptError(f'Сценарий длиннее {MAX_SCRIPT_REPORTS} отчетов за проход')
+        self.events.append((at, report))
+        self.last = at
+        self.cursor = max(self.cursor, at)
+        return at
+
+    def wait(self, ms: float) -> None:
+        self.cursor += ms
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.cursor if self.last is None else max(self.cursor, self.last + self.poll_ms)
+        return end
+
+
+def _number(step: Dict, key: str, default: float, minimum: float = 0) -> float:
+    value = step.get(key, default)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value < minimum:
+        raise ScriptError(f'Поле {key} должно быть числом не меньше {minimum}')
+    return float(value)
+
+
+def _key_chord(names: Iterable[str]) -> Tuple[int, List[int]]:
+    """Модификаторы и коды клавиш аккорда (до 6 клавиш)"""
+    modifiers, keys = 0, []
+    for name in names:
+        if not isinstance(name, str):
+            raise ScriptError('Клавиши задаются строками')
+        lowered = name.lower()
+        if lowered in MODIFIERS:
+            modifiers |= MODIFIERS[lowered]
+        elif lowered in KEY_CODES:
+            keys.append(KEY_CODES[lowered])
+        else:
+            raise ScriptError(f'Неизвестная клавиша: {name}')
+    if len(keys) > 6:
+        raise ScriptError('Одновременно можно нажать не больше 6 клавиш')
+    return modifiers, keys
+
+
+def _char_chord(char: str) -> Tuple[int, List[int]]:
+    if char in TEXT_CHARS:
+        return 0, [KEY_CODES[TEXT_CHARS[char]]]
+    if char in SHIFTED_CHARS:
+        return MODIFIERS['shift'], [KEY_CODES[SHIFTED_CHARS[char]]]
+    if 'A' <= char <= 'Z':
+        return MODIFIERS['shift'], [KEY_CODES[char.lower()]]
+    if char in KEY_CODES:
+        return 0, [KEY_CODES[char]]
+    raise ScriptError(f'Символ {char!r} нельзя набрать на клавиатуре US')
+
+
+def _keyboard_report(modifiers: int, keys: List[int]) -> bytes:
+    return struct.pack('<BB6B', modifiers, 0, *(keys + [0] * (6 - len(keys))))
+
+
+def compile_script(script: Union[Dict, List], hid_type: str, report_length: int,
+                   poll_interval_ms: float = DEFAULT_POLL_INTERVAL_MS) -> CompiledScript:
+    """
+    Скомпилировать сценарий в расписание отчетов
+
+    Сценарий - список шагов или {"steps": [...], "repeat": N}. Шаги
+    выполняются друг за другом; время в миллисекундах:
+        {"wait": 100}
+        {"text": "Hello", "interval_ms": 2, "hold_ms": 1}      клавиатура
+        {"keys": ["ctrl", "alt", "delete"], "hold_ms": 20}     клавиатура
+        {"move": [dx, dy], "duration_ms": 50}                  мышь
+        {"path": [[x, y], ...], "interval_ms": 1}              мышь, точки траектории
+        {"click": "left", "hold_ms": 10}                       мышь
+        {"buttons": ["left"]}                                  мышь, удержание кнопок
+        {"scroll": -3}                                         мышь
+        {"gamepad": {"buttons": [1, 5], "axes": [0, 127, 0, 0]}, "hold_ms": 50}
+        {"report": "0000040000000000"}                         любой тип, отчет как есть
+
+    Raises:
+        ScriptError: Сценарий некорректен или не подходит типу устройства
+    """
+    if isinstance(script, dict):
+        steps = script.get('steps')
+        repeat = script.get('repeat', 1)
+    else:
+        steps, repeat = script, 1
+    if not isinstance(steps, list) or not steps:
+        raise ScriptError('Сценарий должен содержать непустой список шагов')
+    if not isinstance(repeat, int) or isinstance(repeat, bool) or not 1 <= repeat <= MAX_SCRIPT_REPEAT:
+        raise ScriptError(f'repeat должен быть от 1 до {MAX_SCRIPT_REPEAT}')
+
+    poll = float(poll_interval_ms)
+    timeline = _Timeline(poll)
+    mouse_buttons = 0
+
+    def require(*types):
+        if hid_type not in types:
+            raise ScriptError(f'Шаг {step_name} недоступен для устройства типа {hid_type}')
+
+    def mouse_report(dx: int = 0, dy: int = 0, wheel: int = 0) -> bytes:
+        return struct.pack('<Bbbb', mouse_buttons, dx, dy, wheel)
+
+    def mouse_move(dx: int, dy: int, duration: float) -> None:
+        # Отчет несет смещение -127..127; длинное движение делится на шаги
+        count = max(math.ceil(max(abs(dx), abs(dy)) / 127), int(duration // poll), 1)
+        start = timeline.cursor
+        sent_x = sent_y = 0
+        for i in range(1, count + 1):
+            x, y = round(dx * i / count), round(dy * i / count)
+            timeline.emit(mouse_report(x - sent_x, y - sent_y), start + duration * (i - 1) / count)
+            sent_x, sent_y = x, y
+        timeline.cursor = max(timeline.cursor, start + duration)
+
+    for step in steps:
+        if not isinstance(step, dict) or not step:
+            raise ScriptError('Шаг сценария должен быть объектом')
+        step_name = next(iter(step))
+
+        if 'wait' in step:
+            timeline.wait(_number(step, 'wait', 0))
+
+        elif 'report' in step:
+            try:
+                report = bytes.fromhex(str(step['report']))
+            except ValueError:
+                raise ScriptError('report должен быть hex-строкой')
+            if len(report) > report_length:
+                raise ScriptError(f'Отчет длиннее {report_length} байт')
+            timeline.emit(report.ljust(report_length, b'\0'))
+
+        elif 'text' in step or 'keys' in step:
+            require('keyboard')
+            hold = _number(step, 'hold_ms', poll)
+            interval = _number(step, 'interval_ms', hold + poll)
+            if 'text' in step:
+                if not isinstance(step['text'], str):
+                    raise ScriptError('text должен быть строкой')
+                chords = [_char_chord(char) for char in step['text']]
+            else:
+                if not isinstance(step['keys'], list):
+                    raise ScriptError('keys должен быть списком клавиш')
+                chords = [_key_chord(step['keys'])]
+            for modifiers, keys in chords:
+                pressed = timeline.emit(_keyboard_report(modifiers, keys))
+                timeline.emit(_keyboard_report(0, []), pressed + hold)
+                timeline.cursor = max(timeline.cursor, pressed + interval)
+
+        elif 'move' in step:
+            require('mouse')
+            move = step['move']
+            if not (isinstance(move, list) and len(move) == 2 and all(isinstance(v, int) for v in move)):
+                raise ScriptError('move задается как [dx, dy]')
+            mouse_move(move[0], move[1], _number(step, 'duration_ms', 0))
+
+        elif 'path' in step:
+            require('mouse')
+            points = step['path']
+            if not (isinstance(points, list) and len(points) >= 2 and
+                    all(isinstance(p, list) and len(p) == 2 and all(isinstance(v, int) for v in p) for p in points)):
+                raise ScriptError('path задается списком точек [[x, y], ...] (не меньше двух)')
+            interval = _number(step, 'interval_ms', poll)
+            for (x0, y0), (x1, y1) in zip(points, points[1:]):
+                mouse_move(x1 - x0, y1 - y0, interval)
+
+        elif 'click' in step or 'buttons' in step:
+            require('mouse')
+            names = [step['click']] if 'click' in step else step['buttons']
+            if not isinstance(names, list) or any(name not in MOUSE_BUTTONS for name in names):
+                raise ScriptError(f'Кнопки мыши: {", ".join(MOUSE_BUTTONS)}')
+            pressed_buttons = 0
+            for name in names:
+                pressed_buttons |= MOUSE_BUTTONS[name]
+            if 'click' in step:
+                hold = _number(step, 'hold_ms', poll)
+                mouse_buttons |= pressed_buttons
+                pressed = timeline.emit(mouse_report())
+                mouse_buttons &= ~pressed_buttons
+                timeline.emit(mouse_report(), pressed + hold)
+            else:
+                mouse_buttons = pressed_buttons
+                timeline.emit(mouse_report())
+
+        elif 'scroll' in step:
+            require('mouse')
+            amount = step['scroll']
+            if not isinstance(amount, int) or not -127 <= amount <= 127:
+                raise ScriptError('scroll должен быть целым от -127 до 127')
+            timeline.emit(mouse_report(wheel=amount))
+
+        elif 'gamepad' in step:
+            require('gamepad')
+            state = step['gamepad']
+            if not isinstance(state, dict):
+                raise ScriptError('gamepad задается объектом {"buttons": [...], "axes": [...]}')
+            buttons = state.get('buttons', [])
+            axes = state.get('axes', [0, 0, 0, 0])
+            if not isinstance(buttons, list) or any(not isinstance(b, int) or not 1 <= b <= 16 for b in buttons):
+                raise ScriptError('Кнопки геймпада - номера от 1 до 16')
+            if not isinstance(axes, list) or len(axes) != 4 or \
+                    any(not isinstance(a, int) or not -127 <= a <= 127 for a in axes):
+                raise ScriptError('Оси геймпада - четыре целых от -127 до 127')
+            mask = 0
+            for button in buttons:
+                mask |= 1 << (button - 1)
+            pressed = timeline.emit(struct.pack('<H4b', mask, *axes))
+            if 'hold_ms' in step:
+                timeline.emit(struct.pack('<H4b', 0, 0, 0, 0, 0), pressed + _number(step, 'hold_ms', 0))
+
+        else:
+            raise ScriptError(f'Неизвестный шаг сценария: {step_name}')
+
+    if not timeline.events:
+        raise ScriptError('Сценарий не содержит ни одного отчета')
+    return CompiledScript(timeline.events, timeline.duration_ms, repeat)
+
+
+class ScriptRun:
+    """Проигрывание сценария на устройстве; состояние читается потоком сверки"""
+
+    def __init__(self, script_id: int, compiled: CompiledScript):
+        self.script_id = script_id
+        self.compiled = compiled
+        self.status = 'queued'
+        self.reports_sent = 0
+        self.max_lag_ms = 0.0
+        self.error: Optional[str] = None
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_requested = False
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def delivered(self, lag_ms: float) -> None:
+        self.reports_sent += 1
+        if lag_ms > self.max_lag_ms:
+            self.max_lag_ms = lag_ms
+
+    def finish(self, status: str, error: Optional[str] = None) -> None:
+        if not self.finished:
+            self.status = status
+            self.error = error
+            self.finished_at = datetime.utcnow()
+
+    def cancel(self, reason: Optional[str] = None) -> None:
+        self.cancel_requested = True
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.finish('cancelled', reason)
+
+
+@register_device_model('hid')
+class HidDevice(UsbDeviceModel):
+    """
+    HID-устройство с одним интерфейсом и конечной точкой прерывания IN
+
+    Хост опрашивает конечную точку: каждый URB получает следующий отчет из
+    очереди, пока очередь пуста - URB ждет (как NAK у реального устройства).
+    """
+
+    device_type = 'hid'
+    speed = USB_SPEED_FULL
+    bcd_usb = 0x0110
+    max_power_ma = 50
+
+    def __init__(self, hid_type: str = 'keyboard', report_descriptor: Optional[bytes] = None,
+                 report_length: Optional[int] = None, poll_interval_ms: int = DEFAULT_POLL_INTERVAL_MS,
+                 **params):
+        super().__init__(**params)
+        if hid_type not in HID_TYPES:
+            raise ValueError(f'Неизвестный тип HID-устройства: {hid_type}')
+        if hid_type == 'custom':
+            if not report_descriptor or not report_length:
+                raise ValueError('Для custom нужны report_descriptor и report_length')
+            subclass, protocol = 0, 0
+        else:
+            default_descriptor, default_length, subclass, protocol = PROFILES[hid_type]
+            report_descriptor = report_descriptor or default_descriptor
+            report_length = report_length or default_length
+        self.hid_type = hid_type
+        self.report_descriptor = report_descriptor
+        self.report_length = report_length
+        self.poll_interval_ms = poll_interval_ms
+        self.subclass = subclass
+        self.protocol = protocol
+        self.boot_protocol = False
+        self.idle_rate = 0
+        self.leds = 0
+        self.last_report = bytes(report_length)
+        self.reports: asyncio.Queue = asyncio.Queue(maxsize=REPORT_QUEUE_SIZE)
+        self.configured = asyncio.Event()
+        self.scripts: asyncio.Queue = asyncio.Queue()
+        self.current_run: Optional[ScriptRun] = None
+        self._runner: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_device(cls, device, config: Dict) -> 'HidDevice':
+        """Модель для записи VirtualUsbDevice типа hid (профиль из config_json)"""
+        descriptor = config.get('report_descriptor')
+        try:
+            descriptor = bytes.fromhex(descriptor) if descriptor else None
+            report_length = int(config['report_length']) if config.get('report_length') else None
+            poll_interval = int(config.get('poll_interval_ms') or DEFAULT_POLL_INTERVAL_MS)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'Некорректный профиль HID в config_json: {e}')
+        return cls(
+            hid_type=config.get('hid_type') or 'keyboard',
+            report_descriptor=descriptor,
+            report_length=report_length,
+            poll_interval_ms=min(max(poll_interval, 1), 255),
+            **device_model_params(device, config)
+        )
+
+    def interfaces(self) -> List[UsbInterface]:
+        hid_descriptor = struct.pack('<BBHBBBH', 9, DT_HID, 0x0111, 0, 1, DT_HID_REPORT,
+                                     len(self.report_descriptor))
+        return [UsbInterface(0, CLASS_HID, self.subclass, self.protocol,
+                             endpoints=[UsbEndpoint(EP_HID_IN, EP_INTERRUPT, max(self.report_length, 8),
+                                                    self.poll_interval_ms)],
+                             class_descriptors=hid_descriptor)]
+
+    def get_class_descriptor(self, setup: SetupPacket) -> bytes:
+        kind = setup.value >> 8
+        if kind == DT_HID_REPORT:
+            return self.report_descriptor
+        if kind == DT_HID:
+            return self.get_interfaces()[0].class_descriptors
+        return super().get_class_descriptor(setup)
+
+    async def handle_class_request(self, setup: SetupPacket, data: bytes) -> bytes:
+        if setup.type != REQ_TYPE_CLASS:
+            raise UsbStall(f'Unsupported HID request {setup!r}')
+        request = setup.request
+        if request == HID_GET_REPORT:
+            return self._wire_report(self.last_report)
+        if request == HID_SET_REPORT:
+            # Выходной отчет клавиатуры - состояние светодиодов (Num/Caps/Scroll Lock)
+            if data:
+                self.leds = data[0]
+            return b''
+        if request == HID_SET_IDLE:
+            self.idle_rate = setup.value >> 8
+            return b''
+        if request == HID_GET_IDLE:
+            return bytes([self.idle_rate])
+        if request == HID_SET_PROTOCOL:
+            self.boot_protocol = setup.value == 0
+            return b''
+        if request == HID_GET_PROTOCOL:
+            return bytes([0 if self.boot_protocol else 1])
+        raise UsbStall(f'Unsupported HID request {setup!r}')
+
+    def _wire_report(self, report: bytes) -> bytes:
+        # Boot-протокол мыши - только кнопки и X/Y, без колеса
+        if self.boot_protocol and self.hid_type == 'mouse':
+            return report[:3]
+        return report
+
+    async def handle_data(self, endpoint: UsbEndpoint, data: bytes, length: int) -> bytes:
+        if endpoint.address != EP_HID_IN:
+            raise UsbStall(f'Endpoint 0x{endpoint.address:02x} is not implemented')
+        run, deadline, report = await self.reports.get()
+        if run is not None:
+            run.delivered(max(asyncio.get_running_loop().time() - deadline, 0.0) * 1000)
+        self.last_report = report
+        return self._wire_report(report)[:length]
+
+    def on_configured(self) -> None:
+        self.configured.set()
+
+    def reset(self) -> None:
+        super().reset()
+        self.configured.clear()
+        self.boot_protocol = False
+
+    # ------------------------------------------------------------------
+    # Сценарии
+
+    def queue_script(self, run: ScriptRun) -> None:
+        """Поставить сценарий в очередь устройства (вызывается в цикле событий)"""
+        if run.cancel_requested:
+            return
+        self.scripts.put_nowait(run)
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.ensure_future(self._run_scripts())
+
+    async def _run_scripts(self) -> None:
+        while True:
+            run = await self.scripts.get()
+            if run.finished:
+                continue
+            self.current_run = run
+            run.task = asyncio.ensure_future(self._play(run))
+            try:
+                await asyncio.shield(run.task)
+            except asyncio.CancelledError:
+                if not run.task.done():
+                    # Остановлен сам обработчик очереди (устройство снято с экспорта)
+                    run.cancel()
+                    raise
+            finally:
+                self.current_run = None
+
+    async def _play(self, run: ScriptRun) -> None:
+        compiled = run.compiled
+        loop = asyncio.get_running_loop()
+        try:
+            # Проигрывание начинается, когда хост сконфигурировал устройство
+            await self.configured.wait()
+            run.status = 'running'
+            run.started_at = datetime.utcnow()
+            start = loop.time()
+            for iteration in range(compiled.repeat):
+                base = start + iteration * compiled.duration_ms / 1000
+                for offset_ms, report in compiled.events:
+                    deadline = base + offset_ms / 1000
+                    delay = deadline - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await self.reports.put((run, deadline, report))
+            run.finish('done')
+        except asyncio.CancelledError:
+            run.finish('cancelled', run.error)
+            self._release_all(run)
+            raise
+        except Exception as e:
+            logger.error(f"Сценарий HID {run.script_id} на {self.product} завершился ошибкой: {e}")
+            run.finish('failed', str(e))
+            self._release_all(run)
+
+    def _release_all(self, run: ScriptRun) -> None:
+        """Убрать неотправленные отчеты прерванного сценария и отпустить клавиши и кнопки"""
+        kept = []
+        while not self.reports.empty():
+            item = self.reports.get_nowait()
+            if item[0] is not run:
+                kept.append(item)
+        for item in kept:
+            self.reports.put_nowait(item)
+        if not self.reports.full():
+            self.reports.put_nowait((None, 0.0, bytes(self.report_length)))
+
+    def close(self) -> None:
+        if self.current_run is not None:
+            self.current_run.cancel('Устройство снято с экспорта')
+        while not self.scripts.empty():
+            self.scripts.get_nowait().cancel('Устройство снято с экспорта')
+        if self._runner is not None:
+            self._runner.cancel()
+
+
+# ----------------------------------------------------------------------
+# Очередь сценариев в БД
+
+# Сценарии, переданные моделям этого процесса: id -> ScriptRun
+_runs: Dict[int, ScriptRun] = {}
+
+
+def compile_device_script(device, script: Union[Dict, List]) -> CompiledScript:
+    """Скомпилировать сценарий под профиль устройства из его config_json"""
+    from usb_device_models import parse_device_config
+
+    config = parse_device_config(device.config_json)
+    hid_type = config.get('hid_type') or 'keyboard'
+    if hid_type not in HID_TYPES:
+        raise ScriptError(f'Неизвестный тип HID-устройства: {hid_type}')
+    report_length = PROFILES[hid_type][1] if hid_type in PROFILES else int(config.get('report_length') or 8)
+    try:
+        poll_interval = int(config.get('poll_interval_ms') or DEFAULT_POLL_INTERVAL_MS)
+    except (TypeError, ValueError):
+        poll_interval = DEFAULT_POLL_INTERVAL_MS
+    return compile_script(script, hid_type, report_length, min(max(poll_interval, 1), 255))
+
+
+@register_sync_hook
+def sync_hid_scripts(service) -> None:
+    """
+    Передать новые сценарии из hid_scripts моделям экспортируемых устройств,
+    выполнить запросы отмены и записать в БД состояние проигрываемых
+    """
+    import json
+    from models import db, HidScript, VirtualUsbDevice
+
+    with service.app.app_context():
+        try:
+            for script in HidScript.query.filter(HidScript.status.in_(('pending', 'cancelling'))).all():
+                run = _runs.get(script.id)
+                if script.status == 'cancelling':
+                    if run is not None:
+                        service.loop.call_soon_threadsafe(run.cancel, 'Отменен пользователем')
+                    else:
+                        script.status = 'cancelled'
+                        script.finished_at = datetime.utcnow()
+                    continue
+
+                exported = service.server.find_device(script.device_id)
+                if exported is None or not isinstance(exported.model, HidDevice):
+                    device = db.session.get(VirtualUsbDevice, script.device_id)
+                    if device is None or not device.is_active:
+                        script.status = 'failed'
+                        script.error = 'Устройство не подключено'
+                        script.finished_at = datetime.utcnow()
+                    continue
+                try:
+                    model = exported.model
+                    compiled = compile_script(json.loads(script.script_json), model.hid_type,
+                                              model.report_length, model.poll_interval_ms)
+                except (ValueError, TypeError) as e:
+                    script.status = 'failed'
+                    script.error = str(e)
+                    script.finished_at = datetime.utcnow()
+                    continue
+                run = ScriptRun(script.id, compiled)
+                _runs[script.id] = run
+                script.status = 'queued'
+                service.loop.call_soon_threadsafe(exported.model.queue_script, run)
+
+            for script_id, run in list(_runs.items()):
+                script = db.session.get(HidScript, script_id)
+                if script is None:
+                    _runs.pop(script_id, None)
+                    continue
+                if script.status == 'cancelling' and not run.finished:
+                    continue
+                script.status = run.status
+                script.reports_sent = run.reports_sent
+                script.max_lag_ms = round(run.max_lag_ms, 3)
+                script.error = run.error
+                script.started_at = run.started_at
+                script.finished_at = run.finished_at
+                if run.finished:
+                    _runs.pop(script_id, None)
+            db.session.commit()
+        finally:
+            db.session.remove()
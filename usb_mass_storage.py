@@ -0,0 +1,590 @@
+"""
+Модель USB-накопителя (Mass Storage, Bulk-Only Transport + SCSI) для USB/IP.
+
+Блочное устройство - образ диска, отображенный в память (mmap). Чтение
+отдает срезы memoryview прямо из отображения, без копирования в Python;
+запись копирует данные в отображение и запоминает измененные участки.
+Соседние участки объединяются и сбрасываются на диск (msync) одним вызовом:
+по SYNCHRONIZE CACHE, по флагу FUA, при накоплении DIRTY_FLUSH_BYTES, по
+таймеру и при снятии устройства с экспорта.
+
+Устройства с образом FAT32 (fat_image) экспортируются как есть, на запись.
+Для устройств-директорий (в т.ч. системных папок) при экспорте собирается
+снимок - образ FAT32 с копией файлов, - который отдается только на чтение:
+изменения хоста в директорию не возвращаются.
+
+Пока образ подключен на запись, его не следует изменять через веб-интерфейс:
+хост кэширует FAT и не увидит чужих изменений.
+"""
+
+import os
+import mmap
+import time
+import struct
+import asyncio
+import tempfile
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from usb_device_models import (
+    UsbDeviceModel, UsbInterface, UsbEndpoint, UsbStall, SetupPacket,
+    EP_BULK, REQ_TYPE_CLASS, register_device_model, device_model_params
+)
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 512
+
+# Конечные точки накопителя
+EP_BULK_IN = 0x81
+EP_BULK_OUT = 0x02
+BULK_MAX_PACKET = 512
+
+# Класс Mass Storage: SCSI transparent command set, Bulk-Only Transport
+CLASS_MASS_STORAGE = 0x08
+SUBCLASS_SCSI = 0x06
+PROTOCOL_BOT = 0x50
+
+# Запросы класса
+REQ_BOT_RESET = 0xFF
+REQ_GET_MAX_LUN = 0xFE
+
+# Command Block Wrapper / Command Status Wrapper
+CBW = struct.Struct('<IIIBBB16s')
+CSW = struct.Struct('<IIIB')
+CBW_SIGNATURE = 0x43425355
+CSW_SIGNATURE = 0x53425355
+CSW_PASSED = 0
+CSW_FAILED = 1
+CSW_PHASE_ERROR = 2
+
+# Команды SCSI
+TEST_UNIT_READY = 0x00
+REQUEST_SENSE = 0x03
+READ_6 = 0x08
+WRITE_6 = 0x0A
+INQUIRY = 0x12
+MODE_SELECT_6 = 0x15
+MODE_SENSE_6 = 0x1A
+START_STOP_UNIT = 0x1B
+PREVENT_ALLOW_MEDIUM_REMOVAL = 0x1E
+READ_FORMAT_CAPACITIES = 0x23
+READ_CAPACITY_10 = 0x25
+READ_10 = 0x28
+WRITE_10 = 0x2A
+VERIFY_10 = 0x2F
+SYNCHRONIZE_CACHE_10 = 0x35
+MODE_SENSE_10 = 0x5A
+READ_16 = 0x88
+WRITE_16 = 0x8A
+SYNCHRONIZE_CACHE_16 = 0x91
+SERVICE_ACTION_IN_16 = 0x9E
+SAI_READ_CAPACITY_16 = 0x10
+
+# Sense key / additional sense code
+SENSE_NO_SENSE = (0x00, 0x00, 0x00)
+SENSE_INVALID_COMMAND = (0x05, 0x20, 0x00)
+SENSE_LBA_OUT_OF_RANGE = (0x05, 0x21, 0x00)
+SENSE_INVALID_FIELD_IN_CDB = (0x05, 0x24, 0x00)
+SENSE_WRITE_PROTECTED = (0x07, 0x27, 0x00)
+SENSE_WRITE_ERROR = (0x03, 0x0C, 0x00)
+
+# Сброс накопленных изменений на диск
+DIRTY_FLUSH_BYTES = 16 * 1024 * 1024
+DIRTY_FLUSH_DELAY = 1.0
+
+# Суффикс снимка директории, собранного для экспорта
+SNAPSHOT_SUFFIX = '.export.img'
+
+# Фазы Bulk-Only Transport
+PHASE_COMMAND = 'command'
+PHASE_DATA_IN = 'data_in'
+PHASE_DATA_OUT = 'data_out'
+PHASE_STATUS = 'status'
+
+
+class ScsiError(Exception):
+    """Команда завершилась с CHECK CONDITION"""
+
+    def __init__(self, sense: Tuple[int, int, int]):
+        super().__init__(f'SCSI sense {sense[0]:02x}/{sense[1]:02x}/{sense[2]:02x}')
+        self.sense = sense
+
+
+class DirtyRanges:
+    """Измененные участки образа, соседние и перекрывающиеся объединяются"""
+
+    def __init__(self):
+        self.ranges: List[List[int]] = []
+        self.bytes = 0
+
+    def add(self, start: int, end: int) -> None:
+        merged = [start, end]
+        kept = []
+        for current in self.ranges:
+            if current[1] < merged[0] or current[0] > merged[1]:
+                kept.append(current)
+            else:
+                merged[0] = min(merged[0], current[0])
+                merged[1] = max(merged[1], current[1])
+        kept.append(merged)
+        self.ranges = kept
+        self.bytes = sum(e - s for s, e in kept)
+
+    def take(self) -> List[List[int]]:
+        ranges, self.ranges, self.bytes = sorted(self.ranges), [], 0
+        return ranges
+
+
+class BlockImage:
+    """Образ диска в mmap с отложенным объединенным сбросом изменений"""
+
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = path
+        self.read_only = read_only
+        self._file = open(path, 'rb' if read_only else 'r+b')
+        try:
+            self.mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE)
+        except Exception:
+            self._file.close()
+            raise
+        self.view = memoryview(self.mm)
+        self.size = len(self.mm)
+        self.block_count = self.size // BLOCK_SIZE
+        self.dirty = DirtyRanges()
+
+    def read(self, offset: int, length: int) -> memoryview:
+        return self.view[offset:offset + length]
+
+    def write(self, offset: int, data) -> None:
+        self.view[offset:offset + len(data)] = data
+        self.dirty.add(offset, offset + len(data))
+
+    def flush(self) -> int:
+        """Сбросить измененные участки (msync по границам страниц), вернуть число вызовов"""
+        calls = 0
+        for start, end in self.dirty.take():
+            aligned = start - start % mmap.PAGESIZE
+            self.mm.flush(aligned, end - aligned)
+            calls += 1
+        return calls
+
+    def close(self) -> None:
+        if self.mm.closed:
+            return
+        if not self.read_only:
+            self.flush()
+        self.view.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # Срез еще в буфере отправки - отображение закроется вместе с ним
+            logger.debug(f"mmap {self.path} еще используется, закрытие отложено")
+        self._file.close()
+
+
+class ChunkedRead:
+    """Чтение участка образа порциями по размеру URB (срезы memoryview, без копирования)"""
+
+    __slots__ = ('image', 'offset', 'remaining')
+
+    def __init__(self, image: BlockImage, offset: int, length: int):
+        self.image = image
+        self.offset = offset
+        self.remaining = length
+
+    def next(self, length: int) -> memoryview:
+        length = min(length, self.remaining)
+        chunk = self.image.read(self.offset, length)
+        self.offset += length
+        self.remaining -= length
+        return chunk
+
+
+@register_device_model('storage')
+class MassStorageDevice(UsbDeviceModel):
+    """
+    USB-накопитель: один LUN, SCSI Block Commands поверх Bulk-Only Transport
+    """
+
+    device_type = 'storage'
+    bcd_device = 0x0100
+
+    def __init__(self, image: BlockImage, vendor_name: str = 'OrangeUS', snapshot_path: Optional[str] = None,
+                 **params):
+        super().__init__(**params)
+        self.image = image
+        self.vendor_name = vendor_name
+        self.snapshot_path = snapshot_path
+        self.sense = SENSE_NO_SENSE
+        self.phase_changed = asyncio.Event()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._reset_transport()
+
+    @classmethod
+    def from_device(cls, device, config: Dict) -> 'MassStorageDevice':
+        """Модель для записи VirtualUsbDevice типа storage"""
+        from virtual_storage_utils import is_image_storage
+
+        if not device.storage_path:
+            raise ValueError(f'У устройства {device.name} нет хранилища')
+        read_only = bool(config.get('read_only'))
+        snapshot_path = None
+        if is_image_storage(device):
+            path = device.storage_path
+        else:
+            path = snapshot_path = build_directory_snapshot(device)
+            read_only = True
+        try:
+            image = BlockImage(path, read_only=read_only)
+        except Exception:
+            if snapshot_path:
+                _remove_snapshot(snapshot_path)
+            raise
+        return cls(image, snapshot_path=snapshot_path, **device_model_params(device, config))
+
+    def interfaces(self) -> List[UsbInterface]:
+        return [UsbInterface(0, CLASS_MASS_STORAGE, SUBCLASS_SCSI, PROTOCOL_BOT, endpoints=[
+            UsbEndpoint(EP_BULK_IN, EP_BULK, BULK_MAX_PACKET),
+            UsbEndpoint(EP_BULK_OUT, EP_BULK, BULK_MAX_PACKET)
+        ])]
+
+    # ------------------------------------------------------------------
+    # Bulk-Only Transport
+
+    def _reset_transport(self) -> None:
+        self.tag = 0
+        self.expected = 0
+        self.transferred = 0
+        self.csw_status = CSW_PASSED
+        self.data_in = None
+        self.data_out_handler = None
+        self._set_phase(PHASE_COMMAND)
+
+    @staticmethod
+    def _has_loop() -> bool:
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    def _set_phase(self, phase: str) -> None:
+        self.phase = phase
+        self.phase_changed.set()
+
+    def reset(self) -> None:
+        super().reset()
+        self.sense = SENSE_NO_SENSE
+        self._reset_transport()
+
+    async def handle_class_request(self, setup: SetupPacket, data: bytes) -> bytes:
+        if setup.type == REQ_TYPE_CLASS and setup.request == REQ_GET_MAX_LUN:
+            return b'\x00'
+        if setup.type == REQ_TYPE_CLASS and setup.request == REQ_BOT_RESET:
+            self._reset_transport()
+            return b''
+        raise UsbStall(f'Unsupported mass storage request {setup!r}')
+
+    async def handle_data(self, endpoint: UsbEndpoint, data: bytes, length: int):
+        if endpoint.address == EP_BULK_OUT:
+            if self.phase == PHASE_DATA_OUT:
+                self._receive(data)
+            else:
+                self._command(data)
+            return b''
+
+        # Bulk IN: ждем, пока команда не дойдет до фазы данных или статуса
+        while self.phase in (PHASE_COMMAND, PHASE_DATA_OUT):
+            self.phase_changed.clear()
+            await self.phase_changed.wait()
+        if self.phase == PHASE_DATA_IN:
+            return self._send(length)
+        return self._status()
+
+    def _command(self, data: bytes) -> None:
+        if len(data) != CBW.size:
+            logger.warning(f"Накопитель {self.product}: некорректный CBW ({len(data)} байт)")
+            # Reset recovery: хост снимет STALL после сброса класса
+            self.halted.update((EP_BULK_IN, EP_BULK_OUT))
+            raise UsbStall('Invalid CBW')
+        signature, tag, length, flags, lun, cb_length, cb = CBW.unpack(data)
+        if signature != CBW_SIGNATURE:
+            self.halted.update((EP_BULK_IN, EP_BULK_OUT))
+            raise UsbStall('Invalid CBW signature')
+
+        self.tag = tag
+        self.expected = length
+        self.transferred = 0
+        self.csw_status = CSW_PASSED
+        self.data_in = None
+        self.data_out_handler = None
+        direction_in = bool(flags & 0x80)
+
+        try:
+            if lun != 0:
+                raise ScsiError(SENSE_INVALID_FIELD_IN_CDB)
+            result = self.execute(cb[:cb_length] or cb, direction_in)
+            self.sense = SENSE_NO_SENSE
+        except ScsiError as e:
+            self.sense = e.sense
+            self.csw_status = CSW_FAILED
+            result = None
+
+        if length == 0:
+            self._set_phase(PHASE_STATUS)
+        elif direction_in:
+            self.data_in = result if isinstance(result, (bytes, bytearray, memoryview, ChunkedRead)) else b''
+            self._set_phase(PHASE_DATA_IN)
+        else:
+            # Данные хоста принимаются всегда; при ошибке они отбрасываются
+            self.data_out_handler = result if callable(result) else None
+            self._set_phase(PHASE_DATA_OUT)
+
+    def _send(self, length: int):
+        data = self.data_in
+        if isinstance(data, ChunkedRead):
+            chunk = data.next(min(length, self.expected - self.transferred))
+        else:
+            chunk = data[self.transferred:self.transferred + min(length, self.expected - self.transferred)]
+        self.transferred += len(chunk)
+        available = data.remaining if isinstance(data, ChunkedRead) else len(data) - self.transferred
+        if self.transferred >= self.expected or available <= 0 or len(chunk) < length:
+            # Короткий пакет завершает фазу данных, остаток сообщается в CSW
+            self._set_phase(PHASE_STATUS)
+        return chunk
+
+    def _receive(self, data: bytes) -> None:
+        accepted = data[:self.expected - self.transferred]
+        if self.data_out_handler is not None and self.csw_status == CSW_PASSED:
+            try:
+                self.data_out_handler(self.transferred, accepted)
+            except ScsiError as e:
+                self.sense = e.sense
+                self.csw_status = CSW_FAILED
+        self.transferred += len(accepted)
+        if self.transferred >= self.expected:
+            self._set_phase(PHASE_STATUS)
+
+    def _status(self) -> bytes:
+        residue = max(self.expected - self.transferred, 0)
+        csw = CSW.pack(CSW_SIGNATURE, self.tag, residue, self.csw_status)
+        self.data_in = None
+        self.data_out_handler = None
+        self._set_phase(PHASE_COMMAND)
+        return csw
+
+    # ------------------------------------------------------------------
+    # SCSI
+
+    def execute(self, cdb: bytes, direction_in: bool):
+        """
+        Выполнить команду SCSI
+
+        Returns:
+            Данные для хоста (bytes/memoryview/ChunkedRead), приемник данных
+            хоста callable(offset, data) для записи или None
+        """
+        opcode = cdb[0]
+        if opcode in (TEST_UNIT_READY, START_STOP_UNIT, PREVENT_ALLOW_MEDIUM_REMOVAL, VERIFY_10):
+            return None
+        if opcode == REQUEST_SENSE:
+            return self._request_sense(cdb[4])
+        if opcode == INQUIRY:
+            return self._inquiry(cdb)
+        if opcode in (MODE_SENSE_6, MODE_SENSE_10):
+            return self._mode_sense(cdb)
+        if opcode == MODE_SELECT_6:
+            return lambda offset, data: None
+        if opcode == READ_CAPACITY_10:
+            last = min(self.image.block_count - 1, 0xFFFFFFFF)
+            return struct.pack('>II', last, BLOCK_SIZE)
+        if opcode == SERVICE_ACTION_IN_16 and cdb[1] & 0x1F == SAI_READ_CAPACITY_16:
+            allocation = struct.unpack_from('>I', cdb, 10)[0]
+            return struct.pack('>QI', self.image.block_count - 1, BLOCK_SIZE).ljust(32, b'\0')[:allocation]
+        if opcode == READ_FORMAT_CAPACITIES:
+            # Заголовок списка + текущая емкость (formatted media)
+            allocation = struct.unpack_from('>H', cdb, 7)[0]
+            data = struct.pack('>III', 8, min(self.image.block_count, 0xFFFFFFFF), 0x02000000 | BLOCK_SIZE)
+            return data[:allocation]
+        if opcode in (READ_6, READ_10, READ_16):
+            lba, blocks = self._lba_and_length(cdb)
+            return ChunkedRead(self.image, lba * BLOCK_SIZE, blocks * BLOCK_SIZE)
+        if opcode in (WRITE_6, WRITE_10, WRITE_16):
+            lba, blocks = self._lba_and_length(cdb)
+            if self.image.read_only:
+                raise ScsiError(SENSE_WRITE_PROTECTED)
+            force_unit_access = opcode != WRITE_6 and bool(cdb[1] & 0x08)
+            return self._writer(lba * BLOCK_SIZE, blocks * BLOCK_SIZE, force_unit_access)
+        if opcode in (SYNCHRONIZE_CACHE_10, SYNCHRONIZE_CACHE_16):
+            self.flush()
+            return None
+        raise ScsiError(SENSE_INVALID_COMMAND)
+
+    def _lba_and_length(self, cdb: bytes) -> Tuple[int, int]:
+        opcode = cdb[0]
+        if opcode in (READ_6, WRITE_6):
+            lba = struct.unpack_from('>I', cdb, 0)[0] & 0x1FFFFF
+            blocks = cdb[4] or 256
+        elif opcode in (READ_10, WRITE_10):
+            lba, blocks = struct.unpack_from('>IxH', cdb, 2)
+        else:
+            lba, blocks = struct.unpack_from('>QI', cdb, 2)
+        if lba + blocks > self.image.block_count:
+            raise ScsiError(SENSE_LBA_OUT_OF_RANGE)
+        return lba, blocks
+
+    def _writer(self, start: int, length: int, force_unit_access: bool):
+        def write(offset: int, data: bytes) -> None:
+            if offset + len(data) > length:
+                raise ScsiError(SENSE_INVALID_FIELD_IN_CDB)
+            try:
+                self.image.write(start + offset, data)
+            except (OSError, ValueError) as e:
+                logger.error(f"Ошибка записи в образ {self.image.path}: {e}")
+                raise ScsiError(SENSE_WRITE_ERROR)
+            if force_unit_access and offset + len(data) >= length:
+                self.flush()
+            else:
+                self._schedule_flush()
+        return write
+
+    def _request_sense(self, allocation: int) -> bytes:
+        key, asc, ascq = self.sense
+        self.sense = SENSE_NO_SENSE
+        sense = struct.pack('>BxBxxxxBxxxxBBxxxx', 0x70, key, 10, asc, ascq)
+        return sense[:allocation or len(sense)]
+
+    def _inquiry(self, cdb: bytes) -> bytes:
+        allocation = struct.unpack_from('>H', cdb, 3)[0]
+        if cdb[1] & 0x01:
+            page = cdb[2]
+            if page == 0x00:
+                data = bytes([0, 0x00, 0, 2, 0x00, 0x80])
+            elif page == 0x80:
+                serial = (self.serial_number or '0').encode('ascii', 'replace')[:252]
+                data = bytes([0, 0x80, 0, len(serial)]) + serial
+            else:
+                raise ScsiError(SENSE_INVALID_FIELD_IN_CDB)
+            return data[:allocation]
+        data = struct.pack(
+            '>BBBBBBBB8s16s4s', 0x00, 0x80, 0x06, 0x02, 31, 0, 0, 0,
+            self.vendor_name.encode('ascii', 'replace')[:8].ljust(8),
+            self.product.encode('ascii', 'replace')[:16].ljust(16),
+            b'%04x' % self.bcd_device
+        )
+        return data[:allocation]
+
+    def _mode_sense(self, cdb: bytes) -> bytes:
+        page = cdb[2] & 0x3F
+        device_specific = 0x80 if self.image.read_only else 0x00
+        pages = b''
+        if page in (0x08, 0x3F):
+            # Caching page: кэш записи включен (WCE), хост присылает SYNCHRONIZE CACHE
+            pages += bytes([0x08, 0x12, 0x04]) + bytes(17)
+        elif page != 0x00:
+            raise ScsiError(SENSE_INVALID_FIELD_IN_CDB)
+        if cdb[0] == MODE_SENSE_6:
+            allocation = cdb[4]
+            header = struct.pack('>BBBB', 3 + len(pages), 0, device_specific, 0)
+        else:
+            allocation = struct.unpack_from('>H', cdb, 7)[0]
+            header = struct.pack('>HBBxxH', 6 + len(pages), 0, device_specific, 0)
+        return (header + pages)[:allocation]
+
+    # ------------------------------------------------------------------
+    # Сброс изменений
+
+    def _schedule_flush(self) -> None:
+        if self.image.dirty.bytes >= DIRTY_FLUSH_BYTES:
+            self.flush()
+            return
+        if self._flush_handle is None and self._has_loop():
+            self._flush_handle = asyncio.get_running_loop().call_later(DIRTY_FLUSH_DELAY, self.flush)
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        started = time.perf_counter()
+        calls = self.image.flush()
+        if calls:
+            logger.debug(f"Образ {self.image.path}: сброшено {calls} участков за "
+                         f"{(time.perf_counter() - started) * 1000:.1f} мс")
+
+    def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.image.close()
+        if self.snapshot_path:
+            # Удаляется только собственный снимок модели: у пересобранной модели
+            # того же устройства свой файл
+            _remove_snapshot(self.snapshot_path)
+            self.snapshot_path = None
+
+
+def _remove_snapshot(path: str) -> None:
+    """Удалить файл снимка, игнорируя ошибки"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def build_directory_snapshot(device) -> str:
+    """
+    Собрать образ FAT32 с копией файлов директории устройства
+
+    Каждый снимок собирается в отдельном файле: при пересборке прежняя модель
+    может еще экспортировать свой снимок (он отображен в память и смонтирован
+    на клиенте), поэтому перезаписывать или удалять его нельзя.
+
+    Returns:
+        str: Путь к образу снимка (удаляется при снятии устройства с экспорта)
+    """
+    import fat_image
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR, ensure_storage_dir_exists
+
+    ensure_storage_dir_exists()
+    fd, path = tempfile.mkstemp(prefix=f'.device_{device.id}-', suffix=SNAPSHOT_SUFFIX,
+                                dir=VIRTUAL_STORAGE_BASE_DIR)
+    os.close(fd)
+    try:
+        _fill_directory_snapshot(device, path)
+    except Exception:
+        _remove_snapshot(path)
+        raise
+    return path
+
+
+def _fill_directory_snapshot(device, path: str) -> None:
+    """Отформатировать образ снимка и скопировать в него файлы директории"""
+    import fat_image
+    from storage_trash import is_trash_name
+
+    size_mb = min(max(device.storage_size or 0, fat_image.MIN_IMAGE_SIZE_MB), fat_image.MAX_IMAGE_SIZE_MB)
+    fat_image.create_image(path, size_mb, label=f'USB{device.id}')
+
+    root = device.storage_path
+    skipped = 0
+    with fat_image.FatImage(path, writable=True) as image:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(name for name in dirnames if not is_trash_name(name))
+            relative = os.path.relpath(dirpath, root)
+            relative = '' if relative == '.' else relative.replace(os.sep, '/')
+            for name in dirnames:
+                try:
+                    image.make_dir(f'{relative}/{name}' if relative else name)
+                except fat_image.FatError:
+                    skipped += 1
+            for name in sorted(filenames):
+                try:
+                    with open(os.path.join(dirpath, name), 'rb') as stream:
+                        image.write_file(f'{relative}/{name}' if relative else name, stream)
+                except (OSError, fat_image.FatError):
+                    skipped += 1
+    if skipped:
+        logger.warning(f"Снимок устройства {device.name}: пропущено {skipped} элементов (имя или место)")
+    logger.info(f"Собран снимок директории {root} для экспорта устройства {device.name}")
+
@@ -0,0 +1,421 @@
+"""
+Топология виртуальных USB-устройств: шины, хабы, порты и бюджет
+периодических передач.
+
+Корневой хаб (без родителя) - это шина с номером bus_number; внешние хабы
+подключаются к портам родительских хабов (не больше MAX_HUB_DEPTH уровней,
+как в USB 2.0). Виртуальный порт (VirtualUsbPort) размещается на порту хаба
+через VirtualUsbPortLocation, и подключенное к нему устройство получает
+стабильный busid в формате Linux: <шина>-<порт>[.<порт>...], например 10-1.3.
+
+Пропускная способность учитывается для периодических (interrupt и
+isochronous) конечных точек: bulk-передачи в USB не резервируются. Каждый
+хаб ограничен емкостью периодического расписания своей скорости (80% микро-
+кадра high speed, 90% кадра full speed) и числом периодических конечных
+точек ниже него; порт может иметь собственные ограничения. Подключение
+устройства, которое превысит любой бюджет на пути к шине, отклоняется.
+
+Требования устройства берутся из config_json ("usb_bandwidth": {"endpoints":
+[{"type": "isochronous", "max_packet": 1024, "mult": 3, "interval_ms": 0.125}]})
+или по умолчанию для типа устройства.
+"""
+
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from models import db, VirtualUsbDevice, VirtualUsbPort, VirtualUsbHub, VirtualUsbPortLocation
+from usb_device_models import parse_device_config
+
+logger = logging.getLogger(__name__)
+
+SPEEDS = ('full', 'high', 'super')
+
+# Емкость периодического расписания, байт/с:
+# full  - 90% кадра 1 мс (1500 байт), high - 80% микрокадра 125 мкс (7500 байт),
+# super - 3 пакета по 1024 байта x 16 (burst) за микрокадр
+PERIODIC_CAPACITY = {
+    'full': 1350 * 1000,
+    'high': 6000 * 8000,
+    'super': 48 * 1024 * 8000
+}
+
+# Периодических конечных точек ниже хаба по умолчанию
+DEFAULT_PERIODIC_SLOTS = {'full': 16, 'high': 64, 'super': 128}
+
+# Внешних хабов между корневым хабом и устройством (USB 2.0: 5)
+MAX_HUB_DEPTH = 5
+MAX_HUB_PORTS = 15
+
+# Шины топологии нумеруются с 10 (шина 9 - устройства без места в топологии)
+FIRST_BUS_NUMBER = 10
+
+PERIODIC_TYPES = ('interrupt', 'isochronous')
+
+# Периодические конечные точки по типу устройства (если в config_json нет usb_bandwidth)
+DEFAULT_ENDPOINTS = {
+    'hid': [{'type': 'interrupt', 'max_packet': 8, 'interval_ms': 1}],
+    'serial': [{'type': 'interrupt', 'max_packet': 16, 'interval_ms': 16}],
+    'ethernet': [{'type': 'interrupt', 'max_packet': 16, 'interval_ms': 8}],
+    'audio': [{'type': 'isochronous', 'max_packet': 192, 'interval_ms': 1}],
+    'camera': [{'type': 'isochronous', 'max_packet': 1024, 'mult': 3, 'interval_ms': 0.125}]
+}
+
+
+class TopologyError(ValueError):
+    """Недопустимая конфигурация топологии или превышение бюджета"""
+
+
+def _format_rate(value: float) -> str:
+    return f'{value / 1e6:.2f} МБ/с'
+
+
+def endpoint_rate(endpoint: Dict) -> float:
+    """Резервируемая полоса конечной точки, байт/с"""
+    return endpoint['max_packet'] * endpoint.get('mult', 1) * 1000.0 / endpoint['interval_ms']
+
+
+def device_requirements(device: VirtualUsbDevice) -> Dict:
+    """
+    Периодические конечные точки устройства и их суммарная полоса
+
+    Raises:
+        TopologyError: Некорректное описание usb_bandwidth в config_json
+    """
+    config = parse_device_config(device.config_json)
+    spec = config.get('usb_bandwidth')
+    if spec is not None:
+        endpoints = spec.get('endpoints') if isinstance(spec, dict) else None
+        if not isinstance(endpoints, list):
+            raise TopologyError('usb_bandwidth.endpoints должен быть списком')
+    else:
+        endpoints = [dict(endpoint) for endpoint in DEFAULT_ENDPOINTS.get(device.device_type, [])]
+        if device.device_type == 'hid' and config.get('poll_interval_ms'):
+            try:
+                endpoints[0]['interval_ms'] = max(int(config['poll_interval_ms']), 1)
+            except (TypeError, ValueError):
+                pass
+
+    checked = []
+    for endpoint in endpoints:
+        if not isinstance(endpoint, dict) or endpoint.get('type') not in PERIODIC_TYPES:
+            raise TopologyError('Тип конечной точки usb_bandwidth: interrupt или isochronous')
+        max_packet, mult, interval = endpoint.get('max_packet'), endpoint.get('mult', 1), endpoint.get('interval_ms')
+        if not isinstance(max_packet, int) or not 1 <= max_packet <= 1024:
+            raise TopologyError('max_packet должен быть от 1 до 1024')
+        if not isinstance(mult, int) or not 1 <= mult <= 3:
+            raise TopologyError('mult должен быть от 1 до 3')
+        if not isinstance(interval, (int, float)) or interval < 0.125:
+            raise TopologyError('interval_ms должен быть не меньше 0.125')
+        checked.append({'type': endpoint['type'], 'max_packet': max_packet, 'mult': mult, 'interval_ms': interval})
+    return {
+        'endpoints': checked,
+        'bytes_per_second': round(sum(endpoint_rate(endpoint) for endpoint in checked)),
+        'periodic_endpoints': len(checked)
+    }
+
+
+class Topology:
+    """Снимок топологии из БД (хабы, места портов, подключенные устройства)"""
+
+    def __init__(self):
+        self.hubs: Dict[int, VirtualUsbHub] = {hub.id: hub for hub in VirtualUsbHub.query.all()}
+        self.locations: Dict[int, VirtualUsbPortLocation] = {
+            location.port_id: location for location in VirtualUsbPortLocation.query.all()}
+        self.ports: Dict[int, VirtualUsbPort] = {port.id: port for port in VirtualUsbPort.query.all()}
+        self.devices: Dict[int, VirtualUsbDevice] = {
+            device.id: device for device in VirtualUsbDevice.query.filter_by(is_active=True).all()}
+        self._requirements: Dict[int, Dict] = {}
+
+    # ------------------------------------------------------------------
+    # Структура
+
+    def path(self, hub_id: int) -> List[VirtualUsbHub]:
+        """Хабы от корневого до hub_id включительно"""
+        path = []
+        hub = self.hubs.get(hub_id)
+        while hub is not None:
+            path.append(hub)
+            hub = self.hubs.get(hub.parent_hub_id) if hub.parent_hub_id else None
+        return list(reversed(path))
+
+    def effective_speed(self, hub_id: int) -> str:
+        """Скорость хаба с учетом вышестоящих (хаб high speed за full speed работает как full)"""
+        return min((hub.speed for hub in self.path(hub_id)), key=SPEEDS.index)
+
+    def capacity(self, hub_id: int) -> Tuple[int, int]:
+        """Емкость хаба: байт/с периодических передач и число периодических конечных точек"""
+        hub = self.hubs[hub_id]
+        speed = self.effective_speed(hub_id)
+        slots = hub.periodic_slots if hub.periodic_slots is not None else DEFAULT_PERIODIC_SLOTS[speed]
+        return PERIODIC_CAPACITY[speed], slots
+
+    def subtree(self, hub_id: int) -> List[int]:
+        result = [hub_id]
+        for hub in self.hubs.values():
+            if hub.parent_hub_id == hub_id:
+                result.extend(self.subtree(hub.id))
+        return result
+
+    def occupant(self, hub_id: int, hub_port: int) -> Optional[str]:
+        """Что занимает порт хаба: описание хаба или порта, None - свободен"""
+        for hub in self.hubs.values():
+            if hub.parent_hub_id == hub_id and hub.parent_port == hub_port:
+                return f'хаб {hub.name}'
+        for location in self.locations.values():
+            if location.hub_id == hub_id and location.hub_port == hub_port:
+                port = self.ports.get(location.port_id)
+                return f'порт {port.name if port else location.port_id}'
+        return None
+
+    def port_busid(self, port_id: int) -> Optional[str]:
+        """busid порта (None - порт не размещен в топологии)"""
+        location = self.locations.get(port_id)
+        if location is None:
+            return None
+        path = self.path(location.hub_id)
+        numbers = [str(hub.parent_port) for hub in path[1:]] + [str(location.hub_port)]
+        return f'{path[0].bus_number}-{".".join(numbers)}'
+
+    # ------------------------------------------------------------------
+    # Бюджет
+
+    def requirements(self, device: VirtualUsbDevice) -> Dict:
+        if device.id not in self._requirements:
+            self._requirements[device.id] = device_requirements(device)
+        return self._requirements[device.id]
+
+    def connected(self, exclude_device_id: Optional[int] = None, exclude_port_id: Optional[int] = None):
+        """(место порта, устройство) для подключенных устройств на размещенных портах"""
+        for port_id, location in self.locations.items():
+            port = self.ports.get(port_id)
+            if port is None or port.id == exclude_port_id or not port.is_connected or not port.device_id:
+                continue
+            device = self.devices.get(port.device_id)
+            if device is None or device.id == exclude_device_id:
+                continue
+            yield location, device
+
+    def usage(self, hub_id: int, **exclude) -> Tuple[int, int]:
+        """Занято ниже хаба: байт/с и периодических конечных точек"""
+        hubs = set(self.subtree(hub_id))
+        rate = slots = 0
+        for location, device in self.connected(**exclude):
+            if location.hub_id in hubs:
+                requirements = self.requirements(device)
+                rate += requirements['bytes_per_second']
+                slots += requirements['periodic_endpoints']
+        return rate, slots
+
+    def check_connect(self, device: VirtualUsbDevice, port_id: int,
+                      location: Optional[VirtualUsbPortLocation] = None) -> Dict:
+        """
+        Проверить бюджет при подключении устройства к порту
+
+        Args:
+            location: Проверяемое место порта (по умолчанию - текущее)
+
+        Returns:
+            Dict: Требования устройства (порт без места в топологии не проверяется)
+
+        Raises:
+            TopologyError: Подключение превысит бюджет порта, хаба или шины
+        """
+        requirements = self.requirements(device)
+        location = location or self.locations.get(port_id)
+        if location is None:
+            return requirements
+        rate, slots = requirements['bytes_per_second'], requirements['periodic_endpoints']
+
+        if location.bandwidth_budget is not None and rate > location.bandwidth_budget:
+            raise TopologyError(f'Устройству {device.name} нужно {_format_rate(rate)} периодических передач, '
+                                f'бюджет порта {_format_rate(location.bandwidth_budget)}')
+        if location.periodic_slots is not None and slots > location.periodic_slots:
+            raise TopologyError(f'Устройству {device.name} нужно {slots} периодических конечных точек, '
+                                f'на порту доступно {location.periodic_slots}')
+
+        for hub in reversed(self.path(location.hub_id)):
+            capacity_rate, capacity_slots = self.capacity(hub.id)
+            used_rate, used_slots = self.usage(hub.id, exclude_device_id=device.id, exclude_port_id=port_id)
+            kind = 'шины' if hub.parent_hub_id is None else 'хаба'
+            if used_rate + rate > capacity_rate:
+                raise TopologyError(
+                    f'Превышена полоса {kind} {hub.name}: занято {_format_rate(used_rate)}, '
+                    f'устройству {device.name} нужно {_format_rate(rate)}, '
+                    f'доступно {_format_rate(capacity_rate)}')
+            if used_slots + slots > capacity_slots:
+                raise TopologyError(
+                    f'Превышено число периодических конечных точек {kind} {hub.name}: '
+                    f'занято {used_slots} из {capacity_slots}, устройству {device.name} нужно {slots}')
+        return requirements
+
+    # ------------------------------------------------------------------
+    # Представление
+
+    def tree(self) -> List[Dict]:
+        """Дерево шин и хабов с портами, устройствами и загрузкой"""
+        def hub_node(hub: VirtualUsbHub) -> Dict:
+            capacity_rate, capacity_slots = self.capacity(hub.id)
+            used_rate, used_slots = self.usage(hub.id)
+            ports = []
+            for number in range(1, hub.num_ports + 1):
+                child = next((h for h in self.hubs.values()
+                              if h.parent_hub_id == hub.id and h.parent_port == number), None)
+                location = next((loc for loc in self.locations.values()
+                                 if loc.hub_id == hub.id and loc.hub_port == number), None)
+                entry = {'number': number}
+                if child is not None:
+                    entry['hub'] = hub_node(child)
+                elif location is not None:
+                    port = self.ports.get(location.port_id)
+                    device = self.devices.get(port.device_id) if port and port.is_connected else None
+                    entry['port'] = {
+                        'id': location.port_id,
+                        'name': port.name if port else None,
+                        'busid': self.port_busid(location.port_id),
+                        'bandwidth_budget': location.bandwidth_budget,
+                        'periodic_slots': location.periodic_slots,
+                        'device': {
+                            'id': device.id,
+                            'name': device.name,
+                            'device_type': device.device_type,
+                            'requirements': self.requirements(device)
+                        } if device else None
+                    }
+                ports.append(entry)
+            return {
+                'id': hub.id,
+                'name': hub.name,
+                'bus_number': self.path(hub.id)[0].bus_number,
+                'speed': self.effective_speed(hub.id),
+                'tier': len(self.path(hub.id)),
+                'bandwidth': {'used': used_rate, 'capacity': capacity_rate},
+                'periodic_slots': {'used': used_slots, 'capacity': capacity_slots},
+                'ports': ports
+            }
+        return [hub_node(hub) for hub in sorted(self.hubs.values(), key=lambda h: h.bus_number or 0)
+                if hub.parent_hub_id is None]
+
+
+# ----------------------------------------------------------------------
+# Изменение топологии
+
+def create_hub(name: str, parent_hub_id: Optional[int] = None, parent_port: Optional[int] = None,
+               num_ports: int = 4, speed: str = 'high', periodic_slots: Optional[int] = None) -> VirtualUsbHub:
+    """
+    Создать корневой хаб (новую шину) или внешний хаб на порту родителя
+
+    Raises:
+        TopologyError: Недопустимые параметры или порт родителя занят
+    """
+    if not name:
+        raise TopologyError('Имя хаба обязательно')
+    if speed not in SPEEDS:
+        raise TopologyError(f'Скорость хаба: {", ".join(SPEEDS)}')
+    if not isinstance(num_ports, int) or not 1 <= num_ports <= MAX_HUB_PORTS:
+        raise TopologyError(f'Число портов хаба должно быть от 1 до {MAX_HUB_PORTS}')
+    if periodic_slots is not None and (not isinstance(periodic_slots, int) or periodic_slots < 0):
+        raise TopologyError('periodic_slots должен быть неотрицательным числом')
+
+    topology = Topology()
+    hub = VirtualUsbHub(name=name, num_ports=num_ports, speed=speed, periodic_slots=periodic_slots)
+    if parent_hub_id is None:
+        used = {h.bus_number for h in topology.hubs.values() if h.bus_number is not None}
+        hub.bus_number = next(n for n in range(FIRST_BUS_NUMBER, FIRST_BUS_NUMBER + 1000) if n not in used)
+    else:
+        parent = topology.hubs.get(parent_hub_id)
+        if parent is None:
+            raise TopologyError('Родительский хаб не найден')
+        if len(topology.path(parent.id)) > MAX_HUB_DEPTH:
+            raise TopologyError(f'Не больше {MAX_HUB_DEPTH} уровней внешних хабов')
+        if not isinstance(parent_port, int) or not 1 <= parent_port <= parent.num_ports:
+            raise TopologyError(f'Порт родительского хаба должен быть от 1 до {parent.num_ports}')
+        occupant = topology.occupant(parent.id, parent_port)
+        if occupant:
+            raise TopologyError(f'Порт {parent_port} хаба {parent.name} занят ({occupant})')
+        hub.parent_hub_id = parent.id
+        hub.parent_port = parent_port
+    db.session.add(hub)
+    db.session.commit()
+    logger.info(f"Создан виртуальный хаб {hub.name} ({num_ports} портов, {speed})")
+    return hub
+
+
+def delete_hub(hub_id: int) -> None:
+    """Удалить пустой хаб (без дочерних хабов и размещенных портов)"""
+    hub = db.session.get(VirtualUsbHub, hub_id)
+    if hub is None:
+        raise TopologyError('Хаб не найден')
+    if VirtualUsbHub.query.filter_by(parent_hub_id=hub.id).first() or \
+            VirtualUsbPortLocation.query.filter_by(hub_id=hub.id).first():
+        raise TopologyError(f'Хаб {hub.name} не пуст: сначала уберите дочерние хабы и порты')
+    db.session.delete(hub)
+    db.session.commit()
+
+
+def place_port(port: VirtualUsbPort, hub_id: Optional[int], hub_port: Optional[int] = None,
+               bandwidth_budget: Optional[int] = None, periodic_slots: Optional[int] = None) -> Optional[str]:
+    """
+    Разместить виртуальный порт на порту хаба (hub_id=None - убрать из топологии)
+
+    Подключенное к порту устройство проверяется по бюджету нового места.
+
+    Returns:
+        Optional[str]: Новый busid порта
+
+    Raises:
+        TopologyError: Порт хаба занят или устройство не проходит по бюджету
+    """
+    current = db.session.get(VirtualUsbPortLocation, port.id)
+    if hub_id is None:
+        if current is not None:
+            db.session.delete(current)
+            db.session.commit()
+        return None
+
+    for field, value in (('bandwidth_budget', bandwidth_budget), ('periodic_slots', periodic_slots)):
+        if value is not None and (not isinstance(value, int) or value < 0):
+            raise TopologyError(f'{field} должен быть неотрицательным числом')
+
+    topology = Topology()
+    hub = topology.hubs.get(hub_id)
+    if hub is None:
+        raise TopologyError('Хаб не найден')
+    if not isinstance(hub_port, int) or not 1 <= hub_port <= hub.num_ports:
+        raise TopologyError(f'Порт хаба должен быть от 1 до {hub.num_ports}')
+    occupant = topology.occupant(hub.id, hub_port)
+    if occupant and not (current is not None and current.hub_id == hub.id and current.hub_port == hub_port):
+        raise TopologyError(f'Порт {hub_port} хаба {hub.name} занят ({occupant})')
+
+    candidate = VirtualUsbPortLocation(port_id=port.id, hub_id=hub.id, hub_port=hub_port,
+                                       bandwidth_budget=bandwidth_budget, periodic_slots=periodic_slots)
+    device = topology.devices.get(port.device_id) if port.is_connected and port.device_id else None
+    if device is not None:
+        topology.check_connect(device, port.id, candidate)
+
+    if current is None:
+        db.session.add(candidate)
+    else:
+        current.hub_id = hub.id
+        current.hub_port = hub_port
+        current.bandwidth_budget = bandwidth_budget
+        current.periodic_slots = periodic_slots
+    db.session.commit()
+    return Topology().port_busid(port.id)
+
+
+def check_device_connect(device: VirtualUsbDevice, port: VirtualUsbPort) -> Tuple[bool, str]:
+    """Проверка бюджета перед подключением устройства к порту: (можно ли, сообщение)"""
+    try:
+        Topology().check_connect(device, port.id)
+    except TopologyError as e:
+        return False, str(e)
+    return True, ''
+
+
+def device_busids() -> Dict[int, str]:
+    """busid подключенных устройств на размещенных в топологии портах: device_id -> busid"""
+    topology = Topology()
+    busids = {}
+    for location, device in topology.connected():
+        busids.setdefault(device.id, topology.port_busid(location.port_id))
+    return busids
@@ -0,0 +1,543 @@
+"""
+Запись и воспроизведение потока URB сервера USB/IP.
+
+Запись: сервер (UsbipServer.capture) пишет отправку ('S') и завершение ('C')
+каждого URB в файл pcap с заголовками usbmon (LINKTYPE_USB_LINUX_MMAPPED),
+поэтому запись открывается в Wireshark как обычный захват usbmon. Поле id
+заголовка usbmon - (devid << 32) | seqnum: по нему восстанавливаются шина и
+номер устройства (поле devnum usbmon - 7-битный адрес).
+
+Воспроизведение: URB одного устройства из записи передаются модели в этом
+процессе или удаленному серверу USB/IP с исходными интервалами, в N раз
+быстрее или без пауз (speed=0). Зависимости сохраняются: URB отправляется
+только после завершения всех URB, которые в записи завершились раньше его
+отправки (CBW, данные и CSW накопителя, запрос и ответ и т.д.), а URB,
+находившиеся в записи в полете одновременно, и здесь выполняются параллельно.
+Результат - пропускная способность и распределение задержек завершения.
+
+Командная строка:
+
+    python usbip_capture.py info capture.pcap
+    python usbip_capture.py replay capture.pcap --busid 10-1.2 [--host H] [--port P] [--speed 4|max]
+    python usbip_capture.py replay capture.pcap --device-id 7 [--speed max] [--verify]
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import struct
+import asyncio
+import argparse
+import logging
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from usb_device_models import EP_CONTROL, EP_ISOCHRONOUS, EP_BULK, EP_INTERRUPT, UsbDeviceModel
+from usbip_server import Urb, UsbipClient, execute_urb, USBIP_DIR_IN, USBIP_DIR_OUT, DEFAULT_PORT
+
+logger = logging.getLogger(__name__)
+
+# Каталог записей (по умолчанию virtual_storage/captures)
+CAPTURE_DIR_ENV_VAR = 'USBIP_CAPTURE_DIR'
+CAPTURE_SUFFIX = '.pcap'
+
+# Байт данных URB в записи и предельный размер файла
+DEFAULT_SNAPLEN = 65536
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Ожидание завершения URB при воспроизведении (секунды)
+DEFAULT_REPLAY_TIMEOUT = 5.0
+
+# pcap (микросекунды, little-endian) с заголовками usbmon
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD = struct.Struct('<IIII')
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+# id, type, xfer_type, epnum, devnum, busnum, flag_setup, flag_data, ts_sec, ts_usec,
+# status, length, len_cap, setup, interval, start_frame, xfer_flags, ndesc
+USBMON_HEADER = struct.Struct('<QBBBBHBBqiiII8siiII')
+
+EVENT_SUBMIT = ord('S')
+EVENT_COMPLETE = ord('C')
+
+# Тип передачи usbmon по типу конечной точки USB
+USBMON_XFER_TYPES = {EP_ISOCHRONOUS: 0, EP_INTERRUPT: 1, EP_CONTROL: 2, EP_BULK: 3}
+
+
+class CaptureError(ValueError):
+    """Файл не является записью URB или поврежден"""
+
+
+def capture_dir() -> str:
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR
+    return os.environ.get(CAPTURE_DIR_ENV_VAR) or os.path.join(VIRTUAL_STORAGE_BASE_DIR, 'captures')
+
+
+def list_captures() -> List[Dict]:
+    """Файлы записей в каталоге записей, новые первыми"""
+    directory = capture_dir()
+    if not os.path.isdir(directory):
+        return []
+    captures = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(CAPTURE_SUFFIX) and os.path.isfile(path):
+            stat = os.stat(path)
+            captures.append({'name': name, 'size': stat.st_size,
+                             'modified': datetime.fromtimestamp(stat.st_mtime).isoformat()})
+    return sorted(captures, key=lambda c: c['modified'], reverse=True)
+
+
+def capture_path(name: str) -> Optional[str]:
+    """Путь к записи по имени файла (None - нет такой записи)"""
+    if os.path.basename(name) != name or not name.endswith(CAPTURE_SUFFIX):
+        return None
+    path = os.path.join(capture_dir(), name)
+    return path if os.path.isfile(path) else None
+
+
+# ----------------------------------------------------------------------
+# Запись
+
+class UrbCapture:
+    """
+    Запись URB экспортируемых устройств в pcap. Методы вызываются из цикла
+    сервера; запись идет в буфер файла, без отдельного потока.
+    """
+
+    def __init__(self, path: str, busids: Optional[List[str]] = None, snaplen: int = DEFAULT_SNAPLEN,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.busids = set(busids) if busids else None
+        self.snaplen = snaplen
+        self.max_bytes = max_bytes
+        self.records = 0
+        self.size = PCAP_HEADER.size
+        self.truncated = False
+        self.started_at = datetime.utcnow()
+        # Время записи: стенные часы на старте плюс монотонный счетчик
+        self._wall = time.time()
+        self._perf = time.perf_counter()
+        self._file = open(path, 'wb', buffering=1024 * 1024)
+        self._file.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, USBMON_HEADER.size + snaplen,
+                                          LINKTYPE_USB_LINUX_MMAPPED))
+
+    def submit(self, exported, urb: Urb) -> None:
+        if self.busids is None or exported.busid in self.busids:
+            data = urb.data if urb.direction == USBIP_DIR_OUT else b''
+            self._write(exported, urb, EVENT_SUBMIT, 0, urb.length, data)
+
+    def complete(self, exported, urb: Urb, status: int, data=b'') -> None:
+        if self.busids is None or exported.busid in self.busids:
+            if urb.direction == USBIP_DIR_IN:
+                self._write(exported, urb, EVENT_COMPLETE, status, len(data), data)
+            else:
+                self._write(exported, urb, EVENT_COMPLETE, status, urb.length if status == 0 else 0, b'')
+
+    def _write(self, exported, urb: Urb, event: int, status: int, length: int, data) -> None:
+        if self._file is None or self.truncated:
+            return
+        captured = data[:self.snaplen]
+        caplen = USBMON_HEADER.size + len(captured)
+        if self.size + PCAP_RECORD.size + caplen > self.max_bytes:
+            self.truncated = True
+            logger.warning(f"Запись URB {self.path}: достигнут предельный размер, запись остановлена")
+            return
+
+        timestamp = self._wall + (time.perf_counter() - self._perf)
+        sec = int(timestamp)
+        usec = int((timestamp - sec) * 1e6)
+        if urb.ep == 0:
+            xfer_type = USBMON_XFER_TYPES[EP_CONTROL]
+        else:
+            endpoint = exported.model.get_endpoint(urb.ep | (0x80 if urb.direction == USBIP_DIR_IN else 0))
+            xfer_type = USBMON_XFER_TYPES.get(endpoint.transfer_type if endpoint else EP_BULK, 3)
+        with_setup = urb.ep == 0 and event == EVENT_SUBMIT
+        if captured:
+            flag_data = 0
+        else:
+            flag_data = ord('<') if urb.direction == USBIP_DIR_IN else ord('>')
+
+        self._file.write(PCAP_RECORD.pack(sec, usec, caplen, USBMON_HEADER.size + len(data)))
+        self._file.write(USBMON_HEADER.pack(
+            ((exported.devid & 0xFFFFFFFF) << 32) | (urb.seqnum & 0xFFFFFFFF), event, xfer_type,
+            urb.ep | (0x80 if urb.direction == USBIP_DIR_IN else 0), exported.devnum & 0x7F,
+            exported.busnum & 0xFFFF, 0 if with_setup else ord('-'), flag_data, sec, usec,
+            status, length, len(captured), urb.setup if with_setup else b'\0' * 8, 0, 0, 0, 0
+        ))
+        if captured:
+            self._file.write(captured)
+        self.records += 1
+        self.size += PCAP_RECORD.size + caplen
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def info(self) -> Dict:
+        return {
+            'name': os.path.basename(self.path),
+            'busids': sorted(self.busids) if self.busids else None,
+            'records': self.records,
+            'size': self.size,
+            'truncated': self.truncated,
+            'started_at': self.started_at.isoformat(),
+            'active': self._file is not None
+        }
+
+
+def new_capture_path() -> str:
+    directory = capture_dir()
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'usbip-{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}{CAPTURE_SUFFIX}')
+
+
+# ----------------------------------------------------------------------
+# Чтение
+
+class UrbEvent:
+    """Событие записи: отправка или завершение URB"""
+
+    __slots__ = ('urb_id', 'event', 'xfer_type', 'address', 'timestamp', 'status', 'length', 'setup', 'data')
+
+    def __init__(self, urb_id, event, xfer_type, address, timestamp, status, length, setup, data):
+        self.urb_id = urb_id
+        self.event = event
+        self.xfer_type = xfer_type
+        self.address = address
+        self.timestamp = timestamp
+        self.status = status
+        self.length = length
+        self.setup = setup
+        self.data = data
+
+    @property
+    def ep(self) -> int:
+        return self.address & 0x0F
+
+    @property
+    def direction(self) -> int:
+        return USBIP_DIR_IN if self.address & 0x80 else USBIP_DIR_OUT
+
+    @property
+    def device(self) -> Tuple[int, int]:
+        """(шина, номер устройства) из id URB"""
+        devid = self.urb_id >> 32
+        return devid >> 16, devid & 0xFFFF
+
+    @property
+    def complete_data(self) -> bool:
+        """Данные записаны полностью (не обрезаны snaplen)"""
+        return len(self.data) == self.length
+
+
+def read_capture(path: str) -> Iterator[UrbEvent]:
+    """
+    События записи по порядку
+
+    Raises:
+        CaptureError: Не pcap с заголовками usbmon или файл поврежден
+    """
+    with open(path, 'rb') as f:
+        header = f.read(PCAP_HEADER.size)
+        if len(header) < PCAP_HEADER.size:
+            raise CaptureError('Файл слишком короткий для pcap')
+        magic, _, _, _, _, _, linktype = PCAP_HEADER.unpack(header)
+        if magic != PCAP_MAGIC:
+            raise CaptureError('Ожидается pcap (little-endian, микросекунды)')
+        if linktype != LINKTYPE_USB_LINUX_MMAPPED:
+            raise CaptureError(f'Тип канала {linktype}, ожидается {LINKTYPE_USB_LINUX_MMAPPED} (usbmon)')
+        while True:
+            record = f.read(PCAP_RECORD.size)
+            if not record:
+                return
+            if len(record) < PCAP_RECORD.size:
+                raise CaptureError('Запись обрывается на заголовке пакета')
+            _, _, caplen, _ = PCAP_RECORD.unpack(record)
+            packet = f.read(caplen)
+            if len(packet) < caplen or caplen < USBMON_HEADER.size:
+                raise CaptureError('Запись обрывается на пакете')
+            (urb_id, event, xfer_type, address, _, _, _, _, sec, usec,
+             status, length, len_cap, setup, _, _, _, _) = USBMON_HEADER.unpack_from(packet)
+            yield UrbEvent(urb_id, event, xfer_type, address, sec + usec / 1e6, status, length, setup,
+                           packet[USBMON_HEADER.size:USBMON_HEADER.size + len_cap])
+
+
+def capture_summary(path: str) -> List[Dict]:
+    """Устройства в записи: число URB, объем данных и длительность"""
+    devices: Dict[Tuple[int, int], Dict] = {}
+    for event in read_capture(path):
+        summary = devices.setdefault(event.device, {
+            'busnum': event.device[0], 'devnum': event.device[1], 'urbs': 0,
+            'bytes_in': 0, 'bytes_out': 0, 'first': event.timestamp, 'last': event.timestamp})
+        summary['last'] = event.timestamp
+        if event.event == EVENT_SUBMIT:
+            summary['urbs'] += 1
+        elif event.status == 0:
+            summary['bytes_in' if event.direction == USBIP_DIR_IN else 'bytes_out'] += event.length
+    result = []
+    for summary in devices.values():
+        summary['duration_s'] = round(summary.pop('last') - summary.pop('first'), 6)
+        result.append(summary)
+    return result
+
+
+# ----------------------------------------------------------------------
+# Воспроизведение
+
+class ModelTarget:
+    """Воспроизведение на модели устройства в этом процессе (без сети)"""
+
+    def __init__(self, model: UsbDeviceModel, label: str = 'replay'):
+        self.model = model
+        self.label = label
+
+    async def open(self) -> None:
+        self.model.on_export()
+
+    def start(self, urb: Urb):
+        task = asyncio.ensure_future(execute_urb(self.model, urb, self.label))
+        return task, task
+
+    async def flush(self) -> None:
+        pass
+
+    async def cancel(self, handle, future) -> None:
+        handle.cancel()
+
+    async def close(self) -> None:
+        self.model.close()
+
+
+class RemoteTarget:
+    """Воспроизведение на устройстве удаленного сервера USB/IP"""
+
+    def __init__(self, busid: str, host: str = '127.0.0.1', port: int = DEFAULT_PORT):
+        self.busid = busid
+        self.client = UsbipClient(host, port)
+
+    async def open(self) -> None:
+        await self.client.import_device(self.busid)
+
+    def start(self, urb: Urb):
+        return self.client.submit_nowait(urb.ep, urb.direction, urb.length, urb.data, urb.setup)
+
+    async def flush(self) -> None:
+        await self.client.writer.drain()
+
+    async def cancel(self, handle, future) -> None:
+        await self.client.unlink(handle)
+        if not future.done():
+            future.cancel()
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class _InFlight:
+    __slots__ = ('handle', 'future', 'sent_at', 'done_at', 'submit')
+
+    def __init__(self, handle, future, submit: UrbEvent):
+        self.handle = handle
+        self.future = future
+        self.submit = submit
+        self.sent_at = time.perf_counter()
+        self.done_at: Optional[float] = None
+        future.add_done_callback(self._done)
+
+    def _done(self, future) -> None:
+        self.done_at = time.perf_counter()
+
+
+def _latency_summary(values: List[float]) -> Optional[Dict]:
+    """Перцентили задержек, мс"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def percentile(q):
+        return round(values[min(int(q * len(values)), len(values) - 1)] * 1000, 3)
+    return {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99),
+            'p999': percentile(0.999), 'max': round(values[-1] * 1000, 3)}
+
+
+async def replay(events, target, speed: float = 1.0, timeout: float = DEFAULT_REPLAY_TIMEOUT,
+                 verify: bool = False) -> Dict:
+    """
+    Воспроизвести события одного устройства на открытой цели
+
+    Args:
+        events: События записи (read_capture с фильтром по устройству)
+        target: ModelTarget или RemoteTarget после open()
+        speed: Ускорение относительно записи; 0 - без пауз
+        timeout: Сколько ждать завершения URB, которое в записи произошло
+        verify: Сравнивать данные IN с записанными
+
+    Returns:
+        Dict: Пропускная способность, задержки и расхождения с записью
+    """
+    loop = asyncio.get_running_loop()
+    inflight: Dict[int, _InFlight] = {}
+    latencies: List[float] = []
+    captured_latencies: List[float] = []
+    report = {'urbs': 0, 'completed': 0, 'unlinked': 0, 'timeouts': 0, 'status_mismatches': 0,
+              'length_mismatches': 0, 'data_mismatches': 0, 'bytes_in': 0, 'bytes_out': 0}
+    first_timestamp = None
+    seqnum = 0
+    started = loop.time()
+
+    async def finish(entry: _InFlight, captured: UrbEvent) -> None:
+        captured_latencies.append(captured.timestamp - entry.submit.timestamp)
+        if captured.status == -errno.ECONNRESET and not entry.future.done():
+            # В записи клиент отменил URB (например, опрос прерывания)
+            await target.cancel(entry.handle, entry.future)
+            report['unlinked'] += 1
+            return
+        try:
+            status, data = await asyncio.wait_for(asyncio.shield(entry.future), timeout)
+        except asyncio.TimeoutError:
+            report['timeouts'] += 1
+            await target.cancel(entry.handle, entry.future)
+            return
+        except (asyncio.CancelledError, ConnectionError):
+            report['unlinked'] += 1
+            return
+        report['completed'] += 1
+        latencies.append(entry.done_at - entry.sent_at)
+        if status != captured.status:
+            report['status_mismatches'] += 1
+        submit = entry.submit
+        if submit.direction == USBIP_DIR_IN:
+            report['bytes_in'] += len(data)
+            if status == 0 and len(data) != captured.length:
+                report['length_mismatches'] += 1
+            elif verify and captured.complete_data and bytes(data) != captured.data:
+                report['data_mismatches'] += 1
+        elif status == 0:
+            report['bytes_out'] += submit.length
+
+    for event in events:
+        if event.event == EVENT_SUBMIT:
+            if first_timestamp is None:
+                first_timestamp = event.timestamp
+            if speed > 0:
+                delay = started + (event.timestamp - first_timestamp) / speed - loop.time()
+                if delay > 0:
+                    await target.flush()
+                    await asyncio.sleep(delay)
+            data = b''
+            if event.direction == USBIP_DIR_OUT:
+                # Обрезанные snaplen данные дополняются нулями до исходной длины
+                data = event.data + bytes(event.length - len(event.data))
+            seqnum += 1
+            handle, future = target.start(Urb(seqnum, event.direction, event.ep, event.length, event.setup, data))
+            inflight[event.urb_id] = _InFlight(handle, future, event)
+            report['urbs'] += 1
+            await target.flush()
+        elif event.event == EVENT_COMPLETE:
+            entry = inflight.pop(event.urb_id, None)
+            if entry is not None:
+                await finish(entry, event)
+
+    # URB, которые к концу записи еще не завершились
+    for entry in inflight.values():
+        if not entry.future.done():
+            await target.cancel(entry.handle, entry.future)
+            report['unlinked'] += 1
+
+    duration = loop.time() - started
+    transferred = report['bytes_in'] + report['bytes_out']
+    report.update({
+        'speed': speed or 'max',
+        'duration_s': round(duration, 6),
+        'throughput_mb_s': round(transferred / duration / 1e6, 3) if duration else None,
+        'urbs_per_s': round(report['completed'] / duration, 1) if duration else None,
+        'latency_ms': _latency_summary(latencies),
+        'captured_latency_ms': _latency_summary(captured_latencies)
+    })
+    return report
+
+
+def device_events(path: str, device: Optional[Tuple[int, int]] = None) -> Iterator[UrbEvent]:
+    """
+    События одного устройства записи
+
+    Raises:
+        CaptureError: В записи несколько устройств и device не указан, либо нет указанного
+    """
+    devices = [(d['busnum'], d['devnum']) for d in capture_summary(path)]
+    if device is None:
+        if len(devices) != 1:
+            raise CaptureError(f'В записи {len(devices)} устройств, укажите --device <шина>:<номер>')
+        device = devices[0]
+    elif device not in devices:
+        raise CaptureError(f'Устройства {device[0]}:{device[1]} нет в записи')
+    return (event for event in read_capture(path) if event.device == device)
+
+
+def load_device_model(device_id: int) -> UsbDeviceModel:
+    """Модель виртуального устройства из БД приложения"""
+    os.environ.setdefault('USBIP_SERVER', '0')
+    from app import app
+    from models import db, VirtualUsbDevice
+    from usb_device_models import build_device_model
+
+    with app.app_context():
+        device = db.session.get(VirtualUsbDevice, device_id)
+        if device is None:
+            raise CaptureError(f'Виртуальное устройство {device_id} не найдено')
+        db.session.expunge(device)
+        return build_device_model(device)
+
+
+async def _run_replay(args) -> Dict:
+    device = tuple(int(part) for part in args.device.split(':')) if args.device else None
+    events = device_events(args.capture, device)
+    if args.busid:
+        target = RemoteTarget(args.busid, args.host, args.port)
+    else:
+        target = ModelTarget(load_device_model(args.device_id), f'replay:{args.device_id}')
+    await target.open()
+    try:
+        return await replay(events, target, 0 if args.speed == 'max' else float(args.speed),
+                            args.timeout, args.verify)
+    finally:
+        await target.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Запись URB USB/IP: сводка и воспроизведение')
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help='Устройства и объем данных в записи')
+    info.add_argument('capture')
+    play = commands.add_parser('replay', help='Воспроизвести запись и измерить задержки')
+    play.add_argument('capture')
+    target = play.add_mutually_exclusive_group(required=True)
+    target.add_argument('--busid', help='busid устройства на сервере USB/IP')
+    target.add_argument('--device-id', type=int, help='id виртуального устройства (модель в этом процессе)')
+    play.add_argument('--host', default='127.0.0.1')
+    play.add_argument('--port', type=int, default=DEFAULT_PORT)
+    play.add_argument('--device', help='Устройство записи <шина>:<номер>, если их несколько')
+    play.add_argument('--speed', default='1', help='Ускорение (1, 4, ...) или max')
+    play.add_argument('--timeout', type=float, default=DEFAULT_REPLAY_TIMEOUT)
+    play.add_argument('--verify', action='store_true', help='Сравнивать данные IN с записью')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'info':
+            result = capture_summary(args.capture)
+        else:
+            result = asyncio.run(_run_replay(args))
+    except (CaptureError, OSError, ConnectionError) as e:
+        print(f'Ошибка: {e}', file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1026 @@
+"""
+Сервер экспорта виртуальных USB-устройств по протоколу USB/IP.
+
+Активные записи VirtualUsbDevice превращаются в программные модели
+(usb_device_models) и отдаются клиентам USB/IP так же, как usbipd отдает
+физические устройства: сервер отвечает на OP_REQ_DEVLIST/OP_REQ_IMPORT, а
+после импорта передает USBIP_CMD_SUBMIT/USBIP_CMD_UNLINK модели устройства.
+
+Все соединения обслуживаются одним циклом asyncio без потоков на устройство.
+Передачи одной конечной точки выполняются по порядку (для bulk это требование
+протокола: CBW, данные и CSW накопителя не должны переставляться), разные
+конечные точки и устройства работают параллельно.
+
+Сервер запускается внутри приложения в одном процессе (блокировка файла, как
+у наблюдателя системных папок) либо отдельным процессом:
+
+    python usbip_server.py
+
+Клиент: usbip --tcp-port 3340 attach -r <хост> -b <busid>
+
+Сервер не проверяет подлинность клиентов (как и usbipd), а импорт дает полный
+доступ к дискам и последовательным портам моделей. Поэтому по умолчанию он
+слушает только 127.0.0.1; чтобы намеренно открыть его в сеть, задайте
+USBIP_SERVER_HOST=0.0.0.0 (или адрес нужного интерфейса) и ограничьте доступ
+к порту межсетевым экраном. USBIP_SERVER=0 отключает сервер полностью.
+"""
+
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import functools
+import struct
+import asyncio
+import threading
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from usb_device_models import UsbDeviceModel, UsbStall, SetupPacket, build_device_model, run_sync_hooks
+
+logger = logging.getLogger(__name__)
+
+# Переменные окружения
+SERVER_ENV_VAR = 'USBIP_SERVER'
+HOST_ENV_VAR = 'USBIP_SERVER_HOST'
+PORT_ENV_VAR = 'USBIP_SERVER_PORT'
+
+# Порт по умолчанию отличается от 3240, чтобы не конфликтовать с usbipd
+DEFAULT_PORT = 3340
+# Только локальные клиенты: аутентификации в протоколе нет, открытие в сеть -
+# явная настройка через USBIP_SERVER_HOST
+DEFAULT_HOST = '127.0.0.1'
+
+# Номер виртуальной шины в busid ("<шина>-<id устройства>")
+VIRTUAL_BUSNUM = 9
+
+# Очередь входящих соединений: одновременный импорт многих устройств
+LISTEN_BACKLOG = 1024
+
+# Интервал сверки списка экспортируемых устройств с БД (секунды)
+RESYNC_INTERVAL = 5
+
+# Состояние сервера и команды ему от других процессов (воркеров gunicorn):
+# сервер публикует состояние в файл и выполняет команды из каталога управления
+STATUS_FILE = '.usbip_server.status'
+CONTROL_DIR = '.usbip_server.control'
+CONTROL_POLL_INTERVAL = 0.5
+CONTROL_TIMEOUT = 10
+
+# Протокол USB/IP (Documentation/usb/usbip_protocol.rst)
+USBIP_VERSION = 0x0111
+OP_REQ_DEVLIST = 0x8005
+OP_REP_DEVLIST = 0x0005
+OP_REQ_IMPORT = 0x8003
+OP_REP_IMPORT = 0x0003
+
+USBIP_CMD_SUBMIT = 0x0001
+USBIP_CMD_UNLINK = 0x0002
+USBIP_RET_SUBMIT = 0x0003
+USBIP_RET_UNLINK = 0x0004
+
+USBIP_DIR_OUT = 0
+USBIP_DIR_IN = 1
+
+# Статусы операций
+ST_OK = 0
+ST_NA = 1           # Устройство не найдено
+ST_DEV_BUSY = 2     # Устройство уже импортировано
+ST_ERROR = 3
+
+OP_HEADER = struct.Struct('>HHI')
+USB_DEVICE = struct.Struct('>256s32sIIIHHHBBBBBB')
+USB_INTERFACE = struct.Struct('>BBBx')
+BUSID = struct.Struct('>32s')
+URB_HEADER = struct.Struct('>IIIII')              # command, seqnum, devid, direction, ep
+CMD_SUBMIT = struct.Struct('>IiiiI8s')            # flags, length, start_frame, packets, interval, setup
+RET_SUBMIT = struct.Struct('>IIIIIiiiii8x')       # header + status, actual, start_frame, packets, errors
+CMD_UNLINK = struct.Struct('>I24x')
+RET_UNLINK = struct.Struct('>IIIIIi24x')
+ISO_PACKET = struct.Struct('>IIII')
+URB_HEADER_SIZE = 48
+
+# Значение number_of_packets для передач без изохронных пакетов
+NO_ISO_PACKETS = (0, -1)
+
+
+def make_busid(device_id: int) -> str:
+    """Bus ID виртуального устройства вне топологии хабов"""
+    return f'{VIRTUAL_BUSNUM}-{device_id}'
+
+
+def busid_busnum(busid: str) -> int:
+    """Номер шины из busid вида <шина>-<порт>[.<порт>...]"""
+    try:
+        return int(busid.split('-', 1)[0])
+    except ValueError:
+        return VIRTUAL_BUSNUM
+
+
+def _pad(value: str, size: int) -> bytes:
+    return value.encode('utf-8')[:size - 1].ljust(size, b'\0')
+
+
+class ExportedDevice:
+    """Модель устройства, доступная для импорта под своим busid"""
+
+    def __init__(self, busid: str, devnum: int, model: UsbDeviceModel, device_id: Optional[int] = None,
+                 fingerprint=None):
+        self.busid = busid
+        self.busnum = busid_busnum(busid)
+        self.devnum = devnum
+        self.model = model
+        self.device_id = device_id
+        self.fingerprint = fingerprint
+        self.connection: Optional['UsbipConnection'] = None
+
+    @property
+    def devid(self) -> int:
+        return (self.busnum << 16) | self.devnum
+
+    def pack(self, with_interfaces: bool) -> bytes:
+        info = self.model.export_info()
+        data = USB_DEVICE.pack(
+            _pad(f'/sys/devices/platform/orangeusb/usb{self.busnum}/{self.busid}', 256),
+            _pad(self.busid, 32), self.busnum, self.devnum, info['speed'],
+            info['vendor_id'], info['product_id'], info['bcd_device'],
+            info['device_class'], info['device_subclass'], info['device_protocol'],
+            info['configuration'], info['num_configurations'], len(info['interfaces'])
+        )
+        if with_interfaces:
+            data += b''.join(USB_INTERFACE.pack(*interface) for interface in info['interfaces'])
+        return data
+
+
+class Urb:
+    """Передача (USBIP_CMD_SUBMIT) в очереди конечной точки"""
+
+    __slots__ = ('seqnum', 'direction', 'ep', 'length', 'setup', 'data', 'task', 'unlinked')
+
+    def __init__(self, seqnum: int, direction: int, ep: int, length: int, setup: bytes, data: bytes):
+        self.seqnum = seqnum
+        self.direction = direction
+        self.ep = ep
+        self.length = length
+        self.setup = setup
+        self.data = data
+        self.task: Optional[asyncio.Task] = None
+        self.unlinked = False
+
+
+async def execute_urb(model: UsbDeviceModel, urb: Urb, label: str = ''):
+    """Передать URB модели, вернуть (статус, данные)"""
+    try:
+        if urb.ep == 0:
+            setup = SetupPacket(urb.setup)
+            data = await model.handle_control(setup, urb.data)
+        else:
+            address = urb.ep | (0x80 if urb.direction == USBIP_DIR_IN else 0)
+            endpoint = model.get_endpoint(address)
+            if endpoint is None:
+                raise UsbStall(f'No endpoint 0x{address:02x}')
+            if address in model.halted:
+                raise UsbStall(f'Endpoint 0x{address:02x} is halted')
+            data = await model.handle_data(endpoint, urb.data, urb.length)
+    except UsbStall as e:
+        logger.debug(f"USB/IP {label}: STALL ({e})")
+        return -errno.EPIPE, b''
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception(f"USB/IP {label}: ошибка модели устройства")
+        return -errno.EPROTO, b''
+    if urb.direction == USBIP_DIR_IN:
+        return ST_OK, data[:urb.length]
+    return ST_OK, b''
+
+
+class UsbipConnection:
+    """Соединение клиента с импортированным устройством"""
+
+    def __init__(self, server: 'UsbipServer', exported: ExportedDevice,
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.server = server
+        self.exported = exported
+        self.model = exported.model
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.pending: Dict[int, Urb] = {}
+        self.queues: Dict[Tuple[int, int], asyncio.Queue] = {}
+        self.workers: List[asyncio.Task] = []
+        self.submitted = 0
+        self.completed = 0
+        self.unlinked = 0
+
+    async def serve(self) -> None:
+        try:
+            while True:
+                header = await self.reader.readexactly(URB_HEADER_SIZE)
+                command, seqnum, devid, direction, ep = URB_HEADER.unpack_from(header)
+                if command == USBIP_CMD_SUBMIT:
+                    flags, length, start_frame, packets, interval, setup = CMD_SUBMIT.unpack_from(header, 20)
+                    data = b''
+                    if direction == USBIP_DIR_OUT and length > 0:
+                        data = await self.reader.readexactly(length)
+                    if packets not in NO_ISO_PACKETS:
+                        # Изохронные передачи модели не поддерживают
+                        await self.reader.readexactly(packets * ISO_PACKET.size)
+                        self.send_submit_reply(seqnum, -errno.EXDEV)
+                        continue
+                    urb = Urb(seqnum, direction, ep, max(length, 0), setup, data)
+                    if self.server.capture is not None:
+                        self.server.capture.submit(self.exported, urb)
+                    self.submit(urb)
+                elif command == USBIP_CMD_UNLINK:
+                    (target,) = CMD_UNLINK.unpack_from(header, 20)
+                    self.unlink(seqnum, target)
+                else:
+                    logger.warning(f"USB/IP {self.exported.busid}: неизвестная команда 0x{command:x}, соединение закрыто")
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for worker in self.workers:
+                worker.cancel()
+            self.pending.clear()
+
+    def submit(self, urb: Urb) -> None:
+        self.submitted += 1
+        self.pending[urb.seqnum] = urb
+        key = (urb.ep, urb.direction if urb.ep else 0)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = asyncio.Queue()
+            self.workers.append(asyncio.ensure_future(self._endpoint_worker(queue)))
+        queue.put_nowait(urb)
+
+    async def _endpoint_worker(self, queue: asyncio.Queue) -> None:
+        """Выполняет передачи одной конечной точки строго по очереди"""
+        while True:
+            urb = await queue.get()
+            if urb.unlinked:
+                continue
+            urb.task = asyncio.ensure_future(self._execute(urb))
+            try:
+                status, data = await asyncio.shield(urb.task)
+            except asyncio.CancelledError:
+                if not urb.task.cancelled():
+                    # Отменен сам обработчик очереди (соединение закрыто)
+                    urb.task.cancel()
+                    raise
+                continue
+            finally:
+                self.pending.pop(urb.seqnum, None)
+            if urb.unlinked:
+                # Отменен в момент завершения: клиент уже получил RET_UNLINK
+                continue
+            self.completed += 1
+            if self.server.capture is not None:
+                self.server.capture.complete(self.exported, urb, status, data)
+            self.send_submit_reply(urb.seqnum, status, data, urb.direction)
+            await self.writer.drain()
+
+    async def _execute(self, urb: Urb):
+        return await execute_urb(self.model, urb, self.exported.busid)
+
+    def unlink(self, seqnum: int, target: int) -> None:
+        urb = self.pending.pop(target, None)
+        status = 0
+        if urb is not None:
+            urb.unlinked = True
+            if urb.task is not None:
+                urb.task.cancel()
+            self.unlinked += 1
+            status = -errno.ECONNRESET
+            if self.server.capture is not None:
+                self.server.capture.complete(self.exported, urb, status)
+        self.writer.write(RET_UNLINK.pack(USBIP_RET_UNLINK, seqnum, 0, 0, 0, status))
+
+    def send_submit_reply(self, seqnum: int, status: int, data=b'', direction: int = USBIP_DIR_OUT) -> None:
+        if self.writer.is_closing():
+            return
+        actual = len(data)
+        self.writer.write(RET_SUBMIT.pack(USBIP_RET_SUBMIT, seqnum, 0, 0, 0, status, actual, 0, 0, 0))
+        if direction == USBIP_DIR_IN and actual:
+            # Данные (в т.ч. memoryview из mmap) передаются без склейки с заголовком
+            self.writer.write(data)
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def info(self) -> Dict:
+        return {
+            'peer': f'{self.peer[0]}:{self.peer[1]}' if self.peer else None,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'unlinked': self.unlinked,
+            'pending': len(self.pending)
+        }
+
+
+class UsbipServer:
+    """
+    Сервер USB/IP на asyncio
+
+    Экспортируемые устройства задаются через set_exports()/add_device(),
+    остальное делает цикл событий.
+    """
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.exports: Dict[str, ExportedDevice] = {}
+        # Запись URB (usbip_capture.UrbCapture), None - запись выключена
+        self.capture = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients = set()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port,
+                                                  backlog=LISTEN_BACKLOG)
+        logger.info(f"Сервер USB/IP запущен на {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for exported in list(self.exports.values()):
+            self.remove_device(exported.busid)
+        self.stop_capture()
+        # Обработчики клиентов завершаются сами после закрытия соединений
+        if self._clients:
+            await asyncio.gather(*self._clients, return_exceptions=True)
+
+    def add_device(self, model: UsbDeviceModel, busid: Optional[str] = None, device_id: Optional[int] = None,
+                   fingerprint=None) -> ExportedDevice:
+        """Добавить модель в экспорт (busid по умолчанию - следующий свободный номер)"""
+        used = {exported.devnum for exported in self.exports.values()}
+        devnum = device_id if device_id is not None else next(n for n in range(1, 65536) if n not in used)
+        busid = busid or make_busid(devnum)
+        self.remove_device(busid)
+        exported = ExportedDevice(busid, devnum & 0xFFFF, model, device_id, fingerprint)
+        self.exports[busid] = exported
+        try:
+            model.on_export()
+        except Exception as e:
+            logger.error(f"USB/IP: ошибка запуска модели {busid}: {e}")
+        return exported
+
+    def start_capture(self, capture) -> None:
+        """Начать запись URB (предыдущая запись закрывается)"""
+        self.stop_capture()
+        self.capture = capture
+        logger.info(f"USB/IP: запись URB в {capture.path}")
+
+    def stop_capture(self):
+        """Закончить запись URB, вернуть законченную запись"""
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+            logger.info(f"USB/IP: запись URB остановлена ({capture.records} событий)")
+        return capture
+
+    def find_device(self, device_id: int) -> Optional[ExportedDevice]:
+        """Экспортируемое устройство по id виртуального устройства"""
+        return next((exported for exported in self.exports.values() if exported.device_id == device_id), None)
+
+    def remove_device(self, busid: str) -> bool:
+        """Убрать устройство из экспорта (импортировавший клиент отключается)"""
+        exported = self.exports.pop(busid, None)
+        if exported is None:
+            return False
+        if exported.connection is not None:
+            exported.connection.close()
+        try:
+            exported.model.close()
+        except Exception as e:
+            logger.error(f"Ошибка освобождения модели {busid}: {e}")
+        return True
+
+    def set_exports(self, devices: Dict[str, Tuple]) -> None:
+        """
+        Привести экспорт к списку устройств из БД
+
+        Args:
+            devices: busid -> (device_id, fingerprint, фабрика модели); фабрика
+                вызывается только для новых или измененных устройств
+        """
+        for busid in [busid for busid in self.exports if busid not in devices]:
+            logger.info(f"USB/IP: устройство {busid} снято с экспорта")
+            self.remove_device(busid)
+        for busid, (device_id, fingerprint, factory) in devices.items():
+            current = self.exports.get(busid)
+            if current is not None and current.fingerprint == fingerprint:
+                continue
+            try:
+                model = factory()
+            except Exception as e:
+                logger.error(f"USB/IP: не удалось создать модель устройства {busid}: {e}")
+                continue
+            self.add_device(model, busid, device_id, fingerprint)
+            logger.info(f"USB/IP: устройство {busid} ({model.device_type}) доступно для импорта")
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._clients.add(task)
+        try:
+            version, code, status = OP_HEADER.unpack(await reader.readexactly(OP_HEADER.size))
+            if code == OP_REQ_DEVLIST:
+                devices = list(self.exports.values())
+                writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REP_DEVLIST, ST_OK) + struct.pack('>I', len(devices)) +
+                             b''.join(exported.pack(with_interfaces=True) for exported in devices))
+            elif code == OP_REQ_IMPORT:
+                (raw_busid,) = BUSID.unpack(await reader.readexactly(BUSID.size))
+                busid = raw_busid.split(b'\0', 1)[0].decode('utf-8', 'replace')
+                exported = self.exports.get(busid)
+                if exported is None:
+                    writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REP_IMPORT, ST_NA))
+                elif exported.connection is not None:
+                    writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REP_IMPORT, ST_DEV_BUSY))
+                else:
+                    exported.model.reset()
+                    writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REP_IMPORT, ST_OK) + exported.pack(with_interfaces=False))
+                    await writer.drain()
+                    await self._serve_import(exported, reader, writer)
+                    return
+            else:
+                logger.warning(f"USB/IP: неизвестная операция 0x{code:04x}")
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._clients.discard(task)
+            writer.close()
+
+    async def _serve_import(self, exported: ExportedDevice, reader, writer) -> None:
+        connection = UsbipConnection(self, exported, reader, writer)
+        exported.connection = connection
+        logger.info(f"USB/IP: устройство {exported.busid} импортировано клиентом {connection.info()['peer']}")
+        try:
+            await connection.serve()
+        finally:
+            if exported.connection is connection:
+                exported.connection = None
+            logger.info(f"USB/IP: клиент {connection.info()['peer']} отключил устройство {exported.busid}")
+
+    def status(self) -> List[Dict]:
+        return [{
+            'busid': exported.busid,
+            'device_id': exported.device_id,
+            'device_type': exported.model.device_type,
+            'vendor_id': f'{exported.model.vendor_id:04x}',
+            'product_id': f'{exported.model.product_id:04x}',
+            'imported': exported.connection is not None,
+            'connection': exported.connection.info() if exported.connection else None,
+            'model': exported.model.status()
+        } for exported in self.exports.values()]
+
+
+# ----------------------------------------------------------------------
+# Клиент (проверка сервера через loopback и нагрузочные тесты)
+
+class UsbipClient:
+    """
+    Минимальный клиент USB/IP на asyncio: список устройств, импорт и передачи
+    с несколькими URB в полете
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.devid = 0
+        self._seqnum = 0
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._directions: Dict[int, int] = {}
+        self._reader_task: Optional[asyncio.Task] = None
+
+    async def devlist(self) -> List[Dict]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REQ_DEVLIST, 0))
+            await writer.drain()
+            version, code, status = OP_HEADER.unpack(await reader.readexactly(OP_HEADER.size))
+            (count,) = struct.unpack('>I', await reader.readexactly(4))
+            devices = []
+            for _ in range(count):
+                fields = USB_DEVICE.unpack(await reader.readexactly(USB_DEVICE.size))
+                interfaces = [USB_INTERFACE.unpack(await reader.readexactly(USB_INTERFACE.size))
+                              for _ in range(fields[13])]
+                devices.append({
+                    'busid': fields[1].split(b'\0', 1)[0].decode(),
+                    'speed': fields[4],
+                    'vendor_id': fields[5],
+                    'product_id': fields[6],
+                    'interfaces': interfaces
+                })
+            return devices
+        finally:
+            writer.close()
+
+    async def import_device(self, busid: str) -> Dict:
+        """Импортировать устройство; после этого соединение занято передачами"""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(OP_HEADER.pack(USBIP_VERSION, OP_REQ_IMPORT, 0) + BUSID.pack(busid.encode()))
+        await self.writer.drain()
+        version, code, status = OP_HEADER.unpack(await self.reader.readexactly(OP_HEADER.size))
+        if status != ST_OK:
+            self.writer.close()
+            raise ConnectionError(f'Import of {busid} failed with status {status}')
+        fields = USB_DEVICE.unpack(await self.reader.readexactly(USB_DEVICE.size))
+        self.devid = (fields[2] << 16) | fields[3]
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+        return {'busid': busid, 'speed': fields[4], 'vendor_id': fields[5], 'product_id': fields[6]}
+
+    async def _read_replies(self) -> None:
+        try:
+            while True:
+                header = await self.reader.readexactly(URB_HEADER_SIZE)
+                command, seqnum = struct.unpack_from('>II', header)
+                if command == USBIP_RET_SUBMIT:
+                    status, actual = struct.unpack_from('>ii', header, 20)
+                    data = b''
+                    if self._directions.pop(seqnum, USBIP_DIR_OUT) == USBIP_DIR_IN and actual > 0:
+                        data = await self.reader.readexactly(actual)
+                    result = (status, data)
+                else:
+                    (status,) = struct.unpack_from('>i', header, 20)
+                    result = (status, b'')
+                waiter = self._waiters.pop(seqnum, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(result)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            for waiter in self._waiters.values():
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError(str(e) or 'Connection closed'))
+
+    def submit_nowait(self, ep: int, direction: int, length: int = 0, data: bytes = b'',
+                      setup: bytes = b'\0' * 8) -> Tuple[int, asyncio.Future]:
+        """Отправить URB, не дожидаясь ответа: (seqnum, future со (статус, данные))"""
+        self._seqnum += 1
+        seqnum = self._seqnum
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters[seqnum] = waiter
+        self._directions[seqnum] = direction
+        if direction == USBIP_DIR_OUT:
+            length = len(data)
+        self.writer.write(URB_HEADER.pack(USBIP_CMD_SUBMIT, seqnum, self.devid, direction, ep) +
+                          CMD_SUBMIT.pack(0, length, 0, 0, 0, setup))
+        if direction == USBIP_DIR_OUT and data:
+            self.writer.write(data)
+        return seqnum, waiter
+
+    async def submit(self, ep: int, direction: int, length: int = 0, data: bytes = b'',
+                     setup: bytes = b'\0' * 8) -> Tuple[int, bytes]:
+        seqnum, waiter = self.submit_nowait(ep, direction, length, data, setup)
+        await self.writer.drain()
+        return await waiter
+
+    async def control(self, request_type: int, request: int, value: int = 0, index: int = 0,
+                      length: int = 0, data: bytes = b'') -> Tuple[int, bytes]:
+        """Управляющая передача на нулевую конечную точку"""
+        direction = USBIP_DIR_IN if request_type & 0x80 else USBIP_DIR_OUT
+        setup = struct.pack('<BBHHH', request_type, request, value, index, length if direction else len(data))
+        return await self.submit(0, direction, length, data, setup)
+
+    async def unlink(self, target: int) -> int:
+        self._seqnum += 1
+        seqnum = self._seqnum
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters[seqnum] = waiter
+        self.writer.write(URB_HEADER.pack(USBIP_CMD_UNLINK, seqnum, self.devid, 0, 0) + CMD_UNLINK.pack(target))
+        await self.writer.drain()
+        status, _ = await waiter
+        # Ответ на отмененный URB не придет
+        self._waiters.pop(target, None)
+        self._directions.pop(target, None)
+        return status
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+# ----------------------------------------------------------------------
+# Сервис экспорта устройств из БД
+
+def device_fingerprint(device) -> Tuple:
+    """Поля записи, при изменении которых модель устройства пересоздается"""
+    return (device.device_type, device.vendor_id, device.product_id, device.serial_number, device.name,
+            device.config_json, device.storage_path, device.storage_size)
+
+
+class UsbipExportService:
+    """
+    Поток с циклом asyncio, в котором работает UsbipServer, и сверка списка
+    экспортируемых устройств с активными записями VirtualUsbDevice
+    """
+
+    def __init__(self, app, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self.app = app
+        self.server = UsbipServer(host, port)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock_fd: Optional[int] = None
+        self.error: Optional[str] = None
+        self._started = threading.Event()
+        self._resync = threading.Event()
+        self._stopped = threading.Event()
+
+    def start(self) -> bool:
+        threading.Thread(target=self._run_loop, name='usbip-server', daemon=True).start()
+        self._started.wait(5)
+        if self.error:
+            return False
+        threading.Thread(target=self._run_resync, name='usbip-resync', daemon=True).start()
+        return True
+
+    def _run_loop(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.server.start())
+        except OSError as e:
+            self.error = str(e)
+            logger.error(f"Не удалось запустить сервер USB/IP на порту {self.server.port}: {e}")
+            self._started.set()
+            return
+        self._started.set()
+        self.loop.run_forever()
+
+    def _run_resync(self) -> None:
+        next_sync = 0.0
+        while not self._stopped.is_set():
+            if self._resync.is_set() or time.monotonic() >= next_sync:
+                self._resync.clear()
+                try:
+                    self.sync_exports()
+                except Exception as e:
+                    logger.error(f"Ошибка сверки экспортируемых USB/IP устройств: {e}")
+                next_sync = time.monotonic() + RESYNC_INTERVAL
+                self.publish_status()
+            try:
+                self.process_commands()
+            except Exception as e:
+                logger.error(f"Ошибка обработки команд сервера USB/IP: {e}")
+            self._resync.wait(CONTROL_POLL_INTERVAL)
+
+    def request_resync(self) -> None:
+        self._resync.set()
+
+    def load_devices(self) -> Dict[str, Tuple]:
+        """
+        Активные виртуальные устройства из БД: busid -> (id, отпечаток, фабрика модели)
+
+        Устройства на портах, размещенных в топологии хабов, получают busid
+        своего места (10-1.3), остальные - 9-<id>.
+        """
+        from models import db, VirtualUsbDevice
+        from usb_topology import device_busids
+
+        with self.app.app_context():
+            try:
+                devices = {}
+                try:
+                    busids = device_busids()
+                except Exception as e:
+                    logger.error(f"Ошибка чтения топологии виртуальных USB-устройств: {e}")
+                    busids = {}
+                for device in VirtualUsbDevice.query.filter_by(is_active=True).all():
+                    db.session.expunge(device)
+                    devices[busids.get(device.id) or make_busid(device.id)] = (
+                        device.id, device_fingerprint(device),
+                        lambda device=device: build_device_model(device)
+                    )
+                return devices
+            finally:
+                db.session.remove()
+
+    def sync_exports(self) -> None:
+        devices = self.load_devices()
+        # Модели строятся здесь, а не в цикле asyncio: сборка (mmap образа,
+        # снимок директории) может занять секунды и не должна задерживать URB
+        exported = {busid: exp.fingerprint for busid, exp in list(self.server.exports.items())}
+        built = []
+        for busid, (device_id, fingerprint, factory) in list(devices.items()):
+            if exported.get(busid) == fingerprint:
+                continue
+            try:
+                model = factory()
+            except Exception as e:
+                devices[busid] = (device_id, fingerprint, functools.partial(_raise, e))
+                continue
+            built.append(model)
+            devices[busid] = (device_id, fingerprint, lambda model=model: model)
+        future = asyncio.run_coroutine_threadsafe(self._apply(devices, built), self.loop)
+        future.result(timeout=30)
+        run_sync_hooks(self)
+
+    async def _apply(self, devices: Dict[str, Tuple], built: List[UsbDeviceModel]) -> None:
+        self.server.set_exports(devices)
+        in_use = {id(exp.model) for exp in self.server.exports.values()}
+        for model in built:
+            if id(model) not in in_use:
+                model.close()
+
+    def call(self, function, *args, timeout: float = 5):
+        """Выполнить функцию в цикле сервера и вернуть результат"""
+        async def run():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result(timeout=timeout)
+
+    def status(self) -> List[Dict]:
+        if self.loop is None:
+            return []
+        return self.call(self.server.status)
+
+    def export_status(self) -> Dict:
+        """Состояние сервера и записи URB"""
+        capture = self.server.capture
+        return {
+            'running': True,
+            'pid': os.getpid(),
+            'host': self.server.host,
+            'port': self.server.port,
+            'devices': self.status(),
+            'capture': capture.info() if capture is not None else None,
+            'updated': time.time()
+        }
+
+    def publish_status(self) -> None:
+        """Записать состояние в файл для процессов без сервера"""
+        try:
+            _write_json(_storage_file(STATUS_FILE), self.export_status())
+        except Exception as e:
+            logger.error(f"Не удалось записать состояние сервера USB/IP: {e}")
+
+    def start_capture(self, busids: Optional[List[str]] = None, snaplen: Optional[int] = None,
+                      max_bytes: Optional[int] = None) -> Dict:
+        from usbip_capture import UrbCapture, new_capture_path, DEFAULT_SNAPLEN, DEFAULT_MAX_BYTES
+
+        _check_busids(busids)
+        capture = UrbCapture(new_capture_path(), busids, snaplen or DEFAULT_SNAPLEN, max_bytes or DEFAULT_MAX_BYTES)
+        self.call(self.server.start_capture, capture)
+        return capture.info()
+
+    def stop_capture(self) -> Optional[Dict]:
+        capture = self.call(self.server.stop_capture)
+        return capture.info() if capture is not None else None
+
+    def process_commands(self) -> None:
+        """Выполнить команды других процессов из каталога управления"""
+        directory = _storage_file(CONTROL_DIR)
+        try:
+            names = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return
+        handled = False
+        for name in names:
+            path = os.path.join(directory, name)
+            if name.endswith('.result'):
+                # Ответ, который не дождался отправитель команды
+                try:
+                    if time.time() - os.path.getmtime(path) > CONTROL_TIMEOUT * 6:
+                        os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith('.json'):
+                continue
+            command = _read_json(path)
+            try:
+                os.remove(path)
+            except OSError:
+                # Отправитель отменил команду по таймауту
+                continue
+            _write_json(path[:-len('.json')] + '.result', self.execute(command or {}))
+            handled = True
+        if handled:
+            self.publish_status()
+
+    def execute(self, command: Dict) -> Dict:
+        """Выполнить команду управления: {"capture": ...} или {"error": ...}"""
+        action = command.get('action')
+        try:
+            if action == 'capture_start':
+                return {'capture': self.start_capture(command.get('busids'), command.get('snaplen'),
+                                                      command.get('max_bytes'))}
+            if action == 'capture_stop':
+                return {'capture': self.stop_capture()}
+        except Exception as e:
+            logger.error(f"Ошибка команды {action} сервера USB/IP: {e}")
+            return {'error': str(e)}
+        return {'error': f'Неизвестная команда {action}'}
+
+
+def _raise(error: Exception):
+    raise error
+
+
+class UsbipControlError(RuntimeError):
+    """Сервер в другом процессе не выполнил команду"""
+
+
+def _check_busids(busids) -> None:
+    if busids is not None and (not isinstance(busids, list) or
+                               not all(isinstance(busid, str) for busid in busids)):
+        raise ValueError('busids должен быть списком строк')
+
+
+def _storage_file(name: str) -> str:
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR, ensure_storage_dir_exists
+    ensure_storage_dir_exists()
+    return os.path.join(VIRTUAL_STORAGE_BASE_DIR, name)
+
+
+def _write_json(path: str, data: Dict) -> None:
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _process_alive(pid) -> bool:
+    if not isinstance(pid, int) or pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _published_status() -> Optional[Dict]:
+    """Состояние, опубликованное работающим сервером другого процесса"""
+    status = _read_json(_storage_file(STATUS_FILE))
+    if status is None or not _process_alive(status.get('pid')):
+        return None
+    return status
+
+
+def _send_command(action: str, **params) -> Optional[Dict]:
+    """
+    Передать команду серверу другого процесса и дождаться ответа
+
+    Returns:
+        Optional[Dict]: Ответ сервера (None - сервер не запущен)
+
+    Raises:
+        UsbipControlError: Сервер вернул ошибку или не ответил
+    """
+    if _published_status() is None:
+        return None
+    directory = _storage_file(CONTROL_DIR)
+    os.makedirs(directory, exist_ok=True)
+    name = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+    command_path = os.path.join(directory, name + '.json')
+    result_path = os.path.join(directory, name + '.result')
+    _write_json(command_path, dict(params, action=action))
+
+    deadline = time.monotonic() + CONTROL_TIMEOUT
+    while time.monotonic() < deadline:
+        result = _read_json(result_path)
+        if result is not None:
+            os.remove(result_path)
+            if 'error' in result:
+                raise UsbipControlError(result['error'])
+            return result
+        time.sleep(0.1)
+    try:
+        os.remove(command_path)
+    except OSError:
+        pass
+    raise UsbipControlError('Сервер USB/IP не ответил на команду')
+
+
+_service: Optional[UsbipExportService] = None
+_service_lock = threading.Lock()
+
+
+def _acquire_server_lock() -> Optional[int]:
+    """Блокировка сервера (экспорт ведет только один процесс)"""
+    from virtual_storage_utils import VIRTUAL_STORAGE_BASE_DIR, ensure_storage_dir_exists
+    ensure_storage_dir_exists()
+    fd = os.open(os.path.join(VIRTUAL_STORAGE_BASE_DIR, '.usbip_server.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def start_usbip_server(app) -> bool:
+    """
+    Запустить сервер экспорта виртуальных устройств (если он включен и не
+    запущен другим процессом)
+
+    Args:
+        app: Приложение Flask
+
+    Returns:
+        bool: Работает ли сервер в этом процессе
+    """
+    global _service
+    if os.environ.get(SERVER_ENV_VAR, '1').strip().lower() in ('0', 'false', 'no', 'off'):
+        return False
+
+    with _service_lock:
+        if _service is not None:
+            return True
+        lock_fd = _acquire_server_lock()
+        if lock_fd is None:
+            logger.debug("Сервер USB/IP уже запущен в другом процессе")
+            return False
+        service = UsbipExportService(
+            app,
+            os.environ.get(HOST_ENV_VAR, DEFAULT_HOST),
+            int(os.environ.get(PORT_ENV_VAR, DEFAULT_PORT))
+        )
+        if not service.start():
+            os.close(lock_fd)
+            return False
+        service.lock_fd = lock_fd
+        _service = service
+    return True
+
+
+def refresh_usbip_exports() -> None:
+    """
+    Обновить экспорт после подключения/отключения устройства. В процессе без
+    сервера изменения подхватываются при очередной сверке с БД.
+    """
+    if _service is not None:
+        _service.request_resync()
+
+
+def get_usbip_export_status() -> Dict:
+    """
+    Состояние сервера экспорта: в процессе сервера - текущее, в остальных -
+    опубликованное сервером (обновляется при каждой сверке с БД)
+    """
+    if _service is not None:
+        return _service.export_status()
+    return _published_status() or {'running': False, 'devices': []}
+
+
+def start_usbip_capture(busids: Optional[List[str]] = None, snaplen: Optional[int] = None,
+                        max_bytes: Optional[int] = None) -> Optional[Dict]:
+    """
+    Начать запись URB сервера в новый файл pcap (сервер другого процесса
+    получает команду через каталог управления)
+
+    Returns:
+        Optional[Dict]: Состояние записи (None - сервер не запущен)
+
+    Raises:
+        ValueError: busids не список строк
+        UsbipControlError: Сервер другого процесса не выполнил команду
+    """
+    _check_busids(busids)
+    if _service is not None:
+        return _service.start_capture(busids, snaplen, max_bytes)
+    result = _send_command('capture_start', busids=busids, snaplen=snaplen, max_bytes=max_bytes)
+    return result['capture'] if result is not None else None
+
+
+def stop_usbip_capture() -> Optional[Dict]:
+    """
+    Остановить запись URB; состояние законченной записи или None
+
+    Raises:
+        UsbipControlError: Сервер другого процесса не выполнил команду
+    """
+    if _service is not None:
+        return _service.stop_capture()
+    result = _send_command('capture_stop')
+    return result['capture'] if result is not None else None
+
+
+if __name__ == '__main__':
+    # Отдельный процесс: приложение импортируется без собственного сервера
+    os.environ[SERVER_ENV_VAR] = '0'
+    logging.basicConfig(level=logging.INFO)
+    from app import app as flask_app
+
+    os.environ[SERVER_ENV_VAR] = '1'
+    if not start_usbip_server(flask_app):
+        raise SystemExit('USB/IP server is disabled or already running')
+    threading.Event().wait()
@@ -3,6 +3,9 @@ import re
 import logging
 import os
 
+from request_profiler import profiled_command
+from app_metrics import counted_command, count_pkexec_fallback, count_command_timeout, observed_inventory
+
 logger = logging.getLogger(__name__)
 
 def normalize_busid(busid):
@@ -43,6 +46,8 @@ def normalize_busid(busid):
     # Если формат не соответствует ожидаемому, возвращаем исходное значение
     return busid
 
+@counted_command
+@profiled_command
 def run_command(command, use_sudo=True, no_interactive=True):
     """
     Выполняет команду shell с поддержкой sudo
@@ -84,6 +89,7 @@ def run_command(command, use_sudo=True, no_interactive=True):
                 
                 # Если требуется пароль, пробуем с pkexec
                 logger.debug("Sudo с -n не сработал, пробуем использовать pkexec")
+                count_pkexec_fallback(command)
                 pkexec_cmd = ['pkexec'] + command
                 logger.debug(f"Выполнение команды: {' '.join(pkexec_cmd)}")
                 
@@ -101,6 +107,7 @@ def run_command(command, use_sudo=True, no_interactive=True):
                 # Обрабатываем случай таймаута
                 error_msg = "Команда выполнялась слишком долго и была прервана"
                 logger.error(f"{error_msg}: {str(timeout_error)}")
+                count_command_timeout(command)
                 
                 # Безопасное завершение процесса
                 if process:
@@ -489,6 +496,7 @@ def parse_doctor_output(output):
     
     return devices
 
+@observed_inventory('published')
 def get_published_devices():
     """
     Получает список опубликованных USB-устройств
@@ -720,6 +728,7 @@ def get_published_devices():
         # В случае ошибки возвращаем пустой список
         return []
 
+@observed_inventory('local')
 def get_local_usb_devices():
     """
     Получает список локальных USB-устройств с полными названиями
@@ -1093,6 +1102,7 @@ def detach_device(port):
         # Для тестирования в Replit
         return True, f"Эмуляция: устройство на порту {port} успешно отключено"
 
+@observed_inventory('attached')
 def get_attached_devices():
     """
     Получает список подключенных USB-устройств
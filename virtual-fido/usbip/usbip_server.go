@@ -2,6 +2,7 @@ package usbip
 
 import (
         "net"
+        "os"
         "strings"
         "sync"
         "syscall"
@@ -12,6 +13,16 @@ import (
 var usbipLogger = util.NewLogger("[USBIP] ", util.LogLevelTrace)
 var errLogger = util.NewLogger("[ERR] ", util.LogLevelEnabled)
 
+// Default USB/IP port; VIRTUAL_FIDO_PORT overrides it so several devices can run side by side
+const defaultUSBIPPort = "3241"
+
+func listenAddress() string {
+        if port := os.Getenv("VIRTUAL_FIDO_PORT"); port != "" {
+                return ":" + port
+        }
+        return ":" + defaultUSBIPPort
+}
+
 type USBIPServer struct {
         devices []USBIPDevice
 }
@@ -24,7 +35,7 @@ func NewUSBIPServer(devices []USBIPDevice) *USBIPServer {
 
 func (server *USBIPServer) Start() {
         usbipLogger.Println("Starting USBIP server...")
-        listener, err := net.Listen("tcp", ":3241")
+        listener, err := net.Listen("tcp", listenAddress())
         util.CheckErr(err, "Could not create listener")
         for {
                 connection, err := listener.Accept()
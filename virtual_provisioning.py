@@ -0,0 +1,362 @@
+"""
+Массовое создание виртуальных устройств и портов по шаблону.
+
+Шаблон задает тип устройства и шаблоны полей, в которых {n} - порядковый
+номер устройства (с форматом: {n:04x}, {n:05d}). Все записи создаются в
+одной транзакции. Хранилища (директории или образы FAT32) готовятся
+параллельно под временными именами до начала транзакции и переименовываются
+в device_<id> после получения ID, так что запись в БД блокируется только на
+время вставки строк. При любой ошибке не создается ничего.
+
+Номера портов выдает распределитель: наименьшие свободные номера vpNNNN
+под межпроцессной блокировкой, которая держится до коммита.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import string
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set
+
+import fat_image
+from fat_image import FatError
+from models import db, VirtualUsbDevice, VirtualUsbPort, LogEntry
+from usb_topology import Topology, TopologyError
+from virtual_storage_utils import (
+    VIRTUAL_STORAGE_BASE_DIR, STORAGE_MODE_DIRECTORY, STORAGE_MODE_IMAGE,
+    ensure_storage_dir_exists, set_storage_mode
+)
+
+logger = logging.getLogger(__name__)
+
+# Не больше устройств за один запрос
+MAX_PROVISION_COUNT = 1000
+
+# Потоки подготовки хранилищ
+STORAGE_WORKERS = min(8, os.cpu_count() or 1)
+
+PORT_NUMBER_PREFIX = 'vp'
+PORT_NUMBER_PATTERN = re.compile(rf'^{PORT_NUMBER_PREFIX}(\d+)$')
+PORT_LOCK_FILE = '.port_allocator.lock'
+
+HEX_ID_PATTERN = re.compile(r'^[0-9a-f]{4}$')
+
+
+class ProvisioningError(ValueError):
+    """Некорректный шаблон или ошибка создания"""
+
+
+# ----------------------------------------------------------------------
+# Номера портов
+
+@contextmanager
+def port_allocation_lock() -> Iterator[None]:
+    """Блокировка распределителя портов (держать до коммита выданных номеров)"""
+    ensure_storage_dir_exists()
+    fd = os.open(os.path.join(VIRTUAL_STORAGE_BASE_DIR, PORT_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def allocate_port_numbers(count: int, reserved: Optional[Set[str]] = None) -> List[str]:
+    """
+    Наименьшие свободные номера портов вида vpNNNN
+
+    Вызывать под port_allocation_lock(); номера считаются занятыми, когда
+    порты с ними закоммичены.
+    """
+    used = {number for (number,) in db.session.query(VirtualUsbPort.port_number).all() if number}
+    used |= reserved or set()
+    used_indexes = {int(match.group(1)) for match in map(PORT_NUMBER_PATTERN.match, used) if match}
+    numbers = []
+    index = 0
+    while len(numbers) < count:
+        candidate = f'{PORT_NUMBER_PREFIX}{index:04d}'
+        if index not in used_indexes and candidate not in used:
+            numbers.append(candidate)
+        index += 1
+    return numbers
+
+
+def port_number_taken(port_number: str) -> bool:
+    return VirtualUsbPort.query.filter_by(port_number=port_number).first() is not None
+
+
+# ----------------------------------------------------------------------
+# Шаблоны
+
+def _check_pattern(field: str, pattern) -> str:
+    """Разрешены только подстановки {n} с форматом (без атрибутов и индексов)"""
+    if not isinstance(pattern, str):
+        raise ProvisioningError(f'{field}: ожидается строка')
+    try:
+        for _, name, _, _ in string.Formatter().parse(pattern):
+            if name is not None and name != 'n':
+                raise ProvisioningError(f'{field}: допустима только подстановка {{n}}')
+        pattern.format(n=0)
+    except ProvisioningError:
+        raise
+    except (ValueError, IndexError) as e:
+        raise ProvisioningError(f'{field}: некорректный шаблон ({e})')
+    return pattern
+
+
+def parse_template(template: Dict) -> Dict:
+    """
+    Проверить шаблон и подставить значения по умолчанию
+
+    Поля: device_type (обязательно), name, vendor_id, product_id,
+    serial_number, port_name - шаблоны; config (объект), storage_size (МБ),
+    storage_mode, start (первый номер), create_ports, connect.
+    """
+    if not isinstance(template, dict):
+        raise ProvisioningError('Шаблон должен быть объектом')
+    device_type = template.get('device_type')
+    if not device_type or not isinstance(device_type, str):
+        raise ProvisioningError('Не указан тип устройства')
+
+    parsed = {
+        'device_type': device_type,
+        'name': _check_pattern('name', template.get('name', f'{device_type}-{{n:03d}}')),
+        'vendor_id': _check_pattern('vendor_id', template.get('vendor_id', '1a2b')),
+        'product_id': _check_pattern('product_id', template.get('product_id', '{n:04x}')),
+        'serial_number': _check_pattern('serial_number', template.get('serial_number', '')),
+        'port_name': _check_pattern('port_name', template.get('port_name', 'port-{n:03d}')),
+        'create_ports': bool(template.get('create_ports', True)),
+        'connect': bool(template.get('connect', False))
+    }
+    if parsed['connect'] and not parsed['create_ports']:
+        raise ProvisioningError('Для подключения (connect) нужны порты (create_ports)')
+
+    config = template.get('config', {})
+    if isinstance(config, str):
+        try:
+            config = json.loads(config or '{}')
+        except ValueError:
+            raise ProvisioningError('config: некорректный JSON')
+    if not isinstance(config, dict):
+        raise ProvisioningError('config должен быть объектом')
+    parsed['config'] = config
+
+    try:
+        parsed['start'] = int(template.get('start', 1))
+    except (TypeError, ValueError):
+        raise ProvisioningError('start должен быть числом')
+    if parsed['start'] < 0:
+        raise ProvisioningError('start не может быть отрицательным')
+
+    if device_type == 'storage':
+        try:
+            storage_size = int(template.get('storage_size', 1024))
+        except (TypeError, ValueError):
+            raise ProvisioningError('storage_size должен быть числом')
+        storage_mode = template.get('storage_mode', STORAGE_MODE_DIRECTORY)
+        if storage_mode not in (STORAGE_MODE_DIRECTORY, STORAGE_MODE_IMAGE):
+            raise ProvisioningError(f'storage_mode: {STORAGE_MODE_DIRECTORY} или {STORAGE_MODE_IMAGE}')
+        low = fat_image.MIN_IMAGE_SIZE_MB if storage_mode == STORAGE_MODE_IMAGE else 1
+        if not low <= storage_size <= 16384:
+            raise ProvisioningError(f'Размер хранилища должен быть от {low} МБ до 16 ГБ')
+        parsed['storage_size'] = storage_size
+        parsed['storage_mode'] = storage_mode
+    return parsed
+
+
+def expand_template(template: Dict, count: int) -> List[Dict]:
+    """Поля устройств по шаблону (проверяются формат VID/PID и уникальность имен)"""
+    items = []
+    for n in range(template['start'], template['start'] + count):
+        item = {field: template[field].format(n=n)
+                for field in ('name', 'vendor_id', 'product_id', 'serial_number', 'port_name')}
+        item['vendor_id'] = item['vendor_id'].lower()
+        item['product_id'] = item['product_id'].lower()
+        if not item['name']:
+            raise ProvisioningError('Имя устройства не может быть пустым')
+        if not HEX_ID_PATTERN.match(item['vendor_id']) or not HEX_ID_PATTERN.match(item['product_id']):
+            raise ProvisioningError(f'Устройство {n}: VID/PID должны быть 4 hex-символа '
+                                    f'({item["vendor_id"]}:{item["product_id"]})')
+        if len(item['name']) > 64 or len(item['serial_number']) > 32 or len(item['port_name']) > 64:
+            raise ProvisioningError(f'Устройство {n}: слишком длинное имя или серийный номер')
+        items.append(item)
+    if len({item['name'] for item in items}) != len(items):
+        raise ProvisioningError('Шаблон имени дает повторяющиеся имена, используйте {n}')
+    return items
+
+
+# ----------------------------------------------------------------------
+# Хранилища
+
+def _build_storage(path: str, storage_mode: str, size_mb: int, label: str) -> str:
+    """Создать пустое хранилище (директорию или образ) по временному пути"""
+    if storage_mode == STORAGE_MODE_IMAGE:
+        fat_image.create_image(path, size_mb, label=label)
+    else:
+        os.makedirs(path)
+    return path
+
+
+def _remove_storage(path: str) -> None:
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        logger.error(f"Не удалось удалить хранилище {path}: {e}")
+
+
+def build_storages(template: Dict, items: List[Dict]) -> List[str]:
+    """Параллельно подготовить хранилища под временными именами"""
+    ensure_storage_dir_exists()
+    token = uuid.uuid4().hex[:12]
+    suffix = '.img' if template['storage_mode'] == STORAGE_MODE_IMAGE else ''
+    paths = [os.path.join(VIRTUAL_STORAGE_BASE_DIR, f'.provision-{token}-{i}{suffix}') for i in range(len(items))]
+    with ThreadPoolExecutor(max_workers=STORAGE_WORKERS) as executor:
+        futures = [executor.submit(_build_storage, path, template['storage_mode'], template['storage_size'],
+                                   f'USB{template["start"] + i}') for i, path in enumerate(paths)]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except (OSError, FatError) as e:
+                errors.append(e)
+    if errors:
+        for path in paths:
+            _remove_storage(path)
+        raise ProvisioningError(f'Не удалось создать хранилища: {errors[0]}')
+    return paths
+
+
+# ----------------------------------------------------------------------
+# Создание
+
+def connect_devices(devices: List[VirtualUsbDevice], ports: List[VirtualUsbPort]) -> None:
+    """
+    Подключить созданные устройства к их портам с проверкой бюджета топологии
+    (как при подключении через check_device_connect). Снимок топологии один на
+    партию, подключенные устройства партии учитываются в нем сразу.
+
+    Raises:
+        ProvisioningError: Подключение превысит бюджет порта, хаба или шины
+    """
+    db.session.flush()
+    topology = Topology()
+    for device, port in zip(devices, ports):
+        try:
+            topology.check_connect(device, port.id)
+        except TopologyError as e:
+            raise ProvisioningError(f'Устройство {device.name} не подключено к порту {port.name}: {e}')
+        port.is_connected = True
+        device.is_active = True
+        topology.ports[port.id] = port
+        topology.devices[device.id] = device
+
+
+def provision_devices(template: Dict, count: int) -> Dict:
+    """
+    Создать count устройств (и портов) по шаблону одной транзакцией
+
+    Returns:
+        Dict: devices, ports (созданные записи), elapsed_ms
+
+    Raises:
+        ProvisioningError: Некорректный шаблон или ошибка создания (ничего не создано)
+    """
+    started = time.perf_counter()
+    if not isinstance(count, int) or isinstance(count, bool) or not 1 <= count <= MAX_PROVISION_COUNT:
+        raise ProvisioningError(f'Количество устройств должно быть от 1 до {MAX_PROVISION_COUNT}')
+    template = parse_template(template)
+    items = expand_template(template, count)
+
+    is_storage = template['device_type'] == 'storage'
+    temp_paths = build_storages(template, items) if is_storage else []
+    final_paths: List[str] = []
+
+    config_json = json.dumps(template['config'])
+    try:
+        with port_allocation_lock():
+            devices = [VirtualUsbDevice(
+                name=item['name'],
+                device_type=template['device_type'],
+                vendor_id=item['vendor_id'],
+                product_id=item['product_id'],
+                serial_number=item['serial_number'],
+                config_json=config_json,
+                storage_size=template['storage_size'] if is_storage else 0,
+                is_active=False
+            ) for item in items]
+            db.session.add_all(devices)
+            db.session.flush()
+
+            for device, temp_path in zip(devices, temp_paths):
+                suffix = '.img' if template['storage_mode'] == STORAGE_MODE_IMAGE else ''
+                final_path = os.path.join(VIRTUAL_STORAGE_BASE_DIR, f'device_{device.id}{suffix}')
+                if os.path.lexists(final_path):
+                    # Остатки устройства с тем же ID (удаленного без очистки): данные
+                    # неизвестны БД, удалять их молча нельзя
+                    raise ProvisioningError(f'Хранилище {final_path} уже существует и не принадлежит ни одному '
+                                            f'устройству; переместите или удалите его вручную')
+                os.rename(temp_path, final_path)
+                final_paths.append(final_path)
+                device.storage_path = final_path
+                device.is_system_path = False
+                set_storage_mode(device, template['storage_mode'])
+
+            ports = []
+            if template['create_ports']:
+                numbers = allocate_port_numbers(count)
+                ports = [VirtualUsbPort(
+                    name=item['port_name'],
+                    port_number=number,
+                    device_id=device.id if template['connect'] else None,
+                    is_connected=False
+                ) for item, number, device in zip(items, numbers, devices)]
+                db.session.add_all(ports)
+            if template['connect']:
+                connect_devices(devices, ports)
+
+            db.session.add(LogEntry(
+                level='INFO',
+                message=f'Provisioned {count} virtual {template["device_type"]} devices'
+                        f'{" with ports" if ports else ""}'
+                        f'{" (connected)" if template["connect"] else ""}',
+                source='virtual'
+            ))
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        for path in temp_paths + final_paths:
+            _remove_storage(path)
+        if isinstance(e, ProvisioningError):
+            raise
+        logger.error(f"Ошибка массового создания устройств: {e}")
+        raise ProvisioningError(f'Ошибка создания устройств: {e}')
+
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Создано {count} устройств {template['device_type']} за {elapsed_ms} мс")
+    return {
+        'devices': [{
+            'id': device.id,
+            'name': device.name,
+            'vendor_id': device.vendor_id,
+            'product_id': device.product_id,
+            'serial_number': device.serial_number,
+            'storage_path': device.storage_path
+        } for device in devices],
+        'ports': [{
+            'id': port.id,
+            'name': port.name,
+            'port_number': port.port_number,
+            'device_id': port.device_id
+        } for port in ports],
+        'elapsed_ms': elapsed_ms
+    }
@@ -2,9 +2,15 @@ import os
 import shutil
 import json
 import logging
-from typing import List, Dict, Any, Optional, Tuple
+import uuid
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 from werkzeug.utils import secure_filename
 from models import VirtualUsbDevice, VirtualUsbFile, db
+import storage_dedup
+import storage_watcher
+import storage_trash
+import fat_image
+from fat_image import FatImage, FatError
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
@@ -12,6 +18,47 @@ logger = logging.getLogger(__name__)
 # Базовая директория для хранения файлов виртуальных устройств
 VIRTUAL_STORAGE_BASE_DIR = "virtual_storage"
 
+# Режимы хранения: обычная директория или разреженный образ диска FAT32
+STORAGE_MODE_DIRECTORY = "directory"
+STORAGE_MODE_IMAGE = "image"
+
+def get_storage_mode(device: VirtualUsbDevice) -> str:
+    """
+    Получить режим хранения устройства из config_json
+    
+    Args:
+        device: Модель виртуального устройства
+        
+    Returns:
+        str: STORAGE_MODE_IMAGE или STORAGE_MODE_DIRECTORY
+    """
+    try:
+        config = json.loads(device.config_json or '{}')
+    except (ValueError, TypeError):
+        return STORAGE_MODE_DIRECTORY
+    if isinstance(config, dict) and config.get('storage_mode') == STORAGE_MODE_IMAGE:
+        return STORAGE_MODE_IMAGE
+    return STORAGE_MODE_DIRECTORY
+
+def set_storage_mode(device: VirtualUsbDevice, storage_mode: str) -> None:
+    """
+    Сохранить режим хранения в config_json устройства (без коммита)
+    """
+    try:
+        config = json.loads(device.config_json or '{}')
+        if not isinstance(config, dict):
+            config = {}
+    except (ValueError, TypeError):
+        config = {}
+    config['storage_mode'] = storage_mode
+    device.config_json = json.dumps(config)
+
+def is_image_storage(device: VirtualUsbDevice) -> bool:
+    """
+    Проверить, хранится ли устройство в виде образа диска
+    """
+    return not device.is_system_path and get_storage_mode(device) == STORAGE_MODE_IMAGE
+
 def ensure_storage_dir_exists() -> None:
     """
     Убедиться, что базовая директория для хранения файлов существует
@@ -20,7 +67,8 @@ def ensure_storage_dir_exists() -> None:
         os.makedirs(VIRTUAL_STORAGE_BASE_DIR, exist_ok=True)
         logger.info(f"Создана базовая директория для виртуальных устройств: {VIRTUAL_STORAGE_BASE_DIR}")
 
-def create_device_storage(device: VirtualUsbDevice, size_mb: int = 1024, system_path: str = None) -> bool:
+def create_device_storage(device: VirtualUsbDevice, size_mb: int = 1024, system_path: str = None,
+                          storage_mode: Optional[str] = None) -> bool:
     """
     Создать хранилище для виртуального USB-устройства
     
@@ -28,6 +76,7 @@ def create_device_storage(device: VirtualUsbDevice, size_mb: int = 1024, system_
         device: Модель виртуального устройства
         size_mb: Размер хранилища в МБ
         system_path: Путь к существующей системной папке (если None, создается новая папка)
+        storage_mode: Режим хранения (директория или образ); None - режим из config_json
         
     Returns:
         bool: Успешность создания хранилища
@@ -51,12 +100,35 @@ def create_device_storage(device: VirtualUsbDevice, size_mb: int = 1024, system_
         device.storage_size = size_mb
         db.session.commit()
         
+        # Файлы, добавляемые в папку извне, будут попадать в индекс автоматически
+        storage_watcher.watch_device(device)
+        
         logger.info(f"Подключена системная папка {system_path} как хранилище для устройства {device.name}")
         return True
         
     # Создаем новое хранилище в виртуальной папке
     ensure_storage_dir_exists()
     
+    if storage_mode is None:
+        storage_mode = get_storage_mode(device)
+    
+    if storage_mode == STORAGE_MODE_IMAGE:
+        image_path = os.path.join(VIRTUAL_STORAGE_BASE_DIR, f"device_{device.id}.img")
+        try:
+            fat_image.create_image(image_path, size_mb, label=f"USB{device.id}")
+        except (FatError, OSError) as e:
+            logger.error(f"Ошибка при создании образа диска для устройства: {e}")
+            return False
+        
+        device.is_system_path = False
+        device.storage_path = image_path
+        device.storage_size = size_mb
+        set_storage_mode(device, STORAGE_MODE_IMAGE)
+        db.session.commit()
+        
+        logger.info(f"Создан образ диска FAT32 для устройства {device.name} размером {size_mb} МБ")
+        return True
+    
     # Создаем уникальный путь для устройства
     device_dir = os.path.join(VIRTUAL_STORAGE_BASE_DIR, f"device_{device.id}")
     
@@ -102,6 +174,7 @@ def delete_device_storage(device: VirtualUsbDevice) -> bool:
     if device.is_system_path:
         # Системные папки не удаляем, только снимаем связь
         logger.info(f"Отключена системная папка {device.storage_path} от устройства {device.name}")
+        storage_watcher.unwatch_device(device.id)
         
         # Удаляем записи о файлах из базы данных
         VirtualUsbFile.query.filter_by(device_id=device.id).delete()
@@ -124,11 +197,16 @@ def delete_device_storage(device: VirtualUsbDevice) -> bool:
         return True
     
     try:
-        # Удаляем виртуальную директорию
-        shutil.rmtree(device.storage_path)
+        # Удаляем образ диска или виртуальную директорию
+        if is_image_storage(device):
+            os.remove(device.storage_path)
+        else:
+            # Дерево удаляется в фоне, запрос не ждет удаления всех файлов
+            storage_trash.move_to_trash(device.storage_path)
         
-        # Удаляем записи о файлах из базы данных
+        # Удаляем записи о файлах из базы данных и освобождаем ссылки на блобы
         VirtualUsbFile.query.filter_by(device_id=device.id).delete()
+        storage_dedup.release_refs(device.id)
         
         # Обновляем информацию об устройстве
         device.storage_path = None
@@ -152,6 +230,11 @@ def resize_device_storage(device: VirtualUsbDevice, new_size_mb: int) -> bool:
     Returns:
         bool: Успешность изменения размера хранилища
     """
+    # Таблица FAT рассчитана на размер образа при форматировании
+    if is_image_storage(device):
+        logger.error(f"Изменение размера образа диска не поддерживается (устройство {device.name})")
+        return False
+    
     # Проверяем, что новый размер не меньше текущего использования
     used_space = get_device_storage_usage(device)
     if used_space > new_size_mb * 1024 * 1024:
@@ -178,8 +261,15 @@ def get_device_storage_usage(device: VirtualUsbDevice) -> int:
     if not device.storage_path or not os.path.exists(device.storage_path):
         return 0
     
+    # Для образа квотой является сам образ - считаем занятые кластеры
+    if is_image_storage(device):
+        with FatImage(device.storage_path) as image:
+            return image.usage()['used_bytes']
+    
     total_size = 0
     for dirpath, dirnames, filenames in os.walk(device.storage_path):
+        # Содержимое корзины уже удалено с точки зрения пользователя
+        dirnames[:] = [d for d in dirnames if not storage_trash.is_trash_name(d)]
         for filename in filenames:
             file_path = os.path.join(dirpath, filename)
             total_size += os.path.getsize(file_path)
@@ -217,6 +307,21 @@ def list_device_files(device: VirtualUsbDevice, directory: str = "/") -> List[Di
     # Проверяем существует ли хранилище
     storage_exists = device.storage_path and os.path.exists(device.storage_path)
     
+    # Образ диска читается напрямую, без монтирования
+    if storage_exists and is_image_storage(device):
+        try:
+            entries = fat_image.list_image_dir(device.storage_path, directory.lstrip("/"))
+        except FatError as e:
+            logger.error(f"Ошибка чтения образа диска устройства {device.name}: {e}")
+            return result
+        for entry in entries:
+            entry_path = directory + "/" + entry["name"] if directory else "/" + entry["name"]
+            entry["path"] = entry_path.replace("//", "/") if entry["type"] == "directory" else entry_path.lstrip("/")
+            if entry["type"] == "file":
+                entry["available"] = True
+            result.append(entry)
+        return result
+    
     if storage_exists:
         # Полный путь к директории
         dir_path = os.path.join(device.storage_path, directory.lstrip("/"))
@@ -228,7 +333,7 @@ def list_device_files(device: VirtualUsbDevice, directory: str = "/") -> List[Di
             # Список директорий
             for dirname in os.listdir(dir_path):
                 full_path = os.path.join(dir_path, dirname)
-                if os.path.isdir(full_path):
+                if os.path.isdir(full_path) and not storage_trash.is_trash_name(dirname):
                     # Формируем путь для URL с прямыми слэшами
                     path_for_url = directory + "/" + dirname if directory else "/" + dirname
                     path_for_url = path_for_url.replace("//", "/")
@@ -313,6 +418,21 @@ def create_directory(device: VirtualUsbDevice, directory_path: str) -> Tuple[boo
     # Проверяем, существует ли родительская директория
     parent_dir = os.path.dirname(clean_path)
     
+    if storage_exists and is_image_storage(device):
+        try:
+            with FatImage(device.storage_path, writable=True) as image:
+                existing = image.lookup(clean_path)
+                if existing is not None:
+                    if not existing.is_dir:
+                        return False, "По указанному пути уже существует файл"
+                    return False, "Директория с таким именем уже существует"
+                image.make_dir(clean_path)
+            logger.info(f"Создана директория {clean_path} в образе устройства {device.name}")
+            return True, None
+        except FatError as e:
+            logger.warning(f"Не удалось создать директорию {clean_path} в образе устройства {device.name}: {e}")
+            return False, str(e)
+    
     # Создаем директорию в физическом хранилище, если оно доступно
     if storage_exists:
         # Полный путь к директории
@@ -442,34 +562,27 @@ def delete_item(device: VirtualUsbDevice, item_path: str) -> bool:
     is_directory = False
     
     # Удаляем физический файл или директорию, если хранилище доступно
-    if storage_exists:
+    if storage_exists and is_image_storage(device):
+        try:
+            with FatImage(device.storage_path, writable=True) as image:
+                entry = image.lookup(clean_path)
+                if entry is not None:
+                    is_directory = entry.is_dir
+                    image.delete(clean_path)
+        except FatError as e:
+            logger.error(f"Ошибка при удалении элемента из образа диска: {e}")
+            return False
+    elif storage_exists:
         # Полный путь к элементу
         full_path = os.path.join(device.storage_path, clean_path)
         logger.debug(f"Физический путь к удаляемому элементу: {full_path}")
         
-        if os.path.exists(full_path):
+        if os.path.lexists(full_path):
             try:
-                if os.path.isdir(full_path):
-                    # Это директория
-                    is_directory = True
-                    
-                    # Проверяем, пуста ли директория
-                    if not os.listdir(full_path):
-                        # Если директория пуста, можно использовать os.rmdir
-                        os.rmdir(full_path)
-                    else:
-                        # Удаляем директорию и все её содержимое
-                        shutil.rmtree(full_path)
-                    
-                    logger.debug(f"Успешно удалена директория {full_path}")
-                else:
-                    # Удаляем файл
-                    os.remove(full_path)
-                    logger.debug(f"Успешно удален файл {full_path}")
-                
-                # Небольшая задержка для синхронизации файловой системы
-                import time
-                time.sleep(0.1)
+                is_directory = os.path.isdir(full_path) and not os.path.islink(full_path)
+                # Переименование в корзину выполняется мгновенно независимо от размера дерева,
+                # физическое удаление выполняет фоновый поток
+                storage_trash.move_to_trash(full_path, device.storage_path)
             except PermissionError:
                 logger.error(f"Недостаточно прав для удаления элемента {full_path}")
                 return False
@@ -485,60 +598,19 @@ def delete_item(device: VirtualUsbDevice, item_path: str) -> bool:
             
         logger.debug(f"Элемент определен как {'директория' if is_directory else 'файл'}")
         
-        # Удаляем записи из базы данных
-        if is_directory:
-            # Нормализуем путь для сравнения с путями в БД
-            norm_path = clean_path
-            if not norm_path.endswith('/'):
-                norm_path += '/'
-                
-            # Удаляем все файлы внутри директории
-            deleted_count = 0
-            for file_entry in VirtualUsbFile.query.filter_by(device_id=device.id).all():
-                # Нормализуем путь файла
-                file_path = file_entry.file_path.replace("\\", "/")
-                file_path = '/' + file_path.lstrip('/')
-                
-                # Проверяем, что файл находится в удаляемой директории или это она сама
-                if file_path.startswith(item_path + '/') or file_path == item_path:
-                    logger.debug(f"Удаление файла из БД: {file_path}")
-                    db.session.delete(file_entry)
-                    deleted_count += 1
-                    
-            if deleted_count == 0 and not storage_exists:
-                # Если не найдено файлов для удаления и физическое хранилище недоступно,
-                # проверяем существование самой директории в другой логике
-                logger.warning(f"Не найдено файлов для удаления в директории {item_path}")
-        else:
-            # Удаляем запись о файле из базы данных
-            file_entry = VirtualUsbFile.query.filter_by(
-                device_id=device.id, 
-                file_path=clean_path
-            ).first()
-            
-            if file_entry:
-                logger.debug(f"Удаление файла из БД: {file_entry.file_path}")
-                db.session.delete(file_entry)
-            else:
-                # Попытаемся найти файл, игнорируя начальные слэши
-                file_entry = VirtualUsbFile.query.filter(
-                    VirtualUsbFile.device_id == device.id,
-                    VirtualUsbFile.file_path.like(f"%{clean_path}")
-                ).first()
-                
-                if file_entry:
-                    logger.debug(f"Удаление файла из БД (альтернативный поиск): {file_entry.file_path}")
-                    db.session.delete(file_entry)
-                elif not storage_exists:
-                    # Если запись не найдена и хранилище не существует, считаем ошибкой
-                    logger.warning(f"Элемент {clean_path} не найден в базе данных и физическое хранилище недоступно")
-                    return False
+        # Освобождаем ссылки на блобы дедуплицированного хранилища
+        storage_dedup.release_refs(device.id, clean_path)
         
-        db.session.commit()
+        # Удаляем записи о самом элементе и всем его содержимом одним запросом
+        deleted_count = delete_file_records(device.id, clean_path)
+        
+        if deleted_count == 0 and not storage_exists and not is_directory:
+            # Если запись не найдена и хранилище не существует, считаем ошибкой
+            logger.warning(f"Элемент {clean_path} не найден в базе данных и физическое хранилище недоступно")
+            db.session.rollback()
+            return False
         
-        # Еще одна маленькая задержка после коммита
-        import time
-        time.sleep(0.1)
+        db.session.commit()
         
         logger.info(f"Удален элемент {item_path} для устройства {device.name}")
         return True
@@ -547,6 +619,84 @@ def delete_item(device: VirtualUsbDevice, item_path: str) -> bool:
         db.session.rollback()  # Откатываем транзакцию при ошибке
         return False
 
+def delete_file_records(device_id: int, clean_path: str) -> int:
+    """
+    Удалить записи о файле или о всех файлах директории одним запросом (без коммита)
+    
+    Для поддерева используется диапазон file_path >= 'dir/' AND file_path < 'dir0'
+    ('0' - следующий символ после '/'): он эквивалентен LIKE 'dir/%', но в отличие
+    от регистронезависимого LIKE в SQLite использует индекс (device_id, file_path).
+    
+    Args:
+        device_id: ID виртуального устройства
+        clean_path: Путь без начального слэша
+        
+    Returns:
+        int: Количество удаленных записей
+    """
+    clean_path = clean_path.strip("/")
+    conditions = []
+    # Старые записи могли сохраняться с начальным слэшем
+    for path in (clean_path, "/" + clean_path):
+        conditions.append(VirtualUsbFile.file_path == path)
+        conditions.append(db.and_(VirtualUsbFile.file_path >= path + "/",
+                                  VirtualUsbFile.file_path < path + "0"))
+    
+    deleted = VirtualUsbFile.query.filter(
+        VirtualUsbFile.device_id == device_id,
+        db.or_(*conditions)
+    ).delete(synchronize_session=False)
+    
+    logger.debug(f"Удалено {deleted} записей о файлах для пути {clean_path}")
+    return deleted
+
+def save_file_record(device: VirtualUsbDevice, rel_file_path: str, file_size: int) -> VirtualUsbFile:
+    """
+    Создать или обновить запись о файле устройства и зафиксировать транзакцию
+    
+    Args:
+        device: Модель виртуального устройства
+        rel_file_path: Путь файла относительно storage_path
+        file_size: Размер файла в байтах
+        
+    Returns:
+        VirtualUsbFile: Запись о файле
+    """
+    filename = os.path.basename(rel_file_path)
+    
+    # Определяем тип файла по расширению
+    _, file_extension = os.path.splitext(filename)
+    file_type = file_extension.lower().lstrip('.') if file_extension else 'unknown'
+    
+    # Проверяем, существует ли уже запись о файле
+    existing_file = VirtualUsbFile.query.filter_by(
+        device_id=device.id,
+        file_path=rel_file_path
+    ).first()
+    
+    if existing_file:
+        # Обновляем существующую запись
+        existing_file.file_size = file_size
+        existing_file.file_type = file_type
+        db.session.commit()
+        logger.info(f"Обновлен файл {rel_file_path} для устройства {device.name}")
+        return existing_file
+    
+    # Создаем новую запись о файле
+    new_file = VirtualUsbFile(
+        device_id=device.id,
+        filename=filename,
+        file_path=rel_file_path,
+        file_size=file_size,
+        file_type=file_type
+    )
+    
+    db.session.add(new_file)
+    db.session.commit()
+    
+    logger.info(f"Загружен файл {rel_file_path} для устройства {device.name}")
+    return new_file
+
 def upload_file(device: VirtualUsbDevice, file, destination_path: str = "/") -> Optional[VirtualUsbFile]:
     """
     Загрузить файл в хранилище виртуального USB-устройства
@@ -607,6 +757,23 @@ def upload_file(device: VirtualUsbDevice, file, destination_path: str = "/") ->
         # Удаляем конечный слэш, но сохраняем путь
         clean_dest_path = dest_dir
     
+    if is_image_storage(device):
+        rel_file_path = f"{clean_dest_path}/{filename}" if clean_dest_path else filename
+        try:
+            with FatImage(device.storage_path, writable=True) as image:
+                parent = image.lookup(clean_dest_path)
+                if parent is None:
+                    image.make_dir(clean_dest_path)
+                elif not parent.is_dir:
+                    logger.error(f"Путь назначения {clean_dest_path} не является директорией")
+                    return None
+                file_size = image.write_file(rel_file_path, file.stream)
+            return save_file_record(device, rel_file_path, file_size)
+        except FatError as e:
+            logger.error(f"Ошибка при записи файла в образ диска: {e}")
+            db.session.rollback()
+            return None
+    
     try:
         # Создаем директории, если нужно
         if clean_dest_path:
@@ -642,56 +809,30 @@ def upload_file(device: VirtualUsbDevice, file, destination_path: str = "/") ->
             # Если это файл, перезаписываем его
             logger.debug(f"Файл {rel_file_path} уже существует, будет перезаписан")
         
-        # Сохраняем файл
-        file.save(full_path)
-        
-        # Небольшая задержка для синхронизации файловой системы
-        import time
-        time.sleep(0.1)
-        
-        # Проверяем, что файл действительно сохранился
-        if not os.path.exists(full_path):
-            logger.error(f"Не удалось сохранить файл {full_path}")
-            return None
-            
-        # Получаем размер файла
-        file_size = os.path.getsize(full_path)
-        
-        # Определяем тип файла по расширению
-        _, file_extension = os.path.splitext(filename)
-        file_type = file_extension.lower().lstrip('.') if file_extension else 'unknown'
-        
-        # Проверяем, существует ли уже запись о файле
-        existing_file = VirtualUsbFile.query.filter_by(
-            device_id=device.id,
-            file_path=rel_file_path
-        ).first()
-        
-        if existing_file:
-            # Обновляем существующую запись
-            existing_file.file_size = file_size
-            existing_file.file_type = file_type
-            db.session.commit()
-            logger.info(f"Обновлен файл {rel_file_path} для устройства {device.name}")
-            return existing_file
+        if storage_dedup.is_dedup_enabled() and not device.is_system_path:
+            # Сохраняем во временный файл и помещаем содержимое в хранилище блобов
+            tmp_path = os.path.join(os.path.dirname(full_path), f".upload-{uuid.uuid4().hex}")
+            try:
+                file.save(tmp_path)
+                _, file_size, _ = storage_dedup.ingest_file(device, tmp_path, rel_file_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
         else:
-            # Создаем новую запись о файле
-            new_file = VirtualUsbFile(
-                device_id=device.id,
-                filename=filename,
-                file_path=rel_file_path,
-                file_size=file_size,
-                file_type=file_type
-            )
-            
-            db.session.add(new_file)
-            db.session.commit()
-            
-            # Еще одна маленькая задержка после коммита
-            time.sleep(0.1)
-            
-            logger.info(f"Загружен файл {rel_file_path} для устройства {device.name}")
-            return new_file
+            # Сохраняем во временный файл и подменяем им прежний: при ошибке записи
+            # (нет места, обрыв соединения) старый файл и его ссылки остаются.
+            # Файл может быть ссылкой на общий блоб - rename не меняет сам блоб
+            tmp_path = os.path.join(os.path.dirname(full_path), f".upload-{uuid.uuid4().hex}")
+            try:
+                file.save(tmp_path)
+                file_size = os.path.getsize(tmp_path)
+                os.replace(tmp_path, full_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            storage_dedup.release_refs(device.id, rel_file_path)
+        
+        return save_file_record(device, rel_file_path, file_size)
     except PermissionError:
         logger.error(f"Недостаточно прав для сохранения файла в {clean_dest_path}")
         db.session.rollback()
@@ -702,6 +843,61 @@ def upload_file(device: VirtualUsbDevice, file, destination_path: str = "/") ->
         db.session.rollback()
         return None
 
+def upload_file_by_hash(device: VirtualUsbDevice, digest: str, filename: str, destination_path: str = "/") -> Optional[VirtualUsbFile]:
+    """
+    Создать файл из содержимого, уже имеющегося в хранилище блобов, без передачи данных
+    
+    Args:
+        device: Модель виртуального устройства
+        digest: SHA-256 содержимого файла
+        filename: Имя файла
+        destination_path: Путь для сохранения файла
+        
+    Returns:
+        Optional[VirtualUsbFile]: Запись о файле или None, если содержимое неизвестно
+    """
+    if not storage_dedup.is_dedup_enabled() or device.is_system_path or is_image_storage(device):
+        return None
+    
+    if not device.storage_path or not os.path.exists(device.storage_path):
+        logger.error(f"Невозможно загрузить файл: хранилище для устройства {device.name} недоступно")
+        return None
+    
+    filename = secure_filename(filename or '')
+    if not filename:
+        logger.error(f"Невозможно загрузить файл: небезопасное имя файла '{filename}'")
+        return None
+    
+    blob = storage_dedup.find_blob(digest)
+    if not blob:
+        return None
+    
+    # Проверяем доступное место (учитывается логический размер файла)
+    used_space = get_device_storage_usage(device)
+    if used_space + blob.size > device.storage_size * 1024 * 1024:
+        logger.error(f"Недостаточно места в хранилище: используется {used_space/(1024*1024):.2f} МБ из {device.storage_size} МБ")
+        return None
+    
+    clean_dest_path = normalize_path(destination_path).lstrip("/")
+    rel_file_path = f"{clean_dest_path}/{filename}" if clean_dest_path else filename
+    full_path = os.path.join(device.storage_path, rel_file_path)
+    
+    try:
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if os.path.isdir(full_path):
+            logger.error(f"По указанному пути {rel_file_path} уже существует директория")
+            return None
+        
+        file_size = storage_dedup.link_existing_blob(device, digest, rel_file_path)
+        if file_size is None:
+            return None
+        
+        return save_file_record(device, rel_file_path, file_size)
+    except Exception as e:
+        logger.error(f"Ошибка при создании файла по хешу: {e}")
+        db.session.rollback()
+        return None
+
 def get_storage_stats(device: VirtualUsbDevice) -> Dict[str, Any]:
     """
     Получить статистику использования хранилища
@@ -722,13 +918,21 @@ def get_storage_stats(device: VirtualUsbDevice) -> Dict[str, Any]:
     file_count = VirtualUsbFile.query.filter_by(device_id=device.id).count()
     
     # Оцениваем использованное пространство
-    if storage_exists:
+    if storage_exists and is_image_storage(device):
+        # Для образа квота - это размер файловой системы образа
+        with FatImage(device.storage_path) as image:
+            usage = image.usage()
+            used_space = usage['used_bytes']
+            dir_count = sum(len(dirs) for _, dirs, _ in image.walk())
+        storage_size = usage['total_bytes'] // (1024 * 1024)
+    elif storage_exists:
         # Если хранилище доступно, получаем точную информацию
         used_space = get_device_storage_usage(device)
         
         # Подсчитываем количество директорий
         dir_count = 0
         for _, dirnames, _ in os.walk(device.storage_path):
+            dirnames[:] = [d for d in dirnames if not storage_trash.is_trash_name(d)]
             dir_count += len(dirnames)
     else:
         # Если хранилище недоступно, оцениваем использованное место по файлам в БД
@@ -741,6 +945,8 @@ def get_storage_stats(device: VirtualUsbDevice) -> Dict[str, Any]:
     
     # Вычисляем максимальный размер в байтах
     max_space = storage_size * 1024 * 1024  # Переводим МБ в байты
+    if storage_exists and is_image_storage(device):
+        max_space = usage['total_bytes']
     
     # Формируем статистику
     return {
@@ -752,7 +958,8 @@ def get_storage_stats(device: VirtualUsbDevice) -> Dict[str, Any]:
         "usage_percent": (used_space / max_space * 100) if max_space > 0 else 0,
         "file_count": file_count,
         "directory_count": dir_count,
-        "storage_available": storage_exists
+        "storage_available": storage_exists,
+        "storage_mode": get_storage_mode(device)
     }
 
 def download_file(device: VirtualUsbDevice, file_path: str) -> Tuple[Optional[str], Optional[str]]:
@@ -814,4 +1021,34 @@ def download_file(device: VirtualUsbDevice, file_path: str) -> Tuple[Optional[st
         return full_path, filename
     except Exception as e:
         logger.error(f"Не удалось получить доступ к файлу {file_path}: {e}")
-        return None, None
\ No newline at end of file
+        return None, None
+
+def download_image_file(device: VirtualUsbDevice, file_path: str) -> Tuple[Optional[Iterator[bytes]], Optional[str], int]:
+    """
+    Получить поток для скачивания файла из образа диска
+    
+    Args:
+        device: Модель виртуального устройства
+        file_path: Путь к файлу относительно корня образа
+        
+    Returns:
+        Tuple[Optional[Iterator[bytes]], Optional[str], int]: (поток данных, имя файла, размер)
+        или (None, None, 0) при ошибке
+    """
+    file_path_fs = normalize_path(file_path).lstrip("/")
+    
+    if not device.storage_path or not os.path.exists(device.storage_path) or not file_path_fs:
+        logger.error(f"Файл {file_path} недоступен для скачивания из образа устройства {device.name}")
+        return None, None, 0
+    
+    try:
+        with FatImage(device.storage_path) as image:
+            entry = image.lookup(file_path_fs)
+        if entry is None or entry.is_dir:
+            logger.error(f"Файл {file_path} не найден в образе устройства {device.name}")
+            return None, None, 0
+    except FatError as e:
+        logger.error(f"Ошибка чтения образа диска: {e}")
+        return None, None, 0
+    
+    return fat_image.iter_image_file(device.storage_path, file_path_fs), entry.name, entry.size